@@ -1,9 +1,16 @@
+import atexit
 import logging
 import os.path as op
-import os, glob
-import zipfile
+import os
+import subprocess
+import threading
+import uuid
+from collections import namedtuple
 from time import sleep
 
+from . import Apk
+from .AdbClient import AdbClient
+from .LogcatStream import LogcatStream
 from .pyand import ADB
 from AndroidRunner.util import ConfigError
 
@@ -21,27 +28,187 @@ class ConnectionError(Exception):
 
 
 adb = None
+adb_path = 'adb'
+# Native adb server protocol client, only set when the 'socket' backend is used
+client = None
+
+BACKENDS = ['binary', 'socket']
+
+# Per-device command handles, see handle()
+handles = {}
+handles_lock = threading.Lock()
+
+# Per-device logcat streams, see logcat_stream()
+logcat_streams = {}
+logcat_streams_lock = threading.Lock()
+
+# Output (stdout and stderr) and exit code of a command of a batch, see AdbHandle.batch()
+CommandResult = namedtuple('CommandResult', ['command', 'output', 'exit_code'])
 
 settings_options = {"location_high_accuracy": ("settings put secure location_providers_allowed -gps,network","settings put secure location_providers_allowed +gps,network"),
                     "location_gps_only": ("settings put secure location_providers_allowed -gps","settings put secure location_providers_allowed +gps")
                     }
 
+
+class AdbHandle(object):
+    """ Runs adb commands for a single device.
+
+    Unlike the module-global pyand ADB instance, a handle does not keep a target device or output buffers:
+    every command returns its own output. Handles can therefore be used from several threads at once, e.g. by
+    profilers sampling a device while a script interacts with it, or by experiments driving several devices.
+    """
+
+    def __init__(self, device_id, path='adb', adb_client=None):
+        self.device_id = device_id
+        self.adb_path = path
+        self.client = adb_client
+
+    def run(self, args):
+        """Runs 'adb -s <device_id> <args>' and returns the combined stdout and stderr as bytes"""
+        cmd = [self.adb_path, '-s', str(self.device_id)] + list(args)
+        try:
+            return subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT).stdout
+        except OSError as e:
+            raise AdbError('%s: could not run adb: %s' % (self.device_id, e))
+
+    def shell_command(self, cmd):
+        """Runs cmd on the device and returns the raw output"""
+        if self.client is not None:
+            return self.client.shell(self.device_id, cmd)
+        return self.run(['shell', cmd])
+
+    def shell(self, cmd):
+        result = self.shell_command(cmd)
+        result = result.decode('utf-8') if (isinstance(result, bytes) == True) else result
+        logger.debug('%s: "%s" returned: \n%s' % (self.device_id, cmd, result))
+        if 'error' in result:
+            raise AdbError(result)
+        return result.rstrip()
+
+    def batch(self, commands):
+        """Runs commands one after the other in a single shell invocation and returns a CommandResult per command.
+        Every command runs in its own subshell, so a failing command (or an exit) does not stop the commands after
+        it. Unlike shell(), the outputs are not checked for 'error', use the exit codes instead."""
+        commands = list(commands)
+        if not commands:
+            return []
+        marker = 'ANDROID_RUNNER_BATCH_%s' % uuid.uuid4().hex
+        # The echo puts the marker on its own line when the output of a command does not end with a newline
+        script = '\n'.join('(\n%s\n) 2>&1; status=$?; echo; echo %s $status' % (command, marker)
+                           for command in commands)
+        result = self.shell_command(script)
+        result = result.decode('utf-8', 'replace') if isinstance(result, bytes) else result
+        logger.debug('%s: batch of %s commands returned: \n%s' % (self.device_id, len(commands), result))
+        results = []
+        lines = []
+        for line in result.splitlines():
+            if line.startswith(marker):
+                output = '\n'.join(lines).rstrip()
+                results.append(CommandResult(commands[len(results)], output, int(line.split()[1])))
+                lines = []
+                if len(results) == len(commands):
+                    break
+            else:
+                lines.append(line)
+        if len(results) != len(commands):
+            raise AdbError(result)
+        return results
+
+    def shell_su(self, cmd):
+        result = self.shell_command("su -c \'%s\'" % cmd)
+        result = result.decode('utf-8') if (isinstance(result, bytes) == True) else result
+        logger.debug('%s: "su -c \'%s\'" returned: \n%s' % (self.device_id, cmd, result))
+        if 'error' in result:
+            raise AdbError(result)
+        return result.rstrip()
+
+    def install(self, apk, replace=True, all_permissions=True):
+        filename = op.basename(apk)
+        logger.debug('%s: Installing "%s"' % (self.device_id, filename))
+
+        if Apk.is_xapk(apk):
+            cmd = ['install-multiple']
+            # The xapk is only extracted the first time, to the APK cache
+            apk_files = Apk.cache.apk_files(apk)
+            logger.info('installing APKs %s' % ' '.join(apk_files))
+        else:
+            cmd = ['install']
+            apk_files = [apk]
+
+        if replace:
+            cmd += ['-r']
+        if all_permissions:
+            cmd += ['-g']
+        cmd += ['-t'] + apk_files
+        output = self.run(cmd)
+        logger.debug('install returned: %s' % output)
+        return output
+
+    def uninstall(self, name, keep_data=False):
+        logger.debug('%s: Uninstalling "%s"' % (self.device_id, name))
+        if self.client is not None:
+            result = self.client.shell(self.device_id, 'pm uninstall %s%s' % ('-k ' if keep_data else '', name))
+        else:
+            result = self.run(['uninstall'] + (['-k'] if keep_data else []) + [name])
+        success_or_exception(result,
+                             '%s: "%s" uninstalled' % (self.device_id, name),
+                             '%s: Failed to uninstall "%s"' % (self.device_id, name)
+                             )
+
+    def clear_app_data(self, name):
+        success_or_exception(self.shell_command('pm clear %s' % name),
+                             '%s: Data of "%s" cleared' % (self.device_id, name),
+                             '%s: Failed to clear data for "%s"' % (self.device_id, name)
+                             )
+
+    def push(self, local, remote):
+        if self.client is not None:
+            return self.client.push(self.device_id, local, remote)
+        return self.run(['push', local, remote])
+
+    def pull(self, remote, local):
+        if self.client is not None:
+            return self.client.pull(self.device_id, remote, local)
+        return self.run(['pull', remote, local])
+
+
 def configure_settings(device_id, setting, enable):
     cmd = settings_options[setting][enable]
     return shell(device_id, cmd)
 
 # noinspection PyProtectedMember
-def setup(path='adb'):
-    global adb
+def setup(path='adb', backend='binary'):
+    """Sets up adb. With the 'socket' backend shell, push and pull talk to the adb server directly instead of
+    spawning an adb process per command. The adb binary is still used to start the server and to install apps."""
+    global adb, adb_path, client
+    if backend not in BACKENDS:
+        raise ConfigError("adb backend '%s' not recognized. Use one of: %s" % (backend, BACKENDS))
     adb = ADB(adb_path=path)
     # Accessing class private variables to avoid another print of the same error message
     # https://stackoverflow.com/a/1301369
     if adb._ADB__error:
         raise AdbError('adb path is incorrect')
+    adb_path = path
+    client = None
+    if backend == 'socket':
+        adb.start_server()
+        client = AdbClient()
+        logger.debug('Using adb server protocol (server version %s)' % client.version())
+    with handles_lock:
+        handles.clear()
+    close_logcat_streams()
+
+
+def handle(device_id):
+    """Returns the command handle of the device, the same handle is returned for every call with the same id"""
+    with handles_lock:
+        if device_id not in handles:
+            handles[device_id] = AdbHandle(device_id, adb_path, client)
+        return handles[device_id]
 
 
 def connect(device_id):
-    device_list = adb.get_devices()
+    device_list = client.devices() if client is not None else adb.get_devices()
     if not device_list:
         raise ConnectionError('No devices are connected')
     logger.debug('Device list:\n%s' % device_list)
@@ -50,23 +217,15 @@ def connect(device_id):
 
 
 def shell_su(device_id, cmd):
-    adb.set_target_by_name(device_id)
-    result = adb.shell_command("su -c \'%s\'" % cmd)
-    result = result.decode('utf-8') if (isinstance(result, bytes) == True) else result
-    logger.debug('%s: "su -c \'%s\'" returned: \n%s' % (device_id, cmd, result))
-    if 'error' in result:
-        raise AdbError(result)
-    return result.rstrip()
+    return handle(device_id).shell_su(cmd)
 
 
 def shell(device_id, cmd):
-    adb.set_target_by_name(device_id)
-    result = adb.shell_command(cmd)
-    result = result.decode('utf-8') if (isinstance(result, bytes) == True) else result
-    logger.debug('%s: "%s" returned: \n%s' % (device_id, cmd, result))
-    if 'error' in result:
-        raise AdbError(result)
-    return result.rstrip()
+    return handle(device_id).shell(cmd)
+
+
+def batch(device_id, commands):
+    return handle(device_id).batch(commands)
 
 
 def list_apps(device_id):
@@ -74,71 +233,15 @@ def list_apps(device_id):
 
 
 def install(device_id, apk, replace=True, all_permissions=True):
-    filename = op.basename(apk)
-    logger.debug('%s: Installing "%s"' % (device_id, filename))
-    adb.set_target_by_name(device_id)
-
-    # get extension filename
-    extension = op.splitext(apk)[-1].lower()
-
-    if extension == '.xapk':
-        cmd = ['install-multiple']
-        android_runner_dir = os.getcwd()
-        # get path of directory apks will be unzipped into.
-        path_apks_to_be_installed = op.splitext(apk)[0].lower()
-        with zipfile.ZipFile(apk, 'r') as zip_ref:
-            if not op.exists(path_apks_to_be_installed):
-                os.makedirs(path_apks_to_be_installed)
-            zip_ref.extractall(path_apks_to_be_installed)
-
-        os.chdir(path_apks_to_be_installed)
-
-        current_working_directory = os.getcwd()
-
-        apk_files = glob.glob('*.apk')
-
-        if not apk_files:
-            raise ConfigError('No apks found in xapk')
-
-        apk_files_paths = [op.join(current_working_directory, apk_file) for apk_file in apk_files]
-
-        # arguments of install-multiple
-        apk = ' '.join(apk_files_paths)
-        logger.info('installing APKs %s' % apk)
-        os.chdir(android_runner_dir) # go back to android runner dir
-    else:
-        cmd = ['install']
-        
-    if replace:
-        cmd += ['-r']
-    if all_permissions:
-        cmd += ['-g']
-    cmd += ['-t', apk]
-    adb.run_cmd(cmd)
-    # WARNING: Accessing class private variables
-    output = adb._ADB__output
-    logger.debug('install returned: %s' % output)
-    return output
+    return handle(device_id).install(apk, replace=replace, all_permissions=all_permissions)
 
 
 def uninstall(device_id, name, keep_data=False):
-    logger.debug('%s: Uninstalling "%s"' % (device_id, name))
-    adb.set_target_by_name(device_id)
-    # Flips the keep_data flag as it is incorrectly implemented in the pyand library
-    keep_data = not keep_data
-    result = adb.uninstall(package=name, keepdata=keep_data)
-    success_or_exception(result,
-                         '%s: "%s" uninstalled' % (device_id, name),
-                         '%s: Failed to uninstall "%s"' % (device_id, name)
-                         )
+    handle(device_id).uninstall(name, keep_data=keep_data)
 
 
 def clear_app_data(device_id, name):
-    adb.set_target_by_name(device_id)
-    success_or_exception(adb.shell_command('pm clear %s' % name),
-                         '%s: Data of "%s" cleared' % (device_id, name),
-                         '%s: Failed to clear data for "%s"' % (device_id, name)
-                         )
+    handle(device_id).clear_app_data(name)
 
 
 def success_or_exception(result, success_msg, fail_msg):
@@ -150,27 +253,13 @@ def success_or_exception(result, success_msg, fail_msg):
         raise AdbError(result)
 
 
-# Same with push_local_file(), but with the quotes removed
-# adb doesn't want quotes for some reason
-# noinspection PyProtectedMember
+# adb doesn't want quotes for some reason, the arguments are passed to adb as separate arguments instead
 def push(device_id, local, remote):
-    adb.set_target_by_name(device_id)
-    adb.run_cmd('push %s %s' % (local, remote))
-    # WARNING: Accessing class private variables
-    return adb._ADB__output
+    return handle(device_id).push(local, remote)
 
 
-# Same with get_remote_file(), but with the quotes removed
-# adb doesn't want quotes for some reason
-# noinspection PyProtectedMember
 def pull(device_id, remote, local):
-    adb.set_target_by_name(device_id)
-    adb.run_cmd('pull %s %s' % (remote, local))
-    # WARNING: Accessing class private variables
-    if adb._ADB__error and "bytes in" in adb._ADB__error:
-        adb._ADB__output = adb._ADB__error
-        adb._ADB__error = None
-    return adb._ADB__output
+    return handle(device_id).pull(remote, local)
 
 def logcat(device_id, regex=None):
     """Returns the logcat log for the given device.
@@ -200,10 +289,53 @@ def logcat(device_id, regex=None):
     res = shell(device_id, params)
     return res
 
+def logcat_stream(device_id):
+    """Returns the running logcat stream of the device, it is started on the first call for the device. Returns
+    once its logcat command runs, so no line is missed between the return and the start of the stream."""
+    with logcat_streams_lock:
+        stream = logcat_streams.get(device_id)
+        if stream is None or not stream.is_running():
+            stream = LogcatStream(device_id, adb_path, client)
+            stream.start()
+            logcat_streams[device_id] = stream
+    if not stream.wait_started():
+        logger.warning('%s: logcat did not start within %ss' % (device_id, stream.START_TIMEOUT))
+    return stream
+
+
+def reinit_after_fork():
+    """Resets the state of the module in a forked child, like a script worker. The locks may have been held by
+    threads of the parent, which do not exist in the child, and the logcat streams and pooled connections belong to
+    the parent."""
+    global handles_lock, logcat_streams_lock
+    handles_lock = threading.Lock()
+    logcat_streams_lock = threading.Lock()
+    logcat_streams.clear()
+    if client is not None:
+        client.reinit_after_fork()
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=reinit_after_fork)
+
+
+@atexit.register
+def close_logcat_streams():
+    """Stops the logcat commands of all devices"""
+    with logcat_streams_lock:
+        streams = list(logcat_streams.values())
+        logcat_streams.clear()
+    for stream in streams:
+        stream.stop()
+
+
 def reset(cmd):
     if cmd:
         logger.info('Shutting down adb...')
+        close_logcat_streams()
         sleep(1)
+        if client is not None:
+            client.close()
         adb.kill_server()
         sleep(2)
         logger.info('Restarting adb...')
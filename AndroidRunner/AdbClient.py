@@ -0,0 +1,341 @@
+import logging
+import os
+import os.path as op
+import socket
+import stat
+import struct
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class AdbClientError(Exception):
+    """Raised when the adb server refuses a request or the connection to it breaks"""
+    pass
+
+
+class AdbSyncError(AdbClientError):
+    """Raised when the device refuses a file transfer request"""
+    pass
+
+
+class AdbClient(object):
+    """ Client for the adb server wire protocol.
+
+    The adb binary is itself only a client that forwards every command to the adb server listening on
+    localhost:5037. Talking to that server directly saves spawning an adb process for every shell command,
+    push or pull. The protocol is documented in the AOSP sources:
+    https://android.googlesource.com/platform/packages/modules/adb/+/refs/heads/master/SERVICES.TXT
+    https://android.googlesource.com/platform/packages/modules/adb/+/refs/heads/master/SYNC.TXT
+
+    Shell connections are consumed by the service they are opened for, so they can not be reused. Sync
+    connections (used for push and pull) stay open after a transfer and are kept in a per-device pool.
+    """
+    DEFAULT_HOST = '127.0.0.1'
+    DEFAULT_PORT = 5037
+    # Maximum payload of a single sync DATA packet
+    SYNC_DATA_MAX = 64 * 1024
+    DEFAULT_FILE_MODE = 0o644
+
+    def __init__(self, host=DEFAULT_HOST, port=DEFAULT_PORT, timeout=None):
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+        self._sync_pool = {}
+        self._lock = threading.Lock()
+
+    # Connection handling
+
+    def _connect(self):
+        try:
+            return socket.create_connection((self.host, self.port), timeout=self.timeout)
+        except OSError as e:
+            raise AdbClientError('Cannot connect to the adb server at %s:%s: %s' % (self.host, self.port, e))
+
+    @staticmethod
+    def _recv_exactly(sock, size):
+        data = b''
+        while len(data) < size:
+            chunk = sock.recv(size - len(data))
+            if not chunk:
+                raise AdbClientError('Connection closed by the adb server')
+            data += chunk
+        return data
+
+    @staticmethod
+    def _recv_all(sock):
+        chunks = []
+        while True:
+            chunk = sock.recv(AdbClient.SYNC_DATA_MAX)
+            if not chunk:
+                return b''.join(chunks)
+            chunks.append(chunk)
+
+    def _recv_hex_length_payload(self, sock):
+        length = int(self._recv_exactly(sock, 4), 16)
+        return self._recv_exactly(sock, length)
+
+    def _request(self, sock, service):
+        """Sends a service request and raises an AdbClientError when the server does not reply OKAY"""
+        payload = service.encode('utf-8')
+        sock.sendall(b'%04x' % len(payload) + payload)
+        status = self._recv_exactly(sock, 4)
+        if status == b'OKAY':
+            return
+        if status == b'FAIL':
+            raise AdbClientError(self._recv_hex_length_payload(sock).decode('utf-8', 'replace'))
+        raise AdbClientError('Unexpected response from the adb server: %r' % status)
+
+    def _host_query(self, service):
+        """Runs a host service that replies with a hex length prefixed payload"""
+        sock = self._connect()
+        try:
+            self._request(sock, service)
+            return self._recv_hex_length_payload(sock)
+        finally:
+            sock.close()
+
+    def _transport(self, serial):
+        """Returns a connection that is switched to the transport of the device with the given serial"""
+        sock = self._connect()
+        try:
+            self._request(sock, 'host:transport:%s' % serial)
+        except Exception:
+            sock.close()
+            raise
+        return sock
+
+    # Host services
+
+    def version(self):
+        """Returns the internal version number of the adb server"""
+        return int(self._host_query('host:version'), 16)
+
+    def devices(self):
+        """Returns a dictionary of connected devices along with an incremented id, like pyand's ADB.get_devices()"""
+        output = self._host_query('host:devices').decode('utf-8')
+        serials = [line.split('\t')[0] for line in output.splitlines() if '\t' in line]
+        return {n: serial for n, serial in enumerate(serials)}
+
+    def kill_server(self):
+        """Asks the adb server to quit and drops all pooled connections"""
+        self.close()
+        sock = self._connect()
+        try:
+            self._request(sock, 'host:kill')
+        finally:
+            sock.close()
+
+    # Device services
+
+    def shell(self, serial, cmd):
+        """ Runs cmd in a shell on the device.
+
+        Parameters
+        ----------
+        serial : string
+            Serial of the device.
+        cmd : string
+            The shell command.
+
+        Returns
+        -------
+        bytes
+            The combined stdout and stderr of the command.
+        """
+        sock = self.open_shell(serial, cmd)
+        try:
+            return self._recv_all(sock)
+        finally:
+            sock.close()
+
+    def open_shell(self, serial, cmd):
+        """Starts cmd in a shell on the device and returns the connection its output can be read from while it
+        runs, the command is stopped when the connection is closed"""
+        sock = self._transport(serial)
+        try:
+            self._request(sock, 'shell:%s' % cmd)
+        except Exception:
+            sock.close()
+            raise
+        return sock
+
+    def push(self, serial, local, remote):
+        """ Pushes a local file or directory to the device.
+
+        Follows the semantics of adb push: when remote is an existing directory the file or directory is
+        copied into it.
+
+        Returns
+        -------
+        bytes
+            A summary of the transfer in the format of the adb binary.
+        """
+        local = local.rstrip('/') or local
+        if not op.exists(local):
+            return b'adb: error: cannot stat \'%s\': No such file or directory' % local.encode('utf-8')
+        start = time.time()
+        files = self._local_files(local)
+
+        def send_all(sock):
+            target = remote
+            remote_mode = self._sync_stat(sock, remote)[0]
+            if stat.S_ISDIR(remote_mode):
+                target = '/'.join([remote.rstrip('/'), op.basename(local)])
+            total = 0
+            for path in files:
+                relative = op.relpath(path, local)
+                destination = target if relative == '.' else '/'.join([target.rstrip('/')] +
+                                                                      relative.split(os.sep))
+                total += self._sync_send(sock, path, destination)
+            return total
+
+        try:
+            size = self._with_sync(serial, send_all)
+        except AdbClientError as e:
+            return b'adb: error: %s' % str(e).encode('utf-8')
+        return self._transfer_summary(local, 'pushed', len(files), size, time.time() - start)
+
+    def pull(self, serial, remote, local):
+        """ Pulls a file from the device.
+
+        When local is an existing directory the file is stored in it under its remote name.
+
+        Returns
+        -------
+        bytes
+            A summary of the transfer in the format of the adb binary.
+        """
+        if op.isdir(local):
+            local = op.join(local, remote.rstrip('/').split('/')[-1])
+        start = time.time()
+
+        def recv(sock):
+            if self._sync_stat(sock, remote)[0] == 0:
+                raise AdbSyncError('failed to stat remote object \'%s\': No such file or directory' % remote)
+            with open(local, 'wb') as f:
+                return self._sync_recv(sock, remote, f)
+
+        try:
+            size = self._with_sync(serial, recv)
+        except AdbClientError as e:
+            return b'adb: error: %s' % str(e).encode('utf-8')
+        return self._transfer_summary(remote, 'pulled', 1, size, time.time() - start)
+
+    def reinit_after_fork(self):
+        """Forgets the pooled sync connections in a forked child, they are still used by the parent"""
+        self._lock = threading.Lock()
+        self._sync_pool = {}
+
+    def close(self):
+        """Closes all pooled sync connections"""
+        with self._lock:
+            pool = self._sync_pool
+            self._sync_pool = {}
+        for connections in pool.values():
+            for sock in connections:
+                sock.close()
+
+    # Sync service
+
+    @staticmethod
+    def _local_files(local):
+        if not op.isdir(local):
+            return [local]
+        files = []
+        for path, _, filenames in os.walk(local):
+            files.extend(op.join(path, filename) for filename in sorted(filenames))
+        return files
+
+    @staticmethod
+    def _transfer_summary(path, action, count, size, duration):
+        return ('%s: %s file%s %s. (%s bytes in %.3fs)' % (path, count, '' if count == 1 else 's', action,
+                                                            size, duration)).encode('utf-8')
+
+    def _with_sync(self, serial, function):
+        """ Runs function with a sync connection to the device.
+
+        A pooled connection is used when one is available. When a pooled connection turns out to be closed
+        (e.g. the server was restarted) the function is retried once on a fresh connection.
+        """
+        with self._lock:
+            pooled = self._sync_pool.get(serial, [])
+            sock = pooled.pop() if pooled else None
+        if sock is not None:
+            try:
+                result = function(sock)
+            except AdbSyncError:
+                sock.close()
+                raise
+            except (OSError, AdbClientError):
+                sock.close()
+            else:
+                self._release_sync(serial, sock)
+                return result
+        sock = self._transport(serial)
+        try:
+            self._request(sock, 'sync:')
+            result = function(sock)
+        except Exception:
+            sock.close()
+            raise
+        self._release_sync(serial, sock)
+        return result
+
+    def _release_sync(self, serial, sock):
+        with self._lock:
+            self._sync_pool.setdefault(serial, []).append(sock)
+
+    @staticmethod
+    def _sync_packet(command, data=b''):
+        return command + struct.pack('<I', len(data)) + data
+
+    def _sync_fail(self, sock, length):
+        message = self._recv_exactly(sock, length).decode('utf-8', 'replace')
+        # adbd closes the sync service after a failure, so the connection can not be pooled any more
+        raise AdbSyncError(message)
+
+    def _sync_stat(self, sock, path):
+        """Returns (mode, size, mtime) of a remote path, mode is 0 when the path does not exist"""
+        sock.sendall(self._sync_packet(b'STAT', path.encode('utf-8')))
+        response = self._recv_exactly(sock, 16)
+        if response[:4] != b'STAT':
+            raise AdbClientError('Unexpected sync response: %r' % response[:4])
+        return struct.unpack('<III', response[4:])
+
+    def _sync_send(self, sock, local, remote):
+        mode = stat.S_IMODE(os.stat(local).st_mode) or AdbClient.DEFAULT_FILE_MODE
+        sock.sendall(self._sync_packet(b'SEND', ('%s,%d' % (remote, stat.S_IFREG | mode)).encode('utf-8')))
+        size = 0
+        with open(local, 'rb') as f:
+            while True:
+                chunk = f.read(AdbClient.SYNC_DATA_MAX)
+                if not chunk:
+                    break
+                sock.sendall(self._sync_packet(b'DATA', chunk))
+                size += len(chunk)
+        sock.sendall(b'DONE' + struct.pack('<I', int(os.path.getmtime(local))))
+        response = self._recv_exactly(sock, 8)
+        command, length = response[:4], struct.unpack('<I', response[4:])[0]
+        if command == b'FAIL':
+            self._sync_fail(sock, length)
+        if command != b'OKAY':
+            raise AdbClientError('Unexpected sync response: %r' % command)
+        return size
+
+    def _sync_recv(self, sock, remote, f):
+        sock.sendall(self._sync_packet(b'RECV', remote.encode('utf-8')))
+        size = 0
+        while True:
+            response = self._recv_exactly(sock, 8)
+            command, length = response[:4], struct.unpack('<I', response[4:])[0]
+            if command == b'DATA':
+                f.write(self._recv_exactly(sock, length))
+                size += length
+            elif command == b'DONE':
+                return size
+            elif command == b'FAIL':
+                self._sync_fail(sock, length)
+            else:
+                raise AdbClientError('Unexpected sync response: %r' % command)
@@ -0,0 +1,334 @@
+""" Columnar aggregation of the csv files written by the profilers.
+
+The files are read in chunks of CHUNK_ROWS rows with the C parser of pandas and every chunk is aggregated per
+column with NumPy, so the memory used does not grow with the length of a trace. Cells that are empty or not a
+number are left out.
+
+The statistics of a column can be merged, so the statistics of every run file are kept in a cache file
+(CACHE_FILE) in the directory of the runs. When a subject is aggregated again, for instance after an experiment
+was continued with --progress, only the run files that are new or changed since then are read.
+"""
+import csv
+import json
+import os
+from collections import OrderedDict
+
+import numpy as np
+import pandas as pd
+
+from . import util
+from .Plugins import ResultWriter
+
+CHUNK_ROWS = 65536
+AGGREGATED_FILE = 'Aggregated.csv'
+CACHE_FILE = '.aggregation_cache.json'
+CACHE_VERSION = 1
+
+
+class QuantileSketch(object):
+    """Mergeable sketch of the distribution of a column, for quantiles with a relative error of at most
+    relative_accuracy. Values are counted in buckets with logarithmic bounds (as DDSketch does), so merging two
+    sketches is adding their bucket counts."""
+
+    def __init__(self, relative_accuracy=0.01):
+        self.relative_accuracy = relative_accuracy
+        self.gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+        self.log_gamma = np.log(self.gamma)
+        # Bucket index i holds the values in (gamma^(i-1), gamma^i], for negative values their absolute value
+        self.positive = {}
+        self.negative = {}
+        self.zero = 0
+
+    @property
+    def count(self):
+        return self.zero + sum(self.positive.values()) + sum(self.negative.values())
+
+    def add(self, values):
+        """Adds an array of finite values"""
+        values = np.asarray(values, dtype=float)
+        self.zero += int(np.count_nonzero(values == 0))
+        self.add_buckets(self.positive, values[values > 0])
+        self.add_buckets(self.negative, -values[values < 0])
+
+    def add_buckets(self, buckets, values):
+        if not values.size:
+            return
+        indices, counts = np.unique(np.ceil(np.log(values) / self.log_gamma).astype(np.int64), return_counts=True)
+        for index, count in zip(indices.tolist(), counts.tolist()):
+            buckets[index] = buckets.get(index, 0) + count
+
+    def merge(self, other):
+        for buckets, other_buckets in ((self.positive, other.positive), (self.negative, other.negative)):
+            for index, count in other_buckets.items():
+                buckets[index] = buckets.get(index, 0) + count
+        self.zero += other.zero
+
+    def quantile(self, q):
+        """Returns an estimate of the q-th quantile (0 <= q <= 1), NaN when the sketch is empty"""
+        count = self.count
+        if not count:
+            return np.nan
+        rank = q * (count - 1)
+        seen = 0
+        buckets = [(-self.value(i), c) for i, c in sorted(self.negative.items(), reverse=True)]
+        buckets += [(0.0, self.zero)] + [(self.value(i), c) for i, c in sorted(self.positive.items())]
+        for value, bucket_count in buckets:
+            seen += bucket_count
+            if seen > rank:
+                return value
+        return buckets[-1][0]
+
+    def value(self, index):
+        """The value of bucket index with the smallest relative error to all values in the bucket"""
+        return 2 * self.gamma ** index / (self.gamma + 1)
+
+    def to_dict(self):
+        return {'relative_accuracy': self.relative_accuracy, 'zero': self.zero,
+                'positive': {str(i): c for i, c in self.positive.items()},
+                'negative': {str(i): c for i, c in self.negative.items()}}
+
+    @classmethod
+    def from_dict(cls, d):
+        sketch = cls(d['relative_accuracy'])
+        sketch.zero = d['zero']
+        sketch.positive = {int(i): c for i, c in d['positive'].items()}
+        sketch.negative = {int(i): c for i, c in d['negative'].items()}
+        return sketch
+
+
+class ColumnStatistics(object):
+    """Count, sum, mean, standard deviation, minimum, maximum and quantile sketch of a column. Statistics of parts
+    of a column (chunks, runs) are merged into the statistics of the whole."""
+
+    def __init__(self):
+        self.count = 0
+        self.total = 0.0
+        # Sum of the squared differences from the mean, merged as in Chan et al. as this is more precise than a
+        # sum of squares
+        self.m2 = 0.0
+        self.minimum = np.nan
+        self.maximum = np.nan
+        self.sketch = QuantileSketch()
+
+    def add(self, values):
+        """Adds an array of values, values that are NaN or infinite are left out"""
+        values = np.asarray(values, dtype=float)
+        values = values[np.isfinite(values)]
+        if not values.size:
+            return
+        chunk = ColumnStatistics()
+        chunk.count = values.size
+        chunk.total = values.sum()
+        chunk.m2 = ((values - chunk.total / chunk.count) ** 2).sum()
+        chunk.minimum = values.min()
+        chunk.maximum = values.max()
+        chunk.sketch.add(values)
+        self.merge(chunk)
+
+    def merge(self, other):
+        if not other.count:
+            return
+        count = self.count + other.count
+        delta = other.mean - self.mean if self.count else 0.0
+        self.m2 += other.m2 + delta ** 2 * self.count * other.count / count
+        self.total += other.total
+        self.count = count
+        self.minimum = np.fmin(self.minimum, other.minimum)
+        self.maximum = np.fmax(self.maximum, other.maximum)
+        self.sketch.merge(other.sketch)
+
+    @property
+    def mean(self):
+        return self.total / self.count if self.count else np.nan
+
+    @property
+    def std(self):
+        """Population standard deviation"""
+        return np.sqrt(self.m2 / self.count) if self.count else np.nan
+
+    def percentile(self, percentile):
+        """Returns an estimate of a percentile (0-100) from the sketch, within the exact minimum and maximum"""
+        if not self.count:
+            return np.nan
+        return float(np.clip(self.sketch.quantile(percentile / 100.0), self.minimum, self.maximum))
+
+    def result(self, percentiles=()):
+        result = OrderedDict([('count', self.count), ('mean', self.mean), ('std', self.std),
+                              ('min', float(self.minimum)), ('max', float(self.maximum))])
+        for percentile in percentiles:
+            result['p%g' % percentile] = self.percentile(percentile)
+        return result
+
+    def to_dict(self):
+        return {'count': self.count, 'sum': self.total, 'm2': self.m2, 'min': float(self.minimum),
+                'max': float(self.maximum), 'sketch': self.sketch.to_dict()}
+
+    @classmethod
+    def from_dict(cls, d):
+        statistics = cls()
+        statistics.count = d['count']
+        statistics.total = d['sum']
+        statistics.m2 = d['m2']
+        statistics.minimum = d['min']
+        statistics.maximum = d['max']
+        statistics.sketch = QuantileSketch.from_dict(d['sketch'])
+        return statistics
+
+
+def read_chunks(path, usecols=None, chunk_rows=CHUNK_ROWS):
+    """Yields the columns of a csv (or npz or npy, see ResultWriter) file per chunk of rows, as an OrderedDict of
+    column name -> float array. usecols is a function that gets a column name and returns whether the column is
+    read, by default all columns are read. Values that are not a number become NaN."""
+    if os.path.splitext(path)[1] in (ResultWriter.EXTENSIONS['npz'], ResultWriter.EXTENSIONS['npy']):
+        columns = OrderedDict((column, values) for column, values in ResultWriter.read_results(path).items()
+                              if usecols is None or usecols(column))
+        rows = len(next(iter(columns.values()))) if columns else 0
+        for start in range(0, rows, chunk_rows):
+            yield OrderedDict((column, to_floats(pd.Series(values[start:start + chunk_rows])))
+                              for column, values in columns.items())
+        return
+    # round_trip parses the numbers exactly like float() does
+    reader = pd.read_csv(path, usecols=usecols, chunksize=chunk_rows, float_precision='round_trip',
+                         skipinitialspace=True)
+    for chunk in reader:
+        yield OrderedDict((column, to_floats(chunk[column])) for column in chunk.columns)
+
+
+def to_floats(series):
+    if pd.api.types.is_numeric_dtype(series):
+        return series.to_numpy(dtype=float)
+    return pd.to_numeric(series, errors='coerce').to_numpy(dtype=float)
+
+
+def summarize_file(path, usecols=None, chunk_rows=CHUNK_ROWS):
+    """Returns an OrderedDict of column name -> ColumnStatistics of the numeric values in the columns of a csv
+    file"""
+    statistics = OrderedDict()
+    for chunk in read_chunks(path, usecols, chunk_rows):
+        for column, values in chunk.items():
+            statistics.setdefault(column, ColumnStatistics()).add(values)
+    return statistics
+
+
+def merge_summaries(summaries):
+    """Merges the column statistics of several files (runs) into the statistics of all values per column"""
+    merged = OrderedDict()
+    for summary in summaries:
+        for column, statistics in summary.items():
+            merged.setdefault(column, ColumnStatistics()).merge(statistics)
+    return merged
+
+
+class SummaryCache(object):
+    """The column statistics of the run files in a directory, kept in CACHE_FILE in that directory. An entry is
+    used as long as the size and modification time of its file did not change. Use it as a context manager to
+    write the cache back when new files were summarized."""
+
+    def __init__(self, logs_dir):
+        self.path = os.path.join(logs_dir, CACHE_FILE)
+        self.entries = {}
+        self.changed = False
+        if os.path.isfile(self.path):
+            try:
+                with open(self.path, 'r') as f:
+                    cache = json.load(f)
+                if cache.get('version') == CACHE_VERSION:
+                    self.entries = cache['files']
+            except (ValueError, KeyError):
+                # A cache that cannot be read is rebuilt
+                self.entries = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.save()
+
+    def summarize(self, path):
+        """Returns the column statistics of the csv file at path, from the cache when the file did not change"""
+        stat = os.stat(path)
+        name = os.path.basename(path)
+        entry = self.entries.get(name)
+        if entry is not None and entry['size'] == stat.st_size and entry['mtime_ns'] == stat.st_mtime_ns:
+            return OrderedDict((column, ColumnStatistics.from_dict(d)) for column, d in entry['columns'])
+        summary = summarize_file(path)
+        self.entries[name] = {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns,
+                              'columns': [[column, statistics.to_dict()] for column, statistics in summary.items()]}
+        self.changed = True
+        return summary
+
+    def save(self):
+        if not self.changed:
+            return
+        # Written next to the cache and then renamed, so an interrupted write never leaves half a cache behind
+        temp_path = self.path + '.tmp'
+        with open(temp_path, 'w') as f:
+            json.dump({'version': CACHE_VERSION, 'files': self.entries}, f)
+        os.replace(temp_path, self.path)
+        self.changed = False
+
+
+def run_summaries(logs_dir, condition=None):
+    """Returns the column statistics of every run file in logs_dir (see run_files), read from the cache of the
+    directory when possible"""
+    with SummaryCache(logs_dir) as cache:
+        return [cache.summarize(run_file) for run_file in run_files(logs_dir, condition)]
+
+
+def run_means(logs_dir, usecols=None, condition=None):
+    """Returns per run file in logs_dir the mean of every column for which usecols returns True (all columns by
+    default), columns without any numeric value are left out"""
+    return [OrderedDict((column, statistics.mean) for column, statistics in summary.items()
+                        if statistics.count and (usecols is None or usecols(column)))
+            for summary in run_summaries(logs_dir, condition)]
+
+
+def mean_of_runs(runs):
+    """Returns the mean over the runs of every column of the first run, runs is a list of column -> value
+    dictionaries such as returned by run_means"""
+    if not runs:
+        return OrderedDict()
+    return OrderedDict((column, sum(run[column] for run in runs) / len(runs)) for column in runs[0])
+
+
+def run_files(logs_dir, condition=None):
+    """Returns the paths of the run files in logs_dir, only the file names for which condition returns True when
+    it is given. The subject aggregation and cache files are not run files."""
+    return [os.path.join(logs_dir, f) for f in sorted(os.listdir(logs_dir))
+            if os.path.isfile(os.path.join(logs_dir, f)) and f not in (AGGREGATED_FILE, CACHE_FILE)
+            and (condition is None or condition(f))]
+
+
+def read_aggregated(logs_dir, filename=AGGREGATED_FILE):
+    """Returns the last row of the subject aggregation file in logs_dir, None when there is no such file"""
+    path = os.path.join(logs_dir, filename)
+    if not os.path.isfile(path):
+        return None
+    with open(path, 'r', encoding='utf-8') as aggregated:
+        row_dict = OrderedDict()
+        for row in csv.DictReader(aggregated):
+            row_dict.update(row)
+        return row_dict
+
+
+def aggregate_final(data_dir, name, read_subject):
+    """Returns a row per subject (and browser) of the experiment with the device, subject, browser and the
+    columns returned by read_subject(logs_dir) for the output directory of the profiler called name"""
+    rows = []
+    for device in util.list_subdir(data_dir):
+        row = OrderedDict({'device': device})
+        device_dir = os.path.join(data_dir, device)
+        for subject in util.list_subdir(device_dir):
+            row.update({'subject': subject})
+            subject_dir = os.path.join(device_dir, subject)
+            if os.path.isdir(os.path.join(subject_dir, name)):
+                row.update(read_subject(os.path.join(subject_dir, name)))
+                rows.append(row.copy())
+            else:
+                for browser in util.list_subdir(subject_dir):
+                    row.update({'browser': browser})
+                    browser_dir = os.path.join(subject_dir, browser)
+                    if os.path.isdir(os.path.join(browser_dir, name)):
+                        row.update(read_subject(os.path.join(browser_dir, name)))
+                        rows.append(row.copy())
+    return rows
@@ -0,0 +1,251 @@
+""" Package name and version of APK and XAPK files, and a content-addressed cache of them.
+
+The package name and versionCode are read from the binary AndroidManifest.xml of an APK, or from the manifest.json of
+an XAPK. The cache keeps them per SHA-256 of the file and extracts every XAPK only once, to a directory named after
+its hash, so installing the same file again does not need to read or unzip it.
+"""
+import glob
+import hashlib
+import json
+import logging
+import os
+import os.path as op
+import shutil
+import struct
+import tempfile
+import threading
+import zipfile
+from collections import namedtuple
+
+from .util import ConfigError
+
+DEFAULT_CACHE_DIR = op.join(op.expanduser('~'), '.cache', 'android-runner', 'apks')
+
+# package and version_code are None when the manifest could not be read
+ApkInfo = namedtuple('ApkInfo', ['package', 'version_code', 'sha256'])
+
+# Binary XML chunk and value types and the resource id of android:versionCode
+RES_STRING_POOL_TYPE = 0x0001
+RES_XML_TYPE = 0x0003
+RES_XML_RESOURCE_MAP_TYPE = 0x0180
+RES_XML_START_ELEMENT_TYPE = 0x0102
+UTF8_FLAG = 0x100
+TYPE_STRING = 0x03
+NO_INDEX = 0xFFFFFFFF
+VERSION_CODE_RESOURCE_ID = 0x0101021b
+
+
+class ManifestError(Exception):
+    pass
+
+
+def read_string_pool(data, offset):
+    """Returns the strings of the string pool chunk at offset"""
+    header_size, = struct.unpack_from('<H', data, offset + 2)
+    count, _, flags, strings_start, _ = struct.unpack_from('<5I', data, offset + 8)
+    offsets = struct.unpack_from('<%dI' % count, data, offset + header_size)
+    strings = []
+    for string_offset in offsets:
+        position = offset + strings_start + string_offset
+        if flags & UTF8_FLAG:
+            # The length in UTF-16 code units and then in bytes, each one or two bytes long
+            for _ in range(2):
+                length = data[position]
+                position += 1
+                if length & 0x80:
+                    length = ((length & 0x7F) << 8) | data[position]
+                    position += 1
+            strings.append(data[position:position + length].decode('utf-8', 'replace'))
+        else:
+            length, = struct.unpack_from('<H', data, position)
+            position += 2
+            if length & 0x8000:
+                length = ((length & 0x7FFF) << 16) | struct.unpack_from('<H', data, position)[0]
+                position += 2
+            strings.append(data[position:position + length * 2].decode('utf-16-le', 'replace'))
+    return strings
+
+
+def read_manifest_attributes(data):
+    """Returns the attributes of the root (manifest) element of a binary AndroidManifest.xml as a dict of name ->
+    string or int. android:versionCode is found by its resource id as well, for manifests with stripped names."""
+    chunk_type, header_size, size = struct.unpack_from('<HHI', data, 0)
+    if chunk_type != RES_XML_TYPE:
+        raise ManifestError('Not a binary XML file')
+    strings = []
+    resource_ids = []
+    offset = header_size
+    while offset + 8 <= min(size, len(data)):
+        chunk_type, header_size, chunk_size = struct.unpack_from('<HHI', data, offset)
+        if chunk_size < 8:
+            break
+        if chunk_type == RES_STRING_POOL_TYPE:
+            strings = read_string_pool(data, offset)
+        elif chunk_type == RES_XML_RESOURCE_MAP_TYPE:
+            count = (chunk_size - header_size) // 4
+            resource_ids = struct.unpack_from('<%dI' % count, data, offset + header_size)
+        elif chunk_type == RES_XML_START_ELEMENT_TYPE:
+            extension = offset + header_size
+            attribute_start, attribute_size, attribute_count = struct.unpack_from('<HHH', data, extension + 8)
+            attributes = {}
+            for i in range(attribute_count):
+                position = extension + attribute_start + i * attribute_size
+                _, name, raw_value, _, _, data_type, value = struct.unpack_from('<3IHBBI', data, position)
+                key = strings[name] if name < len(strings) else ''
+                if name < len(resource_ids) and resource_ids[name] == VERSION_CODE_RESOURCE_ID:
+                    key = 'versionCode'
+                if raw_value != NO_INDEX:
+                    attributes[key] = strings[raw_value]
+                elif data_type == TYPE_STRING:
+                    attributes[key] = strings[value]
+                else:
+                    attributes[key] = value
+            return attributes
+        offset += chunk_size
+    raise ManifestError('No manifest element found')
+
+
+def read_apk_info(path):
+    """Returns the package name and versionCode of an APK"""
+    with zipfile.ZipFile(path) as apk:
+        attributes = read_manifest_attributes(apk.read('AndroidManifest.xml'))
+    if 'package' not in attributes:
+        raise ManifestError('No package name in the manifest of %s' % path)
+    version_code = attributes.get('versionCode')
+    return attributes['package'], int(version_code) if version_code is not None else None
+
+
+def read_xapk_info(path, apk_dir):
+    """Returns the package name and versionCode of an XAPK from its manifest.json, or else from its base APK"""
+    with zipfile.ZipFile(path) as xapk:
+        if 'manifest.json' in xapk.namelist():
+            manifest = json.loads(xapk.read('manifest.json').decode('utf-8'))
+            return manifest['package_name'], int(manifest['version_code'])
+    for apk in sorted(glob.glob(op.join(apk_dir, '*.apk'))):
+        with zipfile.ZipFile(apk) as z:
+            attributes = read_manifest_attributes(z.read('AndroidManifest.xml'))
+        if 'split' not in attributes and 'package' in attributes:
+            return read_apk_info(apk)
+    raise ManifestError('No base APK found in %s' % path)
+
+
+def sha256_file(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+class ApkCache(object):
+    """ The content-addressed cache of APK and XAPK files in cache_dir.
+
+    index.json maps the path, size and modification time of a file to its hash, so a file is only hashed again when
+    it changed, and maps the hash to the package name and versionCode. XAPKs are extracted to <hash>/. The cache can
+    be used by several threads at once.
+    """
+    INDEX_FILE = 'index.json'
+    INDEX_VERSION = 1
+
+    def __init__(self, cache_dir=DEFAULT_CACHE_DIR):
+        self.logger = logging.getLogger(self.__class__.__name__)
+        self.cache_dir = cache_dir
+        self.lock = threading.RLock()
+        self.index = None
+
+    def load_index(self):
+        if self.index is None:
+            self.index = {'version': self.INDEX_VERSION, 'files': {}, 'apks': {}}
+            try:
+                with open(op.join(self.cache_dir, self.INDEX_FILE)) as f:
+                    index = json.load(f)
+                if index.get('version') == self.INDEX_VERSION:
+                    self.index = index
+            except (OSError, ValueError):
+                pass
+        return self.index
+
+    def save_index(self):
+        os.makedirs(self.cache_dir, exist_ok=True)
+        path = op.join(self.cache_dir, self.INDEX_FILE)
+        temp = '%s.%s.tmp' % (path, os.getpid())
+        with open(temp, 'w') as f:
+            json.dump(self.index, f)
+        os.replace(temp, path)
+
+    def sha256(self, path):
+        """Returns the SHA-256 of the file, it is only computed again when the file changed"""
+        path = op.abspath(path)
+        stat = os.stat(path)
+        with self.lock:
+            entry = self.load_index()['files'].get(path)
+            if entry is not None and entry['size'] == stat.st_size and entry['mtime_ns'] == stat.st_mtime_ns:
+                return entry['sha256']
+        digest = sha256_file(path)
+        with self.lock:
+            self.load_index()['files'][path] = {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns, 'sha256': digest}
+            self.save_index()
+        return digest
+
+    def info(self, path):
+        """Returns the ApkInfo of an APK or XAPK file"""
+        digest = self.sha256(path)
+        with self.lock:
+            entry = self.load_index()['apks'].get(digest)
+        if entry is None:
+            try:
+                if is_xapk(path):
+                    package, version_code = read_xapk_info(path, self.extract(path, digest))
+                else:
+                    package, version_code = read_apk_info(path)
+            except (ManifestError, KeyError, ValueError, struct.error, zipfile.BadZipFile) as e:
+                self.logger.warning('Cannot read the manifest of %s: %s' % (path, e))
+                return ApkInfo(None, None, digest)
+            entry = {'package': package, 'version_code': version_code}
+            with self.lock:
+                self.load_index()['apks'][digest] = entry
+                self.save_index()
+        return ApkInfo(entry['package'], entry['version_code'], digest)
+
+    def extract(self, path, digest=None):
+        """Extracts an XAPK to the cache once and returns the directory"""
+        digest = digest if digest is not None else self.sha256(path)
+        target = op.join(self.cache_dir, digest)
+        if not op.isdir(target):
+            os.makedirs(self.cache_dir, exist_ok=True)
+            # Extract next to the target and rename, another thread never sees a partially extracted XAPK
+            temp = tempfile.mkdtemp(dir=self.cache_dir, prefix='.%s.' % digest)
+            try:
+                with zipfile.ZipFile(path) as xapk:
+                    xapk.extractall(temp)
+                os.rename(temp, target)
+            except OSError:
+                if not op.isdir(target):
+                    raise
+            finally:
+                shutil.rmtree(temp, ignore_errors=True)
+            self.logger.debug('Extracted %s to %s' % (path, target))
+        return target
+
+    def apk_files(self, path):
+        """Returns the APK files to install for an APK or XAPK file"""
+        if not is_xapk(path):
+            return [path]
+        apk_files = sorted(glob.glob(op.join(self.extract(path), '*.apk')))
+        if not apk_files:
+            raise ConfigError('No apks found in xapk')
+        return apk_files
+
+
+def is_xapk(path):
+    return op.splitext(path)[-1].lower() == '.xapk'
+
+
+cache = ApkCache()
+
+
+def setup(cache_dir=DEFAULT_CACHE_DIR):
+    """Sets the directory of the APK cache"""
+    global cache
+    if cache.cache_dir != cache_dir:
+        cache = ApkCache(cache_dir)
@@ -4,6 +4,7 @@ import re
 import time
 
 from . import Adb
+from . import Apk
 from .Adb import AdbError
 from .util import ConfigError, makedirs
 from . import Tests
@@ -14,6 +15,8 @@ class Device:
     LOGCAT_BUFFER_SIZE_MIN = 64
     LOGCAT_BUFFER_SIZE_MAX = 262144 # 256MB = 256 * 1024KB = 262144KB
     LOGCAT_BUFFER_SIZE_DEFAULT = 57344 # 56MB = 56 * 1024KB = 57344KB since Nexus 5X has limit of 56MB.
+    # System properties that can not change until the device reboots
+    READ_ONLY_PROP_PREFIX = 'ro.'
 
     def __init__(self, name, device_id, settings):
         self.logger = logging.getLogger(self.__class__.__name__)
@@ -25,9 +28,14 @@ class Device:
         self.root_plug_value = None
         self.power_device = settings.get('power_device', None)
         self.device_settings_reqs = settings.get('device_settings_reqs', None)
+        # Cached read-only system properties and installed packages, see invalidate_cache()
+        self.props = {}
+        self.app_list = None
         if self.power_device:
             subprocess.call([self.power_device["py_path"], self.power_device["script_path"], self.power_device["vout"], self.power_device["serial_num"]])
         Adb.connect(device_id)
+        # Independent command handle of this device, safe to use from several threads at once
+        self.adb = Adb.handle(device_id)
 
         # Set logcat buffer size for the device based on logcat_buffer_size set in the config file. If it is not
         # defined use the default value.
@@ -77,31 +85,79 @@ class Device:
                     self.logger.info('Enabling ' + str(settings_for_app[setting])) if enable else self.logger.info('Disabling ' + str(settings_for_app[setting]))
                     Adb.configure_settings(self.id, settings_for_app[setting], enable)
 
+    def get_prop(self, name):
+        """Returns a system property, read-only (ro.*) properties are read from the device only once"""
+        if name in self.props:
+            return self.props[name]
+        value = Adb.shell(self.id, 'getprop %s' % name)
+        if name.startswith(Device.READ_ONLY_PROP_PREFIX):
+            self.props[name] = value
+        return value
+
     def get_version(self):
         """Returns the Android version"""
-        return Adb.shell(self.id, 'getprop ro.build.version.release')
+        return self.get_prop('ro.build.version.release')
 
     def get_api_level(self):
         """Returns the Android API level as a number"""
-        return Adb.shell(self.id, 'getprop ro.build.version.sdk')
+        return self.get_prop('ro.build.version.sdk')
 
     def is_installed(self, apps):
         """Returns a boolean if a package is installed"""
-        return {app: app in self.get_app_list() for app in apps}
+        app_list = set(self.get_app_list())
+        return {app: app in app_list for app in apps}
 
     def get_app_list(self):
-        """Returns a list of installed packages on the system"""
-        return Adb.list_apps(self.id)
-
-    def install(self, apk):
-        """Check if the file exists, and then install the package"""
+        """Returns a list of installed packages on the system. The list is cached until an app is installed or
+        uninstalled through this device, call invalidate_cache() when apps are (un)installed in another way."""
+        if self.app_list is None:
+            self.app_list = Adb.list_apps(self.id)
+        return list(self.app_list)
+
+    def invalidate_cache(self):
+        """Makes the next calls read the properties and installed packages from the device again"""
+        self.props = {}
+        self.app_list = None
+
+    def install(self, apk, force=False):
+        """Installs an APK or XAPK, unless the same version of its package is installed already. Returns the package
+        name, which is the file name without extension when it cannot be read from the manifest."""
         if not op.isfile(apk):
             raise AdbError("%s is not found" % apk)
-        Adb.install(self.id, apk)
+        info = Apk.cache.info(apk)
+        package = info.package if info.package is not None else op.splitext(op.basename(apk))[0]
+        if not force and self.is_apk_installed(info, apk):
+            self.logger.info('%s version %s is already installed' % (info.package, info.version_code))
+            return package
+        try:
+            Adb.install(self.id, apk)
+        finally:
+            self.app_list = None
+        return package
+
+    def is_apk_installed(self, info, apk):
+        """Returns whether the package of the ApkInfo is installed with the same versionCode and, for an APK, the
+        same contents"""
+        if info.package is None or info.package not in self.get_app_list():
+            return False
+        # Without a base.apk sha256sum would be started without arguments and wait for stdin
+        version, digest = self.batch(['dumpsys package %s | grep versionCode=' % info.package,
+                                      'p=$(pm path %s | grep base.apk | cut -d: -f2); [ -n "$p" ] && sha256sum "$p"'
+                                      % info.package])
+        match = re.search(r'versionCode=(\d+)', version.output)
+        if match is None or int(match.group(1)) != info.version_code:
+            return False
+        # The installed base.apk is a copy of the APK, sha256sum is not available on every device
+        if not Apk.is_xapk(apk) and digest.exit_code == 0 and digest.output.strip():
+            return digest.output.split()[0] == info.sha256
+        return True
 
     def uninstall(self, name):
         """Uninstalls the package on the device"""
-        Adb.uninstall(self.id, name)
+        try:
+            Adb.uninstall(self.id, name)
+        finally:
+            self.app_list = None
 
     def su_unplug(self, restart):
         """Root unplugs the device"""
@@ -146,10 +202,8 @@ class Device:
                 # API level 23+ (Android 6.0+)
                 Adb.shell(self.id, 'dumpsys battery unplug')
 
-    def su_plug(self):
-        """Reset the power status of the device if root unpluged"""
-        self.logger.info('Root pluged, please check if device is charging')
-        Adb.shell_su(self.id, 'echo %s > %s' % (self.root_plug_value, self.root_unplug_file))
+    def su_plug_command(self):
+        return 'echo %s > %s' % (self.root_plug_value, self.root_unplug_file)
 
     def plug(self):
         """Reset the power status of the device"""
@@ -159,8 +213,10 @@ class Device:
         #    Adb.shell(self.id, 'dumpsys battery set usb 1')
         # API level 23+ (Android 6.0+)
         if self.root_unplug:
-            self.su_plug()
-        Adb.shell(self.id, 'dumpsys battery reset')
+            self.logger.info('Root pluged, please check if device is charging')
+            self.batch(["su -c '%s'" % self.su_plug_command(), 'dumpsys battery reset'], check=True)
+        else:
+            Adb.shell(self.id, 'dumpsys battery reset')
 
     def current_activity(self):
         """Newer Android 10 does not have mCurrentFocus and mFocusedApp. Different approach to get the current activity"""
@@ -216,6 +272,23 @@ class Device:
     def logcat_regex(self, regex):
         return Adb.logcat(self.id, regex=regex)
 
+    def watch_logcat(self, regex, callback, once=False, include_buffer=False):
+        """ Calls callback(line) for the logcat lines that match regex (a Python regular expression) as soon as
+        they are logged. With include_buffer the lines that are already in the logcat buffer are matched too.
+        Returns the subscription, call its cancel() method to stop watching.
+        """
+        subscription = Adb.logcat_stream(self.id).subscribe(regex, callback, once=once)
+        if include_buffer:
+            # The stream is running once logcat_stream() returns and the subscription is made before the dump, so
+            # a line logged in between is delivered twice instead of not at all. The output is not checked for
+            # 'error' like shell() does, a log is full of them.
+            buffer = self.adb.shell_command('logcat -d')
+            buffer = buffer.decode('utf-8', 'replace') if isinstance(buffer, bytes) else buffer
+            for line in buffer.splitlines():
+                if subscription.feed(line) and once:
+                    break
+        return subscription
+
     def push(self, local, remote):
         """Pushes a file from the computer to the device"""
         return Adb.push(self.id, local, remote)
@@ -228,5 +301,19 @@ class Device:
         """Runs the device shell with command specified by cmd"""
         return Adb.shell(self.id, cmd)
 
+    def batch(self, commands, check=False):
+        """ Runs a list of shell commands with a single adb shell invocation instead of one per command.
+
+        Returns a CommandResult (command, output, exit_code) per command, in order. A command that fails does not
+        stop the commands after it; with check an AdbError is raised afterwards for the first command that failed.
+        """
+        results = Adb.batch(self.id, commands)
+        if check:
+            for result in results:
+                if result.exit_code != 0:
+                    raise AdbError('%s: "%s" exited with %s: %s' % (self.id, result.command, result.exit_code,
+                                                                   result.output))
+        return results
+
     def __str__(self):
         return '%s (%s, Android %s, API level %s)' % (self.name, self.id, self.get_version(), self.get_api_level())
@@ -1,22 +1,32 @@
+import copy
 import psutil
 import logging
 import multiprocessing as mp
 import os.path as op
 import time
 from os import remove, rmdir, walk
-from threading import Thread
+from threading import Event, Thread
 from AndroidRunner.USBHandler import USBHandler
 from . import Tests
 from . import Adb
+from . import Readiness
 import paths
 from .Devices import Devices
-from .Profilers import Profilers
+from .Profilers import EXECUTION_MODES, Profilers
 from .Scripts import Scripts
+from .Scripts import EXECUTION_MODES as SCRIPT_EXECUTION_MODES
 from .util import ConfigError, makedirs, slugify_dir
 from AndroidRunner.PrematureStoppableRun import PrematureStoppableRun 
 import multiprocessing as mp
+
+SCHEDULERS = ['sequential', 'parallel']
+
+
 # noinspection PyUnusedLocal
 class Experiment(object):
+    # The readiness probe of every point in a run where the experiment waits for the device, see Readiness
+    READINESS_DEFAULTS = {}
+
     def __init__(self, config, progress, restart):
         self.logger = logging.getLogger(self.__class__.__name__)
         self.progress = progress
@@ -28,30 +38,64 @@ class Experiment(object):
         if 'devices' not in config:
             raise ConfigError('"device" is required in the configuration')
         adb_path = config.get('adb_path', 'adb')
-        self.devices = Devices(config['devices'], adb_path=adb_path, devices_spec=config.get('devices_spec'))
+        self.devices = Devices(config['devices'], adb_path=adb_path, devices_spec=config.get('devices_spec'),
+                               adb_backend=config.get('adb_backend', 'binary'))
         self.repetitions = Tests.is_integer(config.get('repetitions', 1))
         self.paths = config.get('paths', [])
-        self.profilers = Profilers(config.get('profilers', {}))
+        self.profilers_config = config.get('profilers', {})
+        self.profiler_execution = Tests.is_valid_option(config.get('profiler_execution', 'serial'),
+                                                        valid_options=EXECUTION_MODES)
+        self.profilers = Profilers(self.profilers_config, execution=self.profiler_execution)
+        self.aggregation_processes = Tests.is_integer(config.get('aggregation_processes', mp.cpu_count()), minimum=1)
         monkeyrunner_path = config.get('monkeyrunner_path', 'monkeyrunner')
         monkey_playback_path = config.get('monkey_playback_path', 'monkey_playback.py')
-        self.scripts = Scripts(config.get('scripts', {}), monkeyrunner_path=monkeyrunner_path, monkey_playback_path=monkey_playback_path)
+        self.script_execution = Tests.is_valid_option(config.get('script_execution', 'worker'),
+                                                      valid_options=SCRIPT_EXECUTION_MODES)
+        self.scripts = Scripts(config.get('scripts', {}), monkeyrunner_path=monkeyrunner_path, monkey_playback_path=monkey_playback_path,
+                               execution=self.script_execution)
         self.reset_adb_among_runs = config.get('reset_adb_among_runs', False)
         Tests.is_valid_option(self.reset_adb_among_runs, valid_options=[True, False])
         self.time_between_run = Tests.is_integer(config.get('time_between_run', 0))
+        self.readiness = Readiness.probes(config.get('readiness', {}), self.READINESS_DEFAULTS)
         Tests.check_dependencies(self.devices, self.profilers.dependencies())
         self.output_root = paths.OUTPUT_DIR
-        self.result_file_structure = None
         
         self.usb_handler_config = config.get("usb_handler", None)
         self.usb_handler = USBHandler(self.usb_handler_config)
 
         self.run_stopping_condition_config = config.get("run_stopping_condition", None)
         self.queue = mp.Queue()
-        
-        if restart:
+
+        self.scheduler = Tests.is_valid_option(config.get('scheduler', 'sequential'), valid_options=SCHEDULERS)
+        if self.scheduler == 'parallel':
+            self.check_parallel_config()
+        # Output directory of the current run and the files that were in it before the run
+        self.output_dir = None
+        self.run_manifest = None
+        # State of the parallel scheduler: the worker of every device, the device a worker runs for and the
+        # errors raised by the workers
+        self.workers = {}
+        self.worker_device = None
+        self.worker_errors = []
+        self.stop_workers = Event()
+        self.restart = restart
+
+        if restart and self.scheduler != 'parallel':
             for device in self.devices:
                 self.prepare_device(device, restart=True)
 
+    def check_parallel_config(self):
+        """Rejects options that act on all devices at once, they cannot be used when devices run in parallel"""
+        if self.usb_handler_config:
+            raise ConfigError('"usb_handler" cannot be used with the parallel scheduler, '
+                              'it switches the USB ports of all devices at once')
+        if self.reset_adb_among_runs:
+            raise ConfigError('"reset_adb_among_runs" cannot be used with the parallel scheduler, '
+                              'restarting adb disconnects all devices')
+        if self.run_stopping_condition_config and 'post_request' in self.run_stopping_condition_config:
+            raise ConfigError('The "post_request" run_stopping_condition cannot be used with the parallel scheduler, '
+                              'the devices would share the port of the webserver')
+
     def prepare_device(self, device, restart=False):
         """Prepare the device for experiment"""
         self.logger.info('Device: %s' % device)
@@ -65,21 +109,22 @@ class Experiment(object):
         self.profilers.stop_profiling(device)
         self.profilers.unload(device)
 
+    def wait_until_ready(self, name, device, package):
+        """Waits with the readiness probe of wait point name until package is ready on device"""
+        return self.readiness[name].wait(device, package)
+
     def get_progress_xml_file(self):
         return self.progress.progress_xml_file
-    def update_progress(self):
-        self.progress.write_progress_to_file()
-        result_data_path = op.join(paths.BASE_OUTPUT_DIR, 'data')
-        self.result_file_structure = self.walk_to_list(walk(result_data_path))
 
     def start(self):
         try:
-            result_data_path = op.join(paths.BASE_OUTPUT_DIR, 'data')
-            self.result_file_structure = self.walk_to_list(walk(result_data_path))
-            while not self.progress.experiment_finished_check():
-                current_run = self.get_experiment()
-                self.run_experiment(current_run)
-                self.save_progress()
+            if self.scheduler == 'parallel':
+                self.run_parallel()
+            else:
+                while not self.progress.experiment_finished_check():
+                    current_run = self.get_experiment()
+                    self.run_experiment(current_run)
+                    self.save_progress()
         except Exception as e:
             import traceback
             print((traceback.format_exc()))
@@ -92,13 +137,69 @@ class Experiment(object):
         else:
             self.finish_experiment(False, False)
 
+    def run_parallel(self):
+        """Runs the experiment with a worker thread for every device.
+
+        Every worker takes the runs of its own device from the progress, in order or at random just like the
+        sequential scheduler, and executes the device hooks and the subject aggregation of its device. The workers
+        are copies of the experiment with their own profilers, so the state of a run is never shared between devices.
+        When a worker fails the other workers stop after their current run and the error is raised again.
+        """
+        threads = []
+        for device in self.devices:
+            if self.progress.device_finished(device.name):
+                continue
+            worker = self.create_worker(device)
+            self.workers[device] = worker
+            threads.append(Thread(target=worker.run_device, name='device-%s' % device.name, daemon=True))
+        try:
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        except KeyboardInterrupt:
+            self.stop_workers.set()
+            raise
+        if self.worker_errors:
+            raise self.worker_errors[0]
+        if self.workers:
+            # All workers aggregated their subjects the same way, any of them can do the final aggregation
+            self.profilers = next(iter(self.workers.values())).profilers
+
+    def create_worker(self, device):
+        """Returns a copy of the experiment that runs the runs of device"""
+        worker = copy.copy(self)
+        worker.worker_device = device
+        worker.profilers = Profilers(self.profilers_config, execution=self.profiler_execution)
+        worker.queue = mp.Queue()
+        return worker
+
+    def run_device(self):
+        """Runs all remaining runs of the device of this worker"""
+        device = self.worker_device
+        try:
+            if self.restart:
+                self.prepare_device(device, restart=True)
+            while not self.stop_workers.is_set() and not self.progress.device_finished(device.name):
+                current_run = self.get_experiment(device.name)
+                self.run_experiment(current_run)
+                self.save_progress()
+        except Exception as e:
+            import traceback
+            print((traceback.format_exc()))
+            self.logger.error('%s: %s: %s' % (device.name, e.__class__.__name__, str(e)))
+            self.worker_errors.append(e)
+            self.stop_workers.set()
+
     def finish_experiment(self, error, interrupted):
-        self.check_result_files(self.result_file_structure)
+        for experiment in [self] + list(self.workers.values()):
+            experiment.remove_unsaved_run_files()
         for device in self.devices:
             try:
-                self.cleanup(device)
+                self.workers.get(device, self).cleanup(device)
             except Exception:
                 continue
+        self.scripts.stop_workers()
         if not error and not interrupted:
             self.aggregate_end()
 
@@ -109,6 +210,7 @@ class Experiment(object):
 
     def prepare_run(self, current_run):
         self.prepare_output_dir(current_run)
+        self.start_run_manifest()
         self.first_run_device(current_run)
         self.before_every_run_subject(current_run)
 
@@ -126,37 +228,42 @@ class Experiment(object):
         self.last_run_device(current_run)
 
     def save_progress(self):
-        a = Thread(target=self.update_progress)
-        a.start()
-        a.join()
-
-    def check_result_files(self, correct_file_list):
-        result_data_path = op.join(paths.BASE_OUTPUT_DIR, 'data')
-        current_file_structure = walk(result_data_path)
-        current_file_list = self.walk_to_list(current_file_structure)
-        for path in current_file_list:
-            if path not in correct_file_list:
-                if op.isfile(path):
-                    remove(path)
-                else:
-                    rmdir(path)
+        self.progress.write_progress_to_file()
+        # The run is saved, its files are kept from now on
+        self.run_manifest = None
 
     @staticmethod
-    def walk_to_list(walk_result):
-        walk_list = list()
-        for (path, dirs, files) in walk_result:
-            for dr in dirs:
-                walk_list.append(op.join(path, dr))
-            for fl in files:
-                walk_list.append(op.join(path, fl))
-        walk_list.reverse()
-        return walk_list
-
-    def get_experiment(self):
+    def list_files(directory):
+        """Returns a set with the paths of all files and directories below directory"""
+        files = set()
+        for (path, dirs, names) in walk(directory):
+            files.update(op.join(path, name) for name in dirs + names)
+        return files
+
+    def start_run_manifest(self):
+        """Remembers the contents of the output directory of the current run before the run starts"""
+        self.run_manifest = (self.output_dir, self.list_files(self.output_dir))
+
+    def remove_unsaved_run_files(self):
+        """Removes the files created by a run that was not saved to the progress, so the run can be redone.
+        Only the output directory of that run is looked at, the files of saved runs are never touched."""
+        if self.run_manifest is None:
+            return
+        run_dir, files_before_run = self.run_manifest
+        # Reverse order removes the contents of a directory before the directory itself
+        for path in sorted(self.list_files(run_dir) - files_before_run, reverse=True):
+            if op.isdir(path) and not op.islink(path):
+                rmdir(path)
+            else:
+                remove(path)
+        self.run_manifest = None
+
+    def get_experiment(self, device=None):
+        """Returns the next run, only runs of device are considered when it is given"""
         if self.random:
-            return self.progress.get_random_run()
+            return self.progress.get_random_run(device)
         else:
-            return self.progress.get_next_run()
+            return self.progress.get_next_run(device)
 
     def first_run_device(self, current_run):
         device = self.devices.get_device(current_run['device'])
@@ -177,9 +284,19 @@ class Experiment(object):
             self.aggregate_subject()
 
     def prepare_output_dir(self, current_run):
-        paths.OUTPUT_DIR = op.join(paths.BASE_OUTPUT_DIR, 'data/', current_run['device'],
-                                   slugify_dir(current_run['path']))
-        makedirs(paths.OUTPUT_DIR)
+        self.set_output_dir(op.join(paths.BASE_OUTPUT_DIR, 'data/', current_run['device'],
+                                    slugify_dir(current_run['path'])))
+
+    def set_output_dir(self, output_dir):
+        """Creates output_dir and makes it the output directory of the current run.
+
+        paths.OUTPUT_DIR is only updated with the sequential scheduler. With the parallel scheduler the workers of
+        all devices would overwrite it, so the workers only use their own output_dir.
+        """
+        makedirs(output_dir)
+        self.output_dir = output_dir
+        if self.scheduler != 'parallel':
+            paths.OUTPUT_DIR = output_dir
 
     def stop_run(self):
         """
@@ -217,7 +334,7 @@ class Experiment(object):
 
     def before_run(self, device, path, run, *args, **kwargs):
         """Hook executed before a run"""
-        self.profilers.set_output()
+        self.profilers.set_output(self.output_dir)
         self.logger.info('Run %s/%s of subject "%s" on %s' % (run, self.repetitions, path, device.name))
         device.shell('logcat -c')
         self.logger.info('Logcat cleared')
@@ -245,6 +362,9 @@ class Experiment(object):
         """Hook executed after a run"""
         self.scripts.run('after_run', device, *args, **kwargs)
         self.profilers.collect_results(device)
+        if self.reset_adb_among_runs:
+            # The script workers would keep using the connections of the adb server that is restarted
+            self.scripts.stop_workers()
         Adb.reset(self.reset_adb_among_runs)
         self.logger.info('Sleeping for %s milliseconds' % self.time_between_run)
         time.sleep(self.time_between_run / 1000.0)
@@ -262,4 +382,4 @@ class Experiment(object):
         self.profilers.aggregate_subject()
 
     def aggregate_end(self):
-        self.profilers.aggregate_end(self.output_root)
+        self.profilers.aggregate_end(self.output_root, processes=self.aggregation_processes)
@@ -0,0 +1,159 @@
+import logging
+import re
+import socket
+import subprocess
+import threading
+
+
+class LogcatSubscription(object):
+    """ A regex that is matched against every line of a LogcatStream.
+
+    callback(line) is called from the reader thread of the stream for every matching line, so it should return
+    quickly. With once=True only the first matching line is delivered and the subscription is cancelled.
+    """
+
+    def __init__(self, stream, regex, callback, once=False):
+        self.logger = logging.getLogger(self.__class__.__name__)
+        self.stream = stream
+        self.regex = regex
+        self.pattern = re.compile(regex)
+        self.callback = callback
+        self.once = once
+        self.active = True
+        self.lock = threading.Lock()
+
+    def feed(self, line):
+        """Delivers line to the callback when it matches, returns whether it matched"""
+        if not self.active or not self.pattern.search(line):
+            return False
+        with self.lock:
+            if not self.active:
+                return False
+            if self.once:
+                self.cancel()
+            try:
+                self.callback(line)
+            except Exception as e:
+                self.logger.error('Logcat callback for "%s" failed: %s' % (self.regex, e))
+        return True
+
+    def cancel(self):
+        self.active = False
+        self.stream.unsubscribe(self)
+
+
+class LogcatStream(object):
+    """ Follows the logcat of a device with a single long-lived logcat command and delivers the lines matching
+    the regexes of its subscribers.
+
+    Matching the lines as they are logged replaces dumping the whole logcat buffer (which can be up to 256MB)
+    every second to look for a regex. The stream starts at the most recent line of the buffer, use
+    Device.watch_logcat(..., include_buffer=True) to also match the lines that were logged before. start() only
+    starts the reader thread, wait_started() waits until the logcat command runs. When the logcat command ends,
+    e.g. because the connection to the device was lost, it is restarted.
+    """
+    COMMAND = 'logcat -T 1'
+    RESTART_DELAY = 1
+    START_TIMEOUT = 5
+
+    def __init__(self, device_id, adb_path='adb', adb_client=None):
+        self.logger = logging.getLogger(self.__class__.__name__)
+        self.device_id = device_id
+        self.adb_path = adb_path
+        self.client = adb_client
+        self.subscriptions = []
+        self.lock = threading.Lock()
+        # Guards the logcat command, which is stopped from another thread than the one reading it
+        self.source_lock = threading.Lock()
+        self.stopped = threading.Event()
+        # Set once the first logcat command was started (or could not be started)
+        self.started = threading.Event()
+        self.thread = None
+        self.process = None
+        self.sock = None
+        self.lines = 0
+
+    def subscribe(self, regex, callback, once=False):
+        """Calls callback(line) for every line logged from now on that matches regex, returns the subscription"""
+        subscription = LogcatSubscription(self, regex, callback, once=once)
+        with self.lock:
+            self.subscriptions.append(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self.lock:
+            if subscription in self.subscriptions:
+                self.subscriptions.remove(subscription)
+
+    def start(self):
+        self.stopped.clear()
+        self.thread = threading.Thread(target=self.read, name='logcat-%s' % self.device_id, daemon=True)
+        self.thread.start()
+
+    def wait_started(self, timeout=START_TIMEOUT):
+        """Waits until the logcat command was started, returns whether it was within timeout seconds"""
+        return self.started.wait(timeout)
+
+    def stop(self, timeout=5):
+        self.stopped.set()
+        self.close()
+        if self.thread is not None and self.thread is not threading.current_thread():
+            self.thread.join(timeout)
+
+    def is_running(self):
+        return self.thread is not None and self.thread.is_alive()
+
+    def open(self):
+        """Starts the logcat command and returns its output as a binary file"""
+        with self.source_lock:
+            if self.stopped.is_set():
+                return None
+            if self.client is not None:
+                self.sock = self.client.open_shell(self.device_id, self.COMMAND)
+                return self.sock.makefile('rb')
+            self.process = subprocess.Popen([self.adb_path, '-s', str(self.device_id)] + self.COMMAND.split(),
+                                            stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+            return self.process.stdout
+
+    def close(self):
+        """Stops the logcat command, which ends the output that is being read"""
+        with self.source_lock:
+            if self.process is not None:
+                self.process.terminate()
+                self.process.wait()
+                self.process = None
+            if self.sock is not None:
+                try:
+                    self.sock.shutdown(socket.SHUT_RDWR)
+                except OSError:
+                    pass
+                self.sock.close()
+                self.sock = None
+
+    def read(self):
+        while not self.stopped.is_set():
+            try:
+                try:
+                    output = self.open()
+                finally:
+                    self.started.set()
+                if output is None:
+                    return
+                with output:
+                    for line in output:
+                        self.dispatch(line.decode('utf-8', 'replace').rstrip('\r\n'))
+            except Exception as e:
+                self.logger.warning('%s: Reading logcat failed: %s' % (self.device_id, e))
+            finally:
+                self.close()
+            if not self.stopped.is_set():
+                self.logger.warning('%s: logcat ended, restarting it' % self.device_id)
+                self.stopped.wait(self.RESTART_DELAY)
+
+    def dispatch(self, line):
+        """Delivers a logcat line to the subscriptions"""
+        self.lines += 1
+        with self.lock:
+            subscriptions = list(self.subscriptions)
+        for subscription in subscriptions:
+            subscription.feed(line)
@@ -1,17 +1,21 @@
 import os.path as op
 import time
 
+from . import Apk
 from . import Tests
 from .Experiment import Experiment
 from .util import ConfigError
 
 
 class NativeExperiment(Experiment):
+    READINESS_DEFAULTS = {'launch': {'type': 'activity'}, 'close': {'type': 'stopped'}}
+
     def __init__(self, config, progress, restart):
         self.package = None
         self.duration = Tests.is_integer(config.get('duration', 0)) / 1000
         super(NativeExperiment, self).__init__(config, progress, restart)
         self.pre_installed_apps = config.get('apps', [])
+        Apk.setup(config.get('apk_cache_dir', Apk.DEFAULT_CACHE_DIR))
         for apk in config.get('paths', []):
             if not op.isfile(apk):
                 raise ConfigError('File %s not found' % apk)
@@ -29,18 +33,16 @@ class NativeExperiment(Experiment):
         if path in self.pre_installed_apps:
             self.package = path
         else:
-            filename = op.basename(path)
-            self.logger.info('APK: %s' % filename)
-            if filename not in device.get_app_list():
-                device.install(path)
-            self.package = op.splitext(op.basename(path))[0]
+            self.logger.info('APK: %s' % op.basename(path))
+            # Only installs when the device does not have this version of the package yet
+            self.package = device.install(path)
 
 
     def before_run(self, device, path, run, *args, **kwargs):
         super(NativeExperiment, self).before_run(device, path, run)
         device.configure_settings_device(self.package, enable=True)
         device.launch_package(self.package)
-        time.sleep(1)
+        self.wait_until_ready('launch', device, self.package)
         self.after_launch(device, path, run)
 
     def start_profiling(self, device, path, run, *args, **kwargs):
@@ -56,7 +58,7 @@ class NativeExperiment(Experiment):
         if self.clear_cache == True:
             device.clear_app_data(self.package)
         device.configure_settings_device(self.package, enable=False)
-        time.sleep(3)
+        self.wait_until_ready('close', device, self.package)
         super(NativeExperiment, self).after_run(device, path, run)
 
     def after_last_run(self, device, path, *args, **kwargs):
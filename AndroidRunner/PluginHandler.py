@@ -1,5 +1,8 @@
 import logging
+import multiprocessing as mp
 import os
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
 from shutil import copyfile
 
 from pluginbase import PluginBase
@@ -69,9 +72,11 @@ class PluginHandler(object):
         self.logger.debug('%s: %s: Cleanup' % (self.moduleName, device))
         self.currentProfiler.unload(device)
 
-    def set_output(self):
+    def set_output(self, output_dir=None):
         # TODO clean up!
-        self.paths['OUTPUT_DIR'] = os.path.join(paths.OUTPUT_DIR, self.name)
+        if output_dir is None:
+            output_dir = paths.OUTPUT_DIR
+        self.paths['OUTPUT_DIR'] = os.path.join(output_dir, self.name)
         makedirs(self.paths['OUTPUT_DIR'])
         self.logger.debug('%s: Setting output: %s' % (self.moduleName, self.paths['OUTPUT_DIR']))
         self.currentProfiler.set_output(self.paths['OUTPUT_DIR'])
@@ -94,7 +99,7 @@ class PluginHandler(object):
             self.subject_aggregated_default = False
             aggregate_subject_script.run(None, self.paths['OUTPUT_DIR'])
 
-    def aggregate_data_end(self, output_dir):
+    def aggregate_data_end(self, output_dir, processes=1):
         aggregate_function = self.pluginParams.get('experiment_aggregation', 'default')
         aggregate_function_lower = aggregate_function.lower()
 
@@ -109,7 +114,7 @@ class PluginHandler(object):
                 self.currentProfiler.aggregate_end(data_dir, result_file)
             elif not self.subject_aggregated:
                 self.logger.debug('%s: aggregating results')
-                self.aggregate_subjects_default(data_dir)
+                self.aggregate_subjects_default(data_dir, processes)
                 self.currentProfiler.aggregate_end(data_dir, result_file)
             else:
                 self.logger.info("{} profiler: User defined subject aggregation used,"
@@ -120,24 +125,54 @@ class PluginHandler(object):
             self.logger.debug('%s: aggregating results')
             aggregate_script.run(None, data_dir, result_file)
 
-    def aggregate_subjects_default(self, data_dir):
+    def subject_dirs(self, data_dir):
+        """Returns the output directories of the profiler of every subject (and browser) in data_dir, in sorted
+        order"""
+        subject_dirs = []
         for device in self.list_subdir(data_dir):
             device_dir = os.path.join(data_dir, device)
             for subject in self.list_subdir(device_dir):
                 subject_dir = os.path.join(device_dir, subject)
                 if os.path.isdir(os.path.join(subject_dir, self.name)):
-                    self.currentProfiler.set_output(os.path.join(subject_dir, self.name))
-                    self.currentProfiler.aggregate_subject()
+                    subject_dirs.append(os.path.join(subject_dir, self.name))
                 else:
                     for browser in self.list_subdir(subject_dir):
                         browser_dir = os.path.join(subject_dir, browser)
                         if os.path.isdir(os.path.join(browser_dir, self.name)):
-                            self.currentProfiler.set_output(os.path.join(browser_dir, self.name))
-                            self.currentProfiler.aggregate_subject()
+                            subject_dirs.append(os.path.join(browser_dir, self.name))
+        return subject_dirs
+
+    def aggregate_subjects_default(self, data_dir, processes=1):
+        """Runs the default subject aggregation for every subject in data_dir. With more than one process the
+        subjects are divided over a pool of processes that each load the profiler again."""
+        subject_dirs = self.subject_dirs(data_dir)
+        if processes > 1 and len(subject_dirs) > 1:
+            self.logger.debug('%s: aggregating %d subjects in %d processes' %
+                              (self.moduleName, len(subject_dirs), min(processes, len(subject_dirs))))
+            # Spawned instead of forked, the experiment may still have threads (and their locks) around
+            with ProcessPoolExecutor(max_workers=min(processes, len(subject_dirs)),
+                                     mp_context=mp.get_context('spawn')) as executor:
+                list(executor.map(aggregate_subject_dir, repeat(self.name), repeat(self.pluginParams),
+                                  repeat(paths.paths_dict()), subject_dirs))
+        else:
+            for subject_dir in subject_dirs:
+                self.currentProfiler.set_output(subject_dir)
+                self.currentProfiler.aggregate_subject()
 
     @staticmethod
     def list_subdir(a_dir):
-        """List immediate subdirectories of a_dir"""
+        """List immediate subdirectories of a_dir, sorted"""
         # https://stackoverflow.com/a/800201
-        return [name for name in os.listdir(a_dir)
-                if os.path.isdir(os.path.join(a_dir, name))]
+        return sorted(name for name in os.listdir(a_dir)
+                      if os.path.isdir(os.path.join(a_dir, name)))
+
+
+def aggregate_subject_dir(name, params, paths_dict, subject_dir):
+    """Runs the default subject aggregation of the profiler called name on subject_dir, in a process of the
+    aggregation pool"""
+    for key, value in paths_dict.items():
+        setattr(paths, key, value)
+    # The handler is kept as pluginbase clears the plugin module once its plugin source is garbage collected
+    handler = PluginHandler(name, params)
+    handler.currentProfiler.set_output(subject_dir)
+    handler.currentProfiler.aggregate_subject()
@@ -0,0 +1,96 @@
+""" Writers for the samples of the profilers, selected with the result_format option of a profiler.
+
+csv  Text, the default.
+npz  Compressed NumPy archive with an array per column; a column is only decompressed when it is accessed.
+npy  Uncompressed NumPy structured array (a field per column) that is read back memory-mapped, so the columns are
+     views on the file and are only paged in as far as they are used.
+
+The column names of the npz and npy files are made unique the way pandas does for csv files ('Time', 'Time.1',
+...), so the aggregation sees the same columns whichever format is used.
+"""
+import csv
+import os.path as op
+from collections import OrderedDict
+
+import numpy as np
+import pandas as pd
+
+RESULT_FORMATS = ['csv', 'npz', 'npy']
+EXTENSIONS = {'csv': '.csv', 'npz': '.npz', 'npy': '.npy'}
+
+
+def result_path(path, result_format):
+    """Returns the path of the result file for the csv file path, with the extension of result_format"""
+    if result_format == 'csv':
+        return path
+    return op.splitext(path)[0] + EXTENSIONS[result_format]
+
+
+def write_results(path, rows, result_format='csv'):
+    """Writes rows, of which the first is the header, to path in result_format and returns the path written.
+    For formats other than csv the extension of path is replaced by that of the format."""
+    path = result_path(path, result_format)
+    if result_format == 'csv':
+        with open(path, 'w') as f:
+            writer = csv.writer(f)
+            writer.writerows(rows)
+        return path
+    rows = list(rows)
+    header = unique_names(rows[0]) if rows else []
+    columns = list(zip(*rows[1:])) if len(rows) > 1 else [()] * len(header)
+    arrays = [to_array(column) for column in columns]
+    if result_format == 'npz':
+        np.savez_compressed(path, columns=np.array(header, dtype=str),
+                            **{'c{}'.format(i): array for i, array in enumerate(arrays)})
+    else:
+        table = np.empty(len(rows) - 1 if rows else 0,
+                         dtype=[(name, array.dtype) for name, array in zip(header, arrays)])
+        for name, array in zip(header, arrays):
+            table[name] = array
+        np.save(path, table)
+    return path
+
+
+def read_results(path):
+    """Returns the columns of a result file as an OrderedDict of column name -> array, memory-mapped for npy"""
+    extension = op.splitext(path)[1]
+    if extension == EXTENSIONS['npz']:
+        with np.load(path) as archive:
+            return OrderedDict((str(name), archive['c{}'.format(i)]) for i, name in enumerate(archive['columns']))
+    if extension == EXTENSIONS['npy']:
+        table = np.load(path, mmap_mode='r')
+        return OrderedDict((name, table[name]) for name in table.dtype.names)
+    frame = pd.read_csv(path, float_precision='round_trip')
+    return OrderedDict((column, frame[column].to_numpy()) for column in frame.columns)
+
+
+def unique_names(header):
+    names = []
+    seen = {}
+    for name in header:
+        name = str(name)
+        if name in seen:
+            seen[name] += 1
+            name = '{}.{}'.format(name, seen[name])
+        else:
+            seen[name] = 0
+        names.append(name)
+    return names
+
+
+def to_array(values):
+    """Turns a column of values into an int, float, bool or (when all else fails) string array. Empty strings in
+    a numeric column become NaN."""
+    array = np.asarray(values)
+    if array.dtype.kind == 'O':
+        array = array.astype(str)
+    if array.dtype.kind not in 'US':
+        return array
+    try:
+        return array.astype(np.int64)
+    except ValueError:
+        pass
+    try:
+        return np.where(np.char.strip(array) == '', 'nan', array).astype(float)
+    except ValueError:
+        return array
@@ -0,0 +1,85 @@
+import logging
+import threading
+import time
+
+
+class Sampler(object):
+    """ Calls sample(*args) every interval seconds in a single long-lived thread, for profilers that poll the device.
+
+    The deadlines are kept on the monotonic clock: sample n is due at start + n * interval, so the time the samples
+    take does not make the interval drift. A sample that starts after its deadline is an overrun. When a sample
+    took so long that whole intervals passed, the samples of those intervals are skipped and counted as missed
+    instead of being taken back to back. With an interval of 0 the samples are taken one after the other.
+
+    An exception raised by sample stops the sampler, it is logged and kept in error.
+
+    Usage in a profiler:
+        self.sampler = Sampler(self.interval, self.get_data, args=(device, app), name='android')
+        self.sampler.start()
+        ...
+        self.sampler.stop()
+    """
+
+    def __init__(self, interval, sample, args=(), name=None):
+        self.logger = logging.getLogger(self.__class__.__name__)
+        self.interval = interval
+        self.sample = sample
+        self.args = args
+        self.name = name or getattr(sample, '__name__', 'sampler')
+        self.stopped = threading.Event()
+        self.thread = None
+        self.error = None
+        self.samples = 0
+        self.overruns = 0
+        self.missed = 0
+        self.max_overrun = 0.0
+
+    def start(self):
+        self.stopped.clear()
+        self.thread = threading.Thread(target=self.run, name='sampler-%s' % self.name, daemon=True)
+        self.thread.start()
+
+    def stop(self, timeout=None):
+        """Stops sampling and waits until the sample that is being taken is done"""
+        self.stopped.set()
+        if self.thread is not None and self.thread is not threading.current_thread():
+            self.thread.join(timeout)
+        if self.missed:
+            self.logger.warning('%s: %s samples were missed, %s of %s samples were late (at most %.3fs). '
+                                'The sample interval of %ss is too short.'
+                                % (self.name, self.missed, self.overruns, self.samples, self.max_overrun,
+                                   self.interval))
+        else:
+            self.logger.debug('%s: %s samples, %s late (at most %.3fs)'
+                              % (self.name, self.samples, self.overruns, self.max_overrun))
+
+    def is_running(self):
+        return self.thread is not None and self.thread.is_alive()
+
+    def stats(self):
+        """Returns the number of samples taken, late and missed and the largest delay of a sample in seconds"""
+        return {'samples': self.samples, 'overruns': self.overruns, 'missed': self.missed,
+                'max_overrun': self.max_overrun}
+
+    def run(self):
+        deadline = time.monotonic()
+        while not self.stopped.is_set():
+            try:
+                self.sample(*self.args)
+            except Exception as e:
+                self.error = e
+                self.logger.error('%s: sampling stopped: %s' % (self.name, e))
+                break
+            self.samples += 1
+            if self.interval <= 0:
+                continue
+            deadline += self.interval
+            late = time.monotonic() - deadline
+            if late > 0:
+                self.overruns += 1
+                self.max_overrun = max(self.max_overrun, late)
+                # Skip the samples of the intervals that passed completely, take the current one right away
+                skipped = int(late // self.interval)
+                self.missed += skipped
+                deadline += skipped * self.interval
+            self.stopped.wait(max(0.0, deadline - time.monotonic()))
@@ -1 +1,3 @@
 from .Profiler import Profiler
+from .Sampler import Sampler
+from .ResultWriter import RESULT_FORMATS, read_results, write_results
@@ -1,18 +1,23 @@
-import csv
 import os
 import os.path as op
 import threading
 import time
-import timeit
 from collections import OrderedDict
-from functools import reduce
 
+from AndroidRunner import Aggregation
 from AndroidRunner import util
 from AndroidRunner import Tests
 from AndroidRunner.Plugins.Profiler import Profiler
+from AndroidRunner.Plugins.ResultWriter import RESULT_FORMATS, write_results
+from AndroidRunner.Plugins.Sampler import Sampler
 
 
 class Android(Profiler):
+    SAMPLING_MODES = ['host', 'device']
+    # Location of the sampling loop and its output on the device when sampling is done on the device
+    DEVICE_SAMPLER = '/data/local/tmp/android_runner_sampler.sh'
+    DEVICE_SAMPLES = '/data/local/tmp/android_runner_samples.txt'
+
     def __init__(self, config, paths):
         super(Android, self).__init__(config, paths)
         self.output_dir = ''
@@ -32,17 +37,27 @@ class Android(Profiler):
                             if dp in set(available_data_points)]
         self.data = [['datetime'] + self.data_points]
         self.lock = threading.Lock()
+        # With 'device' sampling a shell loop on the device takes the samples, see sampler.sh
+        self.sampling = Tests.is_valid_option(config.get('sampling', 'host'), self.SAMPLING_MODES)
+        self.sampler_pid = None
+        self.sampler = None
+        self.app = None
+        self.result_format = Tests.is_valid_option(config.get('result_format', 'csv'), RESULT_FORMATS)
 
     @staticmethod
     def get_cpu_usage(device):
         """Get CPU usage in percentage"""
         # return device.shell('dumpsys cpuinfo | grep TOTAL | cut -d" " -f1').strip()[:-1]
-        shell_result = device.shell('dumpsys cpuinfo | grep TOTAL')
+        return Android.parse_cpu_usage(device.shell('dumpsys cpuinfo | grep TOTAL'))
+        # return device.shell('dumpsys cpuinfo | grep TOTAL').split('%')[0]
+
+    @staticmethod
+    def parse_cpu_usage(shell_result):
+        """Get CPU usage in percentage from the TOTAL line of dumpsys cpuinfo"""
         shell_splitted = shell_result.split('%')[0]
         if '.-' in shell_splitted:
             shell_splitted = shell_splitted.replace('.-', '.')
         return shell_splitted
-        # return device.shell('dumpsys cpuinfo | grep TOTAL').split('%')[0]
 
     @staticmethod
     def get_mem_usage(device, app):
@@ -50,55 +65,109 @@ class Android(Profiler):
         if not app:
             # return device.shell('dumpsys meminfo | grep Used | cut -d" " -f5').strip()[1:-1]
             # return device.shell('dumpsys meminfo | grep Used').split()[2].strip()[1:-1].replace(",", ".")
-            # https://stackoverflow.com/questions/23175809/str-translate-gives-typeerror-translate-takes-one-argument-2-given-worked-i
-            return device.shell('dumpsys meminfo | grep Used').translate(str.maketrans('', '', '(kB,K')).split()[2]
+            return Android.parse_mem_usage(device.shell('dumpsys meminfo | grep Used'), app)
         else:
             result = device.shell(
                 'dumpsys meminfo {} | grep TOTAL'.format(app))
             if result == '':
                 result = device.shell('dumpsys meminfo {}'.format(app))
-                if 'No process found' in result:
-                    raise Exception('Android Profiler: {}'.format(result))
-            return ' '.join(result.strip().split()).split()[1]
+            return Android.parse_mem_usage(result, app)
+
+    @staticmethod
+    def parse_mem_usage(shell_result, app):
+        """Get memory usage in KB from the Used line of dumpsys meminfo, or from the TOTAL line of dumpsys meminfo
+        of app"""
+        if not app:
+            # https://stackoverflow.com/questions/23175809/str-translate-gives-typeerror-translate-takes-one-argument-2-given-worked-i
+            return shell_result.translate(str.maketrans('', '', '(kB,K')).split()[2]
+        if 'No process found' in shell_result:
+            raise Exception('Android Profiler: {}'.format(shell_result))
+        return ' '.join(shell_result.strip().split()).split()[1]
 
     def start_profiling(self, device, **kwargs):
         self.profile = True
         self.data = [['datetime'] + self.data_points]
         app = kwargs.get('app', None)
-        self.get_data(device, app)
+        if self.sampling == 'device':
+            self.start_device_sampler(device, app)
+        else:
+            self.sampler = Sampler(self.interval, self.get_data, args=(device, app),
+                                   name='android-{}'.format(device.id))
+            self.sampler.start()
+
+    def start_device_sampler(self, device, app):
+        """Starts the sampling loop on the device in the background, its output is read by collect_results"""
+        self.app = app
+        args = ['%d' % round(self.interval * 1000), ','.join(self.data_points)] + ([app] if app else [])
+        self.sampler_pid = device.shell('nohup sh {} {} > {} 2> /dev/null < /dev/null & echo $!'.format(
+            self.DEVICE_SAMPLER, ' '.join(args), self.DEVICE_SAMPLES)).strip()
 
     def get_data(self, device, app):
-        """Runs the profiling methods every self.interval seconds in a separate thread"""
-        self.lock.acquire()
-        if not self.profile:
-            self.lock.release()
-            return
-        start = timeit.default_timer()
-        device_time = device.shell('date -u')
-        row = [device_time]
-        if 'cpu' in self.data_points:
-            row.append(self.get_cpu_usage(device))
-        if 'mem' in self.data_points:
-            row.append(self.get_mem_usage(device, app))
-        self.data.append(row)
-        end = timeit.default_timer()
-        # timer results could be negative
-        interval = max(float(0), self.interval - max(0, int(end - start)))
-        self.lock.release()
-        threading.Timer(interval, self.get_data, args=(device, app)).start()
+        """Takes a sample of the data points, called every self.interval seconds by the sampler thread"""
+        with self.lock:
+            if not self.profile:
+                return
+            device_time = device.shell('date -u')
+            row = [device_time]
+            if 'cpu' in self.data_points:
+                row.append(self.get_cpu_usage(device))
+            if 'mem' in self.data_points:
+                row.append(self.get_mem_usage(device, app))
+            self.data.append(row)
 
     def stop_profiling(self, device, **kwargs):
-        self.lock.acquire()
-        self.profile = False
-        self.lock.release()
+        with self.lock:
+            self.profile = False
+        if self.sampler:
+            self.sampler.stop()
+            self.sampler = None
+        if self.sampler_pid:
+            device.shell('kill {}'.format(self.sampler_pid))
+            self.sampler_pid = None
 
     def collect_results(self, device):
         filename = '{}_{}.csv'.format(
             device.id, time.strftime('%Y.%m.%d_%H%M%S'))
-        with open(op.join(self.output_dir, filename), 'w+') as f:
-            writer = csv.writer(f)
-            for row in self.data:
-                writer.writerow(row)
+        if self.sampling == 'device':
+            self.data += self.pull_device_samples(device)
+        write_results(op.join(self.output_dir, filename), self.data, self.result_format)
+
+    def pull_device_samples(self, device):
+        """Pulls the output of the sampling loop from the device and returns its rows"""
+        samples_file = op.join(self.output_dir, 'samples_{}.txt'.format(device.id))
+        device.pull(self.DEVICE_SAMPLES, samples_file)
+        device.shell('rm -f {}'.format(self.DEVICE_SAMPLES))
+        try:
+            with open(samples_file, 'r') as samples:
+                return self.parse_device_samples(samples, self.app)
+        finally:
+            os.remove(samples_file)
+
+    def parse_device_samples(self, lines, app):
+        """Turns the output of the sampling loop into rows, samples that are incomplete because the loop was
+        stopped while taking them, or that failed, are left out"""
+        rows = []
+        row = None
+        for line in lines:
+            key, _, value = line.rstrip('\n').partition(' ')
+            if key == 'sample':
+                row = {'datetime': value}
+            elif row is not None and key in self.data_points:
+                try:
+                    if key == 'cpu':
+                        row[key] = self.parse_cpu_usage(value)
+                    else:
+                        row[key] = self.parse_mem_usage(value, app)
+                except Exception as e:
+                    self.logger.warning('Skipped sample of {}: {}'.format(row['datetime'], e))
+                    row = None
+                    continue
+            else:
+                continue
+            if len(row) == len(self.data_points) + 1:
+                rows.append([row['datetime']] + [row[dp] for dp in self.data_points])
+                row = None
+        return rows
 
     def set_output(self, output_dir):
         self.output_dir = output_dir
@@ -107,10 +176,12 @@ class Android(Profiler):
         return []
 
     def load(self, device):
-        return
+        if self.sampling == 'device':
+            device.push(op.join(op.dirname(op.realpath(__file__)), 'sampler.sh'), self.DEVICE_SAMPLER)
 
     def unload(self, device):
-        return
+        if self.sampling == 'device':
+            device.shell('rm -f {}'.format(self.DEVICE_SAMPLER))
 
     def aggregate_subject(self):
         filename = os.path.join(self.output_dir, 'Aggregated.csv')
@@ -126,56 +197,13 @@ class Android(Profiler):
 
     @staticmethod
     def aggregate_android_subject(logs_dir):
-        def add_row(accum, new):
-            row = {k: v + float(new[k]) for k, v in list(accum.items())
-                   if k not in ['Component', 'count']}
-            count = accum['count'] + 1
-            return dict(row, **{'count': count})
-
-        runs = []
-        for run_file in [f for f in os.listdir(logs_dir) if os.path.isfile(os.path.join(logs_dir, f))]:
-            with open(os.path.join(logs_dir, run_file), 'r') as run:
-                reader = csv.DictReader(run)
-                init = dict(
-                    {fn: 0 for fn in reader.fieldnames if fn != 'datetime'}, **{'count': 0})
-                run_total = reduce(add_row, reader, init)
-                runs.append(
-                    {k: v / run_total['count'] for k, v in list(run_total.items()) if k != 'count'})
-        runs_total = reduce(
-            lambda x, y: {k: v + y[k] for k, v in list(x.items())}, runs)
+        runs = Aggregation.run_means(logs_dir, usecols=lambda column: column != 'datetime')
         return OrderedDict(
-            sorted(list({'android_' + k: v / len(runs) for k, v in list(runs_total.items())}.items()), key=lambda x: x[0]))
+            sorted([('android_' + k, v) for k, v in Aggregation.mean_of_runs(runs).items()], key=lambda x: x[0]))
 
     def aggregate_final(self, data_dir):
-        rows = []
-        for device in util.list_subdir(data_dir):
-            row = OrderedDict({'device': device})
-            device_dir = os.path.join(data_dir, device)
-            for subject in util.list_subdir(device_dir):
-                row.update({'subject': subject})
-                subject_dir = os.path.join(device_dir, subject)
-                if os.path.isdir(os.path.join(subject_dir, 'android')):
-                    row.update(self.aggregate_android_final(
-                        os.path.join(subject_dir, 'android')))
-                    rows.append(row.copy())
-                else:
-                    for browser in util.list_subdir(subject_dir):
-                        row.update({'browser': browser})
-                        browser_dir = os.path.join(subject_dir, browser)
-                        if os.path.isdir(os.path.join(browser_dir, 'android')):
-                            row.update(self.aggregate_android_final(
-                                os.path.join(browser_dir, 'android')))
-                            rows.append(row.copy())
-        return rows
+        return Aggregation.aggregate_final(data_dir, 'android', self.aggregate_android_final)
 
     @staticmethod
     def aggregate_android_final(logs_dir):
-        for aggregated_file in [f for f in os.listdir(logs_dir) if os.path.isfile(os.path.join(logs_dir, f))]:
-            if aggregated_file == "Aggregated.csv":
-                with open(os.path.join(logs_dir, aggregated_file), 'r') as aggregated:
-                    reader = csv.DictReader(aggregated)
-                    row_dict = OrderedDict()
-                    for row in reader:
-                        for f in reader.fieldnames:
-                            row_dict.update({f: row[f]})
-                    return OrderedDict(row_dict)
\ No newline at end of file
+        return Aggregation.read_aggregated(logs_dir)
@@ -0,0 +1,56 @@
+# Samples the cpu and memory usage on the device until it is killed, used by the Android profiler when
+# "sampling" is "device".
+# Usage: sh sampler.sh <interval in milliseconds> <comma separated data points> [app]
+# Every sample is a 'sample' line with the UTC device time in milliseconds followed by a line per data point with
+# the raw dumpsys output, the profiler parses them when the results are collected.
+# Sample n is due at n * interval after the start on the monotonic clock of /proc/uptime, so the time dumpsys takes
+# does not add to the interval. When a sample took longer than the interval the missed samples are skipped.
+interval=$1
+data_points=",$2,"
+app=$3
+
+# Sets elapsed to the milliseconds since the start of the loop (the arithmetic of the shell may be 32 bit)
+elapsed_ms() {
+    read uptime idle < /proc/uptime
+    seconds=${uptime%.*}
+    hundredths=${uptime#*.}
+    elapsed=$(( (seconds - start) * 1000 + 1$hundredths * 10 - 1000 ))
+}
+
+# Sets timestamp to the UTC time, with milliseconds when date supports %N
+timestamp_ms() {
+    set -- $(date -u '+%Y-%m-%d %H:%M:%S %N')
+    case $3 in
+        [0-9][0-9][0-9][0-9][0-9][0-9][0-9][0-9][0-9]) timestamp="$1 $2.${3%??????}" ;;
+        *) timestamp="$1 $2.000" ;;
+    esac
+}
+
+read uptime idle < /proc/uptime
+start=${uptime%.*}
+elapsed_ms
+next=$elapsed
+while true; do
+    timestamp_ms
+    echo "sample $timestamp"
+    case $data_points in *,cpu,*)
+        echo "cpu $(dumpsys cpuinfo | grep TOTAL | head -n 1)" ;;
+    esac
+    case $data_points in *,mem,*)
+        if [ -z "$app" ]; then
+            echo "mem $(dumpsys meminfo | grep Used | head -n 1)"
+        else
+            echo "mem $(dumpsys meminfo $app | grep -e TOTAL -e 'No process found' | head -n 1)"
+        fi ;;
+    esac
+    [ "$interval" -gt 0 ] || continue
+    next=$(( next + interval ))
+    elapsed_ms
+    if [ $elapsed -lt $next ]; then
+        remaining=$(( next - elapsed ))
+        fraction=$(( 1000 + remaining % 1000 ))
+        sleep $(( remaining / 1000 )).${fraction#1}
+    else
+        next=$(( next + (elapsed - next) / interval * interval ))
+    fi
+done
@@ -1,4 +1,3 @@
-import csv
 import numpy as np
 import os.path as op
 import os
@@ -6,7 +5,9 @@ import pandas as pd
 import time
 import re
 
+from AndroidRunner import Tests
 from AndroidRunner.Plugins.Profiler import Profiler
+from AndroidRunner.Plugins.ResultWriter import EXTENSIONS, RESULT_FORMATS, read_results, write_results
 
 
 class Batterymanager(Profiler):
@@ -48,6 +49,8 @@ class Batterymanager(Profiler):
                                                          config['persistency_strategy'],
                                                          Batterymanager.AVAILABLE_PERSISTENCY_STRATEGIES)
 
+        self.result_format = Tests.is_valid_option(config.get('result_format', 'csv'), valid_options=RESULT_FORMATS)
+
     def validate_config(self, field, raw_data_points, available_data_points):
         invalid_data_points = [
             dp for dp in raw_data_points if dp not in set(available_data_points)]
@@ -100,7 +103,7 @@ class Batterymanager(Profiler):
         From Android 11 (API level 30) the path /mnt/sdcard cannot be accessed via ADB
         as you don't have permissions to access this path. However, we can access /sdcard.
         """
-        device_api_version = int(device.shell("getprop ro.build.version.sdk"))
+        device_api_version = int(device.get_api_level())
 
         if device_api_version >= Batterymanager.ANDROID_VERSION_11_API_LEVEL_30:
             logcat_output_file_device_dir_path = "/sdcard"
@@ -143,11 +146,7 @@ class Batterymanager(Profiler):
         logcat_csv_file = op.join(self.output_dir,
                                   'logcat_{}_{}.csv'.format(device.id, time.strftime('%Y.%m.%d_%H%M%S')))
 
-        with open(logcat_csv_file, 'w') as lc_csv_file:
-            csv_writer = csv.writer(lc_csv_file)
-            csv_writer.writerow(header)
-            for row in rows:
-                csv_writer.writerow(row)
+        write_results(logcat_csv_file, [header] + rows, self.result_format)
 
     def unload(self, device):
         return
@@ -193,9 +192,12 @@ class Batterymanager(Profiler):
         run_number = 0
         for run_file in [f for f in os.listdir(logs_dir) if os.path.isfile(os.path.join(logs_dir, f))]:
             f_name = os.path.join(logs_dir, run_file)
-            if not f_name.endswith(".csv"):
+            if f_name.endswith(".csv"):
+                run_df = pd.read_csv(f_name)
+            elif f_name.endswith((EXTENSIONS['npz'], EXTENSIONS['npy'])):
+                run_df = pd.DataFrame(read_results(f_name))
+            else:
                 continue
-            run_df = pd.read_csv(f_name)
 
             stats = {}
             if 'BATTERY_PROPERTY_CURRENT_NOW' in run_df.columns and 'EXTRA_VOLTAGE' in run_df.columns:
@@ -10,7 +10,7 @@ from collections import OrderedDict
 from AndroidRunner.Plugins.batterystats import BatterystatsParser
 from AndroidRunner.BrowserFactory import BrowserFactory
 from AndroidRunner.Plugins.Profiler import Profiler
-from functools import reduce
+from AndroidRunner import Aggregation
 from AndroidRunner import Tests
 from AndroidRunner import util
 
@@ -25,6 +25,7 @@ class Batterystats(Profiler):
         self.cleanup = config.get('cleanup')
         self.enable_systrace_parsing = config.get('enable_systrace_parsing', True)
         self.python2_path = config.get('python2_path', 'python2')
+        self.systrace_parsing_processes = Tests.is_integer(config.get('systrace_parsing_processes', 1))
 
         # "config" only passes the fields under "profilers", so config.json is loaded again for the fields below
         # FIX
@@ -97,7 +98,7 @@ class Batterystats(Profiler):
         From Android 11 (API level 30) the path /mnt/sdcard cannot be accessed via ADB
         as you don't have permissions to access this path. However, we can access /sdcard.
         """
-        device_api_version = int(device.shell("getprop ro.build.version.sdk"))
+        device_api_version = int(device.get_api_level())
 
         if device_api_version >= Batterystats.ANDROID_VERSION_11_API_LEVEL_30:
             logcat_output_file_device_dir_path = "/sdcard"
@@ -118,8 +119,10 @@ class Batterystats(Profiler):
     # Estimate total consumption, charge is given in mAh, volt in mV
     @staticmethod
     def get_consumed_joules(device):
-        charge = device.shell('dumpsys batterystats | grep "Computed drain:"').split(',')[1].split(':')[1]
-        volt = device.shell('dumpsys batterystats | grep "volt="').split('volt=')[1].split()[0]
+        charge, volt = device.batch(['dumpsys batterystats | grep "Computed drain:"',
+                                     'dumpsys batterystats | grep "volt="'], check=True)
+        charge = charge.output.split(',')[1].split(':')[1]
+        volt = volt.output.split('volt=')[1].split()[0]
         energy_consumed_wh = float(charge) * float(volt) / 1000000.0
         energy_consumed_j = energy_consumed_wh * 3600.0
         return energy_consumed_j
@@ -136,9 +139,10 @@ class Batterystats(Profiler):
 
         systrace_results = []
         if self.enable_systrace_parsing: 
-            device_api_version = int(device.shell("getprop ro.build.version.sdk"))
+            device_api_version = int(device.get_api_level())
             systrace_results = BatterystatsParser.parse_systrace(app, systrace_file, logcat_file, batterystats_file, \
-                                                                self.powerprofile, cores, device_api_version)
+                                                                self.powerprofile, cores, device_api_version,
+                                                                processes=self.systrace_parsing_processes)
         return systrace_results
 
     def write_results(self, batterystats_results, systrace_results, energy_consumed_j):
@@ -197,53 +201,16 @@ class Batterystats(Profiler):
 
     @staticmethod
     def aggregate_battery_subject(logs_dir, joules):
-        def add_row(accum, new):
-            row = {k: v + float(new[k]) for k, v in list(accum.items()) if k not in ['Component', 'count']}
-            count = accum['count'] + 1
-            return dict(row, **{'count': count})
-
-        # FIX
-        runs = []
-        runs_total = dict()
-        for run_file in [f for f in os.listdir(logs_dir) if os.path.isfile(os.path.join(logs_dir, f))]:
-            if ('Joule' in run_file) and joules:
-                with open(os.path.join(logs_dir, run_file), 'r', encoding='utf-8') as run:
-                    reader = csv.DictReader(run)
-                    init = dict({fn: 0 for fn in reader.fieldnames if fn != 'datetime'}, **{'count': 0})
-                    run_total = reduce(add_row, reader, init)
-                    runs.append({k: v / run_total['count'] for k, v in list(run_total.items()) if k != 'count'})
-                runs_total = reduce(lambda x, y: {k: v + y[k] for k, v in list(x.items())}, runs)
+        if not joules:
+            return OrderedDict()
+        runs = Aggregation.run_means(logs_dir, usecols=lambda column: column != 'datetime',
+                                     condition=lambda f: 'Joule' in f)
         return OrderedDict(
-            sorted(list({'batterystats_' + k: v / len(runs) for k, v in list(runs_total.items())}.items()), key=lambda x: x[0]))
+            sorted([('batterystats_' + k, v) for k, v in Aggregation.mean_of_runs(runs).items()], key=lambda x: x[0]))
 
     def aggregate_final(self, data_dir):
-        rows = []
-        for device in util.list_subdir(data_dir):
-            row = OrderedDict({'device': device})
-            device_dir = os.path.join(data_dir, device)
-            for subject in util.list_subdir(device_dir):
-                row.update({'subject': subject})
-                subject_dir = os.path.join(device_dir, subject)
-                if os.path.isdir(os.path.join(subject_dir, 'batterystats')):
-                    row.update(self.aggregate_battery_final(os.path.join(subject_dir, 'batterystats')))
-                    rows.append(row.copy())
-                else:
-                    for browser in util.list_subdir(subject_dir):
-                        row.update({'browser': browser})
-                        browser_dir = os.path.join(subject_dir, browser)
-                        if os.path.isdir(os.path.join(browser_dir, 'batterystats')):
-                            row.update(self.aggregate_battery_final(os.path.join(browser_dir, 'batterystats')))
-                            rows.append(row.copy())
-        return rows
+        return Aggregation.aggregate_final(data_dir, 'batterystats', self.aggregate_battery_final)
 
     @staticmethod
     def aggregate_battery_final(logs_dir):
-        for aggregated_file in [f for f in os.listdir(logs_dir) if os.path.isfile(os.path.join(logs_dir, f))]:
-            if aggregated_file == "Aggregated.csv":
-                with open(os.path.join(logs_dir, aggregated_file), 'r', encoding='utf-8') as aggregated:
-                    reader = csv.DictReader(aggregated)
-                    row_dict = OrderedDict()
-                    for row in reader:
-                        for f in reader.fieldnames:
-                            row_dict.update({f: row[f]})
-                    return OrderedDict(row_dict)
+        return Aggregation.read_aggregated(logs_dir)
@@ -1,7 +1,11 @@
 from xml.dom import minidom
+import multiprocessing
+import os
 import re
+import threading
 import time as t
 import datetime as dt
+from collections import namedtuple
 
 SECONDS_IN_MS = 1000.0
 SECONDS_IN_M = 60.0
@@ -13,243 +17,337 @@ ANDROID_API_VERSION_28 = 28
 Power Profile
 '''
 
-
-def get_amp_value(power_profile, component, state=''):
+# Names used by the parsers that differ from the item names in power_profile.xml
+COMPONENT_NAMES = {'camera': 'camera.avg',
+                   'flashlight': 'flashlight.on',
+                   'gps': 'gps.on',
+                   'audio': 'dsp.audio',
+                   'video': 'dsp.video',
+                   'bluetooth': 'bluetooth.on',
+                   'phone_scanning': 'radio.scanning'}
+
+
+class PowerProfile(object):
+    """ The values of a power_profile.xml file, parsed once into lookup tables.
+
+    Items are kept by name and arrays as lists of strings. For every cpu.speeds array (cpu.speeds for a single
+    cluster, cpu.speeds.clusterN for devices with several clusters) the index of each speed is kept, so the
+    current of a cpu frequency is a pair of dictionary lookups.
+    """
+
+    def __init__(self, power_profile):
+        xmlfile = minidom.parse(power_profile)
+        self.items = {}
+        for item in xmlfile.getElementsByTagName('item'):
+            # Keep the first item with a name, that is the one the linear search used to find
+            self.items.setdefault(item.attributes['name'].value,
+                                  item.childNodes[0].nodeValue if item.childNodes else '')
+        self.arrays = {}
+        for array in xmlfile.getElementsByTagName('array'):
+            self.arrays.setdefault(array.attributes['name'].value,
+                                   [value.childNodes[0].nodeValue for value in array.getElementsByTagName('value')])
+        self.speed_indexes = {}
+        for name, values in self.arrays.items():
+            if name == 'cpu.speeds' or name.startswith('cpu.speeds.cluster'):
+                # The last index wins when a speed is listed twice, like the linear search did
+                self.speed_indexes[name] = {speed: i for i, speed in enumerate(values)}
+        # First core of every cluster, cpu.clusters.cores lists the number of cores per cluster
+        self.cluster_first_cores = []
+        first_core = 0
+        for cores in self.arrays.get('cpu.clusters.cores', []):
+            self.cluster_first_cores.append(first_core)
+            first_core += int(cores)
+
+    def cluster_of(self, core):
+        """Returns the cluster core belongs to, 0 when the profile does not describe the clusters"""
+        cluster = 0
+        for i, first_core in enumerate(self.cluster_first_cores):
+            if core >= first_core:
+                cluster = i
+        return cluster
+
+    def cpu_active(self, state='', core=None):
+        """Returns the current in mA of a core running at frequency state. Unknown frequencies fall back to
+        the lowest frequency. Profiles with clusters use the cluster of core, or the first cluster."""
+        if 'cpu.active' in self.arrays:
+            suffix = ''
+        else:
+            suffix = '.cluster%d' % (self.cluster_of(core) if core is not None else 0)
+            if 'cpu.active' + suffix not in self.arrays:
+                return None
+        index = self.speed_indexes.get('cpu.speeds' + suffix, {}).get(state, 0)
+        return float(self.arrays['cpu.active' + suffix][index])
+
+    def amps(self, component, state='', core=None):
+        """ Returns the current of component in A, None when the profile does not list it """
+        profilename = COMPONENT_NAMES.get(component, component)
+        if profilename in self.items:
+            return float(self.items[profilename]) / 1000.0
+        milliamps = self.cpu_active(state, core)
+        if milliamps is None:
+            return None
+        return milliamps / 1000.0
+
+
+power_profiles = {}
+power_profiles_lock = threading.Lock()
+
+
+def get_power_profile(power_profile):
+    """ Returns the parsed profile of the power_profile.xml file at the given path.
+
+    The profile is parsed once and shared by all runs, it is parsed again when the file was modified.
+    PowerProfile objects are returned as is.
+    """
+    if isinstance(power_profile, PowerProfile):
+        return power_profile
+    key = (os.path.abspath(power_profile), os.path.getmtime(power_profile))
+    with power_profiles_lock:
+        if key not in power_profiles:
+            power_profiles[key] = PowerProfile(power_profile)
+        return power_profiles[key]
+
+
+def get_amp_value(power_profile, component, state='', core=None):
     """ Retrieve mAh for component in power_profile.xml and convert to Ah """
-    if component == 'camera':
-        profilename = 'camera.avg'
-    elif component == 'flashlight':
-        profilename = 'flashlight.on'
-    elif component == 'gps':
-        profilename = 'gps.on'
-    elif component == 'audio':
-        profilename = 'dsp.audio'
-    elif component == 'video':
-        profilename = 'dsp.video'
-    elif component == 'bluetooth':
-        profilename = 'bluetooth.on'
-    elif component == 'phone_scanning':
-        profilename = 'radio.scanning'
-    else:
-        profilename = component
-    xmlfile = minidom.parse(power_profile)
-    itemlist = xmlfile.getElementsByTagName('item')
-    arraylist = xmlfile.getElementsByTagName('array')
-    value_index = 0
-    for item in itemlist:
-        itemname = item.attributes['name'].value
-        milliamps = item.childNodes[0].nodeValue
-        if profilename == itemname:
-            return float(milliamps) / 1000.0
-    for arrays in arraylist:
-        arrayname = arrays.attributes['name'].value
-        if arrayname == 'cpu.speeds':
-            valuelist = arrays.getElementsByTagName('value')
-            for i in range(valuelist.length):
-                value = valuelist.item(i).childNodes[0].nodeValue
-                if value == state:
-                    value_index = i
-        if arrayname == 'cpu.active':
-            valuelist = arrays.getElementsByTagName('value')
-            milliamps = valuelist.item(value_index).childNodes[0].nodeValue
-            return float(milliamps) / 1000.0
+    return get_power_profile(power_profile).amps(component, state, core)
 
 
 '''
 Batterystats
 '''
 
+HistoryEvent = namedtuple('HistoryEvent', ['time', 'flags', 'values'])
+
+COMPONENTS = ['camera', 'flashlight', 'gps', 'audio', 'video', 'bluetooth', 'phone_scanning']
+# The flags and values of a history line the parser uses, a flag is turned on with + and off with -
+HISTORY_TOKEN_PATTERN = re.compile(r'([+-])(screen|wifi_(running|radio|scan)|{})|'
+                                   r'brightness=(dark|dim|medium|light|bright)|volt=(\d+)'.format('|'.join(COMPONENTS)))
+HISTORY_TIME_PATTERN = re.compile(r'(0|\+\d.*ms).*')
+
+
+def parse_history_line(line):
+    """ Returns the event of a line of the batterystats history, None when the line has no timestamp.
+
+    When a flag or value occurs more than once in the line the last occurrence is kept, except for volt.
+    The wifi flag keeps the state (running, radio or scan) in values.
+    """
+    fields = line.split(None, 1)
+    timestamp = fields[0] if fields else ''
+    if timestamp != '0' and not (timestamp[:1] == '+' and timestamp[1:2].isdigit() and timestamp.endswith('ms')):
+        # Not a history line, use the first 0 or +...ms in the line like the history lines do
+        match = HISTORY_TIME_PATTERN.search(line)
+        if not match:
+            return None
+        timestamp = match.group(1)
+    flags = {}
+    values = {}
+    for match in HISTORY_TOKEN_PATTERN.finditer(line):
+        sign, flag, wifi_state, brightness, volt = match.groups()
+        if brightness is not None:
+            values['brightness'] = brightness
+        elif volt is not None:
+            if 'volt' not in values:
+                values['volt'] = volt
+        elif wifi_state is None:
+            flags[flag] = sign
+        else:
+            flags['wifi'] = sign
+            values['wifi'] = wifi_state
+    return HistoryEvent(convert_to_s(timestamp), flags, values)
 
-def parse_batterystats(app, batterystats_file, power_profile):
-    """ Parse Batterystats history and calculate results """
+
+def read_batterystats_history(app, batterystats_file):
+    """ Reads the batterystats history in a single pass.
+
+    Returns the events of the history lines and the times at which app was shown on top.
+    """
+    app_pattern = re.compile(r'(0|\+\d.*ms).*( top|-top|\+top).*"{}"'.format(app))
+    events = []
+    app_times = []
     with open(batterystats_file, 'r') as bs_file:
-        voltage_pattern = re.compile(r'(0|\+\d.*ms).*volt=(\d+)')
-        app_pattern = re.compile(r'(0|\+\d.*ms).*( top|-top|\+top).*"{}"'.format(app))
-        print(("Current app: "+str(format(app))))
-        screen_pattern = re.compile(r'(0|\+\d.*ms).*([+-])screen')
-        brightness_pattern = re.compile(r'(0|\+\d.*ms).*brightness=(dark|dim|medium|light|bright)')
-        wifi_pattern = re.compile(r'(0|\+\d.*ms).*([+-])wifi_(running|radio|scan)')
-        camera_pattern = re.compile(r'(0|\+\d.*ms).*([+-])(camera)')
-        flashlight_pattern = re.compile(r'(0|\+\d.*ms).*([+-])(flashlight)')
-        gps_pattern = re.compile(r'(0|\+\d.*ms).*([+-])(gps)')
-        audio_pattern = re.compile(r'(0|\+\d.*ms).*([+-])(audio)')
-        video_pattern = re.compile(r'(0|\+\d.*ms).*([+-])(video)')
-        bluetooth_pattern = re.compile(r'(0|\+\d.*ms).*([+-])(bluetooth)')
-        phone_scanning_pattern = re.compile(r'(0|\+\d.*ms).*([+-])(phone_scanning)')
-        time_pattern = re.compile(r'(0|\+\d.*ms).*')
-        f = bs_file.read()
-        app_start_time = convert_to_s(re.findall(app_pattern, f)[0][0])
-        app_end_time = convert_to_s(re.findall(app_pattern, f)[-1][0])
-        voltage = float(re.findall(voltage_pattern, f)[0][1]) / 1000.0
-
-        brightness = None
-        screen_start_time = 0
-        screen_activation = 0
-        wifi_activation = 0
-
-        screen_results = []
-        wifi_results = []
-        all_results = []
-
-        bs_file.seek(0)
         for line in bs_file:
-            time_pattern_match = time_pattern.search(line)
-            if not time_pattern_match:
+            event = parse_history_line(line)
+            if event is None:
                 continue
-            current_time = convert_to_s(time_pattern_match.group(1))
-
-            if voltage_pattern.search(line):
-                voltage = get_voltage(line)
-
-            if screen_activation == 0 and screen_pattern.search(line) and brightness_pattern.search(line):
-                screen_state = screen_pattern.search(line).group(2)
-                if screen_state == '+' and brightness is None:
-                    screen_activation = 1
-                    screen_start_time = current_time
-                    brightness = brightness_pattern.search(line).group(2)
-            elif screen_activation == 0 and screen_pattern.search(line):
-                screen_state = screen_pattern.search(line).group(2)
-                if screen_state == '+' and brightness is None:
-                    screen_activation = 1
-                    screen_start_time = app_start_time
-                    brightness = 'dark'
-            elif screen_activation == 1 and brightness_pattern.search(line):
-                if screen_start_time < app_start_time:
-                    screen_start_time = app_start_time
-                screen_end_time = current_time
-                duration = screen_end_time - screen_start_time
-                intensity = get_screen_intensity(brightness, power_profile)
-                energy_consumption = calculate_energy_usage(intensity, voltage, duration)
-                if screen_end_time >= app_start_time and duration != 0:
-                    screen_results.append('{},{},{},screen {},{}'.format(
-                        screen_start_time - app_start_time, screen_end_time - app_start_time,
-                        duration, brightness, energy_consumption))
-                brightness = brightness_pattern.search(line).group(2)
+            events.append(event)
+            if 'top' in line:
+                app_match = app_pattern.search(line)
+                if app_match:
+                    app_times.append(convert_to_s(app_match.group(1)))
+    return events, app_times
+
+
+def parse_batterystats(app, batterystats_file, power_profile):
+    """ Parse Batterystats history and calculate results """
+    power_profile = get_power_profile(power_profile)
+    print(("Current app: "+str(format(app))))
+    events, app_times = read_batterystats_history(app, batterystats_file)
+    app_start_time = app_times[0]
+    app_end_time = app_times[-1]
+    voltage = [float(event.values['volt']) / 1000.0 for event in events if 'volt' in event.values][0]
+
+    brightness = None
+    screen_start_time = 0
+    screen_activation = 0
+    wifi_activation = 0
+
+    screen_results = []
+    wifi_results = []
+    all_results = []
+
+    for event in events:
+        current_time = event.time
+        screen_state = event.flags.get('screen')
+        line_brightness = event.values.get('brightness')
+
+        if 'volt' in event.values:
+            voltage = float(event.values['volt']) / 1000.0
+
+        if screen_activation == 0 and screen_state and line_brightness:
+            if screen_state == '+' and brightness is None:
+                screen_activation = 1
                 screen_start_time = current_time
-            elif screen_activation == 1 and current_time >= app_end_time:
+                brightness = line_brightness
+        elif screen_activation == 0 and screen_state:
+            if screen_state == '+' and brightness is None:
+                screen_activation = 1
+                screen_start_time = app_start_time
+                brightness = 'dark'
+        elif screen_activation == 1 and line_brightness:
+            if screen_start_time < app_start_time:
+                screen_start_time = app_start_time
+            screen_end_time = current_time
+            duration = screen_end_time - screen_start_time
+            intensity = get_screen_intensity(brightness, power_profile)
+            energy_consumption = calculate_energy_usage(intensity, voltage, duration)
+            if screen_end_time >= app_start_time and duration != 0:
+                screen_results.append('{},{},{},screen {},{}'.format(
+                    screen_start_time - app_start_time, screen_end_time - app_start_time,
+                    duration, brightness, energy_consumption))
+            brightness = line_brightness
+            screen_start_time = current_time
+        elif screen_activation == 1 and current_time >= app_end_time:
+            screen_activation = 0
+            if screen_start_time < app_start_time:
+                screen_start_time = app_start_time
+            screen_end_time = app_end_time
+            duration = screen_end_time - screen_start_time
+            intensity = get_screen_intensity(brightness, power_profile)
+            energy_consumption = calculate_energy_usage(intensity, voltage, duration)
+            if screen_end_time >= app_start_time and duration != 0:
+                screen_results.append('{},{},{},screen {},{}'.format(
+                    screen_start_time - app_start_time, screen_end_time - app_start_time,
+                    duration, brightness, energy_consumption))
+        elif screen_activation == 1 and screen_state:
+            if screen_state == '-':
                 screen_activation = 0
                 if screen_start_time < app_start_time:
-                    screen_start_time = app_start_time
-                screen_end_time = app_end_time
+                    screen_start_time = 0
+                screen_end_time = current_time - app_start_time
                 duration = screen_end_time - screen_start_time
                 intensity = get_screen_intensity(brightness, power_profile)
                 energy_consumption = calculate_energy_usage(intensity, voltage, duration)
-                if screen_end_time >= app_start_time and duration != 0:
+                if screen_end_time >= app_start_time:
                     screen_results.append('{},{},{},screen {},{}'.format(
                         screen_start_time - app_start_time, screen_end_time - app_start_time,
                         duration, brightness, energy_consumption))
-            elif screen_activation == 1 and screen_pattern.search(line):
-                screen_state = screen_pattern.search(line).group(2)
-                if screen_state == '-':
-                    screen_activation = 0
-                    if screen_start_time < app_start_time:
-                        screen_start_time = 0
-                    screen_end_time = current_time - app_start_time
-                    duration = screen_end_time - screen_start_time
-                    intensity = get_screen_intensity(brightness, power_profile)
-                    energy_consumption = calculate_energy_usage(intensity, voltage, duration)
-                    if screen_end_time >= app_start_time:
-                        screen_results.append('{},{},{},screen {},{}'.format(
-                            screen_start_time - app_start_time, screen_end_time - app_start_time,
-                            duration, brightness, energy_consumption))
-
-            if wifi_pattern.search(line):
-                wifi_state = wifi_pattern.search(line).group(3)
-                if wifi_activation == 0 and wifi_pattern.search(line).group(2) == '+' and current_time < app_end_time:
-                    wifi_activation = 1
-                    old_wifi_state = wifi_state
-                    if current_time < app_start_time:
-                        wifi_start_time = app_start_time
-                    else:
-                        wifi_start_time = current_time
-                elif wifi_activation == 1 and wifi_state != old_wifi_state and \
-                        wifi_pattern.search(line).group(2) == '+':
-                    if old_wifi_state == 'running':
-                        wifi_intensity = get_amp_value(power_profile, 'wifi.on')
-                    if old_wifi_state == 'radio':
-                        wifi_intensity = get_amp_value(power_profile, 'wifi.active')
-                    if old_wifi_state == 'scan':
-                        wifi_intensity = get_amp_value(power_profile, 'wifi.scan')
-                    wifi_end_time = current_time
-                    duration = wifi_end_time - wifi_start_time
-                    if duration <= 0:
-                        continue
-                    energy_consumption = calculate_energy_usage(wifi_intensity, voltage, duration)
-                    wifi_results.append('{},{},{},wifi {},{}'.format(
-                        wifi_start_time - app_start_time, wifi_end_time - app_start_time, duration,
-                        old_wifi_state, energy_consumption))
-                    wifi_start_time = current_time
-                elif wifi_activation == 1 and wifi_pattern.search(line).group(2) == '-' and current_time < app_end_time:
-                    if wifi_state == 'radio':
-                        wifi_intensity = get_amp_value(power_profile, 'wifi.active')
-                    if wifi_state == 'scan':
-                        wifi_intensity = get_amp_value(power_profile, 'wifi.scan')
-                    wifi_end_time = current_time
-                    duration = wifi_end_time - wifi_start_time
-                    if duration <= 0:
-                        continue
-                    energy_consumption = calculate_energy_usage(wifi_intensity, voltage, duration)
-                    wifi_results.append('{},{},{},wifi {},{}'.format(
-                        wifi_start_time - app_start_time, wifi_end_time - app_start_time, duration,
-                        wifi_state, energy_consumption))
+
+        if 'wifi' in event.flags:
+            wifi_sign = event.flags['wifi']
+            wifi_state = event.values['wifi']
+            if wifi_activation == 0 and wifi_sign == '+' and current_time < app_end_time:
+                wifi_activation = 1
+                old_wifi_state = wifi_state
+                if current_time < app_start_time:
+                    wifi_start_time = app_start_time
+                else:
                     wifi_start_time = current_time
-                    wifi_state = 'running'
-            if wifi_activation == 1 and current_time >= app_end_time:
-                wifi_activation = 0
-                wifi_end_time = app_end_time
-                duration = wifi_end_time - wifi_start_time
-                if wifi_state == 'running':
+            elif wifi_activation == 1 and wifi_state != old_wifi_state and wifi_sign == '+':
+                if old_wifi_state == 'running':
                     wifi_intensity = get_amp_value(power_profile, 'wifi.on')
+                if old_wifi_state == 'radio':
+                    wifi_intensity = get_amp_value(power_profile, 'wifi.active')
+                if old_wifi_state == 'scan':
+                    wifi_intensity = get_amp_value(power_profile, 'wifi.scan')
+                wifi_end_time = current_time
+                duration = wifi_end_time - wifi_start_time
+                if duration <= 0:
+                    continue
+                energy_consumption = calculate_energy_usage(wifi_intensity, voltage, duration)
+                wifi_results.append('{},{},{},wifi {},{}'.format(
+                    wifi_start_time - app_start_time, wifi_end_time - app_start_time, duration,
+                    old_wifi_state, energy_consumption))
+                wifi_start_time = current_time
+            elif wifi_activation == 1 and wifi_sign == '-' and current_time < app_end_time:
                 if wifi_state == 'radio':
                     wifi_intensity = get_amp_value(power_profile, 'wifi.active')
                 if wifi_state == 'scan':
                     wifi_intensity = get_amp_value(power_profile, 'wifi.scan')
+                wifi_end_time = current_time
+                duration = wifi_end_time - wifi_start_time
+                if duration <= 0:
+                    continue
                 energy_consumption = calculate_energy_usage(wifi_intensity, voltage, duration)
                 wifi_results.append('{},{},{},wifi {},{}'.format(
                     wifi_start_time - app_start_time, wifi_end_time - app_start_time, duration,
                     wifi_state, energy_consumption))
-        all_results.extend(screen_results + wifi_results)
-
-        component_patterns = [camera_pattern, flashlight_pattern, gps_pattern, audio_pattern, video_pattern,
-                              bluetooth_pattern, phone_scanning_pattern]
-        component_activation = 0
-        component_results = []
-        for component_pattern in component_patterns:
-            bs_file.seek(0)
-            for line in bs_file:
-                if component_pattern.search(line):
-                    component = component_pattern.search(line).group(3)
-                    component_state = component_pattern.search(line).group(2)
-                    component_state_time = convert_to_s(component_pattern.search(line).group(1))
-                    component_intensity = get_amp_value(power_profile, component)
-                    if component_state == '+' and component_state_time < app_end_time:
-                        component_activation = 1
-                        if component_state_time < app_start_time:
-                            component_start_time = app_start_time
-                        else:
-                            component_start_time = component_state_time
-                    elif component_state == '-' and component_state_time < app_end_time:
-                        component_activation = 0
-                        if (component_start_time < app_end_time) and (component_state_time > app_end_time):
-                            component_end_time = app_end_time
-                        else:
-                            component_end_time = convert_to_s(component_pattern.search(line).group(1))
-                        duration = component_end_time - component_start_time
-                        if duration != 0:
-                            energy_consumption = calculate_energy_usage(component_intensity, voltage, duration)
-                            component_results.append('{},{},{},{},{}'.format(
-                                component_start_time - app_start_time,
-                                component_end_time - app_start_time, duration, component, energy_consumption))
-                if component_activation == 1 and current_time >= app_end_time:
+                wifi_start_time = current_time
+                wifi_state = 'running'
+        if wifi_activation == 1 and current_time >= app_end_time:
+            wifi_activation = 0
+            wifi_end_time = app_end_time
+            duration = wifi_end_time - wifi_start_time
+            if wifi_state == 'running':
+                wifi_intensity = get_amp_value(power_profile, 'wifi.on')
+            if wifi_state == 'radio':
+                wifi_intensity = get_amp_value(power_profile, 'wifi.active')
+            if wifi_state == 'scan':
+                wifi_intensity = get_amp_value(power_profile, 'wifi.scan')
+            energy_consumption = calculate_energy_usage(wifi_intensity, voltage, duration)
+            wifi_results.append('{},{},{},wifi {},{}'.format(
+                wifi_start_time - app_start_time, wifi_end_time - app_start_time, duration,
+                wifi_state, energy_consumption))
+    all_results.extend(screen_results + wifi_results)
+
+    # The components are replayed one by one with the time of the last history line
+    component_activation = 0
+    component_results = []
+    for component in COMPONENTS:
+        component_intensity = get_amp_value(power_profile, component)
+        for event in events:
+            component_state = event.flags.get(component)
+            if component_state is None:
+                continue
+            component_state_time = event.time
+            if component_state == '+' and component_state_time < app_end_time:
+                component_activation = 1
+                if component_state_time < app_start_time:
+                    component_start_time = app_start_time
+                else:
+                    component_start_time = component_state_time
+            elif component_state == '-' and component_state_time < app_end_time:
+                component_activation = 0
+                if (component_start_time < app_end_time) and (component_state_time > app_end_time):
                     component_end_time = app_end_time
-                    component_activation = 0
-                    duration = component_end_time - component_start_time
-                    if duration != 0:
-                        energy_consumption = calculate_energy_usage(component_intensity, voltage, duration)
-                        component_results.append('{},{},{},{},{}'.format(
-                            component_start_time - app_start_time,
-                            component_end_time - app_start_time, duration, component, energy_consumption))
-        all_results.extend(component_results)
+                else:
+                    component_end_time = component_state_time
+                duration = component_end_time - component_start_time
+                if duration != 0:
+                    energy_consumption = calculate_energy_usage(component_intensity, voltage, duration)
+                    component_results.append('{},{},{},{},{}'.format(
+                        component_start_time - app_start_time,
+                        component_end_time - app_start_time, duration, component, energy_consumption))
+            if component_activation == 1 and current_time >= app_end_time:
+                component_end_time = app_end_time
+                component_activation = 0
+                duration = component_end_time - component_start_time
+                if duration != 0:
+                    energy_consumption = calculate_energy_usage(component_intensity, voltage, duration)
+                    component_results.append('{},{},{},{},{}'.format(
+                        component_start_time - app_start_time,
+                        component_end_time - app_start_time, duration, component, energy_consumption))
+    all_results.extend(component_results)
     return all_results
 
 
@@ -281,14 +379,15 @@ def calculate_energy_usage(intensity, voltage, duration):
     return intensity * voltage * duration
 
 
+milliseconds_pattern = re.compile(r'\+(\d{3})ms')
+seconds_pattern = re.compile(r'\+(\d{1,2})s(\d{3})ms')
+minutes_pattern = re.compile(r'\+(\d{1,2})m(\d{2})s(\d{3})ms')
+hours_pattern = re.compile(r'\+(\d{1,2})h(\d{1,2})m(\d{2})s(\d{3})ms')
+days_pattern = re.compile(r'\+(\d)d(\d{1,2})h(\d{1,2})m(\d{2})s(\d{3})ms')
+
+
 def convert_to_s(line):
     """ Convert Batterystats timestamps to seconds """
-    milliseconds_pattern = re.compile(r'\+(\d{3})ms')
-    seconds_pattern = re.compile(r'\+(\d{1,2})s(\d{3})ms')
-    minutes_pattern = re.compile(r'\+(\d{1,2})m(\d{2})s(\d{3})ms')
-    hours_pattern = re.compile(r'\+(\d{1,2})h(\d{1,2})m(\d{2})s(\d{3})ms')
-    days_pattern = re.compile(r'\+(\d)d(\d{1,2})h(\d{1,2})m(\d{2})s(\d{3})ms')
-
     milliseconds_matches = milliseconds_pattern.search(line)
     seconds_matches = seconds_pattern.search(line)
     minutes_matches = minutes_pattern.search(line)
@@ -328,111 +427,160 @@ def convert_to_s(line):
 Systrace
 '''
 
+SYSTRACE_EVENT_PATTERN = re.compile(
+    r'(?:<.{3,4}>-\d{1,4}|kworker.+-\d{3}).*\s(\d+\.\d+): (cpu_.*): state=(.*) cpu_id=(\d)')
+SYSTRACE_CLOCK_SYNC_PATTERN = re.compile(
+    r'(\d+\.\d+):\stracing_mark_write:\strace_event_clock_sync:\srealtime_ts=(\d+)')
+# Traces smaller than this are not worth sharding across processes
+SYSTRACE_MIN_SHARD_SIZE = 16 * 1024 * 1024
+
+
+class SystraceCore(object):
+    """ The idle and frequency state of a single core while the systrace events are replayed.
+
+    Only the events of the core are passed to event(), except for the first event after the end of the app,
+    which closes the last state of every core.
+    """
+
+    def __init__(self, cpu_id, start_time, power_profile, voltage):
+        self.cpu_id = cpu_id
+        self.start_time = start_time
+        self.power_profile = power_profile
+        self.voltage = voltage
+        self.found_first_match = False
+        self.time = None
+        self.activity = None
+        self.state = None
+        self.results = []
+
+    def add_result(self, start, end, duration, label, cpu_intensity):
+        energy_consumption = calculate_energy_usage(cpu_intensity, self.voltage, duration)
+        self.results.append('{},{},{},core {} {},{}'.format(start, end, duration, self.cpu_id, label,
+                                                            energy_consumption))
+
+    def event(self, current_time, current_activity, current_state, end_time):
+        if not self.found_first_match:
+            if current_time > self.start_time:
+                # The core is considered idle from the start of the app until its first event
+                self.add_result(0.0, current_time - self.start_time, current_time - self.start_time,
+                                'cpu_idle start', get_amp_value(self.power_profile, 'cpu.idle'))
+                self.time = current_time
+                self.activity = current_activity
+                self.state = current_state
+                self.found_first_match = True
+            return
+        if current_time >= end_time or (current_activity == self.activity and current_state == self.state):
+            return
+        if current_activity == 'cpu_frequency' and self.activity == 'cpu_idle':
+            cpu_intensity = get_amp_value(self.power_profile, 'cpu.idle')
+        elif self.activity == 'cpu_frequency' and current_activity in ('cpu_frequency', 'cpu_idle'):
+            cpu_intensity = get_amp_value(self.power_profile, self.activity, self.state, self.cpu_id)
+        else:
+            return
+        self.add_result(self.time - self.start_time, current_time - self.start_time, current_time - self.time,
+                        self.activity, cpu_intensity)
+        self.time = current_time
+        self.activity = current_activity
+        self.state = current_state
+
+    def close(self, end_time, current_activity):
+        """Ends the last state of the core at end_time, current_activity is the activity of the closing event"""
+        if not self.found_first_match:
+            self.add_result(0, end_time - self.start_time, end_time - self.start_time, 'cpu_idle',
+                            get_amp_value(self.power_profile, 'cpu.idle'))
+            return
+        if current_activity == 'cpu_idle':
+            cpu_intensity = get_amp_value(self.power_profile, 'cpu.idle')
+        else:
+            cpu_intensity = get_amp_value(self.power_profile, self.activity, self.state, self.cpu_id)
+        self.add_result(self.time - self.start_time, end_time - self.start_time, end_time - self.time,
+                        self.activity, cpu_intensity)
+
 
-def parse_systrace(app, systrace_file, logcat, batterystats, power_profile, core_amount, device_api_version):
-    """ Parse systrace file and calculate results """
+def get_systrace_clock_sync(systrace_file):
+    """ Returns the trace time and the unix time in ms of the first clock sync marker in the systrace file """
+    with open(systrace_file, 'r') as sys:
+        for line in sys:
+            match = SYSTRACE_CLOCK_SYNC_PATTERN.search(line)
+            if match:
+                return float(match.group(1)), float(match.group(2))
+    raise ValueError('No trace_event_clock_sync marker found in {}'.format(systrace_file))
+
+
+def read_systrace_events(systrace_file, start=0, end=None):
+    """ Returns the cpu_idle and cpu_frequency events as (time, activity, state, cpu_id) tuples.
+
+    Only the lines that start within the byte range [start, end) are read, so a large trace can be split in
+    ranges that are read by separate processes.
+    """
+    events = []
+    with open(systrace_file, 'rb') as sys:
+        if start > 0:
+            # Skip the line that started before the range, it belongs to the previous range
+            sys.seek(start - 1)
+            sys.readline()
+        while end is None or sys.tell() < end:
+            line = sys.readline()
+            if not line:
+                break
+            if b': cpu_' not in line:
+                continue
+            for match in SYSTRACE_EVENT_PATTERN.finditer(line.decode('utf-8')):
+                events.append((float(match.group(1)), match.group(2), match.group(3), int(match.group(4))))
+    return events
+
+
+def read_systrace_events_range(args):
+    return read_systrace_events(*args)
+
+
+def iter_systrace_events(systrace_file, processes=None):
+    """ Yields the cpu events of the systrace file in file order. With processes, traces larger than
+    SYSTRACE_MIN_SHARD_SIZE are split in byte ranges that are read by a pool of at most processes processes,
+    limited to the number of cpus of the host. """
+    size = os.path.getsize(systrace_file)
+    processes = min(processes or 1, multiprocessing.cpu_count())
+    if processes < 2 or size < SYSTRACE_MIN_SHARD_SIZE:
+        for event in read_systrace_events(systrace_file):
+            yield event
+        return
+    shard_size = -(-size // (processes * 4))
+    ranges = [(systrace_file, start, start + shard_size) for start in range(0, size, shard_size)]
+    with multiprocessing.Pool(processes) as pool:
+        for events in pool.imap(read_systrace_events_range, ranges):
+            for event in events:
+                yield event
+
+
+def parse_systrace(app, systrace_file, logcat, batterystats, power_profile, core_amount, device_api_version,
+                   processes=None):
+    """ Parse systrace file and calculate results
+
+    The file is read once, every event is passed to the state of its core. The results are grouped per core.
+    With processes, large traces are read by a pool of processes.
+    """
+    power_profile = get_power_profile(power_profile)
     with open(batterystats, 'r') as bs:
         voltage_pattern = re.compile(r'(0|\+\d.*ms).*volt=(\d+)')
         voltage = float(re.findall(voltage_pattern, bs.read())[0][1]) / 1000.0
 
-    with open(systrace_file, 'r') as sys:
-        f = sys.read()
-        pattern = re.compile(r'(?:<.{3,4}>-\d{1,4}|kworker.+-\d{3}).*\s(\d+\.\d+): (cpu_.*): state=(.*) cpu_id=(\d)')
-        unix_time_pattern = re.compile(r'(\d+\.\d+):\stracing_mark_write:\strace_event_clock_sync:\srealtime_ts=(\d+)')
-        logcat_time = parse_logcat(app, logcat, device_api_version)
-        systrace_time = float(unix_time_pattern.search(f).group(2))
-        start_time = (logcat_time[0] - systrace_time) / 1000 + float(unix_time_pattern.search(f).group(1))
-        end_time = (logcat_time[1] - systrace_time) / 1000 + float(unix_time_pattern.search(f).group(1))
-        cpu_id_list = []
-        results = []
-
-        for i in range(0, core_amount):
-            cpu_id_list.append(i)
-
-        cpu_id_list.sort()
-        for cpu_id in cpu_id_list:
-            matches = pattern.finditer(f)
-            found_first_match = 0
-            for match in matches:
-                current_time = float(match.group(1))
-                current_activity = str(match.group(2))
-                current_state = str(match.group(3))
-                current_cpu_id = int(match.group(4))
-                if current_time < start_time:
-                    pass
-                else:
-                    if (found_first_match == 0) and (current_cpu_id == cpu_id) and current_time > start_time:
-                        time = start_time
-                        duration = current_time - time
-                        activity = 'cpu_idle'
-                        cpu_intensity = get_amp_value(power_profile, 'cpu.idle')
-                        energy_consumption = calculate_energy_usage(cpu_intensity, voltage, duration)
-                        results.append('{},{},{},core {} {} start,{}'.format
-                                       (time - start_time, current_time - start_time,
-                                        duration, cpu_id, activity, energy_consumption))
-                        time = current_time
-                        activity = current_activity
-                        state = current_state
-                        cpu_id = current_cpu_id
-                        found_first_match = 1
-                    elif found_first_match == 1 and (current_cpu_id == cpu_id) and current_time < end_time:
-                        if (current_activity == activity) and (current_state == state):
-                            pass
-                        elif current_activity == activity == 'cpu_idle':
-                            pass
-                        elif current_activity == 'cpu_frequency' and activity == 'cpu_idle':
-                            duration = current_time - time
-                            cpu_intensity = get_amp_value(power_profile, 'cpu.idle')
-                            energy_consumption = calculate_energy_usage(cpu_intensity, voltage, duration)
-                            results.append('{},{},{},core {} {},{}'.format
-                                           (time - start_time, current_time - start_time,
-                                            duration, cpu_id, activity, energy_consumption))
-                            time = current_time
-                            activity = current_activity
-                            state = current_state
-                        elif (current_activity == activity == 'cpu_frequency') and (current_state == state):
-                            pass
-                        elif (current_activity == activity == 'cpu_frequency') and (current_state != state):
-                            duration = current_time - time
-                            cpu_intensity = get_amp_value(power_profile, activity, state)
-                            energy_consumption = calculate_energy_usage(cpu_intensity, voltage, duration)
-                            results.append('{},{},{},core {} {},{}'.format
-                                           (time - start_time, current_time - start_time,
-                                            duration, cpu_id, activity, energy_consumption))
-                            time = current_time
-                            activity = current_activity
-                            state = current_state
-                        elif current_activity == 'cpu_idle' and activity == 'cpu_frequency':
-                            duration = current_time - time
-                            cpu_intensity = get_amp_value(power_profile, activity, state)
-                            energy_consumption = calculate_energy_usage(cpu_intensity, voltage, duration)
-                            results.append('{},{},{},core {} {},{}'.format
-                                           (time - start_time, current_time - start_time,
-                                            duration, cpu_id, activity, energy_consumption))
-                            time = current_time
-                            activity = current_activity
-                            state = current_state
-                if found_first_match == 1 and current_time >= end_time:
-                    duration = end_time - time
-                    if current_activity == 'cpu_idle':
-                        cpu_intensity = get_amp_value(power_profile, 'cpu.idle')
-                    else:
-                        cpu_intensity = get_amp_value(power_profile, activity, state)
-                    energy_consumption = calculate_energy_usage(cpu_intensity, voltage, duration)
-                    results.append('{},{},{},core {} {},{}'.format
-                                   (time - start_time, end_time - start_time,
-                                    duration, cpu_id, activity, energy_consumption))
-                    break
-                if found_first_match == 0 and current_time >= end_time:
-                    duration = end_time - start_time
-                    activity = 'cpu_idle'
-                    cpu_intensity = get_amp_value(power_profile, 'cpu.idle')
-                    energy_consumption = calculate_energy_usage(cpu_intensity, voltage, duration)
-                    results.append('{},{},{},core {} {},{}'.format
-                                   (0, end_time - start_time,
-                                    duration, cpu_id, activity, energy_consumption))
-                    break
-    return results
+    logcat_time = parse_logcat(app, logcat, device_api_version)
+    sync_time, systrace_time = get_systrace_clock_sync(systrace_file)
+    start_time = (logcat_time[0] - systrace_time) / 1000 + sync_time
+    end_time = (logcat_time[1] - systrace_time) / 1000 + sync_time
+    cores = [SystraceCore(cpu_id, start_time, power_profile, voltage) for cpu_id in range(core_amount)]
+
+    for current_time, current_activity, current_state, current_cpu_id in iter_systrace_events(systrace_file,
+                                                                                             processes):
+        if current_time >= start_time and current_cpu_id < core_amount:
+            cores[current_cpu_id].event(current_time, current_activity, current_state, end_time)
+        if current_time >= end_time:
+            # The first event after the end of the app ends the last state of every core
+            for core in cores:
+                core.close(end_time, current_activity)
+            break
+    return [result for core in cores for result in core.results]
+
 
 
 ''' Logcat '''
@@ -1,17 +1,124 @@
 import os.path as op
 import os
 import time
-import timeit
-import threading
 import csv
+from collections import OrderedDict
 
+import numpy as np
+
+from AndroidRunner import Aggregation
+from AndroidRunner import Tests
 from AndroidRunner.Plugins.Profiler import Profiler
+from AndroidRunner.Plugins.ResultWriter import RESULT_FORMATS, read_results, write_results
+from AndroidRunner.Plugins.Sampler import Sampler
 
 
 class ConfigError(Exception):
     pass
 
 
+class FrameStore(object):
+    """ The start (intended vsync) and end timestamps in nanoseconds of the frames of a run, in time order.
+
+    gfxinfo framestats dumps the frames of the last 120 seconds on every poll, so successive dumps overlap. A frame is
+    only added when it starts after the last frame added, which leaves out the frames seen before without remembering
+    them and keeps the frames in time order. The frames are kept in arrays that double in size when they are full, up
+    to max_frames after which the oldest frames are overwritten. The jank metrics are updated as frames are added and
+    so cover all frames of the run, also the overwritten ones.
+    """
+    INITIAL_CAPACITY = 1024
+    # About an hour of frames at 120 Hz, 7 MB of timestamps
+    DEFAULT_MAX_FRAMES = 432000
+    # https://developer.android.com/topic/performance/vitals/render
+    # TL;DR; A frame is considered as delayed whenever it took more than 16ms to render
+    DELAYED_FRAME_TIME = 16000000
+    SEVERELY_DELAYED_FRAME_TIME = 32000000
+
+    def __init__(self, max_frames=DEFAULT_MAX_FRAMES):
+        self.max_frames = max_frames
+        capacity = min(self.INITIAL_CAPACITY, max_frames) if max_frames else self.INITIAL_CAPACITY
+        self.starts = np.empty(capacity, dtype=np.int64)
+        self.ends = np.empty(capacity, dtype=np.int64)
+        # The frames are at (first + i) % capacity for i in range(size)
+        self.first = 0
+        self.size = 0
+        self.dropped = 0
+        self.last_start = None
+        # Frame times in milliseconds
+        self.statistics = Aggregation.ColumnStatistics()
+        self.delayed = 0
+        self.severely_delayed = 0
+
+    def __len__(self):
+        return self.size
+
+    def add(self, starts, ends):
+        """Adds frames, frames that do not start after the last frame added are left out. Returns the number of
+        frames added."""
+        starts = np.asarray(starts, dtype=np.int64)
+        ends = np.asarray(ends, dtype=np.int64)
+        order = np.argsort(starts, kind='stable')
+        starts, ends = starts[order], ends[order]
+        new = np.ones(starts.size, dtype=bool)
+        new[1:] = np.diff(starts) > 0
+        if self.last_start is not None:
+            new &= starts > self.last_start
+        starts, ends = starts[new], ends[new]
+        if not starts.size:
+            return 0
+        self.last_start = int(starts[-1])
+        frame_times = ends - starts
+        self.statistics.add(frame_times / 1e6)
+        self.delayed += int(np.count_nonzero(frame_times > self.DELAYED_FRAME_TIME))
+        self.severely_delayed += int(np.count_nonzero(frame_times > self.SEVERELY_DELAYED_FRAME_TIME))
+        self.append(starts, ends)
+        return starts.size
+
+    def append(self, starts, ends):
+        if self.max_frames and starts.size > self.max_frames:
+            self.dropped += starts.size - self.max_frames
+            starts, ends = starts[-self.max_frames:], ends[-self.max_frames:]
+        needed = self.size + starts.size
+        capacity = len(self.starts)
+        if needed > capacity and (not self.max_frames or capacity < self.max_frames):
+            capacity = max(needed, 2 * capacity)
+            if self.max_frames:
+                capacity = min(capacity, self.max_frames)
+            old_starts, old_ends = self.frames()
+            self.starts = np.empty(capacity, dtype=np.int64)
+            self.ends = np.empty(capacity, dtype=np.int64)
+            self.starts[:self.size] = old_starts
+            self.ends[:self.size] = old_ends
+            self.first = 0
+        # The oldest frames make room when the store is full
+        overwritten = max(0, needed - capacity)
+        self.first = (self.first + overwritten) % capacity
+        self.size -= overwritten
+        self.dropped += overwritten
+        positions = (self.first + self.size + np.arange(starts.size)) % capacity
+        self.starts[positions] = starts
+        self.ends[positions] = ends
+        self.size += starts.size
+
+    def frames(self):
+        """Returns the start and end timestamps of the frames in the store, in time order"""
+        positions = (self.first + np.arange(self.size)) % len(self.starts)
+        return self.starts[positions], self.ends[positions]
+
+    def metrics(self):
+        """Returns the jank metrics of all frames added. The percentiles have a relative error of at most 1%."""
+        count = self.statistics.count
+        result = self.statistics.result(percentiles=[50, 90, 99])
+        return OrderedDict([('frames', count),
+                            ('p50_frame_time_ms', result['p50']),
+                            ('p90_frame_time_ms', result['p90']),
+                            ('p99_frame_time_ms', result['p99']),
+                            ('max_frame_time_ms', result['max']),
+                            ('janky_frames_percent', 100.0 * self.delayed / count if count else np.nan),
+                            ('frames_over_16ms', self.delayed),
+                            ('frames_over_32ms', self.severely_delayed)])
+
+
 class Frametimes(Profiler):
     def __init__(self, config, paths):
         super(Frametimes, self).__init__(config, paths)
@@ -19,7 +126,10 @@ class Frametimes(Profiler):
         self.paths = paths
         self.profile = False
         self.interval = float(self.is_integer(config.get('sample_interval', 0))) / 1000
-        self.data = set()
+        self.max_frames = self.is_integer(config.get('max_frames', FrameStore.DEFAULT_MAX_FRAMES), minimum=1)
+        self.data = FrameStore(self.max_frames)
+        self.sampler = None
+        self.result_format = Tests.is_valid_option(config.get('result_format', 'csv'), RESULT_FORMATS)
 
     def get_frame_times(self, device, app):
         result = device.shell(
@@ -30,54 +140,59 @@ class Frametimes(Profiler):
 
         filteredResult = filter(lambda row: not row.startswith('Flags') and row != '---PROFILEDATA---', result.split())
 
-        return map(lambda stats: self.extract_frame_start_end(stats.split(',')), filteredResult)
+        return [self.extract_frame_start_end(stats.split(',')) for stats in filteredResult]
 
     def extract_frame_start_end(self, frame_times):
         return [int(frame_times[1]), int(frame_times[13])]
 
     def start_profiling(self, device, **kwargs):
         self.profile = True
-        self.data = set()
+        self.data = FrameStore(self.max_frames)
         app = kwargs.get('app', None)
-        self.get_data(device, app)
+        self.sampler = Sampler(self.interval, self.get_data, args=(device, app),
+                               name='frametimes-{}'.format(device.id))
+        self.sampler.start()
 
     def get_data(self, device, app):
-        """Runs the profiling methods every self.interval seconds in a separate thread"""
-        start = timeit.default_timer()
-        for frame in self.get_frame_times(device, app):
-            self.data.add(tuple(frame))
-        end = timeit.default_timer()
-        # timer results could be negative
-        interval = max(float(0), self.interval - max(0, end - start))
-        if self.profile:
-            threading.Timer(interval, self.get_data, args=(device, app)).start()
+        """Adds the frames of the last gfxinfo dump, called every self.interval seconds by the sampler thread"""
+        if not self.profile:
+            return
+        frames = np.array(self.get_frame_times(device, app), dtype=np.int64).reshape(-1, 2)
+        self.data.add(frames[:, 0], frames[:, 1])
 
     def stop_profiling(self, device, **kwargs):
         self.profile = False
+        if self.sampler:
+            self.sampler.stop()
+            self.sampler = None
 
     def collect_results(self, device, path=None):
         times_filename = 'frame_times_{}_{}.csv'.format(device.id, time.strftime('%Y.%m.%d_%H%M%S'))
         delayed_filename = 'delayed_{}_{}.csv'.format(device.id, time.strftime('%Y.%m.%d_%H%M%S'))
-        delayed_count = 0
+        jank_filename = 'jank_{}_{}.csv'.format(device.id, time.strftime('%Y.%m.%d_%H%M%S'))
 
-        with open(op.join(self.output_dir, times_filename), 'w+') as f:
-            writer = csv.writer(f)
-            writer.writerow(['frame_start', 'frame_end', 'frame_time', 'is_delayed'])
-            for row in self.data:
-                frame_time = row[1] - row[0]
-                # https://developer.android.com/topic/performance/vitals/render
-                # TL;DR; A frame is considered as delayed whenever it took more than 16m to render
-                if row[1] - row[0] > 16000000:
-                    writer.writerow([row[0], row[1], frame_time, True])
-                    delayed_count += 1
-                else:
-                    writer.writerow([row[0], row[1], frame_time, False])
-        self.data = set()
+        if self.data.dropped:
+            self.logger.warning('Kept the last {} frames of {}, the frame times of {} earlier frames are only '
+                                'counted in the jank metrics'.format(len(self.data), self.data.statistics.count,
+                                                                     self.data.dropped))
+        starts, ends = self.data.frames()
+        frame_times = ends - starts
+        is_delayed = frame_times > FrameStore.DELAYED_FRAME_TIME
+        rows = [['frame_start', 'frame_end', 'frame_time', 'is_delayed']]
+        rows.extend(zip(starts.tolist(), ends.tolist(), frame_times.tolist(), is_delayed.tolist()))
+        write_results(op.join(self.output_dir, times_filename), rows, self.result_format)
 
         with open(op.join(self.output_dir, delayed_filename), 'w+') as f:
             writer = csv.writer(f)
             writer.writerow(['delayed_frames_count'])
-            writer.writerow([delayed_count])
+            writer.writerow([self.data.delayed])
+
+        metrics = self.data.metrics()
+        with open(op.join(self.output_dir, jank_filename), 'w+') as f:
+            writer = csv.writer(f)
+            writer.writerow(list(metrics.keys()))
+            writer.writerow(list(metrics.values()))
+        self.data = FrameStore(self.max_frames)
 
     def set_output(self, output_dir):
         self.output_dir = output_dir
@@ -94,23 +209,40 @@ class Frametimes(Profiler):
     def aggregate_subject(self):
         self.aggregate_delayed_frames()
         self.aggregate_frame_times()
+        self.aggregate_jank_metrics()
 
     def aggregate_delayed_frames(self):
         with open(op.join(self.output_dir, 'all_delayed_frame_counts.csv'), 'w+') as output:
             writer = csv.writer(output)
             writer.writerow(['delayed_frames'])
-            for output_file in os.listdir(self.output_dir):
+            for output_file in sorted(os.listdir(self.output_dir)):
                 if output_file.startswith("delayed_"):
-                    writer.writerow([int(open(op.join(self.output_dir, output_file)).readlines()[1])])
+                    with open(op.join(self.output_dir, output_file)) as f:
+                        for row in csv.DictReader(f):
+                            writer.writerow([int(row['delayed_frames_count'])])
 
     def aggregate_frame_times(self):
         with open(op.join(self.output_dir, 'all_frame_times.csv'), 'w+') as output:
             writer = csv.writer(output)
             writer.writerow(['frame_time'])
-            for output_file in os.listdir(self.output_dir):
+            for output_file in sorted(os.listdir(self.output_dir)):
                 if output_file.startswith("frame_times_"):
-                    for row in open(op.join(self.output_dir, output_file)).readlines()[1:]:
-                        writer.writerow([int(row.split(',')[2])])
+                    frame_times = read_results(op.join(self.output_dir, output_file))['frame_time']
+                    writer.writerows([frame_time] for frame_time in np.asarray(frame_times, dtype=np.int64).tolist())
+
+    def aggregate_jank_metrics(self):
+        """Writes the jank metrics of every run to all_jank_metrics.csv, with the run file in the first column"""
+        rows = []
+        for output_file in sorted(os.listdir(self.output_dir)):
+            if output_file.startswith("jank_"):
+                with open(op.join(self.output_dir, output_file)) as f:
+                    for row in csv.DictReader(f):
+                        rows.append(OrderedDict([('run', output_file)] + list(row.items())))
+        if rows:
+            with open(op.join(self.output_dir, 'all_jank_metrics.csv'), 'w+') as output:
+                writer = csv.DictWriter(output, list(rows[0].keys()))
+                writer.writeheader()
+                writer.writerows(rows)
 
     def aggregate_end(self, data_dir, output_file):
         return
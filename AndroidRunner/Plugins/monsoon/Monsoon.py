@@ -26,8 +26,7 @@ class Monsoon(Profiler):
         """Start the profiling process"""
 
         # Quickly let the mobile device sleep and wake up so a run can take up to 30 minutes.
-        device.shell("input keyevent KEYCODE_SLEEP")
-        device.shell("input keyevent KEYCODE_WAKEUP")
+        device.batch(["input keyevent KEYCODE_SLEEP", "input keyevent KEYCODE_WAKEUP"], check=True)
         time.sleep(5)
         self.profile = True
         power_meter.start()
@@ -39,8 +38,7 @@ class Monsoon(Profiler):
 
         # Quickly let the mobile device sleep and wake up so the device is awake for 30 minutes.
         # This solves the issue of certain commands sent to the device blocking the execution of the program.
-        device.shell("input keyevent KEYCODE_SLEEP")
-        device.shell("input keyevent KEYCODE_WAKEUP")
+        device.batch(["input keyevent KEYCODE_SLEEP", "input keyevent KEYCODE_WAKEUP"], check=True)
         time.sleep(5)
 
     def collect_results(self, device):
@@ -1,11 +1,19 @@
 from AndroidRunner import Tests
+from AndroidRunner import Aggregation
 from AndroidRunner.Plugins.Profiler import Profiler
 from AndroidRunner.Plugins.Profiler import ProfilerException
+from AndroidRunner.Plugins.perfetto import trace_analysis
+from collections import OrderedDict
+import pandas as pd
+import re
 import subprocess
 import os
 from AndroidRunner import util
 import os.path as op
 import datetime
+import hashlib
+import time
+import zlib
 from AndroidRunner import Adb
 from AndroidRunner import util
 
@@ -18,6 +26,14 @@ class Perfetto(Profiler):
     """
     PERFETTO_CONFIG_DEVICE_PATH = "/sdcard/perfetto/"
     PERFETTO_TRACES_DEVICE_PATH = "/data/misc/perfetto-traces/"
+    # Directory in the output directory of a subject where the results of the queries are cached
+    QUERY_CACHE_DIR = ".query_cache"
+    # Every trace_processor holds a whole trace in memory, often several times the size of the trace
+    DEFAULT_TRACE_PROCESSOR_SESSIONS = 2
+    # Trace transfer: bytes read from adb at once, attempts before giving up and seconds between progress messages
+    TRANSFER_CHUNK_SIZE = 1 << 20
+    TRANSFER_ATTEMPTS = 3
+    TRANSFER_PROGRESS_INTERVAL = 5
 
     def __init__(self, config, paths):
         """ Inits the Perfetto class with config and paths params.
@@ -37,9 +53,40 @@ class Perfetto(Profiler):
         self.perfetto_config_file_local_path = config["config_file"]
         self.perfetto_config_file_format = config.get("config_file_format", "text")
         self.perfetto_config_file_device_path = ""
+        # Compress the trace with gzip on the device while it is transferred
+        self.compress_transfer = config.get("compress_transfer", False)
 
         self.adb_path = util.load_json(op.join(self.paths["CONFIG_DIR"], self.paths['ORIGINAL_CONFIG_DIR'])).get("adb_path", "adb")
 
+        # Named SQL queries that the default aggregation runs on every trace.
+        self.queries = self.check_queries(config.get("queries", {}))
+        self.trace_processor_path = op.join(self.paths["CONFIG_DIR"], config["trace_processor_path"]) \
+            if "trace_processor_path" in config else op.join(op.dirname(op.abspath(__file__)), "trace_processor")
+        self.trace_processor_sessions = Tests.is_integer(config.get("trace_processor_sessions",
+                                                                    self.DEFAULT_TRACE_PROCESSOR_SESSIONS), minimum=1)
+
+    @staticmethod
+    def check_queries(queries):
+        """ Checks the queries option, a dictionary of query name -> SQL query. The names are used as file names.
+
+        Parameters
+        ----------
+        queries : dict
+            The queries option of the config.
+
+        Returns
+        -------
+        collections.OrderedDict
+            The queries.
+        """
+        if not isinstance(queries, dict):
+            raise util.ConfigError("The perfetto queries should be an object of query name -> SQL query")
+        for name, query in queries.items():
+            if not re.match(r"^[\w\-]+$", name):
+                raise util.ConfigError(f"Perfetto query name '{name}' may only contain letters, digits, _ and -")
+            Tests.is_string(query)
+        return OrderedDict(queries)
+
     def dependencies(self):
         return []
 
@@ -125,19 +172,110 @@ class Perfetto(Profiler):
         - device : AndroidRunner.Device.Device
             device on which the profiler is ran.
         """
-        # Copy resulting trace files from device to host.
-        # Before Android 9 we cannot directly pull the trace files from the device due to over-restrictive SELinux rules.
-        # We therefore use cat and redirect its output to a file on the host machine. 
         filename = self.perfetto_trace_file_device_path.split("/")[-1]
         perfetto_trace_file_host_path = os.path.join(self.paths["OUTPUT_DIR"], filename)
 
-        with open(perfetto_trace_file_host_path, "w") as f:
-            proc = subprocess.Popen([self.adb_path, "-s", device.id, "shell", f"cat {self.perfetto_trace_file_device_path}"], stdin=subprocess.PIPE, stdout=f)
-            (_, _) = proc.communicate()
+        self.transfer_trace(device, self.perfetto_trace_file_device_path, perfetto_trace_file_host_path)
 
         # Remove trace file from device since we already have it locally.
         device.shell(f"rm -f {self.perfetto_trace_file_device_path}")
 
+    def transfer_trace(self, device, device_path, host_path):
+        """ Copies a trace from the device to the host and checks it against the SHA-256 of the trace on the device.
+
+        Before Android 9 we cannot directly pull the trace files from the device due to over-restrictive SELinux rules,
+        so the trace is streamed with cat over adb exec-out, which unlike adb shell does not translate line endings of
+        the binary trace. A transfer that is interrupted is resumed from the bytes already received, a trace that does
+        not match the checksum is transferred again, up to TRANSFER_ATTEMPTS times in total.
+
+        Parameters
+        ----------
+        - device : AndroidRunner.Device.Device
+            device on which the profiler is ran.
+        - device_path : string
+            Path of the trace on the device.
+        - host_path : string
+            Path the trace is written to on the host.
+        """
+        size, checksum = self.device_file_info(device, device_path)
+        offset = 0
+        for attempt in range(1, self.TRANSFER_ATTEMPTS + 1):
+            start = time.monotonic()
+            returncode, error = self.stream_file(device, device_path, host_path, offset, size)
+            received = os.path.getsize(host_path)
+            elapsed = time.monotonic() - start
+            self.logger.info(f"{device.id}: transferred {received - offset} bytes of {device_path} in {elapsed:.2f}s "
+                             f"({(received - offset) / max(elapsed, 1e-6) / 1e6:.1f} MB/s)")
+            if returncode != 0 or (size is not None and received < size):
+                self.logger.warning(f"{device.id}: transfer of {device_path} stopped at {received} bytes "
+                                    f"(attempt {attempt}): {error}")
+                # Resumed where it stopped, unless more than the whole trace was received
+                offset = received if size is None or received <= size else 0
+                continue
+            if checksum is not None and self.sha256(host_path) != checksum:
+                self.logger.warning(f"{device.id}: checksum of {host_path} does not match {device_path} (attempt {attempt})")
+                offset = 0
+                continue
+            if checksum is None:
+                self.logger.warning(f"{device.id}: cannot compute the checksum of {device_path}, transfer not checked")
+            return
+        raise ProfilerException(f"Could not transfer {device_path} from {device.id} in {self.TRANSFER_ATTEMPTS} attempts")
+
+    @staticmethod
+    def device_file_info(device, device_path):
+        """ Returns the size and SHA-256 of a file on the device, None for each one that cannot be read there. """
+        size, checksum = device.batch([f"stat -c %s {device_path}", f"sha256sum {device_path}"])
+        size = int(size.output.strip()) if size.exit_code == 0 and size.output.strip().isdigit() else None
+        checksum = checksum.output.split()[0].lower() if checksum.exit_code == 0 and checksum.output.strip() else None
+        return size, checksum
+
+    def stream_file(self, device, device_path, host_path, offset, size):
+        """ Writes a file on the device from byte offset on to host_path, in chunks of TRANSFER_CHUNK_SIZE bytes. With
+        compress_transfer the file is compressed with gzip on the device and decompressed while it is received.
+
+        Returns
+        -------
+        tuple
+            The exit code and error output of adb.
+        """
+        command = f"tail -c +{offset + 1} {device_path}" if offset else f"cat {device_path}"
+        decompressor = None
+        if self.compress_transfer:
+            command += " | gzip -c"
+            # 16 + MAX_WBITS: a gzip stream
+            decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        proc = subprocess.Popen([self.adb_path, "-s", device.id, "exec-out", command],
+                                stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        received = offset
+        last_progress = time.monotonic()
+        with open(host_path, "ab" if offset else "wb") as f:
+            try:
+                for chunk in iter(lambda: proc.stdout.read(self.TRANSFER_CHUNK_SIZE), b""):
+                    if decompressor is not None:
+                        chunk = decompressor.decompress(chunk)
+                    f.write(chunk)
+                    received += len(chunk)
+                    if time.monotonic() - last_progress >= self.TRANSFER_PROGRESS_INTERVAL:
+                        last_progress = time.monotonic()
+                        total = f" of {size}" if size is not None else ""
+                        self.logger.debug(f"{device.id}: received {received}{total} bytes of {device_path}")
+                if decompressor is not None:
+                    f.write(decompressor.flush())
+            except zlib.error as e:
+                # The bytes decompressed so far are written, the rest of the trace is transferred again
+                proc.kill()
+                proc.communicate()
+                return 1, f"corrupt gzip stream: {e}"
+        _, error = proc.communicate()
+        return proc.returncode, error.decode("utf-8", "replace").strip()
+
+    def sha256(self, path):
+        digest = hashlib.sha256()
+        with open(path, "rb") as f:
+            for block in iter(lambda: f.read(self.TRANSFER_CHUNK_SIZE), b""):
+                digest.update(block)
+        return digest.hexdigest()
+
     def unload(self, device):
         """ Remove files from device that were used for profiling.
 
@@ -149,13 +287,49 @@ class Perfetto(Profiler):
         # Delete perfetto config file from device.
         device.shell(f"rm -Rf {self.perfetto_config_file_device_path}")
 
-    def aggregate_subject(self): # pragma: no cover
-        # Since we require users to extract the data from the trace files themselves...
-        pass
+    def aggregate_subject(self):
+        """ Runs the configured queries on every trace of the subject, up to trace_processor_sessions traces at once.
+
+        The result of a query on a run is written to <query name>/<trace name>.csv, the results of all runs to
+        Aggregated_<query name>.csv with the run in the first column. Aggregated.csv gets the mean over the runs of the
+        mean of every numeric column of every query. Results are cached per trace and query in QUERY_CACHE_DIR, so
+        aggregating the subject again only runs the queries that are new or changed.
+        """
+        if not self.queries:
+            # Without queries the users extract the data from the trace files themselves...
+            return
+        traces = trace_analysis.trace_files(self.output_dir)
+        if not traces:
+            self.logger.warning(f"No perfetto traces found in {self.output_dir}")
+            return
+        with trace_analysis.QueryCache(op.join(self.output_dir, self.QUERY_CACHE_DIR)) as cache:
+            results = trace_analysis.query_traces(traces, self.queries, self.trace_processor_path, cache,
+                                                  self.trace_processor_sessions)
+        runs = [op.basename(trace)[:-len(trace_analysis.TRACE_EXTENSION)] for trace in traces]
+
+        subject_row = OrderedDict()
+        for name in self.queries:
+            query_dir = op.join(self.output_dir, name)
+            util.makedirs(query_dir)
+            frames = []
+            for run, result in zip(runs, results):
+                result[name].to_csv(op.join(query_dir, f"{run}.csv"), index=False)
+                frame = result[name].copy()
+                frame.insert(0, "run", run, allow_duplicates=True)
+                frames.append(frame)
+            pd.concat(frames, ignore_index=True).to_csv(op.join(self.output_dir, f"Aggregated_{name}.csv"), index=False)
+            run_means = pd.concat([result[name].mean(numeric_only=True) for result in results], axis=1)
+            for column, value in run_means.mean(axis=1).items():
+                subject_row[f"{name}_{column}"] = value
+        util.write_to_file(op.join(self.output_dir, "Aggregated.csv"), [subject_row])
 
-    def aggregate_end(self, data_dir, output_file): # pragma: no cover
-        # Since we require users to extract the data from the trace files themselves...
-        pass
+    def aggregate_end(self, data_dir, output_file):
+        """ Writes the Aggregated.csv row of every subject to output_file. """
+        if not self.queries:
+            return
+        rows = Aggregation.aggregate_final(data_dir, "perfetto", lambda logs_dir: Aggregation.read_aggregated(logs_dir) or {})
+        if rows:
+            util.write_to_file(output_file, rows)
 
     def _datetime_now(self):
         """ Returns the datetime.now() value: the current local date and time 
@@ -0,0 +1,132 @@
+import hashlib
+import json
+import logging
+import os
+import os.path as op
+import pickle
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from AndroidRunner.Plugins.perfetto.trace_wrapper import PerfettoTrace, PerfettoTraceException
+
+TRACE_EXTENSION = ".perfetto_trace"
+
+
+class QueryCache(object):
+    """ The results of the queries on perfetto traces, kept in cache_dir.
+
+    A result is stored as a pickled dataframe in a file named after the SHA-256 of the trace and the text of the
+    query, so it is found again as long as neither of them changed, also when the trace was copied or renamed.
+    index.json maps the path, size and modification time of a trace to its hash, so a trace is only hashed again when
+    it changed. Use it as a context manager to write the index back. The cache can be used by several threads at
+    once.
+    """
+    INDEX_FILE = "index.json"
+    INDEX_VERSION = 1
+
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+        self.lock = threading.Lock()
+        self.files = {}
+        self.changed = False
+        try:
+            with open(op.join(cache_dir, self.INDEX_FILE), "r") as f:
+                index = json.load(f)
+            if index.get("version") == self.INDEX_VERSION:
+                self.files = index["files"]
+        except (OSError, ValueError, KeyError):
+            # An index that cannot be read is rebuilt
+            self.files = {}
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.save()
+
+    def sha256(self, path):
+        """Returns the SHA-256 of the trace at path, it is only computed again when the trace changed"""
+        stat = os.stat(path)
+        name = op.abspath(path)
+        with self.lock:
+            entry = self.files.get(name)
+            if entry is not None and entry["size"] == stat.st_size and entry["mtime_ns"] == stat.st_mtime_ns:
+                return entry["sha256"]
+        digest = hashlib.sha256()
+        with open(path, "rb") as f:
+            for block in iter(lambda: f.read(1 << 20), b""):
+                digest.update(block)
+        with self.lock:
+            self.files[name] = {"size": stat.st_size, "mtime_ns": stat.st_mtime_ns, "sha256": digest.hexdigest()}
+            self.changed = True
+        return digest.hexdigest()
+
+    def result_path(self, trace_sha256, query):
+        key = hashlib.sha256(("%s\0%s" % (trace_sha256, query)).encode("utf-8")).hexdigest()
+        return op.join(self.cache_dir, key + ".pkl")
+
+    def get(self, trace_sha256, query):
+        """Returns the cached result of query on the trace, None when there is none"""
+        try:
+            with open(self.result_path(trace_sha256, query), "rb") as f:
+                return pickle.load(f)
+        except (OSError, pickle.UnpicklingError, EOFError):
+            return None
+
+    def put(self, trace_sha256, query, result):
+        os.makedirs(self.cache_dir, exist_ok=True)
+        path = self.result_path(trace_sha256, query)
+        # Written next to the result and then renamed, so another reader never sees half a result
+        temp_path = "%s.%s.tmp" % (path, threading.get_ident())
+        with open(temp_path, "wb") as f:
+            pickle.dump(result, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(temp_path, path)
+
+    def save(self):
+        if not self.changed:
+            return
+        os.makedirs(self.cache_dir, exist_ok=True)
+        path = op.join(self.cache_dir, self.INDEX_FILE)
+        temp_path = path + ".tmp"
+        with self.lock:
+            with open(temp_path, "w") as f:
+                json.dump({"version": self.INDEX_VERSION, "files": self.files}, f)
+            os.replace(temp_path, path)
+            self.changed = False
+
+
+def trace_files(logs_dir):
+    """Returns the paths of the perfetto traces in logs_dir, sorted"""
+    return [op.join(logs_dir, f) for f in sorted(os.listdir(logs_dir))
+            if f.endswith(TRACE_EXTENSION) and op.isfile(op.join(logs_dir, f))]
+
+
+def query_trace(trace_path, queries, trace_processor_path, cache):
+    """Returns an OrderedDict of query name -> dataframe with the results of queries (name -> SQL) on one trace. The
+    queries that are not in the cache are run in one round trip to a trace_processor that is started for this
+    trace."""
+    trace_sha256 = cache.sha256(trace_path)
+    results = OrderedDict((name, cache.get(trace_sha256, query)) for name, query in queries.items())
+    missing = [name for name, result in results.items() if result is None]
+    if missing:
+        logging.getLogger("TraceAnalysis").debug("Running %d queries on %s" % (len(missing), trace_path))
+        trace = PerfettoTrace(trace_path, trace_processor_path)
+        try:
+            frames = trace.query_many([queries[name] for name in missing])
+        except PerfettoTraceException as e:
+            raise PerfettoTraceException("Queries %s on %s failed: %s" % (missing, trace_path, e))
+        for name, frame in zip(missing, frames):
+            cache.put(trace_sha256, queries[name], frame)
+            results[name] = frame
+    return results
+
+
+def query_traces(trace_paths, queries, trace_processor_path, cache, sessions=1):
+    """Returns the results of query_trace for every trace in trace_paths, in the same order. Up to sessions traces
+    are queried at once, each one by its own trace_processor."""
+    if sessions > 1 and len(trace_paths) > 1:
+        with ThreadPoolExecutor(max_workers=min(sessions, len(trace_paths))) as executor:
+            return list(executor.map(lambda path: query_trace(path, queries, trace_processor_path, cache),
+                                     trace_paths))
+    return [query_trace(path, queries, trace_processor_path, cache) for path in trace_paths]
@@ -1,8 +1,29 @@
 import subprocess
 import platform
+import socket
+import struct
+import tempfile
+import time
+import weakref
 import pandas as pd
 from io import StringIO
 
+# Field numbers of the QueryArgs, QueryResult and QueryResult.CellsBatch messages of trace_processor.proto
+QUERY_ARGS_SQL_QUERY = 1
+QUERY_RESULT_COLUMN_NAMES = 1
+QUERY_RESULT_ERROR = 2
+QUERY_RESULT_BATCH = 3
+BATCH_CELLS = 1
+BATCH_VARINT_CELLS = 2
+BATCH_FLOAT64_CELLS = 3
+BATCH_BLOB_CELLS = 4
+BATCH_STRING_CELLS = 5
+CELL_VARINT = 2
+CELL_FLOAT64 = 3
+CELL_STRING = 4
+CELL_BLOB = 5
+
+
 class PerfettoTrace(object):
     def __init__(self, trace_path, trace_processor_path):
         """ Inits PerfettoTrace with the trace_path and trace_processor_path.
@@ -20,11 +41,42 @@ class PerfettoTrace(object):
         """
         self.trace_path = trace_path
         self.trace_processor_path = trace_processor_path
+        self.session = None
 
         # Since trace_processor executable only works on x86 based architectures give an error when running this script on ARM based machine.
         if "arm" in platform.uname().machine:
             raise PerfettoTraceException("Trace processor is not yet supported on ARM.")
 
+    def open(self, load_timeout=None):
+        """ Starts a trace_processor that keeps the trace loaded until close() is called. Queries are then answered by
+        this trace_processor instead of a new one that loads the whole trace again for every query.
+
+        Parameters
+        ----------
+        load_timeout : int, optional
+            Seconds to wait for trace_processor to load the trace, TraceProcessorSession.LOAD_TIMEOUT by default.
+
+        Returns
+        -------
+        PerfettoTrace
+            The trace itself.
+        """
+        if self.session is None:
+            self.session = TraceProcessorSession(self.trace_path, self.trace_processor_path, load_timeout)
+        return self
+
+    def close(self):
+        """ Stops the trace_processor started by open(). """
+        if self.session is not None:
+            self.session.close()
+            self.session = None
+
+    def __enter__(self):
+        return self.open()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
     def query(self, query):
         """ Runs query on trace file and returns data as Pandas object.
 
@@ -38,6 +90,8 @@ class PerfettoTrace(object):
         pandas.DataFrame
             Pandas dataframe containing the results of the query.
         """
+        if self.session is not None:
+            return self.session.query(query)
         proc = subprocess.Popen([self.trace_processor_path, "-q", "/dev/stdin", self.trace_path], stdin=subprocess.PIPE, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
         stdout, stderr = proc.communicate(input=query.encode("ascii"))
 
@@ -46,9 +100,283 @@ class PerfettoTrace(object):
         data = pd.read_csv(StringIO(stdout.decode('ascii')))
         return data
 
+    def query_many(self, queries):
+        """ Runs several queries on trace file in one round trip to trace_processor. Without open() a trace_processor is
+        started for these queries only, so the trace is still loaded once for all of them.
+
+        Parameters
+        ----------
+        queries : list of string
+            Queries that are run on the perfetto trace file.
+
+        Returns
+        -------
+        list of pandas.DataFrame
+            Pandas dataframes containing the results of the queries, in the order of queries.
+        """
+        if self.session is not None:
+            return self.session.query_many(queries)
+        with self:
+            return self.session.query_many(queries)
+
+
+class TraceProcessorSession(object):
+    """ A trace_processor that keeps one trace loaded and answers queries over its HTTP RPC interface.
+
+    trace_processor is started with -D (--httpd) on a free port. Every query is a POST /query of a QueryArgs message,
+    answered by a QueryResult message. Several queries are sent at once on the same connection and the answers are
+    read in order.
+    """
+    HOST = '127.0.0.1'
+    LOAD_TIMEOUT = 120
+    POLL_INTERVAL = 0.1
+    STOP_TIMEOUT = 5
+
+    def __init__(self, trace_path, trace_processor_path, load_timeout=None):
+        self.trace_path = trace_path
+        self.port = free_port(self.HOST)
+        self.stderr = tempfile.TemporaryFile()
+        self.process = subprocess.Popen([trace_processor_path, "-D", "--http-port", str(self.port), trace_path],
+                                        stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=self.stderr)
+        # trace_processor is stopped as well when the session is not closed
+        self.finalizer = weakref.finalize(self, stop_process, self.process, self.STOP_TIMEOUT)
+        self.connection = None
+        self.stream = None
+        try:
+            self.wait_until_loaded(load_timeout if load_timeout is not None else self.LOAD_TIMEOUT)
+        except Exception:
+            self.close()
+            raise
+
+    def wait_until_loaded(self, timeout):
+        """Waits until trace_processor loaded the trace and answers GET /status"""
+        deadline = time.monotonic() + timeout
+        while True:
+            if self.process.poll() is not None:
+                raise PerfettoTraceException("Trace processor exited with %s while loading %s: %s" %
+                                             (self.process.returncode, self.trace_path, self.error_output()))
+            try:
+                status, body = self.send([self.request("GET", "/status")])[0]
+                if status == 200:
+                    return
+            except (OSError, EOFError):
+                self.disconnect()
+            if time.monotonic() >= deadline:
+                raise PerfettoTraceException("Trace processor did not load %s within %ss" % (self.trace_path, timeout))
+            time.sleep(self.POLL_INTERVAL)
+
+    def error_output(self):
+        self.stderr.seek(0)
+        return self.stderr.read().decode("utf-8", "replace").strip()
+
+    def close(self):
+        self.disconnect()
+        self.finalizer()
+        self.stderr.close()
+
+    def query(self, query):
+        return self.query_many([query])[0]
+
+    def query_many(self, queries):
+        """Returns the results of queries as dataframes, the queries are sent in one round trip"""
+        try:
+            answers = self.send([self.request("POST", "/query", encode_query_args(query)) for query in queries])
+        except (OSError, EOFError) as e:
+            raise PerfettoTraceException("Lost the connection to trace processor: %s %s" % (e, self.error_output()))
+        results = []
+        for query, (status, body) in zip(queries, answers):
+            if status != 200:
+                raise PerfettoTraceException("Trace processor answered %s to %s: %s" %
+                                             (status, query, body.decode("utf-8", "replace")))
+            columns, rows, error = decode_query_result(body)
+            if error:
+                raise PerfettoTraceException(error)
+            results.append(pd.DataFrame(rows, columns=columns))
+        return results
+
+    def request(self, method, path, body=b""):
+        header = "%s %s HTTP/1.1\r\nHost: %s:%s\r\nContent-Type: application/x-protobuf\r\nContent-Length: %s\r\n\r\n" % \
+                 (method, path, self.HOST, self.port, len(body))
+        return header.encode("ascii") + body
+
+    def connect(self):
+        if self.connection is None:
+            self.connection = socket.create_connection((self.HOST, self.port))
+            self.stream = self.connection.makefile("rb")
+
+    def disconnect(self):
+        if self.connection is not None:
+            self.stream.close()
+            self.connection.close()
+            self.connection = self.stream = None
+
+    def send(self, requests):
+        """Sends requests at once and returns the (status, body) of every answer. Requests that are not answered
+        because trace_processor closed the connection are sent again on a new connection."""
+        answers = []
+        while len(answers) < len(requests):
+            pending = requests[len(answers):]
+            fresh = self.connection is None
+            self.connect()
+            try:
+                self.connection.sendall(b"".join(pending))
+                for _ in pending:
+                    status, body, keep_alive = read_response(self.stream)
+                    answers.append((status, body))
+                    if not keep_alive:
+                        self.disconnect()
+                        break
+            except (OSError, EOFError):
+                self.disconnect()
+                # A connection that was kept alive may have been closed by trace_processor in the meantime
+                if fresh:
+                    raise
+        return answers
+
+
 class PerfettoTraceException(Exception):
     pass
 
 
+def free_port(host):
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+        s.bind((host, 0))
+        return s.getsockname()[1]
+
+
+def stop_process(process, timeout):
+    if process.poll() is None:
+        process.terminate()
+        try:
+            process.wait(timeout)
+        except subprocess.TimeoutExpired:
+            process.kill()
+            process.wait()
+
+
+def read_response(stream):
+    """Reads one HTTP response from stream, returns its status, body and whether the connection stays open"""
+    status_line = stream.readline()
+    if not status_line:
+        raise EOFError("Connection closed by trace processor")
+    status = int(status_line.split()[1])
+    headers = {}
+    while True:
+        line = stream.readline()
+        if line in (b"\r\n", b"\n", b""):
+            break
+        name, _, value = line.decode("latin-1").partition(":")
+        headers[name.strip().lower()] = value.strip().lower()
+    if "chunked" in headers.get("transfer-encoding", ""):
+        body = bytearray()
+        while True:
+            size_line = stream.readline()
+            if not size_line:
+                raise EOFError("Connection closed by trace processor")
+            size = int(size_line.split(b";")[0], 16)
+            if size == 0:
+                while stream.readline() not in (b"\r\n", b"\n", b""):
+                    pass
+                break
+            body += stream.read(size)
+            stream.readline()
+        body = bytes(body)
+    elif "content-length" in headers:
+        body = stream.read(int(headers["content-length"]))
+    else:
+        return status, stream.read(), False
+    return status, body, headers.get("connection") != "close"
+
+
+def read_varint(data, position):
+    result = shift = 0
+    while True:
+        byte = data[position]
+        position += 1
+        result |= (byte & 0x7F) << shift
+        shift += 7
+        if byte < 0x80:
+            return result, position
+
+
+def encode_varint(value):
+    encoded = bytearray()
+    while value > 0x7F:
+        encoded.append((value & 0x7F) | 0x80)
+        value >>= 7
+    encoded.append(value)
+    return bytes(encoded)
+
+
+def proto_fields(data):
+    """Yields the field number, wire type and value of every field of a serialized protobuf message"""
+    position = 0
+    while position < len(data):
+        key, position = read_varint(data, position)
+        wire_type = key & 0x7
+        if wire_type == 0:
+            value, position = read_varint(data, position)
+        elif wire_type == 1:
+            value = data[position:position + 8]
+            position += 8
+        elif wire_type == 2:
+            length, position = read_varint(data, position)
+            value = data[position:position + length]
+            position += length
+        elif wire_type == 5:
+            value = data[position:position + 4]
+            position += 4
+        else:
+            raise PerfettoTraceException("Unsupported protobuf wire type %s" % wire_type)
+        yield key >> 3, wire_type, value
+
+
+def packed_varints(wire_type, value):
+    if wire_type == 0:
+        return [value]
+    values = []
+    position = 0
+    while position < len(value):
+        varint, position = read_varint(value, position)
+        values.append(varint)
+    return values
+
+
+def encode_query_args(query):
+    sql = query.encode("utf-8")
+    return encode_varint(QUERY_ARGS_SQL_QUERY << 3 | 2) + encode_varint(len(sql)) + sql
+
+
+def decode_cells_batch(data):
+    """Returns the values of the cells of a serialized QueryResult.CellsBatch, row after row"""
+    cell_types, varints, floats, blobs, strings = [], [], [], [], []
+    for field, wire_type, value in proto_fields(data):
+        if field == BATCH_CELLS:
+            cell_types.extend(packed_varints(wire_type, value))
+        elif field == BATCH_VARINT_CELLS:
+            # int64 values, negative ones are encoded as their two's complement
+            varints.extend(v - (1 << 64) if v >= 1 << 63 else v for v in packed_varints(wire_type, value))
+        elif field == BATCH_FLOAT64_CELLS:
+            floats.extend(struct.unpack("<%dd" % (len(value) // 8), value))
+        elif field == BATCH_BLOB_CELLS:
+            blobs.append(bytes(value))
+        elif field == BATCH_STRING_CELLS:
+            # All strings of the batch, each one terminated by a null character
+            strings.extend(value.decode("utf-8", "replace").split("\0")[:-1])
+    values = {CELL_VARINT: iter(varints), CELL_FLOAT64: iter(floats), CELL_STRING: iter(strings),
+              CELL_BLOB: iter(blobs)}
+    return [next(values[cell_type]) if cell_type in values else None for cell_type in cell_types]
 
 
+def decode_query_result(data):
+    """Returns the column names, the rows and the error message of a serialized QueryResult"""
+    columns, cells, error = [], [], ""
+    for field, wire_type, value in proto_fields(data):
+        if field == QUERY_RESULT_COLUMN_NAMES:
+            columns.append(value.decode("utf-8", "replace"))
+        elif field == QUERY_RESULT_ERROR:
+            error = value.decode("utf-8", "replace")
+        elif field == QUERY_RESULT_BATCH:
+            cells.extend(decode_cells_batch(value))
+    rows = [cells[i:i + len(columns)] for i in range(0, len(cells), len(columns))] if columns else []
+    return columns, rows, error
@@ -3,19 +3,25 @@ import errno
 import json
 import os
 import os.path as op
-import time
 from collections import OrderedDict
 
 import lxml.etree as et
 from lxml.etree import ElementTree
 
 from AndroidRunner.Plugins.Profiler import Profiler
-from functools import reduce
+from AndroidRunner.Plugins.ResultWriter import RESULT_FORMATS, write_results
+from AndroidRunner import Aggregation
+from AndroidRunner import Readiness
+from AndroidRunner import Tests
 from AndroidRunner import util
 
 
 class Trepn(Profiler):
     DEVICE_PATH = '/sdcard/trepn/'
+    PACKAGE = 'com.quicinc.trepn'
+    # 'am broadcast' returns when the preferences were received, so there is no wait after it unless configured
+    READINESS_DEFAULTS = {'launch': {'type': 'activity'}, 'preferences': {'type': 'delay'},
+                          'close': {'type': 'stopped'}, 'service': {'type': 'process'}}
 
     def dependencies(self):
         return ['com.quicinc.trepn']
@@ -27,6 +33,8 @@ class Trepn(Profiler):
         self.pref_dir = None
         self.remote_pref_dir = op.join(Trepn.DEVICE_PATH, 'saved_preferences/')
         self.data_points = []
+        self.result_format = Tests.is_valid_option(config.get('result_format', 'csv'), RESULT_FORMATS)
+        self.readiness = Readiness.probes(config.get('readiness', {}), Trepn.READINESS_DEFAULTS)
         self.build_preferences(config)
 
     def override_preferences(self, params: OrderedDict, preferences_file: ElementTree) -> ElementTree:
@@ -75,17 +83,17 @@ class Trepn(Profiler):
 
     def load(self, device):
         device.push(self.pref_dir, self.remote_pref_dir)
-        # There is no way to know if the following succeeded
-        device.launch_package('com.quicinc.trepn')
-        time.sleep(5)  # launch_package returns instantly
-        # Trepn needs to be started for this to work
+        device.launch_package(Trepn.PACKAGE)
+        # launch_package returns instantly, Trepn needs to be started to load the preferences
+        self.readiness['launch'].wait(device, Trepn.PACKAGE)
         device.shell('am broadcast -a com.quicinc.trepn.load_preferences '
                      '-e com.quicinc.trepn.load_preferences_file "%s"'
                      % op.join(self.remote_pref_dir, 'trepn.pref'))
-        time.sleep(1)  # am broadcast returns instantly
-        device.force_stop('com.quicinc.trepn')
-        time.sleep(2)  # am force-stop returns instantly
+        self.readiness['preferences'].wait(device, Trepn.PACKAGE)
+        device.force_stop(Trepn.PACKAGE)
+        self.readiness['close'].wait(device, Trepn.PACKAGE)
         device.shell('am startservice com.quicinc.trepn/.TrepnService')
+        self.readiness['service'].wait(device, Trepn.PACKAGE)
 
     def start_profiling(self, device, **kwargs):
         device.shell('am broadcast -a com.quicinc.trepn.start_profiling')
@@ -112,10 +120,9 @@ class Trepn(Profiler):
         bool
             Whether the file exists and is not empty on the device.
         """
-        ls = device.shell(f"ls {path}")
-        cat = device.shell(f"cat {os.path.join(path, csv_filename)}")
+        ls, cat = device.batch([f"ls {path}", f"cat {os.path.join(path, csv_filename)}"])
 
-        return (csv_filename in ls) and bool(cat)
+        return (csv_filename in ls.output) and cat.exit_code == 0 and bool(cat.output)
 
     def collect_results(self, device):
         # Gives the latest result
@@ -138,8 +145,8 @@ class Trepn(Profiler):
             util.wait_until(os.path.exists, 5, 1, op.join(self.output_dir, csv_filename))
 
             # Delete the originals
-            device.shell('rm %s' % op.join(Trepn.DEVICE_PATH, newest_db))
-            device.shell('rm %s' % op.join(Trepn.DEVICE_PATH, csv_filename))
+            device.batch(['rm %s' % op.join(Trepn.DEVICE_PATH, newest_db),
+                          'rm %s' % op.join(Trepn.DEVICE_PATH, csv_filename)])
         self.filter_results(op.join(self.output_dir, csv_filename))
 
     @staticmethod
@@ -160,13 +167,14 @@ class Trepn(Profiler):
                                   not statistic == []}
         wanted_statistics = [system_statistics_dict[data_point] for data_point in self.data_points]
         filtered_data = self.filter_data(wanted_statistics, data)
-        self.write_list_to_file(filename, filtered_data)
+        self.write_list_to_file(filename, filtered_data, self.result_format)
+        if self.result_format != 'csv':
+            # The csv exported by Trepn is replaced by the result file
+            os.remove(filename)
 
     @staticmethod
-    def write_list_to_file(filename, rows):
-        with open(filename, 'w') as f:
-            writer = csv.writer(f)
-            writer.writerows(rows)
+    def write_list_to_file(filename, rows, result_format='csv'):
+        return write_results(filename, rows, result_format)
 
     def filter_data(self, wanted_statistics, data):
         wanted_columns = self.get_wanted_columns(wanted_statistics, data[0])
@@ -217,67 +225,12 @@ class Trepn(Profiler):
         util.write_to_file(output_file, rows)
 
     def aggregate_trepn_subject(self, logs_dir):
-        def add_row(accum, new):
-            row = {key: value + float(new[key]) for key, value in list(accum.items()) if
-                   key not in ['Component', 'count']}
-            count = accum['count'] + 1
-            return dict(row, **{'count': count})
-
-        runs = []
-        for run_file in [f for f in os.listdir(logs_dir) if os.path.isfile(os.path.join(logs_dir, f))]:
-            with open(os.path.join(logs_dir, run_file), 'r') as run:
-                run_dict = {}
-                reader = csv.DictReader(run)
-                column_readers = self.split_reader(reader)
-                for k, v in list(column_readers.items()):
-                    init = dict({k: 0}, **{'count': 0})
-                    run_total = reduce(add_row, v, init)
-                    if not run_total['count'] == 0:
-                        run_dict[k] = run_total[k] / run_total['count']
-                runs.append(run_dict)
-        init = dict({fn: 0 for fn in list(runs[0].keys())}, **{'count': 0})
-        runs_total = reduce(add_row, runs, init)
-        return OrderedDict(
-            sorted(list({k: v / len(runs) for k, v in list(runs_total.items()) if not k == 'count'}.items()),
-                   key=lambda x: x[0]))
-
-    @staticmethod
-    def split_reader(reader):
-        column_dicts = {fn: [] for fn in reader.fieldnames if not fn.split('[')[0].strip() == 'Time'}
-        for row in reader:
-            for k, v in list(row.items()):
-                if not k.split('[')[0].strip() == 'Time' and not v == '':
-                    column_dicts[k].append({k: v})
-        return column_dicts
+        runs = Aggregation.run_means(logs_dir, usecols=lambda column: column.split('[')[0].strip() != 'Time')
+        return OrderedDict(sorted(list(Aggregation.mean_of_runs(runs).items()), key=lambda x: x[0]))
 
     def aggregate_final(self, data_dir):
-        rows = []
-        for device in util.list_subdir(data_dir):
-            row = OrderedDict({'device': device})
-            device_dir = os.path.join(data_dir, device)
-            for subject in util.list_subdir(device_dir):
-                row.update({'subject': subject})
-                subject_dir = os.path.join(device_dir, subject)
-                if os.path.isdir(os.path.join(subject_dir, 'trepn')):
-                    row.update(self.aggregate_trepn_final(os.path.join(subject_dir, 'trepn')))
-                    rows.append(row.copy())
-                else:
-                    for browser in util.list_subdir(subject_dir):
-                        row.update({'browser': browser})
-                        browser_dir = os.path.join(subject_dir, browser)
-                        if os.path.isdir(os.path.join(browser_dir, 'trepn')):
-                            row.update(self.aggregate_trepn_final(os.path.join(browser_dir, 'trepn')))
-                            rows.append(row.copy())
-        return rows
+        return Aggregation.aggregate_final(data_dir, 'trepn', self.aggregate_trepn_final)
 
     @staticmethod
     def aggregate_trepn_final(logs_dir):
-        for aggregated_file in [f for f in os.listdir(logs_dir) if os.path.isfile(os.path.join(logs_dir, f))]:
-            if aggregated_file == "Aggregated.csv":
-                with open(os.path.join(logs_dir, aggregated_file), 'r') as aggregated:
-                    reader = csv.DictReader(aggregated)
-                    row_dict = OrderedDict()
-                    for row in reader:
-                        for f in reader.fieldnames:
-                            row_dict.update({f: row[f]})
-                    return OrderedDict(row_dict)
+        return Aggregation.read_aggregated(logs_dir)
@@ -1,7 +1,6 @@
 import logging
 from .StopRunWebserver import StopRunWebserver
 from .util import ConfigError, keyboardinterrupt_handler
-import time
 from http.server import BaseHTTPRequestHandler, HTTPServer
 import multiprocessing as mp
 import psutil
@@ -21,15 +20,14 @@ class PrematureStoppableRun(object):
         post request is received or function call is executed.
         
         From a high level perspective it works as follows:
-        We run two processes (in addition to our main process) simultaneously:
-        1. A process running the interaction function (the AR "run")
-        2. A processes that either:
-            - runs a webserver (for the post_request option) or
-            - continuosly checks the logcat for the given regex (for the logcat_regex option). 
-        In addition we have a queue which is shared among these two processes (as well as the main process).
-        We then block the main process, waiting for one of the two processes to write to the queue.
+        We run a process running the interaction function (the AR "run") and either:
+            - a process running a webserver (for the post_request option) or
+            - a subscription to the logcat stream of the device that matches the lines against the given regex as
+              they are logged (for the logcat_regex option).
+        In addition we have a queue which is shared among these processes (as well as the main process).
+        We then block the main process, waiting for something to write to the queue.
         The process running the interaction function will write to the queue when the interation (and thus the run) has finished.
-        The process running either a webserver will write to the queue when a HTTP POST request is received or when the logcat matches the regex.
+        The webserver process will write to the queue when a HTTP POST request is received and the logcat subscription when a line matches the regex.
         When the stop() method is called on the Experiment object instance it will also write to the queue.
         After a process writes to the queue the given process is finished and the main process will continue as well.
         We then terminate the "other" process that is left. 
@@ -108,24 +106,17 @@ class PrematureStoppableRun(object):
         interaction_function(device, path, run, *args, **kwargs)
         queue.put("interaction")
 
-    @keyboardinterrupt_handler
-    def _mp_logcat_regex(self, queue, device, regex):
-        """ Keeps checking the logcat of the <device> until an 
-            entry matching the <regex> is found. When done it writes
-            to the shared <queue> so main process knows it can stop other process(es).
+    def _logcat_regex_matched(self, line):
+        """ Called by the logcat stream of the device for the first line matching the regex. Writes to the
+            shared queue so the main process knows it can stop the interaction process.
 
             Parameters
             ----------
-            queue : multiprocessing.Queue
-                The queue that is shared among the main process and child processes.
-            device : AndroidRunner.Device
-                The device for the current run.
-            regex : str
-                The regex that should be matched.
+            line : str
+                The logcat line that matched the regex.
         """
-        while not device.logcat_regex(regex):
-            time.sleep(1)
-        queue.put(PrematureStoppableRun.STOPPING_MECHANISM_LOGCAT_REGEX)
+        self.logger.debug(f"Logcat line matched the regex: {line}")
+        self.queue.put(PrematureStoppableRun.STOPPING_MECHANISM_LOGCAT_REGEX)
 
     @keyboardinterrupt_handler
     def _mp_post_request(self, queue, server_port):
@@ -151,13 +142,16 @@ class PrematureStoppableRun(object):
             the stop() function call, a receiving HTTP POST request or found regex. 
         """
         procs = []
+        subscription = None
 
-        # Start either a local webserver or continuously check the devices logcat for a regex in a new process.
+        # Start either a local webserver in a new process or watch the devices logcat for a regex.
         # When the condition is set to "function" we don't need to start another process, only the interaction process.
         if self.condition == "post_request":
             procs.append(mp.Process(target=self._mp_post_request, args=(self.queue, self.server_port,)))
         elif self.condition == "logcat_regex":
-            procs.append(mp.Process(target=self._mp_logcat_regex, args=(self.queue, self.device, self.regex,)))
+            # Lines logged since the logcat was cleared before the run count as well
+            subscription = self.device.watch_logcat(self.regex, self._logcat_regex_matched, once=True,
+                                                    include_buffer=True)
 
         # Always run the interaction (run).
         procs.append(mp.Process(target=self._mp_interaction, args=(self.queue, self.interaction_function, self.device, self.path, self.run, *self.args,), kwargs=self.kwargs))
@@ -167,6 +161,8 @@ class PrematureStoppableRun(object):
 
         # Wait till one of the created processes writes to the queue. It means that that process is finished.
         res = self.queue.get()
+        if subscription is not None:
+            subscription.cancel()
 
         if res != "interaction":
             self.logger.info(f"Run was prematurely stopped by means of a(n) {res}.")
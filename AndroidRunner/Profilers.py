@@ -1,15 +1,37 @@
+import csv
 import logging
+import os.path as op
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from itertools import chain
 
+import paths
 from .PluginHandler import PluginHandler
 
+EXECUTION_MODES = ['serial', 'concurrent']
+
 
 class Profilers(object):
+    """ The profilers of the experiment.
+
+    With the 'serial' execution the profilers are started, stopped and their results are collected one after the
+    other, in the order of the configuration. With 'concurrent' execution every profiler gets its own thread: the
+    threads wait for each other at a barrier and then start (or stop) their profiler at the same moment, and the
+    results are collected in parallel. Either way the time at which every profiler was asked to start and stop and
+    the time it returned are kept in timestamps; with concurrent execution they are also written to a
+    profiler_timestamps csv file per run.
+    """
 
-    def __init__(self, config):
+    def __init__(self, config, execution='serial'):
         self.logger = logging.getLogger(self.__class__.__name__)
         self.profilers = []
         self.loaded_devices = []
+        self.execution = execution
+        self.output_dir = None
+        # Per profiler name: start_requested, started, stop_requested and stopped of the last run
+        self.timestamps = OrderedDict()
         for name, params in list(config.items()):
             try:
                 self.profilers.append(PluginHandler(name, params))
@@ -28,37 +50,82 @@ class Profilers(object):
                 p.load(device)
             self.loaded_devices.append(device.name)
 
+    def run_profilers(self, function, barrier=False):
+        """Calls function(profiler) for all profilers, in a thread per profiler with concurrent execution. With
+        barrier the threads only call function when all of them are ready to do so. Exceptions are raised after
+        all profilers are done."""
+        if self.execution != 'concurrent' or len(self.profilers) < 2:
+            for p in self.profilers:
+                function(p)
+            return
+        ready = threading.Barrier(len(self.profilers)) if barrier else None
+
+        def run(p):
+            if ready is not None:
+                ready.wait()
+            function(p)
+
+        with ThreadPoolExecutor(max_workers=len(self.profilers)) as executor:
+            futures = [executor.submit(run, p) for p in self.profilers]
+        for future in futures:
+            future.result()
+
+    def timed(self, method, requested, returned, device, **kwargs):
+        """Returns a function that calls the method of a profiler and records when it was called and returned"""
+        def call(p):
+            timestamps = self.timestamps.setdefault(p.name, {})
+            timestamps[requested] = time.time()
+            getattr(p, method)(device, **kwargs)
+            timestamps[returned] = time.time()
+        return call
+
     def start_profiling(self, device, **kwargs):
         self.logger.info('Start profiling')
-        for p in self.profilers:
-            p.start_profiling(device, **kwargs)
+        self.timestamps = OrderedDict((p.name, {}) for p in self.profilers)
+        self.run_profilers(self.timed('start_profiling', 'start_requested', 'started', device, **kwargs),
+                           barrier=True)
 
     def stop_profiling(self, device, **kwargs):
         self.logger.info('Stop profiling')
-        for p in self.profilers:
-            p.stop_profiling(device, **kwargs)
+        self.run_profilers(self.timed('stop_profiling', 'stop_requested', 'stopped', device, **kwargs),
+                           barrier=True)
 
     def collect_results(self, device):
         self.logger.info('Collecting results')
-        for p in self.profilers:
-            p.collect_results(device)
+        self.run_profilers(lambda p: p.collect_results(device))
+        if self.execution == 'concurrent':
+            self.write_timestamps(device)
+
+    def write_timestamps(self, device):
+        """Writes the start and stop times of the profilers in the last run to the output directory"""
+        output_dir = self.output_dir if self.output_dir is not None else paths.OUTPUT_DIR
+        filename = 'profiler_timestamps_{}_{}.csv'.format(device.id, time.strftime('%Y.%m.%d_%H%M%S'))
+        columns = ['start_requested', 'started', 'stop_requested', 'stopped']
+        with open(op.join(output_dir, filename), 'w') as f:
+            writer = csv.writer(f)
+            writer.writerow(['profiler'] + columns)
+            for name, timestamps in self.timestamps.items():
+                writer.writerow([name] + [timestamps.get(column, '') for column in columns])
 
     def unload(self, device):
         self.logger.info('Unloading')
         for p in self.profilers:
             p.unload(device)
 
-    def set_output(self):
+    def set_output(self, output_dir=None):
         self.logger.info('Setting output')
+        self.output_dir = output_dir
         for p in self.profilers:
-            p.set_output()
+            p.set_output(output_dir)
 
     def aggregate_subject(self):
         self.logger.info('Start subject aggregation')
         for p in self.profilers:
             p.aggregate_subject()
 
-    def aggregate_end(self, output_dir):
+    def aggregate_end(self, output_dir, processes=1):
+        """Aggregates the results of the experiment in output_dir. Subjects that were not aggregated yet are
+        aggregated in a pool of processes when processes is larger than 1."""
         self.logger.info('Start final aggregation')
         for p in self.profilers:
-            p.aggregate_data_end(output_dir)
+            p.aggregate_data_end(output_dir, processes=processes)
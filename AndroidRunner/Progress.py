@@ -1,7 +1,10 @@
+import functools
 import hashlib
 import logging
 import os
 import sys
+import threading
+from collections import Counter, OrderedDict
 from random import randint
 
 import lxml.etree as et
@@ -9,21 +12,101 @@ import lxml.etree as et
 import paths
 
 
+def synchronized(method):
+    """Runs the method while holding the lock of the Progress instance, so that several device workers can
+    query and update the progress at the same time"""
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        with self.lock:
+            return method(self, *args, **kwargs)
+    return wrapper
+
+
+class RunQueue(object):
+    """ Ids of the runs that still have to be done.
+
+    Keeps the order in which the runs were added and supports removing a run and picking a random run in
+    constant time.
+    """
+
+    def __init__(self):
+        self.ordered = OrderedDict()
+        self.ids = []
+        self.positions = {}
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __iter__(self):
+        return iter(self.ordered)
+
+    def append(self, run_id):
+        self.ordered[run_id] = None
+        self.positions[run_id] = len(self.ids)
+        self.ids.append(run_id)
+
+    def remove(self, run_id):
+        del self.ordered[run_id]
+        # Move the last id into the gap so the list stays dense
+        position = self.positions.pop(run_id)
+        last_id = self.ids.pop()
+        if last_id != run_id:
+            self.ids[position] = last_id
+            self.positions[last_id] = position
+
+    def first(self):
+        return next(iter(self.ordered))
+
+    def random(self):
+        return self.ids[randint(0, len(self.ids) - 1)]
+
+
 class Progress(object):
+    """ Keeps track of the runs that are done and the runs that still have to be done.
+
+    The runs are kept in memory and indexed by device and subject, so the queries done for every run take
+    constant time regardless of the size of the experiment. progress.xml is a snapshot of the progress. The
+    runs finished after the snapshot are appended to a journal next to it (progress.xml.journal), which is
+    replayed when the progress is loaded. After COMPACT_AFTER journal entries, and when the experiment is
+    finished, the snapshot is rewritten and the journal is emptied.
+    """
+    COMPACT_AFTER = 200
+
     def __init__(self, progress_file=None, config_file=None, config=None, load_progress=None):
         self.logger = logging.getLogger(self.__class__.__name__)
+        self.lock = threading.RLock()
+        self.config_hash = None
+        self.output_dir = None
+        self.runs = {}
+        self.runs_to_run = RunQueue()
+        self.device_runs_to_run = {}
+        self.runs_done = []
+        # Number of runs to run and runs done per device, per subject (device, path, browser) and per
+        # device and path of all browsers (device, path, None)
+        self.to_run_counts = Counter()
+        self.done_counts = Counter()
+        # Finished runs that are not in the journal yet and the number of entries in the journal
+        self.unsaved_runs = []
+        self.journal_size = 0
         if load_progress:
             self.progress_xml_file = progress_file
-            self.progress_xml_content = et.parse(self.progress_xml_file).getroot()
+            self.load_xml(et.parse(self.progress_xml_file).getroot())
+            self.replay_journal()
             self.check_config_hash(config_file)
         else:
             self.progress_xml_file = os.path.join(paths.OUTPUT_DIR, 'progress.xml')
-            self.progress_xml_content = self.build_progress_xml(config, config_file)
+            self.config_hash = self.file_to_hash(config_file)
+            self.output_dir = paths.OUTPUT_DIR
+            for run in self.build_runs(config):
+                self.add_run(run)
             self.write_progress_to_file()
 
     def get_progress_xml_file(self):
         return self.progress_xml_file
 
+    def get_journal_file(self):
+        return '%s.journal' % self.progress_xml_file
+
     @staticmethod
     def file_to_hash(path):
         with open(path, 'r') as myfile:
@@ -32,166 +115,192 @@ class Progress(object):
         return hashed_string_obj.hexdigest()
 
     def check_config_hash(self, config_file):
-        progress_config_hash = self.progress_xml_content.find('configHash').text
-        if progress_config_hash == self.file_to_hash(config_file):
+        if self.config_hash == self.file_to_hash(config_file):
             return
         else:
             print('Current config.json and config.json from progress.xml are not the same, cannot continue')
             sys.exit()
 
-    def build_progress_xml(self, config, config_file):
-        config_hash_xml = '<configHash>{}</configHash>'.format(self.file_to_hash(config_file))
-        output_dir_xml = '<outputDir>{}</outputDir>'.format(paths.OUTPUT_DIR)
-        runs_to_run_xml = '<runsToRun>{}</runsToRun>'.format(self.build_runs_xml(config))
-        runs_done_xml = '<runsDone></runsDone>'
-        experiment_xml = '<experiment>{}{}{}{}</experiment>'.format(config_hash_xml, output_dir_xml,
-                                                                    runs_to_run_xml, runs_done_xml)
-        return et.fromstring(experiment_xml)
-
     @staticmethod
-    def build_subject_xml(device, path, browser=None):
-        device_xml = '<device>{}</device>'.format(device)
-        path_xml = '<path>{}</path>'.format(path)
-        if browser is not None:
-            browser_xml = '<browser>{}</browser>'.format(browser)
-            return '{}{}{}'.format(device_xml, path_xml, browser_xml)
-        else:
-            return '{}{}'.format(device_xml, path_xml)
-
-    def build_runs_xml(self, config):
-        runs_xml = ''
-        run_id = 0
+    def build_runs(config):
+        """Returns the runs of the experiment described by config, in the order they are run without randomization"""
+        runs = []
         for device in config['devices']:
             current_paths = config.get('paths', []) + config.get('apps', [])
             for path in current_paths:
-                if config['type'] == 'web':
-                    for browser in config['browsers']:
-                        subject_xml = self.build_subject_xml(device, path, browser)
-                        for run in range(config['repetitions']):
-                            runs_xml = runs_xml + '<run runId="{}">{}<runCount>{}</runCount></run>'. \
-                                format(run_id, subject_xml, run + 1)
-                            run_id += 1
-                else:
-                    subject_xml = self.build_subject_xml(device, path)
+                browsers = config['browsers'] if config['type'] == 'web' else [None]
+                for browser in browsers:
                     for run in range(config['repetitions']):
-                        runs_xml = runs_xml + '<run runId="{}">{}<runCount>{}</runCount></run>'. \
-                            format(run_id, subject_xml, run + 1)
-                        run_id += 1
-
-        return runs_xml
+                        subject = {'runId': str(len(runs)), 'device': device, 'path': path}
+                        if browser is not None:
+                            subject['browser'] = browser
+                        subject['runCount'] = str(run + 1)
+                        runs.append(subject)
+        return runs
 
+    @staticmethod
+    def subject_keys(run):
+        """The counter keys a run is counted under"""
+        keys = [('device', run['device']), ('subject', run['device'], run['path'], None)]
+        if 'browser' in run:
+            keys.append(('subject', run['device'], run['path'], run['browser']))
+        return keys
+
+    def add_run(self, run, done=False):
+        """Adds a run to the runs to run, or to the runs done"""
+        self.runs[run['runId']] = run
+        if done:
+            self.runs_done.append(run['runId'])
+            self.done_counts.update(self.subject_keys(run))
+        else:
+            self.runs_to_run.append(run['runId'])
+            self.device_runs_to_run.setdefault(run['device'], RunQueue()).append(run['runId'])
+            self.to_run_counts.update(self.subject_keys(run))
+
+    """Import the runs from a progress.xml <experiment> element"""
+
+    def load_xml(self, experiment_xml):
+        self.config_hash = experiment_xml.find('configHash').text
+        self.output_dir = experiment_xml.find('outputDir').text
+        for list_name, done in (('runsToRun', False), ('runsDone', True)):
+            for run_xml in experiment_xml.find(list_name):
+                run = {'runId': run_xml.get('runId')}
+                for child in run_xml:
+                    run[child.tag] = child.text
+                self.add_run(run, done=done)
+
+    """Export the runs as a progress.xml <experiment> element"""
+
+    def to_xml(self):
+        experiment_xml = et.Element('experiment')
+        et.SubElement(experiment_xml, 'configHash').text = self.config_hash
+        et.SubElement(experiment_xml, 'outputDir').text = self.output_dir
+        for list_name, run_ids in (('runsToRun', self.runs_to_run), ('runsDone', self.runs_done)):
+            runs_xml = et.SubElement(experiment_xml, list_name)
+            for run_id in run_ids:
+                run = self.runs[run_id]
+                run_xml = et.SubElement(runs_xml, 'run', runId=run_id)
+                for key in ('device', 'path', 'browser', 'runCount'):
+                    if key in run:
+                        et.SubElement(run_xml, key).text = run[key]
+        return experiment_xml
+
+    @property
+    def progress_xml_content(self):
+        return self.to_xml()
+
+    def replay_journal(self):
+        """Marks the runs in the journal as finished, runs that are already done in the snapshot are skipped"""
+        if not os.path.isfile(self.get_journal_file()):
+            return
+        with open(self.get_journal_file(), 'r') as journal:
+            for line in journal:
+                run_id = line.strip()
+                if run_id in self.runs_to_run.ordered:
+                    self.mark_finished(run_id)
+                self.journal_size += 1
+
+    @synchronized
     def write_progress_to_file(self):
-        xml = self.progress_xml_content.getroottree()
-        xml.write(self.progress_xml_file, pretty_print=True)
+        """Saves the runs finished since the last call to the journal. The full snapshot is only written when
+        it does not exist yet, when the journal has grown large or when the experiment is finished."""
+        if self.unsaved_runs:
+            with open(self.get_journal_file(), 'a') as journal:
+                journal.write(''.join('%s\n' % run_id for run_id in self.unsaved_runs))
+                journal.flush()
+                os.fsync(journal.fileno())
+            self.journal_size += len(self.unsaved_runs)
+            self.unsaved_runs = []
+        if not os.path.isfile(self.progress_xml_file) or self.journal_size >= self.COMPACT_AFTER or \
+                not self.runs_to_run:
+            self.write_snapshot()
+
+    @synchronized
+    def write_snapshot(self):
+        """Writes all runs to progress.xml and empties the journal"""
+        # Write to a temporary file first, an interrupted write must never leave a truncated progress file behind
+        xml = self.to_xml().getroottree()
+        temp_file = '%s.tmp' % self.progress_xml_file
+        xml.write(temp_file, pretty_print=True)
+        os.replace(temp_file, self.progress_xml_file)
+        # Replaying runs that are also in the snapshot is harmless, so a crash before this point loses nothing
+        if os.path.isfile(self.get_journal_file()):
+            os.remove(self.get_journal_file())
+        self.journal_size = 0
 
     def get_output_dir(self):
-        return self.progress_xml_content.find('outputDir').text
+        return self.output_dir
 
-    """Get a random run from the <runsToRuns> element"""
+    """Get a random run from the runs to run"""
 
-    def get_random_run(self):
-        runs_to_run = self.progress_xml_content.find('runsToRun')
-        count = len(runs_to_run.getchildren())
-        random_index = randint(0, count - 1)
-        next_run_xml = self.progress_xml_content.find('runsToRun')[random_index]
-        return self.run_to_dict(next_run_xml)
+    @synchronized
+    def get_random_run(self, device=None):
+        runs_to_run = self.runs_to_run if device is None else self.device_runs_to_run[device]
+        return self.run_to_dict(self.runs[runs_to_run.random()])
 
     """Get the top run of the list"""
 
-    def get_next_run(self):
-        next_run_xml = self.progress_xml_content.find('runsToRun')[0]  # First run in list
-        return self.run_to_dict(next_run_xml)
-
-    """Turn a <run> element and its childeren into a dictionary"""
-
-    def run_to_dict(self, run_xml):
-        run = dict()
-        run['runId'] = run_xml.get('runId')
-        run['device'] = run_xml.find('device').text
-        run['path'] = run_xml.find('path').text
-        run['runCount'] = self.get_run_count(run_xml, run['device'], run['path'])
-        browser = run_xml.find('browser')
-        if browser is not None:
-            run['browser'] = run_xml.find('browser').text
-        return run
-
-    def get_run_count(self, run_xml, device, path):
-        runs_done = self.progress_xml_content.find('runsDone')
-        browser_val = run_xml.find('browser')
-        if browser_val is not None:
-            browser_name = browser_val.text
-            query = "run[device='{}' and path='{}' and browser='{}']".format(device, path, browser_name)
-        else:
-            query = "run[device='{}' and path='{}']".format(device, path)
-        elements = runs_done.xpath(query)
-        return len(elements) + 1
+    @synchronized
+    def get_next_run(self, device=None):
+        runs_to_run = self.runs_to_run if device is None else self.device_runs_to_run[device]
+        return self.run_to_dict(self.runs[runs_to_run.first()])  # First run in list
+
+    """Turn a run into the dictionary used by the experiment"""
+
+    def run_to_dict(self, run):
+        run_dict = dict()
+        run_dict['runId'] = run['runId']
+        run_dict['device'] = run['device']
+        run_dict['path'] = run['path']
+        run_dict['runCount'] = self.get_run_count(run['device'], run['path'], run.get('browser'))
+        if 'browser' in run:
+            run_dict['browser'] = run['browser']
+        return run_dict
+
+    def get_run_count(self, device, path, browser=None):
+        return self.done_counts[('subject', device, path, browser)] + 1
+
+    def mark_finished(self, run_id):
+        run = self.runs[run_id]
+        self.runs_to_run.remove(run_id)
+        self.device_runs_to_run[run['device']].remove(run_id)
+        self.to_run_counts.subtract(self.subject_keys(run))
+        self.runs_done.append(run_id)
+        self.done_counts.update(self.subject_keys(run))
 
     """Marks run as finished"""
 
+    @synchronized
     def run_finished(self, run_id):
-        runs_to_run = self.progress_xml_content.find('runsToRun')
-        runs_done = self.progress_xml_content.find('runsDone')
-        elements = runs_to_run.findall("run[@runId='{}']".format(run_id))
-        for el in elements:
-            runs_to_run.remove(el)
-            runs_done.append(el)
+        run_id = str(run_id)
+        if run_id in self.runs_to_run.ordered:
+            self.mark_finished(run_id)
+            self.unsaved_runs.append(run_id)
 
     """Check if this subject already had it's first run"""
 
+    @synchronized
     def subject_first(self, device, path, browser=None):
-        runs_done = self.progress_xml_content.find('runsDone')
-        if browser is not None:
-            elements = runs_done.xpath(
-                "run[device='{}' and path='{}' and browser='{}']".format(device, path, browser))
-        else:
-            elements = runs_done.xpath(
-                "run[device='{}' and path='{}']".format(device, path))
-        if not elements:
-            return True
-        else:
-            return False
+        return self.done_counts[('subject', device, path, browser)] == 0
 
     """Checks if all subject runs are done"""
 
+    @synchronized
     def subject_finished(self, device, path, browser=None):
-        runs_to_run = self.progress_xml_content.find('runsToRun')
-        if browser is not None:
-            elements = runs_to_run.xpath(
-                "run[device='{}' and path='{}' and browser='{}']".format(device, path, browser))
-        else:
-            elements = runs_to_run.xpath(
-                "run[device='{}' and path='{}']".format(device, path))
-        if not elements:
-            return True
-        else:
-            return False
+        return self.to_run_counts[('subject', device, path, browser)] == 0
 
     """Check if this device already had it's first run"""
 
+    @synchronized
     def device_first(self, device):
-        runs_done = self.progress_xml_content.find('runsDone')
-        elements = runs_done.xpath("run[device='{}']".format(device))
-
-        if not elements:
-            return True
-        else:
-            return False
+        return self.done_counts[('device', device)] == 0
 
     """Checks if all device runs are done"""
 
+    @synchronized
     def device_finished(self, device):
-        runs_to_run = self.progress_xml_content.find('runsToRun')
-        elements = runs_to_run.xpath("run[device='{}']".format(device))
-
-        if not elements:
-            return True
-        else:
-            return False
+        return self.to_run_counts[('device', device)] == 0
 
+    @synchronized
     def experiment_finished_check(self):
-        runs_to_run = self.progress_xml_content.find('runsToRun')
-        count = len(runs_to_run.getchildren())
-        if count == 0:
-            return True
-        else:
-            return False
+        return len(self.runs_to_run) == 0
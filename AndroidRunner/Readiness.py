@@ -0,0 +1,93 @@
+import logging
+import re
+import threading
+import time
+
+from . import Tests
+from .util import ConfigError
+
+PROBE_TYPES = ['activity', 'logcat', 'process', 'stopped', 'delay']
+DEFAULT_TIMEOUT = 10000
+POLL_INTERVAL = 0.1
+
+
+class Probe(object):
+    """ Waits until a device is ready for the next step of a run, instead of sleeping for a fixed time.
+
+    activity  The activity of the package is resumed (dumpsys activity).
+    logcat    A logcat line matches regex, e.g. "Displayed {package}". Lines logged since the logcat was cleared at
+              the start of the run count as well.
+    process   A process of the package is running.
+    stopped   No process of the package is running.
+    delay     Sleeps for duration milliseconds, the fixed delay of earlier versions.
+
+    {package} in the regex is replaced by the package that is waited for. The probes other than delay give up after
+    timeout milliseconds, after which the run continues with a warning.
+    """
+
+    def __init__(self, config):
+        self.logger = logging.getLogger(self.__class__.__name__)
+        self.type = Tests.is_valid_option(config.get('type'), valid_options=PROBE_TYPES)
+        self.timeout = Tests.is_integer(config.get('timeout', DEFAULT_TIMEOUT)) / 1000
+        self.duration = Tests.is_integer(config.get('duration', 0)) / 1000
+        self.regex = config.get('regex', None)
+        if self.type == 'logcat' and self.regex is None:
+            raise ConfigError('The logcat readiness probe needs a "regex"')
+
+    def wait(self, device, package):
+        """Waits until device is ready, returns False when the probe timed out"""
+        start = time.time()
+        if self.type == 'delay':
+            time.sleep(self.duration)
+            return True
+        if self.type == 'logcat':
+            ready = self.wait_for_logcat(device, package)
+        else:
+            ready = self.poll(getattr(self, 'is_%s' % self.type), device, package)
+        if ready:
+            self.logger.debug('%s: %s probe for %s ready after %.2fs' % (device.id, self.type, package,
+                                                                         time.time() - start))
+        else:
+            self.logger.warning('%s: %s probe for %s not ready after %ss, continuing' % (device.id, self.type,
+                                                                                           package, self.timeout))
+        return ready
+
+    def poll(self, check, device, package):
+        deadline = time.time() + self.timeout
+        while True:
+            if check(device, package):
+                return True
+            if time.time() >= deadline:
+                return False
+            time.sleep(POLL_INTERVAL)
+
+    def wait_for_logcat(self, device, package):
+        matched = threading.Event()
+        subscription = device.watch_logcat(self.regex.replace('{package}', re.escape(package)),
+                                           lambda line: matched.set(), once=True, include_buffer=True)
+        try:
+            return matched.wait(self.timeout)
+        finally:
+            subscription.cancel()
+
+    @staticmethod
+    def is_activity(device, package):
+        # mResumedActivity up to Android 9, topResumedActivity from Android 10
+        resumed = device.shell('dumpsys activity activities | grep -E "mResumedActivity|topResumedActivity"')
+        return ' %s/' % package in resumed
+
+    @staticmethod
+    def is_process(device, package):
+        return bool(device.shell('pidof %s' % package).strip())
+
+    @staticmethod
+    def is_stopped(device, package):
+        return not Probe.is_process(device, package)
+
+
+def probes(config, defaults):
+    """Returns the probe of every wait point in defaults, configured by config when it has the wait point"""
+    unknown = set(config) - set(defaults)
+    if unknown:
+        raise ConfigError('Unknown readiness wait point(s) %s, use one of: %s' % (sorted(unknown), sorted(defaults)))
+    return {name: Probe(config.get(name, default)) for name, default in defaults.items()}
@@ -1,8 +1,8 @@
+import functools
 import logging
 import multiprocessing as mp
 import os.path as op
-import signal
-import time
+import queue as queue_module
 from . import Tests
 from .util import FileNotFoundError
 
@@ -38,60 +38,45 @@ class Script(object):
         queue.put('script')
 
     @staticmethod
-    def mp_logcat_regex(queue, device, regex):
-        """The multiprocessing wrapper of Device.logcat_regex()"""
-        # https://stackoverflow.com/a/21936682
-        # pyadb uses subprocess.communicate(), therefore it blocks
-        while not device.logcat_regex(regex):
-            time.sleep(1)
+    def logcat_regex_matched(queue, line):
+        """Called by the logcat stream of the device for the first line matching the logcat_regex"""
         queue.put('logcat')
 
     def run(self, device, *args, **kwargs):
         """Execute the script with respect to the termination conditions"""
-        # https://stackoverflow.com/a/6286343
-        with script_timeout(seconds=self.timeout):
-            processes = []
+        # The timeout is applied while waiting for the queue instead of with SIGALRM, signals can only be used
+        # from the main thread while scripts are also run from device worker threads
+        processes = []
+        subscription = None
+        try:
+            queue = mp.Queue()
+            processes.append(mp.Process(target=self.mp_run, args=(queue, device,) + args, kwargs=kwargs))
+            if self.logcat_event is not None and device is not None:
+                matched = functools.partial(self.logcat_regex_matched, queue)
+                subscription = device.watch_logcat(self.logcat_event, matched, once=True, include_buffer=True)
+            for p in processes:
+                p.start()
             try:
-                queue = mp.Queue()
-                processes.append(mp.Process(target=self.mp_run, args=(queue, device,) + args, kwargs=kwargs))
-                if self.logcat_event is not None and device is not None:
-                    processes.append(mp.Process(target=self.mp_logcat_regex, args=(queue, device, self.logcat_event)))
-                for p in processes:
-                    p.start()
-                result = queue.get()
-                if isinstance(result, tuple):
-                    name = result[0].__class__.__name__
-                    message = str(result[0])
-                    trace = result[1]
-                    log_message = '%s in %s: %s\n%s' % (name, self.filename, message, trace)
-                    # self.logger.error(log_message)
-                    raise ScriptError(log_message)
-            except TimeoutError:
-                self.logger.debug('Interaction function timeout (%sms)' % self.timeout)
-                result = 'timeout'
-            finally:
-                for p in processes:
-                    p.terminate()
-            return result
+                result = queue.get(timeout=self.timeout if self.timeout != 0 else None)
+            except queue_module.Empty:
+                raise TimeoutError()
+            if isinstance(result, tuple):
+                name = result[0].__class__.__name__
+                message = str(result[0])
+                trace = result[1]
+                log_message = '%s in %s: %s\n%s' % (name, self.filename, message, trace)
+                # self.logger.error(log_message)
+                raise ScriptError(log_message)
+        except TimeoutError:
+            self.logger.debug('Interaction function timeout (%sms)' % self.timeout)
+            result = 'timeout'
+        finally:
+            if subscription is not None:
+                subscription.cancel()
+            for p in processes:
+                p.terminate()
+        return result
 
 
 class TimeoutError(Exception):
     pass
-
-
-# https://stackoverflow.com/a/22348885
-class script_timeout:
-    def __init__(self, seconds):
-        self.seconds = float(seconds)
-
-    def handle_timeout(self, signum, frame):
-        raise TimeoutError()
-
-    def __enter__(self):
-        if self.seconds != 0:
-            signal.signal(signal.SIGALRM, self.handle_timeout)
-            signal.setitimer(signal.ITIMER_REAL, self.seconds)
-
-    def __exit__(self, type, value, traceback):
-        if self.seconds != 0:
-            signal.alarm(0)
@@ -0,0 +1,363 @@
+import functools
+import io
+import itertools
+import logging
+import multiprocessing as mp
+import os
+import pickle
+import queue as queue_module
+import signal
+import threading
+import time
+import traceback
+
+import paths
+from .Script import ScriptError
+
+
+class ScriptCancelled(BaseException):
+    """Raised inside the worker to stop the running script, a BaseException so scripts do not catch it by accident"""
+    pass
+
+
+class ArgumentPickler(pickle.Pickler):
+    """Pickles the messages between the experiment and the worker, objects the worker refers to are sent by
+    reference"""
+
+    def __init__(self, file, worker):
+        super(ArgumentPickler, self).__init__(file, protocol=pickle.HIGHEST_PROTOCOL)
+        self.worker = worker
+
+    def persistent_id(self, obj):
+        return self.worker.reference(obj)
+
+
+class ArgumentUnpickler(pickle.Unpickler):
+    def __init__(self, file, worker):
+        super(ArgumentUnpickler, self).__init__(file)
+        self.worker = worker
+
+    def persistent_load(self, pid):
+        return self.worker.dereference(pid)
+
+
+class ParentProxy(object):
+    """ An object of the experiment process that cannot be pickled, as a script in the worker sees it.
+
+    Reading an attribute reads it from the object in the experiment process and calling a method calls it there, so
+    the script always sees the current state of the object, like the run queue of the experiment.
+    """
+
+    def __init__(self, worker, token):
+        self._worker = worker
+        self._token = token
+
+    def __getattr__(self, name):
+        if name.startswith('__'):
+            raise AttributeError(name)
+        return self._worker.call_parent(self._token, 'getattr', name)
+
+    def __call__(self, *args, **kwargs):
+        return self._worker.call_parent(self._token, 'call', None, args, kwargs)
+
+
+class ScriptWorker(object):
+    """ A long-lived process that runs the scripts of the hooks for one device.
+
+    The worker is forked when the first hook is run, so it starts with the modules of the Python3 scripts already
+    loaded and with its own copy of the device. Every hook is then a request to the worker instead of a new process.
+    The termination conditions are those of Script.run: the script returns, the logcat_regex matches or the timeout
+    expires. In the last two cases the running script is cancelled with a signal and the worker waits for the next
+    request; a script that does not stop within CANCEL_GRACE seconds is terminated with its worker, which is forked
+    again for the next hook.
+
+    Arguments are pickled for every request, together with the current paths (OUTPUT_DIR changes for every subject).
+    Arguments that cannot be pickled, like the experiment that is passed to the interaction hook, reach the script as
+    a ParentProxy: the worker sends its attribute reads and method calls back to the experiment process, which
+    answers them while it waits for the result of the script. The device is the copy the worker got when it was forked.
+    """
+    CANCEL_SIGNAL = signal.SIGUSR1
+    CANCEL_GRACE = 5
+
+    def __init__(self, scripts, device):
+        self.logger = logging.getLogger(self.__class__.__name__)
+        self.scripts = scripts
+        self.device = device
+        self.process = None
+        self.requests = None
+        self.results = None
+        self.lock = threading.Lock()
+        self.request_ids = itertools.count()
+        # Objects the worker got a copy of when it was forked: token -> object and id(object) -> token
+        self.shared = {}
+        self.shared_ids = {}
+        # Objects the worker refers to in the experiment process: token -> object and id(object) -> token. The
+        # proxies created while answering the calls of a request are dropped after the request.
+        self.proxies = {}
+        self.proxy_ids = {}
+        self.proxy_tokens = itertools.count()
+        self.request_proxies = []
+        self.replies = None
+        # Worker process: the request that is running and the ids of its calls to the experiment process
+        self.in_worker = False
+        self.request_id = None
+        self.call_ids = itertools.count()
+        self.running = False
+
+    def is_alive(self):
+        return self.process is not None and self.process.is_alive()
+
+    @staticmethod
+    def picklable(value):
+        try:
+            pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+            return True
+        except Exception:
+            return False
+
+    def proxy(self, value):
+        """Makes the worker refer to value in the experiment process instead of getting a copy of it, returns its
+        token"""
+        token = self.proxy_ids.get(id(value))
+        if token is None:
+            token = next(self.proxy_tokens)
+            self.proxies[token] = value
+            self.proxy_ids[id(value)] = token
+        return token
+
+    def proxy_arguments(self, values):
+        """Proxies the arguments of a hook that cannot be pickled, they keep their proxy until the worker stops"""
+        for value in values:
+            if id(value) not in self.proxy_ids and id(value) not in self.shared_ids and not self.picklable(value):
+                self.proxy(value)
+
+    def drop_request_proxies(self):
+        for token in self.request_proxies:
+            self.proxy_ids.pop(id(self.proxies.pop(token)), None)
+        self.request_proxies = []
+
+    def reference(self, obj):
+        """The persistent id of obj in a message, None when obj is pickled"""
+        if isinstance(obj, ParentProxy):
+            return 'proxy', obj._token
+        if id(obj) in self.shared_ids:
+            return 'shared', self.shared_ids[id(obj)]
+        if id(obj) in self.proxy_ids:
+            return 'proxy', self.proxy_ids[id(obj)]
+        return None
+
+    def dereference(self, pid):
+        kind, token = pid
+        if kind == 'shared':
+            return self.shared[token]
+        if self.in_worker:
+            return ParentProxy(self, token)
+        return self.proxies[token]
+
+    def start(self):
+        """Forks the worker"""
+        self.stop()
+        self.shared = {}
+        self.shared_ids = {}
+        if self.device is not None:
+            self.shared[0] = self.device
+            self.shared_ids[id(self.device)] = 0
+        context = mp.get_context('fork')
+        self.requests = context.Queue()
+        self.results = context.Queue()
+        self.replies = context.Queue()
+        self.process = context.Process(target=self.serve, name='script-worker', daemon=True)
+        self.process.start()
+        self.logger.debug('Started script worker %s' % self.process.pid)
+
+    def stop(self):
+        """Stops the worker, it is terminated when it does not stop within CANCEL_GRACE seconds"""
+        self.proxies = {}
+        self.proxy_ids = {}
+        self.request_proxies = []
+        if self.process is None:
+            return
+        if self.process.is_alive():
+            self.requests.put(None)
+            self.process.join(self.CANCEL_GRACE)
+        self.terminate()
+
+    def terminate(self):
+        if self.process.is_alive():
+            self.process.terminate()
+        self.process.join()
+        self.process = None
+        for q in (self.requests, self.results, self.replies):
+            q.close()
+            q.cancel_join_thread()
+        self.requests = self.results = self.replies = None
+
+    def dumps(self, message):
+        buffer = io.BytesIO()
+        ArgumentPickler(buffer, self).dump(message)
+        return buffer.getvalue()
+
+    def loads(self, data):
+        return ArgumentUnpickler(io.BytesIO(data), self).load()
+
+    # Worker process
+
+    def cancelled(self, signum, frame):
+        """Signal handler of the worker, a cancel request that arrives after the script returned is ignored"""
+        if self.running:
+            raise ScriptCancelled()
+
+    def serve(self):
+        """The loop of the worker process"""
+        signal.signal(self.CANCEL_SIGNAL, self.cancelled)
+        # Interrupts are handled by the experiment, which stops the worker
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        # The objects of the experiment process are only reached through their proxies
+        self.in_worker = True
+        self.proxies = {}
+        self.proxy_ids = {}
+        while True:
+            data = self.requests.get()
+            if data is None:
+                break
+            self.results.put(self.execute(data))
+
+    def execute(self, data):
+        """Runs the script of a request, returns (request id, 'script' | 'cancelled' | 'error', error message)"""
+        request_id, name, index, args, kwargs, paths_dict = self.loads(data)
+        self.request_id = request_id
+        for key, value in paths_dict.items():
+            setattr(paths, key, value)
+        script = self.scripts[name][index]
+        try:
+            # Device state that may have been changed by the experiment since the worker was forked
+            if self.device is not None:
+                self.device.invalidate_cache()
+            self.running = True
+            try:
+                output = script.execute_script(self.device, *args, **kwargs)
+            finally:
+                self.running = False
+            self.logger.debug('%s returned %s' % (script.filename, output))
+            return request_id, 'script', None
+        except ScriptCancelled:
+            return request_id, 'cancelled', None
+        except Exception as e:
+            message = '%s in %s: %s\n%s' % (e.__class__.__name__, script.filename, str(e), traceback.format_exc())
+            return request_id, 'error', message
+
+    def call_parent(self, token, operation, name, args=(), kwargs=None):
+        """Reads attribute name of the proxied object token ('getattr') or calls it ('call', the object itself when
+        name is None) in the experiment process and returns the result"""
+        call_id = next(self.call_ids)
+        call = self.dumps((token, operation, name, args, kwargs or {}))
+        self.results.put((self.request_id, 'call', (call_id, call)))
+        while True:
+            reply_id, kind, data = self.replies.get()
+            # Replies to the calls of a cancelled script are dropped
+            if reply_id == call_id:
+                break
+        if kind == 'method':
+            return lambda *method_args, **method_kwargs: self.call_parent(token, 'call', name, method_args,
+                                                                          method_kwargs)
+        value = self.loads(data)
+        if kind == 'error':
+            raise value
+        return value
+
+    # Experiment process
+
+    def logcat_regex_matched(self, request_id, line):
+        """Called by the logcat stream of the device for the first line matching the logcat_regex"""
+        results = self.results
+        if results is not None:
+            results.put((request_id, 'logcat', None))
+
+    def run(self, name, index, *args, **kwargs):
+        """Runs script index of hook name in the worker with respect to the termination conditions, returns
+        'script', 'logcat' or 'timeout' like Script.run"""
+        script = self.scripts[name][index]
+        with self.lock:
+            if not self.is_alive():
+                self.start()
+            self.proxy_arguments(list(args) + list(kwargs.values()))
+            request_id = next(self.request_ids)
+            data = self.dumps((request_id, name, index, args, kwargs, paths.paths_dict()))
+            subscription = None
+            try:
+                if script.logcat_event is not None and self.device is not None:
+                    matched = functools.partial(self.logcat_regex_matched, request_id)
+                    subscription = self.device.watch_logcat(script.logcat_event, matched, once=True,
+                                                            include_buffer=True)
+                self.requests.put(data)
+                kind, message = self.wait(request_id, script.timeout if script.timeout != 0 else None,
+                                          logcat=True)
+                if kind == 'error':
+                    raise ScriptError(message)
+                if kind == 'timeout':
+                    self.logger.debug('Interaction function timeout (%sms)' % script.timeout)
+                if kind in ('logcat', 'timeout'):
+                    self.cancel(request_id)
+                return kind
+            finally:
+                if subscription is not None:
+                    subscription.cancel()
+                self.drop_request_proxies()
+
+    def wait(self, request_id, timeout, logcat=False):
+        """Waits for the result of request_id, results of earlier (cancelled) requests are dropped and the calls of
+        the script to the experiment process are answered. Returns the kind and error message of the result, kind is
+        'timeout' when there was none within timeout seconds."""
+        deadline = time.monotonic() + timeout if timeout is not None else None
+        while True:
+            remaining = max(0, deadline - time.monotonic()) if deadline is not None else None
+            try:
+                result_id, kind, message = self.results.get(timeout=remaining)
+            except queue_module.Empty:
+                return 'timeout', None
+            if result_id != request_id:
+                continue
+            if kind == 'call':
+                self.answer(message)
+            elif logcat or kind != 'logcat':
+                return kind, message
+
+    def answer(self, call):
+        """Answers a call of the worker to a proxied object with a reply (call id, kind, pickled value). Kind
+        'method' tells the worker that the attribute is a method, which it then calls with 'call'."""
+        call_id, data = call
+        try:
+            token, operation, name, args, kwargs = self.loads(data)
+            target = self.proxies[token]
+            if operation == 'getattr':
+                value = getattr(target, name)
+                if callable(value):
+                    self.replies.put((call_id, 'method', None))
+                    return
+            else:
+                value = (target if name is None else getattr(target, name))(*args, **kwargs)
+        except Exception as e:
+            try:
+                error = self.dumps(e)
+            except Exception:
+                error = self.dumps(ScriptError('%s: %s' % (e.__class__.__name__, str(e))))
+            self.replies.put((call_id, 'error', error))
+            return
+        try:
+            data = self.dumps(value)
+        except Exception:
+            # The worker gets a proxy for this request
+            self.request_proxies.append(self.proxy(value))
+            data = self.dumps(value)
+        self.replies.put((call_id, 'value', data))
+
+    def cancel(self, request_id):
+        """Cancels the script of request_id, the worker is terminated when the script does not stop in time"""
+        try:
+            os.kill(self.process.pid, self.CANCEL_SIGNAL)
+        except OSError:
+            pass
+        kind, _ = self.wait(request_id, self.CANCEL_GRACE)
+        if kind == 'timeout':
+            self.logger.warning('Script did not stop within %ss, terminating the script worker' % self.CANCEL_GRACE)
+            self.terminate()
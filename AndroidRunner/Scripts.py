@@ -1,16 +1,36 @@
 import logging
+import os
 import os.path as op
+import threading
 
 import paths
 from .MonkeyReplay import MonkeyReplay
 from .MonkeyRunner import MonkeyRunner
 from .Python3 import Python3
+from .ScriptWorker import ScriptWorker
 from .util import ConfigError
 
+EXECUTION_MODES = ['worker', 'process']
+
 
 class Scripts(object):
-    def __init__(self, config, monkeyrunner_path='monkeyrunner', monkey_playback_path='monkey_playback.py'):
+    """ The scripts of the hooks of the experiment.
+
+    With 'worker' execution the scripts of a device are run by a ScriptWorker, a process that is started once and
+    runs every hook. With 'process' execution every script is run in a new process by Script.run. Hooks that are run
+    from another process than the one that created the scripts, like the interaction of a run with a
+    run_stopping_condition, are run with 'process' execution as well: that process is terminated with its children
+    when the run is stopped, and it must not use the workers of the experiment process.
+    """
+
+    def __init__(self, config, monkeyrunner_path='monkeyrunner', monkey_playback_path='monkey_playback.py',
+                 execution='worker'):
         self.logger = logging.getLogger(self.__class__.__name__)
+        self.execution = execution
+        self.pid = os.getpid()
+        # The script worker of every device
+        self.workers = {}
+        self.workers_lock = threading.Lock()
         self.scripts = {}
         for name, script in list(config.items()):
             self.scripts[name] = []
@@ -36,5 +56,23 @@ class Scripts(object):
 
     def run(self, name, device, *args, **kwargs):
         self.logger.debug('Running hook {} on device {}\nargs: {}\nkwargs: {}'.format(name, device, args, kwargs))
-        for script in self.scripts.get(name, []):
-            script.run(device, *args, **kwargs)
+        for index, script in enumerate(self.scripts.get(name, [])):
+            if self.execution == 'worker' and os.getpid() == self.pid:
+                self.worker(device).run(name, index, *args, **kwargs)
+            else:
+                script.run(device, *args, **kwargs)
+
+    def worker(self, device):
+        """Returns the script worker of device, its process is only started when it runs the first script"""
+        with self.workers_lock:
+            if device not in self.workers:
+                self.workers[device] = ScriptWorker(self.scripts, device)
+            return self.workers[device]
+
+    def stop_workers(self):
+        """Stops the script workers of all devices"""
+        with self.workers_lock:
+            workers = list(self.workers.values())
+            self.workers = {}
+        for worker in workers:
+            worker.stop()
@@ -5,11 +5,15 @@ from . import Tests
 import paths
 from .BrowserFactory import BrowserFactory
 from .Experiment import Experiment
-from .util import makedirs, slugify_dir
+from .util import slugify_dir
 from AndroidRunner.PrematureStoppableRun import PrematureStoppableRun 
 
 
 class WebExperiment(Experiment):
+    # The browser is the resumed activity as soon as the URL is opened, so the page load gets the fixed delay
+    READINESS_DEFAULTS = {'browser_start': {'type': 'activity'}, 'load': {'type': 'delay', 'duration': 5000},
+                          'close': {'type': 'stopped'}}
+
     def __init__(self, config, progress, restart):
         super(WebExperiment, self).__init__(config, progress, restart)
         self.browsers = [BrowserFactory.get_browser(b)() for b in config.get('browsers', ['chrome'])]
@@ -49,10 +53,9 @@ class WebExperiment(Experiment):
             self.aggregate_subject()
 
     def prepare_output_dir(self, current_run):
-        paths.OUTPUT_DIR = op.join(paths.BASE_OUTPUT_DIR, 'data/', current_run['device'],
-                                   slugify_dir(current_run['path']),
-                                   current_run['browser'])
-        makedirs(paths.OUTPUT_DIR)
+        self.set_output_dir(op.join(paths.BASE_OUTPUT_DIR, 'data/', current_run['device'],
+                                    slugify_dir(current_run['path']),
+                                    current_run['browser']))
 
     def before_run_subject(self, device, path, *args, **kwargs):
         super(WebExperiment, self).before_run_subject(device, path, *args, **kwargs)
@@ -62,18 +65,18 @@ class WebExperiment(Experiment):
         super(WebExperiment, self).before_run(device, path, run, *args, **kwargs)
         device.shell('logcat -c')
         kwargs['browser'].start(device)
-        time.sleep(5)
+        self.wait_until_ready('browser_start', device, kwargs['browser'].package_name)
 
     def interaction(self, device, path, run, *args, **kwargs):
         kwargs['browser'].load_url(device, path)
-        time.sleep(5)
+        self.wait_until_ready('load', device, kwargs['browser'].package_name)
         super(WebExperiment, self).interaction(device, path, run, *args, **kwargs)
         # TODO: Fix web experiments running longer than self.duration
         time.sleep(self.duration)
 
     def after_run(self, device, path, run, *args, **kwargs):
         kwargs['browser'].stop(device, self.clear_cache)
-        time.sleep(3)
+        self.wait_until_ready('close', device, kwargs['browser'].package_name)
         super(WebExperiment, self).after_run(device, path, run, *args, **kwargs)
 
     def after_last_run(self, device, path, *args, **kwargs):
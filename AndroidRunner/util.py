@@ -42,10 +42,10 @@ def load_json(path):
             raise e
 
 def list_subdir(a_dir):
-    """List immediate subdirectories of a_dir"""
+    """List immediate subdirectories of a_dir, sorted"""
     # https://stackoverflow.com/a/800201
-    return [name for name in os.listdir(a_dir)
-            if os.path.isdir(os.path.join(a_dir, name))]
+    return sorted(name for name in os.listdir(a_dir)
+                  if os.path.isdir(os.path.join(a_dir, name)))
 
 def makedirs(path):
     """Create a directory on path if it does not exist"""
@@ -1,17 +1,23 @@
 import argparse
 import logging
+import multiprocessing as mp
 import os.path as op
 import sys
 import time
 
 import paths
+from AndroidRunner import Tests
 from AndroidRunner.ExperimentFactory import ExperimentFactory
+from AndroidRunner.Profilers import Profilers
 from AndroidRunner.Progress import Progress
-from AndroidRunner.util import makedirs
+from AndroidRunner.util import load_json, makedirs
 
 
 def main():
     args = parse_arguments(sys.argv[1:])
+    if args.get('aggregate') is not None:
+        aggregate(args)
+        return
     progress, log_dir = set_progress(args)
     config_file = op.abspath(args['file'])
     setup_paths(config_file, log_dir)
@@ -38,6 +44,22 @@ def main():
                      '--progress {}'.format(progress_file))
 
 
+def aggregate(args):
+    """Aggregates the results in the output directory of an earlier experiment again, without running it"""
+    config_file = op.abspath(args['file'])
+    output_dir = op.abspath(args['aggregate'])
+    setup_paths(config_file, output_dir)
+    logger = setup_logger(output_dir)
+
+    try:
+        config = load_json(config_file)
+        processes = Tests.is_integer(config.get('aggregation_processes', mp.cpu_count()), minimum=1)
+        Profilers(config.get('profilers', {})).aggregate_end(output_dir, processes=processes)
+    except Exception as e:
+        logger.error('%s: %s' % (e.__class__.__name__, str(e)))
+        logger.error('An error occurred, the aggregation of {} has been stopped.'.format(output_dir))
+
+
 def set_progress(args):
     config_file = op.abspath(args['file'])
     if not args.get('progress') is None:
@@ -53,6 +75,8 @@ def parse_arguments(args):
     parser = argparse.ArgumentParser()
     parser.add_argument('file')
     parser.add_argument('--progress', default=argparse.SUPPRESS)
+    parser.add_argument('--aggregate', metavar='OUTPUT_DIR', default=argparse.SUPPRESS,
+                        help='aggregate the results in the output directory of an earlier run of the experiment')
     return vars(parser.parse_args(args))
 
 
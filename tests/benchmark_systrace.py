@@ -0,0 +1,106 @@
+""" Benchmark of BatterystatsParser.parse_systrace on synthetic traces of increasing size.
+
+Run from the root of the repository:
+
+    python -m tests.benchmark_systrace [--events 10000 100000 1000000] [--cores 8] [--processes 4]
+
+For every size a trace with the given number of cpu_idle and cpu_frequency events (and twice as many other
+events) is generated, parsed in a single process and, when --processes is given, sharded across a process pool.
+"""
+import argparse
+import os
+import random
+import shutil
+import tempfile
+import time
+
+from AndroidRunner.Plugins.batterystats import BatterystatsParser
+
+APP = 'com.example.app'
+SPEEDS = ['384000', '486000', '594000', '702000', '810000', '918000', '1026000', '1134000', '1242000', '1350000',
+          '1458000', '1512000']
+IDLE_STATES = ['0', '1', '4294967295']
+
+
+def write_synthetic_run(directory, events, cores=8, seed=0):
+    """Writes a systrace, logcat and batterystats file for a run with the given number of cpu events and returns
+    their paths. The app is displayed 1 second after the clock sync marker and stopped half a second before the end
+    of the trace."""
+    rng = random.Random(seed)
+    systrace_file = os.path.join(directory, 'systrace.html')
+    logcat_file = os.path.join(directory, 'logcat.txt')
+    batterystats_file = os.path.join(directory, 'batterystats.txt')
+
+    duration = max(events // 1000, 10)
+    stopped = duration - 1
+    with open(logcat_file, 'w') as logcat:
+        logcat.write('01-01 10:00:00.000  1000  1000 I ActivityManager: Displayed %s/.MainActivity: +1s\n' % APP)
+        logcat.write('01-01 %02d:%02d:%02d.000  1000  1000 I ActivityManager: Force stopping %s appid=10001\n'
+                     % (10 + stopped // 3600, stopped // 60 % 60, stopped % 60, APP))
+    logcat_start, _ = BatterystatsParser.parse_logcat(APP, logcat_file, 28)
+    sync_time = 100.0
+
+    with open(systrace_file, 'w') as systrace:
+        systrace.write('<!DOCTYPE html>\n<html>\n<body>\n<script class="trace-data" type="application/text">\n')
+        systrace.write('# tracer: nop\n#\n')
+        systrace.write('          <...>-4321  (-----) [000] ...1  %.6f: tracing_mark_write: '
+                       'trace_event_clock_sync: realtime_ts=%d\n' % (sync_time, logcat_start - 1000))
+        timestamp = sync_time - 0.5
+        step = (duration + 1.0) / events
+        for _ in range(events):
+            timestamp += step
+            cpu_id = rng.randrange(cores)
+            for _ in range(2):
+                systrace.write('     surfaceflinger-512   (  512) [00%d] d..3  %.6f: sched_switch: prev_comm=surfaceflinger '
+                               'prev_pid=512 prev_prio=112 prev_state=S ==> next_comm=swapper/%d next_pid=0 '
+                               'next_prio=120\n' % (cpu_id, timestamp, cpu_id))
+            if rng.random() < 0.5:
+                systrace.write('          <idle>-0     (-----) [00%d] d..2  %.6f: cpu_idle: state=%s cpu_id=%d\n'
+                               % (cpu_id, timestamp, rng.choice(IDLE_STATES), cpu_id))
+            else:
+                systrace.write('     kworker/%d:1-123   (  123) [00%d] ...1  %.6f: cpu_frequency: state=%s cpu_id=%d\n'
+                               % (cpu_id, cpu_id, timestamp, rng.choice(SPEEDS), cpu_id))
+        systrace.write('</script>\n</body>\n</html>\n')
+
+    with open(batterystats_file, 'w') as batterystats:
+        batterystats.write('                    0 (2) 100 status=discharging health=good plug=none temp=250 '
+                           'volt=4012 charge=3000\n')
+    return systrace_file, logcat_file, batterystats_file
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--events', type=int, nargs='+', default=[10000, 100000, 1000000])
+    parser.add_argument('--cores', type=int, default=8)
+    parser.add_argument('--processes', type=int, default=None)
+    parser.add_argument('--power-profile', default=os.path.join(os.path.dirname(os.path.abspath(__file__)), 'unit',
+                                                                'fixtures', 'power_profile.xml'))
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp()
+    try:
+        print('%10s %10s %12s %12s' % ('events', 'MB', 'single (s)', 'pool (s)'))
+        for events in args.events:
+            systrace_file, logcat_file, batterystats_file = write_synthetic_run(directory, events, args.cores)
+            size = os.path.getsize(systrace_file) / 1024.0 / 1024.0
+
+            start = time.perf_counter()
+            rows = BatterystatsParser.parse_systrace(APP, systrace_file, logcat_file, batterystats_file,
+                                                     args.power_profile, args.cores, 28)
+            single = time.perf_counter() - start
+
+            pool = float('nan')
+            if args.processes:
+                start = time.perf_counter()
+                pool_rows = BatterystatsParser.parse_systrace(APP, systrace_file, logcat_file, batterystats_file,
+                                                              args.power_profile, args.cores, 28,
+                                                              processes=args.processes)
+                pool = time.perf_counter() - start
+                assert pool_rows == rows, 'The process pool returned different rows'
+            print('%10d %10.1f %12.3f %12.3f' % (events, size, single, pool))
+    finally:
+        shutil.rmtree(directory)
+
+
+if __name__ == '__main__':
+    main()
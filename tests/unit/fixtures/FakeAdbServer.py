@@ -0,0 +1,136 @@
+import socketserver
+import struct
+import threading
+
+
+class FakeAdbServer(object):
+    """ Minimal in-process adb server for testing AdbClient without a phone.
+
+    Implements host:version, host:devices, host:kill, host:transport:<serial>, shell:<cmd> and the
+    STAT/SEND/RECV/QUIT requests of the sync service. Shell commands are answered from the shell_responses
+    dictionary, files live in the files dictionary (path -> bytes).
+    """
+    VERSION = 41
+
+    def __init__(self, serials=('fake_serial',)):
+        self.serials = list(serials)
+        self.shell_responses = {}
+        self.files = {}
+        self.directories = {'/sdcard'}
+        self.requests = []
+        self.connections = 0
+        self.killed = False
+        server = self
+
+        class Handler(socketserver.BaseRequestHandler):
+            def handle(self):
+                server.connections += 1
+                server.handle(self.request)
+
+        socketserver.ThreadingTCPServer.allow_reuse_address = True
+        self.tcp_server = socketserver.ThreadingTCPServer(('127.0.0.1', 0), Handler)
+        self.tcp_server.daemon_threads = True
+        self.port = self.tcp_server.server_address[1]
+        self.thread = threading.Thread(target=self.tcp_server.serve_forever, kwargs={'poll_interval': 0.05},
+                                       daemon=True)
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *args):
+        self.tcp_server.shutdown()
+        self.tcp_server.server_close()
+
+    @staticmethod
+    def recv_exactly(sock, size):
+        data = b''
+        while len(data) < size:
+            chunk = sock.recv(size - len(data))
+            if not chunk:
+                raise EOFError
+            data += chunk
+        return data
+
+    def recv_request(self, sock):
+        length = int(self.recv_exactly(sock, 4), 16)
+        request = self.recv_exactly(sock, length).decode('utf-8')
+        self.requests.append(request)
+        return request
+
+    @staticmethod
+    def okay(sock, payload=None):
+        sock.sendall(b'OKAY')
+        if payload is not None:
+            sock.sendall(b'%04x' % len(payload) + payload)
+
+    @staticmethod
+    def fail(sock, message):
+        sock.sendall(b'FAIL' + b'%04x' % len(message) + message)
+
+    def handle(self, sock):
+        try:
+            request = self.recv_request(sock)
+            if request == 'host:version':
+                self.okay(sock, b'%04x' % FakeAdbServer.VERSION)
+            elif request == 'host:devices':
+                self.okay(sock, ''.join('%s\tdevice\n' % s for s in self.serials).encode('utf-8'))
+            elif request == 'host:kill':
+                self.killed = True
+                self.okay(sock)
+            elif request.startswith('host:transport:'):
+                if request.split(':', 2)[2] not in self.serials:
+                    self.fail(sock, b'device not found')
+                    return
+                self.okay(sock)
+                self.handle_device_service(sock, self.recv_request(sock))
+            else:
+                self.fail(sock, b'unknown host service')
+        except EOFError:
+            return
+
+    def handle_device_service(self, sock, request):
+        if request.startswith('shell:'):
+            self.okay(sock)
+            sock.sendall(self.shell_responses.get(request[len('shell:'):], b''))
+        elif request == 'sync:':
+            self.okay(sock)
+            self.handle_sync(sock)
+        else:
+            self.fail(sock, b'unknown device service')
+
+    def handle_sync(self, sock):
+        while True:
+            header = self.recv_exactly(sock, 8)
+            command, length = header[:4], struct.unpack('<I', header[4:])[0]
+            if command == b'QUIT':
+                return
+            argument = self.recv_exactly(sock, length).decode('utf-8')
+            if command == b'STAT':
+                if argument.rstrip('/') in self.directories:
+                    mode, size = 0o40755, 0
+                elif argument in self.files:
+                    mode, size = 0o100644, len(self.files[argument])
+                else:
+                    mode, size = 0, 0
+                sock.sendall(b'STAT' + struct.pack('<III', mode, size, 0))
+            elif command == b'SEND':
+                path = argument.rsplit(',', 1)[0]
+                data = b''
+                while True:
+                    header = self.recv_exactly(sock, 8)
+                    if header[:4] == b'DONE':
+                        break
+                    data += self.recv_exactly(sock, struct.unpack('<I', header[4:])[0])
+                self.files[path] = data
+                sock.sendall(b'OKAY' + struct.pack('<I', 0))
+            elif command == b'RECV':
+                if argument not in self.files:
+                    message = b'No such file or directory'
+                    sock.sendall(b'FAIL' + struct.pack('<I', len(message)) + message)
+                    return
+                data = self.files[argument]
+                for i in range(0, len(data), 4096):
+                    chunk = data[i:i + 4096]
+                    sock.sendall(b'DATA' + struct.pack('<I', len(chunk)) + chunk)
+                sock.sendall(b'DONE' + struct.pack('<I', 0))
@@ -0,0 +1,71 @@
+""" Stands in for trace_processor -D --http-port PORT TRACE in the tests of the perfetto trace wrapper.
+
+Every start is appended to TRACE.loads. A query is answered with the columns sql, number, missing and ratio in two
+batches of one row, a query starting with FAIL with an error and a query starting with CLOSE closes the connection
+after the answer.
+"""
+import struct
+import sys
+from http.server import BaseHTTPRequestHandler, HTTPServer
+
+
+def varint(value):
+    encoded = bytearray()
+    value &= (1 << 64) - 1
+    while value > 0x7F:
+        encoded.append((value & 0x7F) | 0x80)
+        value >>= 7
+    encoded.append(value)
+    return bytes(encoded)
+
+
+def field(number, value):
+    return varint(number << 3 | 2) + varint(len(value)) + value
+
+
+def batch(sql, number, ratio, last):
+    cells = field(1, bytes([4, 2, 1, 3]))
+    cells += field(2, varint(number))
+    cells += field(3, struct.pack('<d', ratio))
+    cells += field(5, sql.encode('utf-8') + b'\0')
+    return cells + varint(6 << 3) + varint(int(last))
+
+
+def query_result(sql):
+    if sql.startswith('FAIL'):
+        return field(2, b'no such table: FAIL')
+    result = b''.join(field(1, column.encode()) for column in ['sql', 'number', 'missing', 'ratio'])
+    result += field(3, batch(sql, -5, 1.5, False))
+    return result + field(3, batch('second', 7, 0.25, True))
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        self.send_response(200)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers['Content-Length']))
+        sql = body[2:].decode('utf-8')
+        result = query_result(sql)
+        self.send_response(200)
+        self.send_header('Transfer-Encoding', 'chunked')
+        if sql.startswith('CLOSE'):
+            self.send_header('Connection', 'close')
+        self.end_headers()
+        half = len(result) // 2
+        for chunk in (result[:half], result[half:], b''):
+            self.wfile.write(b'%x\r\n%s\r\n' % (len(chunk), chunk))
+
+    def log_message(self, *args):
+        pass
+
+
+if __name__ == '__main__':
+    port, trace = int(sys.argv[3]), sys.argv[4]
+    with open(trace + '.loads', 'a') as f:
+        f.write('loaded\n')
+    HTTPServer(('127.0.0.1', port), Handler).serve_forever()
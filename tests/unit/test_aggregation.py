@@ -0,0 +1,201 @@
+import json
+import os.path as op
+
+import numpy as np
+import pytest
+from mock import patch
+
+from AndroidRunner import Aggregation
+from AndroidRunner.Plugins import ResultWriter
+
+
+class TestColumnStatistics(object):
+    def test_empty(self):
+        statistics = Aggregation.ColumnStatistics()
+        result = statistics.result(percentiles=[50])
+
+        assert result['count'] == 0
+        assert np.isnan(result['mean'])
+        assert np.isnan(result['std'])
+        assert np.isnan(result['min'])
+        assert np.isnan(result['p50'])
+
+    def test_chunks_match_numpy(self):
+        values = np.random.RandomState(7).normal(10, 3, 1000)
+        statistics = Aggregation.ColumnStatistics()
+        for chunk in np.array_split(values, 7):
+            statistics.add(chunk)
+        result = statistics.result(percentiles=[50, 95])
+
+        assert result['count'] == 1000
+        assert result['mean'] == pytest.approx(values.mean())
+        assert result['std'] == pytest.approx(values.std())
+        assert result['min'] == values.min()
+        assert result['max'] == values.max()
+        assert result['p50'] == pytest.approx(np.percentile(values, 50), rel=0.01)
+        assert result['p95'] == pytest.approx(np.percentile(values, 95), rel=0.01)
+
+    def test_nan_ignored(self):
+        statistics = Aggregation.ColumnStatistics()
+        statistics.add([1.0, np.nan, 3.0])
+        statistics.add([np.nan])
+
+        assert statistics.count == 2
+        assert statistics.mean == 2.0
+        assert statistics.std == 1.0
+
+    def test_merge_matches_single_column(self):
+        values = np.random.RandomState(3).exponential(5, 500)
+        first = Aggregation.ColumnStatistics()
+        first.add(values[:200])
+        second = Aggregation.ColumnStatistics()
+        second.add(values[200:])
+        whole = Aggregation.ColumnStatistics()
+        whole.add(values)
+
+        first.merge(second)
+
+        assert first.count == whole.count
+        assert first.mean == pytest.approx(whole.mean)
+        assert first.std == pytest.approx(whole.std)
+        assert first.minimum == whole.minimum
+        assert first.maximum == whole.maximum
+        assert first.percentile(90) == whole.percentile(90)
+
+    def test_to_dict_round_trip(self):
+        statistics = Aggregation.ColumnStatistics()
+        statistics.add([-2.5, 0, 1, 4, 8])
+
+        copy = Aggregation.ColumnStatistics.from_dict(json.loads(json.dumps(statistics.to_dict())))
+
+        assert copy.result(percentiles=[10, 50, 90]) == statistics.result(percentiles=[10, 50, 90])
+
+
+class TestQuantileSketch(object):
+    def test_relative_accuracy(self):
+        values = np.random.RandomState(11).lognormal(0, 2, 10000) * np.where(np.arange(10000) % 3, 1, -1)
+        sketch = Aggregation.QuantileSketch(relative_accuracy=0.01)
+        sketch.add(values)
+
+        for q in [0.01, 0.25, 0.5, 0.75, 0.99]:
+            exact = np.percentile(values, q * 100, method='lower')
+            assert abs(sketch.quantile(q) - exact) <= 0.01 * abs(exact)
+
+    def test_empty(self):
+        assert np.isnan(Aggregation.QuantileSketch().quantile(0.5))
+
+    def test_zeros(self):
+        sketch = Aggregation.QuantileSketch()
+        sketch.add([0, 0, 0, 5])
+
+        assert sketch.count == 4
+        assert sketch.quantile(0.5) == 0.0
+
+
+class TestAggregation(object):
+    @pytest.fixture()
+    def fixture_dir(self):
+        return op.join(op.dirname(op.abspath(__file__)), 'fixtures')
+
+    @pytest.fixture()
+    def csv_file(self, tmpdir):
+        path = op.join(str(tmpdir), 'run.csv')
+        with open(path, 'w') as f:
+            f.write('datetime,cpu,mem\n')
+            f.write('2019-03-03T15:36:04,1.5,10\n')
+            f.write('2019-03-03T15:36:05,,20\n')
+            f.write('2019-03-03T15:36:06,4.5,abc\n')
+            f.write('2019-03-03T15:36:07,3,30\n')
+        return path
+
+    def test_summarize_file_chunked(self, csv_file):
+        statistics = Aggregation.summarize_file(csv_file, usecols=lambda column: column != 'datetime',
+                                                chunk_rows=1)
+
+        assert list(statistics.keys()) == ['cpu', 'mem']
+        assert statistics['cpu'].result()['count'] == 3
+        assert statistics['cpu'].mean == 3.0
+        assert statistics['cpu'].result()['max'] == 4.5
+        assert statistics['mem'].result(percentiles=[50])['p50'] == pytest.approx(20.0, rel=0.01)
+
+    @pytest.mark.parametrize('result_format', ['npz', 'npy'])
+    def test_summarize_binary_file(self, tmpdir, result_format):
+        rows = [['datetime', 'cpu']] + [['2019-03-03T15:36:0%d' % i, i] for i in range(5)]
+        path = ResultWriter.write_results(op.join(str(tmpdir), 'run.csv'), rows, result_format)
+
+        statistics = Aggregation.summarize_file(path, chunk_rows=2)
+
+        assert statistics['datetime'].count == 0
+        assert statistics['cpu'].count == 5
+        assert statistics['cpu'].mean == 2.0
+
+    def test_run_means_skips_non_numeric_columns(self, csv_file):
+        assert Aggregation.run_means(op.dirname(csv_file)) == [{'cpu': 3.0, 'mem': 20.0}]
+        assert Aggregation.run_means(op.dirname(csv_file), usecols=lambda column: column == 'cpu') == [{'cpu': 3.0}]
+
+    @patch('AndroidRunner.Aggregation.summarize_file', wraps=Aggregation.summarize_file)
+    def test_run_summaries_cached(self, summarize_file, csv_file, tmpdir):
+        first = Aggregation.run_summaries(str(tmpdir))
+        assert op.isfile(op.join(str(tmpdir), Aggregation.CACHE_FILE))
+
+        second = Aggregation.run_summaries(str(tmpdir))
+
+        assert summarize_file.call_count == 1
+        assert second[0]['cpu'].result() == first[0]['cpu'].result()
+
+    @patch('AndroidRunner.Aggregation.summarize_file', wraps=Aggregation.summarize_file)
+    def test_run_summaries_changed_file(self, summarize_file, csv_file, tmpdir):
+        Aggregation.run_summaries(str(tmpdir))
+        with open(csv_file, 'a') as f:
+            f.write('2019-03-03T15:36:08,7,40\n')
+        tmpdir.join('run2.csv').write('cpu\n1\n')
+
+        summaries = Aggregation.run_summaries(str(tmpdir))
+
+        assert summarize_file.call_count == 3
+        assert summaries[0]['cpu'].count == 4
+        assert summaries[1]['cpu'].count == 1
+
+    def test_merge_summaries(self, csv_file, tmpdir):
+        tmpdir.join('run2.csv').write('cpu\n7\n')
+
+        merged = Aggregation.merge_summaries(Aggregation.run_summaries(str(tmpdir)))
+
+        assert merged['cpu'].count == 4
+        assert merged['cpu'].mean == 4.0
+        assert merged['mem'].count == 3
+
+    def test_run_summaries_corrupt_cache(self, csv_file, tmpdir):
+        tmpdir.join(Aggregation.CACHE_FILE).write('{"version": 1, "fi')
+
+        assert Aggregation.run_summaries(str(tmpdir))[0]['cpu'].mean == 3.0
+
+    def test_mean_of_runs(self):
+        runs = [{'a': 1.0, 'b': 2.0}, {'a': 3.0, 'b': 4.0}]
+
+        assert Aggregation.mean_of_runs(runs) == {'a': 2.0, 'b': 3.0}
+        assert Aggregation.mean_of_runs([]) == {}
+
+    def test_run_files(self, tmpdir):
+        tmpdir.join('Joule_results.csv').write('')
+        tmpdir.join('results.csv').write('')
+        tmpdir.join(Aggregation.AGGREGATED_FILE).write('')
+        tmpdir.join(Aggregation.CACHE_FILE).write('')
+        tmpdir.mkdir('subdir')
+
+        files = Aggregation.run_files(str(tmpdir), lambda f: 'Joule' in f)
+
+        assert files == [op.join(str(tmpdir), 'Joule_results.csv')]
+        assert len(Aggregation.run_files(str(tmpdir))) == 2
+
+    def test_read_aggregated_missing(self, tmpdir):
+        assert Aggregation.read_aggregated(str(tmpdir)) is None
+
+    def test_aggregate_final_native(self, fixture_dir):
+        data_dir = op.join(fixture_dir, 'test_dir_struct', 'data_native')
+
+        rows = Aggregation.aggregate_final(data_dir, 'android', lambda logs_dir: {'logs_dir': logs_dir})
+
+        assert len(rows) == 2
+        for row in rows:
+            assert row['logs_dir'] == op.join(data_dir, row['device'], row['subject'], 'android')
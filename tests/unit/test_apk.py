@@ -0,0 +1,138 @@
+import json
+import os.path as op
+import struct
+import zipfile
+
+import pytest
+from mock import patch
+
+from AndroidRunner import Apk
+
+TREPN_APK = op.join(op.dirname(op.dirname(op.dirname(op.abspath(__file__)))), 'AndroidRunner', 'Plugins', 'trepn',
+                    'com.quicinc.trepn.apk')
+
+
+def binary_manifest(attributes, resource_ids=()):
+    """Returns a binary AndroidManifest.xml with a UTF-8 string pool and a manifest element with attributes, a list
+    of (name, string or int)"""
+    strings = [name for name, _ in attributes] + [v for _, v in attributes if isinstance(v, str)] + ['manifest']
+    data = b''
+    offsets = []
+    for string in strings:
+        offsets.append(len(data))
+        encoded = string.encode('utf-8')
+        data += bytes([len(string), len(encoded)]) + encoded + b'\x00'
+    data += b'\x00' * (-len(data) % 4)
+    pool_header = 28 + 4 * len(strings)
+    pool = struct.pack('<HHI5I', 0x0001, 28, pool_header + len(data), len(strings), 0, Apk.UTF8_FLAG,
+                       pool_header, 0) + struct.pack('<%dI' % len(strings), *offsets) + data
+    resource_map = struct.pack('<HHI', 0x0180, 8, 8 + 4 * len(resource_ids)) + \
+        struct.pack('<%dI' % len(resource_ids), *resource_ids)
+    body = b''
+    for i, (name, value) in enumerate(attributes):
+        if isinstance(value, str):
+            index = strings.index(value)
+            body += struct.pack('<3IHBBI', Apk.NO_INDEX, i, index, 8, 0, Apk.TYPE_STRING, index)
+        else:
+            body += struct.pack('<3IHBBI', Apk.NO_INDEX, i, Apk.NO_INDEX, 8, 0, 0x10, value)
+    extension = struct.pack('<IIHHHHHH', Apk.NO_INDEX, strings.index('manifest'), 20, 20, len(attributes), 0, 0, 0)
+    element = struct.pack('<HHIII', 0x0102, 16, 16 + len(extension) + len(body), 1, Apk.NO_INDEX) + extension + body
+    chunks = pool + resource_map + element
+    return struct.pack('<HHI', 0x0003, 8, 8 + len(chunks)) + chunks
+
+
+def write_apk(path, manifest):
+    with zipfile.ZipFile(path, 'w') as apk:
+        apk.writestr('AndroidManifest.xml', manifest)
+    return path
+
+
+class TestManifest(object):
+    def test_read_apk_info_utf16(self):
+        assert Apk.read_apk_info(TREPN_APK) == ('com.quicinc.trepn', 7)
+
+    def test_read_manifest_attributes_utf8(self):
+        manifest = binary_manifest([('versionCode', 42), ('package', 'com.test.app')])
+
+        assert Apk.read_manifest_attributes(manifest) == {'versionCode': 42, 'package': 'com.test.app'}
+
+    def test_read_manifest_attributes_stripped_names(self):
+        manifest = binary_manifest([('', 42), ('package', 'com.test.app')],
+                                   resource_ids=[Apk.VERSION_CODE_RESOURCE_ID])
+
+        assert Apk.read_manifest_attributes(manifest)['versionCode'] == 42
+
+    def test_read_manifest_attributes_not_binary(self):
+        with pytest.raises(Apk.ManifestError):
+            Apk.read_manifest_attributes(b'<?xml version="1.0"?><manifest/>')
+
+    def test_read_xapk_info_manifest_json(self, tmpdir):
+        xapk = str(tmpdir.join('app.xapk'))
+        with zipfile.ZipFile(xapk, 'w') as z:
+            z.writestr('manifest.json', json.dumps({'package_name': 'com.test.app', 'version_code': '12'}))
+
+        assert Apk.read_xapk_info(xapk, str(tmpdir)) == ('com.test.app', 12)
+
+    def test_read_xapk_info_base_apk(self, tmpdir):
+        xapk = str(tmpdir.join('app.xapk'))
+        with zipfile.ZipFile(xapk, 'w') as z:
+            z.writestr('readme.txt', '')
+        write_apk(str(tmpdir.join('config.arm64_v8a.apk')),
+                  binary_manifest([('package', 'com.test.app'), ('split', 'config.arm64_v8a')]))
+        write_apk(str(tmpdir.join('com.test.app.apk')),
+                  binary_manifest([('versionCode', 3), ('package', 'com.test.app')]))
+
+        assert Apk.read_xapk_info(xapk, str(tmpdir)) == ('com.test.app', 3)
+
+
+class TestApkCache(object):
+    @pytest.fixture()
+    def cache(self, tmpdir):
+        return Apk.ApkCache(str(tmpdir.join('cache')))
+
+    def test_info(self, cache):
+        info = cache.info(TREPN_APK)
+
+        assert info == Apk.ApkInfo('com.quicinc.trepn', 7, Apk.sha256_file(TREPN_APK))
+
+    @patch('AndroidRunner.Apk.read_apk_info', wraps=Apk.read_apk_info)
+    @patch('AndroidRunner.Apk.sha256_file', wraps=Apk.sha256_file)
+    def test_info_cached(self, sha256_file, read_apk_info, cache, tmpdir):
+        apk = write_apk(str(tmpdir.join('app.apk')), binary_manifest([('versionCode', 1), ('package', 'com.a')]))
+        cache.info(apk)
+
+        # A new cache reads the index of the first one
+        assert Apk.ApkCache(cache.cache_dir).info(apk).package == 'com.a'
+        assert sha256_file.call_count == 1
+        assert read_apk_info.call_count == 1
+
+    def test_info_changed_file(self, cache, tmpdir):
+        apk = write_apk(str(tmpdir.join('app.apk')), binary_manifest([('versionCode', 1), ('package', 'com.a')]))
+        first = cache.info(apk)
+        write_apk(apk, binary_manifest([('versionCode', 2), ('package', 'com.a')]))
+
+        second = cache.info(apk)
+
+        assert second.version_code == 2
+        assert second.sha256 != first.sha256
+
+    def test_info_unreadable(self, cache, tmpdir):
+        apk = tmpdir.join('app.apk')
+        apk.write('not a zip file')
+
+        info = cache.info(str(apk))
+
+        assert info.package is None
+        assert info.sha256 is not None
+
+    def test_apk_files(self, cache, tmpdir):
+        xapk = str(tmpdir.join('app.xapk'))
+        with zipfile.ZipFile(xapk, 'w') as z:
+            z.writestr('base.apk', '')
+            z.writestr('config.en.apk', '')
+
+        files = cache.apk_files(xapk)
+
+        assert [op.basename(f) for f in files] == ['base.apk', 'config.en.apk']
+        assert op.dirname(files[0]) == op.join(cache.cache_dir, cache.sha256(xapk))
+        assert cache.apk_files(TREPN_APK) == [TREPN_APK]
@@ -1,12 +1,34 @@
+import io
 import os
+import os.path as op
+import subprocess
+import threading
+import time
+import zipfile
+from concurrent.futures import ThreadPoolExecutor
 
 import pytest
 from mock import MagicMock, Mock, call, patch
 
 import AndroidRunner.Adb as Adb
+from AndroidRunner import Apk
+from AndroidRunner.AdbClient import AdbClient, AdbClientError
 from AndroidRunner.Device import Device
 from AndroidRunner.Devices import Devices
+from AndroidRunner.LogcatStream import LogcatStream
 from AndroidRunner.util import ConfigError
+from tests.unit.fixtures.FakeAdbServer import FakeAdbServer
+
+
+TREPN_APK = op.join(op.dirname(op.dirname(op.dirname(op.abspath(__file__)))), 'AndroidRunner', 'Plugins', 'trepn',
+                    'com.quicinc.trepn.apk')
+
+
+@pytest.fixture()
+def apk_cache(tmpdir, monkeypatch):
+    cache = Apk.ApkCache(str(tmpdir.join('apk_cache')))
+    monkeypatch.setattr(Apk, 'cache', cache)
+    return cache
 
 
 class TestDevice(object):
@@ -48,6 +70,16 @@ class TestDevice(object):
 
         return Device(name, device_id, device_settings)
 
+    @patch('AndroidRunner.Adb.connect')
+    @patch('AndroidRunner.Adb.shell')
+    def test_init_adb_handle(self, adb_shell, adb_connect):
+        device = Device('fake_device', 'serial_1', {})
+        other_device = Device('other_device', 'serial_2', {})
+
+        assert device.adb is Adb.handle('serial_1')
+        assert device.adb.device_id == 'serial_1'
+        assert other_device.adb is not device.adb
+
     @patch('AndroidRunner.Adb.connect')
     @patch('AndroidRunner.Adb.shell')
     def test_init(self, adb_shell, adb_connect):
@@ -130,6 +162,57 @@ class TestDevice(object):
 
         assert app_list == ['app1', 'app2', 'app3']
 
+    @patch('AndroidRunner.Adb.shell')
+    def test_get_prop_read_only_cached(self, adb_shell, device):
+        adb_shell.side_effect = ['28', '9']
+
+        assert device.get_api_level() == '28'
+        assert device.get_version() == '9'
+        assert str(device) == 'fake_device (123456789, Android 9, API level 28)'
+        assert adb_shell.mock_calls == [call(123456789, 'getprop ro.build.version.sdk'),
+                                        call(123456789, 'getprop ro.build.version.release')]
+
+    @patch('AndroidRunner.Adb.shell')
+    def test_get_prop_not_read_only(self, adb_shell, device):
+        adb_shell.side_effect = ['1', '0']
+
+        assert device.get_prop('sys.boot_completed') == '1'
+        assert device.get_prop('sys.boot_completed') == '0'
+        assert adb_shell.call_count == 2
+
+    @patch('AndroidRunner.Adb.shell')
+    def test_invalidate_cache(self, adb_shell, device):
+        adb_shell.side_effect = ['28', '29']
+
+        device.get_api_level()
+        device.invalidate_cache()
+
+        assert device.get_api_level() == '29'
+
+    @patch('AndroidRunner.Adb.list_apps')
+    def test_get_app_list_cached(self, adb_list_apps, device):
+        adb_list_apps.return_value = ['app1', 'app2', 'app3']
+
+        device.get_app_list().append('app4')
+        result_installed = device.is_installed(['app1', 'app4'])
+
+        assert result_installed == {'app1': True, 'app4': False}
+        adb_list_apps.assert_called_once_with(123456789)
+
+    @patch('AndroidRunner.Adb.uninstall')
+    @patch('AndroidRunner.Adb.install')
+    @patch('AndroidRunner.Adb.list_apps')
+    def test_get_app_list_after_install(self, adb_list_apps, adb_install, adb_uninstall, device, tmpdir, apk_cache):
+        apk = tmpdir.join('app4.apk')
+        apk.write('apk')
+        adb_list_apps.side_effect = [['app1'], ['app1', 'app4'], ['app1']]
+
+        assert device.get_app_list() == ['app1']
+        device.install(str(apk))
+        assert device.get_app_list() == ['app1', 'app4']
+        device.uninstall('app4')
+        assert device.get_app_list() == ['app1']
+
     @patch('AndroidRunner.Adb.install')
     def test_install_file_not_exist(self, adb_install, device):
         with pytest.raises(Adb.AdbError):
@@ -137,14 +220,66 @@ class TestDevice(object):
 
         assert adb_install.call_count == 0
 
-    @patch('os.path.isfile')
     @patch('AndroidRunner.Adb.install')
-    def test_install_file_exist(self, adb_install, os_isfile, device):
-        os_isfile.return_value = True
+    @patch('AndroidRunner.Adb.list_apps')
+    def test_install_file_exist(self, adb_list_apps, adb_install, device, apk_cache):
+        adb_list_apps.return_value = []
+
+        assert device.install(TREPN_APK) == 'com.quicinc.trepn'
+
+        adb_install.assert_called_once_with(123456789, TREPN_APK)
+
+    @patch('AndroidRunner.Adb.batch')
+    @patch('AndroidRunner.Adb.install')
+    @patch('AndroidRunner.Adb.list_apps')
+    def test_install_same_version_installed(self, adb_list_apps, adb_install, adb_batch, device, apk_cache):
+        adb_list_apps.return_value = ['com.quicinc.trepn']
+        digest = apk_cache.sha256(TREPN_APK)
+        adb_batch.return_value = [Adb.CommandResult('dumpsys', 'versionCode=7 minSdk=9 targetSdk=22', 0),
+                                  Adb.CommandResult('sha256sum', '%s  /data/app/base.apk' % digest, 0)]
+
+        assert device.install(TREPN_APK) == 'com.quicinc.trepn'
+        assert adb_install.call_count == 0
+        device.install(TREPN_APK, force=True)
+        adb_install.assert_called_once_with(123456789, TREPN_APK)
+
+    @pytest.mark.parametrize('digest', [Adb.CommandResult('sha256sum', '', 1), Adb.CommandResult('sha256sum', '', 0),
+                                        Adb.CommandResult('sha256sum', '\n', 0)])
+    @patch('AndroidRunner.Adb.batch')
+    @patch('AndroidRunner.Adb.install')
+    @patch('AndroidRunner.Adb.list_apps')
+    def test_install_same_version_no_digest(self, adb_list_apps, adb_install, adb_batch, device, digest):
+        adb_list_apps.return_value = ['com.quicinc.trepn']
+        adb_batch.return_value = [Adb.CommandResult('dumpsys', 'versionCode=7 minSdk=9 targetSdk=22', 0), digest]
 
-        device.install('fake.apk')
+        assert device.install(TREPN_APK) == 'com.quicinc.trepn'
+        assert adb_install.call_count == 0
+        command = adb_batch.call_args[0][1][1]
+        assert '[ -n "$p" ] && sha256sum "$p"' in command
+
+    @pytest.mark.parametrize('version, digest', [('versionCode=6 minSdk=9', Adb.CommandResult('sha256sum', '', 1)),
+                                                 ('', Adb.CommandResult('sha256sum', '', 1)),
+                                                 ('versionCode=7 minSdk=9',
+                                                  Adb.CommandResult('sha256sum', '0123  base.apk', 0))])
+    @patch('AndroidRunner.Adb.batch')
+    @patch('AndroidRunner.Adb.install')
+    @patch('AndroidRunner.Adb.list_apps')
+    def test_install_other_version_installed(self, adb_list_apps, adb_install, adb_batch, device, apk_cache,
+                                             version, digest):
+        adb_list_apps.return_value = ['com.quicinc.trepn']
+        adb_batch.return_value = [Adb.CommandResult('dumpsys', version, 0), digest]
+
+        device.install(TREPN_APK)
 
-        adb_install.assert_called_once_with(123456789, 'fake.apk')
+        adb_install.assert_called_once_with(123456789, TREPN_APK)
+
+    @patch('AndroidRunner.Adb.install')
+    def test_install_unreadable_manifest(self, adb_install, device, apk_cache, tmpdir):
+        apk = tmpdir.join('com.test.app.apk')
+        apk.write('not a zip file')
+
+        assert device.install(str(apk)) == 'com.test.app'
+        adb_install.assert_called_once_with(123456789, str(apk))
 
     @patch("AndroidRunner.Adb.shell")
     @pytest.mark.parametrize('size', [Device.LOGCAT_BUFFER_SIZE_MIN,
@@ -346,29 +481,34 @@ class TestDevice(object):
         assert device_root.root_plug_value == 'disabled'
         assert device_root.root_unplug_value == 'enabled'
 
-    @patch('AndroidRunner.Device.Device.su_plug')
+    @patch('AndroidRunner.Adb.batch')
     @patch('AndroidRunner.Adb.shell')
-    def test_plug_no_root(self, adb_shell, su_plug, device):
+    def test_plug_no_root(self, adb_shell, adb_batch, device):
         device.plug()
 
-        assert su_plug.call_count == 0
+        assert adb_batch.call_count == 0
         adb_shell.assert_called_once_with(123456789, 'dumpsys battery reset')
 
-    @patch('AndroidRunner.Device.Device.su_plug')
+    @patch('AndroidRunner.Adb.batch')
     @patch('AndroidRunner.Adb.shell')
-    def test_plug_root(self, adb_shell, su_plug, device_root):
-        device_root.plug()
+    def test_plug_root(self, adb_shell, adb_batch, device_root):
+        device_root.root_plug_value = '123456'
+        adb_batch.return_value = [Adb.CommandResult('su', '', 0), Adb.CommandResult('reset', '', 0)]
 
-        su_plug.assert_called_once()
-        adb_shell.assert_called_once_with(123456789, 'dumpsys battery reset')
+        device_root.plug()
 
-    @patch('AndroidRunner.Adb.shell_su')
-    def test_su_plug(self, adb_shell_su, device_root):
-        device_root.root_plug_value = '123456'
+        adb_batch.assert_called_once_with(123456789, ["su -c 'echo 123456 > test/file'", 'dumpsys battery reset'])
+        assert adb_shell.call_count == 0
 
-        device_root.su_plug()
+    @patch('AndroidRunner.Adb.batch')
+    def test_batch_check(self, adb_batch, device):
+        adb_batch.return_value = [Adb.CommandResult('ls', 'file', 0),
+                                  Adb.CommandResult('rm missing', 'rm: missing: No such file or directory', 1)]
 
-        adb_shell_su.assert_called_once_with(123456789, 'echo 123456 > test/file')
+        assert device.batch(['ls', 'rm missing']) == adb_batch.return_value
+        with pytest.raises(Adb.AdbError) as expect_ex:
+            device.batch(['ls', 'rm missing'], check=True)
+        assert '"rm missing" exited with 1' in str(expect_ex.value)
 
     @patch('AndroidRunner.Adb.shell')
     def test_current_activity_success(self, adb_shell, device):
@@ -489,6 +629,58 @@ class TestDevice(object):
         adb_logcat.assert_called_once_with(123456789, regex=fake_regex)
         assert result == logcat_result
 
+    @patch('AndroidRunner.Adb.logcat_stream')
+    def test_watch_logcat(self, logcat_stream, device):
+        stream = LogcatStream(123456789)
+        logcat_stream.return_value = stream
+        callback = Mock()
+
+        subscription = device.watch_logcat('Displayed', callback)
+        stream.dispatch('I ActivityManager: Displayed com.example/.Main')
+
+        logcat_stream.assert_called_once_with(123456789)
+        callback.assert_called_once_with('I ActivityManager: Displayed com.example/.Main')
+        assert stream.subscriptions == [subscription]
+
+    @patch('AndroidRunner.Adb.logcat_stream')
+    def test_watch_logcat_include_buffer(self, logcat_stream, device):
+        stream = LogcatStream(123456789)
+        logcat_stream.return_value = stream
+        device.adb = Mock()
+        device.adb.shell_command.return_value = b'E Tag: error\nI Tag: match 1\nI Tag: match 2\n'
+        callback = Mock()
+
+        device.watch_logcat('match', callback, once=True, include_buffer=True)
+        stream.dispatch('I Tag: match 3')
+
+        device.adb.shell_command.assert_called_once_with('logcat -d')
+        callback.assert_called_once_with('I Tag: match 1')
+        assert stream.subscriptions == []
+
+    @patch('AndroidRunner.LogcatStream.LogcatStream.open')
+    def test_watch_logcat_waits_for_stream(self, stream_open, device):
+        read_fd, write_fd = os.pipe()
+        opened = threading.Event()
+
+        def slow_open():
+            if opened.is_set():
+                return None
+            time.sleep(0.3)
+            opened.set()
+            return os.fdopen(read_fd, 'rb')
+        stream_open.side_effect = slow_open
+        device.adb = Mock()
+        # The buffer may only be dumped once the stream runs, the lines logged before it started are in the dump
+        device.adb.shell_command.side_effect = lambda command: b'I Tag: match %d\n' % opened.is_set()
+        callback = Mock()
+        try:
+            device.watch_logcat('match', callback, once=True, include_buffer=True)
+        finally:
+            os.close(write_fd)
+            Adb.close_logcat_streams()
+
+        callback.assert_called_once_with('I Tag: match 1')
+
     @patch('AndroidRunner.Adb.push')
     def test_push(self, adb_push, device):
         adb_push.return_value = 'pushpush'
@@ -548,7 +740,7 @@ class TestDevices(object):
         with pytest.raises(ConfigError):
             Devices(['fake_device'])
 
-        adb_setup.assert_called_once_with('adb')
+        adb_setup.assert_called_once_with('adb', backend='binary')
 
     @patch('AndroidRunner.Device.Device.__init__')
     @patch('AndroidRunner.Devices.load_json')
@@ -559,7 +751,7 @@ class TestDevices(object):
         mock_device_settings = Mock()
         devices = Devices({'fake_device': mock_device_settings}, 'adb/path')
 
-        adb_setup.assert_called_once_with('adb/path')
+        adb_setup.assert_called_once_with('adb/path', backend='binary')
         device.assert_called_once_with('fake_device', 123456789, mock_device_settings)
         assert len(devices.devices) == 1
         assert isinstance(devices.devices[0], Device)
@@ -688,47 +880,198 @@ class TestAdb(object):
 
         mock_adb.get_devices.assert_called_once()
 
-    def test_shell_succes(self):
-        mock_adb = Mock()
-        mock_adb.shell_command.return_value = "succes         "
-        Adb.adb = mock_adb
-        result = Adb.shell(123, "test_command")
+    @pytest.fixture()
+    def adb_handle(self):
+        with patch('AndroidRunner.Adb.AdbHandle.run') as run:
+            yield Adb.AdbHandle(123, 'adb/path'), run
 
-        expected_calls = [call.set_target_by_name(123), call.shell_command('test_command')]
-        assert mock_adb.mock_calls == expected_calls
+    def test_shell_succes(self, adb_handle):
+        handle, run = adb_handle
+        run.return_value = b"succes         "
+        result = handle.shell("test_command")
+
+        run.assert_called_once_with(['shell', 'test_command'])
         assert result == 'succes'
 
-    def test_shell_error(self):
-        mock_adb = Mock()
-        mock_adb.shell_command.return_value = "error"
-        Adb.adb = mock_adb
+    def test_shell_error(self, adb_handle):
+        handle, run = adb_handle
+        run.return_value = b"error"
 
         with pytest.raises(Adb.AdbError):
-            Adb.shell(123, "test_command")
+            handle.shell("test_command")
 
-        expected_calls = [call.set_target_by_name(123), call.shell_command('test_command')]
-        assert mock_adb.mock_calls == expected_calls
+        run.assert_called_once_with(['shell', 'test_command'])
 
-    def test_shell_su_succes(self):
-        mock_adb = Mock()
-        mock_adb.shell_command.return_value = "su_succes         "
-        Adb.adb = mock_adb
-        result = Adb.shell_su(123, "test_command_su")
+    def test_batch(self, adb_handle):
+        handle, run = adb_handle
+        run.side_effect = lambda args: ('file1\nfile2\n\n%s 0\nrm: x: No such file\n\n%s 1\n\n%s 0\n'
+                                        % ((args[1].split()[-2],) * 3)).encode()
 
-        expected_calls = [call.set_target_by_name(123), call.shell_command('su -c \'test_command_su\'')]
-        assert mock_adb.mock_calls == expected_calls
+        results = handle.batch(['ls', 'rm x', 'true'])
+
+        script = run.call_args[0][0][1]
+        assert script.startswith('(\nls\n) 2>&1;')
+        assert results == [Adb.CommandResult('ls', 'file1\nfile2', 0),
+                           Adb.CommandResult('rm x', 'rm: x: No such file', 1),
+                           Adb.CommandResult('true', '', 0)]
+
+    def test_batch_output_without_newline(self, adb_handle):
+        handle, run = adb_handle
+        run.side_effect = lambda args: ('no newline\n%s 0\n' % args[1].split()[-2]).encode()
+
+        assert handle.batch(['printf "no newline"']) == [Adb.CommandResult('printf "no newline"', 'no newline', 0)]
+
+    def test_batch_shell(self, adb_handle):
+        handle, run = adb_handle
+        run.side_effect = lambda args: subprocess.run(['sh', '-c', args[1]], stdout=subprocess.PIPE).stdout
+
+        results = handle.batch(['echo one; echo two', 'printf three', 'ls /nonexistent', 'exit 3', 'echo # four'])
+
+        assert [r.output for r in results[:2]] == ['one\ntwo', 'three']
+        assert results[2].exit_code != 0 and 'nonexistent' in results[2].output
+        assert results[3] == Adb.CommandResult('exit 3', '', 3)
+        assert results[4] == Adb.CommandResult('echo # four', '', 0)
+
+    def test_batch_device_error(self, adb_handle):
+        handle, run = adb_handle
+        run.return_value = b"error: device '123' not found"
+
+        with pytest.raises(Adb.AdbError):
+            handle.batch(['ls', 'rm x'])
+
+    def test_batch_empty(self, adb_handle):
+        handle, run = adb_handle
+
+        assert handle.batch([]) == []
+        assert run.call_count == 0
+
+    def test_shell_su_succes(self, adb_handle):
+        handle, run = adb_handle
+        run.return_value = b"su_succes         "
+        result = handle.shell_su("test_command_su")
+
+        run.assert_called_once_with(['shell', 'su -c \'test_command_su\''])
         assert result == 'su_succes'
 
-    def test_shell_su_error(self):
-        mock_adb = Mock()
-        mock_adb.shell_command.return_value = "su_error"
-        Adb.adb = mock_adb
+    def test_shell_su_error(self, adb_handle):
+        handle, run = adb_handle
+        run.return_value = b"su_error"
 
         with pytest.raises(Adb.AdbError):
-            Adb.shell_su(123, "test_command_su")
+            handle.shell_su("test_command_su")
 
-        expected_calls = [call.set_target_by_name(123), call.shell_command('su -c \'test_command_su\'')]
-        assert mock_adb.mock_calls == expected_calls
+        run.assert_called_once_with(['shell', 'su -c \'test_command_su\''])
+
+    @patch('subprocess.run')
+    def test_handle_run(self, subprocess_run):
+        subprocess_run.return_value.stdout = b'output'
+
+        result = Adb.AdbHandle(123, 'adb/path').run(['shell', 'ls'])
+
+        assert result == b'output'
+        subprocess_run.assert_called_once_with(['adb/path', '-s', '123', 'shell', 'ls'],
+                                               stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+
+    @patch('subprocess.run')
+    def test_handle_run_adb_missing(self, subprocess_run):
+        subprocess_run.side_effect = OSError('not found')
+
+        with pytest.raises(Adb.AdbError):
+            Adb.AdbHandle(123, 'adb/path').run(['shell', 'ls'])
+
+    @patch('AndroidRunner.Adb.ADB')
+    def test_handle_per_device(self, adb):
+        adb.return_value._ADB__error = None
+        Adb.setup('adb/path')
+
+        handle_a = Adb.handle('a')
+
+        assert Adb.handle('a') is handle_a
+        assert Adb.handle('b') is not handle_a
+        assert handle_a.device_id == 'a' and handle_a.adb_path == 'adb/path' and handle_a.client is None
+        Adb.setup('adb/path')
+        assert Adb.handle('a') is not handle_a
+
+    def test_handle_concurrent_shell(self):
+        def run(args):
+            time.sleep(0.01)
+            return ('output of %s' % args[1]).encode('utf-8')
+
+        handle = Adb.AdbHandle(123)
+        commands = ['command %s' % i for i in range(20)]
+        with patch('AndroidRunner.Adb.AdbHandle.run', side_effect=run):
+            with ThreadPoolExecutor(max_workers=10) as executor:
+                results = list(executor.map(handle.shell, commands))
+
+        assert results == ['output of %s' % c for c in commands]
+
+    @patch('AndroidRunner.Adb.handle')
+    def test_module_functions_use_device_handle(self, adb_handle):
+        Adb.shell_su(123, 'su_cmd')
+        Adb.install(123, 'test.apk')
+        Adb.uninstall(123, 'app', keep_data=True)
+        Adb.clear_app_data(123, 'app')
+        Adb.push(123, 'local', 'remote')
+        Adb.pull(123, 'remote', 'local')
+
+        assert adb_handle.mock_calls == [call(123), call().shell_su('su_cmd'),
+                                         call(123), call().install('test.apk', replace=True, all_permissions=True),
+                                         call(123), call().uninstall('app', keep_data=True),
+                                         call(123), call().clear_app_data('app'),
+                                         call(123), call().push('local', 'remote'),
+                                         call(123), call().pull('remote', 'local')]
+
+    @patch('AndroidRunner.Adb.AdbClient')
+    @patch('AndroidRunner.Adb.ADB')
+    def test_setup_socket_backend(self, adb, adb_client):
+        adb_instance = MagicMock()
+        adb_instance._ADB__error = None
+        adb.return_value = adb_instance
+
+        Adb.setup('adb/path', backend='socket')
+
+        adb_instance.start_server.assert_called_once_with()
+        assert Adb.client is adb_client.return_value
+        assert Adb.handle(123).client is adb_client.return_value
+        Adb.client = None
+        Adb.handles.clear()
+
+    def test_setup_unknown_backend(self):
+        with pytest.raises(ConfigError):
+            Adb.setup(backend='fork')
+
+    @patch('AndroidRunner.Adb.AdbHandle.run')
+    def test_shell_socket_backend(self, run):
+        mock_client = Mock()
+        mock_client.shell.return_value = b'socket succes\n'
+
+        result = Adb.AdbHandle(123, adb_client=mock_client).shell('test_command')
+
+        assert result == 'socket succes'
+        mock_client.shell.assert_called_once_with(123, 'test_command')
+        run.assert_not_called()
+
+    def test_push_pull_socket_backend(self):
+        mock_client = Mock()
+        handle = Adb.AdbHandle(123, adb_client=mock_client)
+
+        push_result = handle.push('local/path', 'remote/path')
+        pull_result = handle.pull('remote/path', 'local/path')
+
+        assert push_result == mock_client.push.return_value
+        assert pull_result == mock_client.pull.return_value
+        assert mock_client.mock_calls == [call.push(123, 'local/path', 'remote/path'),
+                                          call.pull(123, 'remote/path', 'local/path')]
+
+    @patch('AndroidRunner.Adb.success_or_exception')
+    def test_uninstall_socket_backend(self, s_or_e):
+        mock_client = Mock()
+        mock_client.shell.return_value = b'Success'
+
+        Adb.AdbHandle(123, adb_client=mock_client).uninstall('app_name', keep_data=True)
+
+        mock_client.shell.assert_called_once_with(123, 'pm uninstall -k app_name')
+        s_or_e.assert_called_once_with(b'Success', '123: "app_name" uninstalled', '123: Failed to uninstall "app_name"')
 
     @patch('AndroidRunner.Adb.shell')
     def test_list_apps(self, adb_shell):
@@ -742,135 +1085,104 @@ class TestAdb(object):
         assert 'com.app.2' in result
         assert 'com.app.3' in result
 
-    def test_install_default(self):
-        mock_adb = Mock()
-        mock_adb._ADB__output = 'succes'
-        Adb.adb = mock_adb
-        device_id = 123
+    def test_install_default(self, adb_handle):
+        handle, run = adb_handle
+        run.return_value = b'succes'
         apk = 'test_apk.apk'
 
-        result = Adb.install(device_id, apk)
-
-        assert result == 'succes'
-        expected_calls = [call.set_target_by_name(device_id), call.run_cmd(['install', '-r', '-g', '-t', apk])]
-        assert mock_adb.mock_calls == expected_calls
+        result = handle.install(apk)
 
-    @patch("zipfile.ZipFile")
-    def test_install_multiple_default(self, zipfile, tmpdir):
-        xapk_file = tmpdir.mkdir("xapk").join("test_apk.xapk")
-        apk_file = tmpdir.mkdir("xapk/test_apk/").join("test_apk.apk")
+        assert result == b'succes'
+        run.assert_called_once_with(['install', '-r', '-g', '-t', apk])
 
-        xapk_file.write("This is an xapk file")
-        apk_file.write("This is an apk file")
-        device_id = 123
+    def test_install_multiple_default(self, adb_handle, tmpdir, apk_cache):
+        handle, run = adb_handle
+        xapk_file = str(tmpdir.mkdir("xapk").join("test_apk.xapk"))
+        with zipfile.ZipFile(xapk_file, 'w') as xapk:
+            xapk.writestr('test_apk.apk', 'This is an apk file')
+            xapk.writestr('config.arm64.apk', 'This is a split apk file')
+            xapk.writestr('icon.png', '')
+        run.return_value = b'succes'
+        cwd = os.getcwd()
 
-        mock_adb = Mock()
-        mock_adb._ADB__output = 'succes'
-        Adb.adb = mock_adb
-        result = Adb.install(device_id, xapk_file)
+        result = handle.install(xapk_file)
 
-        assert result == 'succes'
-        expected_calls = [call.set_target_by_name(device_id), call.run_cmd(['install-multiple', '-r', '-g', '-t', apk_file])]
-        assert mock_adb.mock_calls == expected_calls
+        assert result == b'succes'
+        assert os.getcwd() == cwd
+        apk_dir = op.join(apk_cache.cache_dir, apk_cache.sha256(xapk_file))
+        run.assert_called_once_with(['install-multiple', '-r', '-g', '-t', op.join(apk_dir, 'config.arm64.apk'),
+                                     op.join(apk_dir, 'test_apk.apk')])
+        assert not op.exists(op.join(str(tmpdir), 'xapk', 'test_apk'))
 
-    @patch("zipfile.ZipFile")
-    def test_install_multiple_no_apks_in_xapk_file(self, zipfile, tmpdir):
-        xapk_file = tmpdir.mkdir("xapk").join("test_apk.xapk")
-        xapk_file.write("This is an xapk file")
-        device_id = 123
+        with patch('zipfile.ZipFile') as zipfile_mock:
+            handle.install(xapk_file)
+        assert zipfile_mock.call_count == 0
 
-        mock_adb = Mock()
-        mock_adb._ADB__output = 'succes'
-        Adb.adb = mock_adb
+    def test_install_multiple_no_apks_in_xapk_file(self, adb_handle, tmpdir, apk_cache):
+        handle, run = adb_handle
+        xapk_file = str(tmpdir.mkdir("xapk").join("test_apk.xapk"))
+        with zipfile.ZipFile(xapk_file, 'w') as xapk:
+            xapk.writestr('manifest.json', '{}')
 
         with pytest.raises(ConfigError):
-            Adb.install(device_id, xapk_file)
+            handle.install(xapk_file)
 
-    def test_install_no_replace(self):
-        mock_adb = Mock()
-        mock_adb._ADB__output = 'succes'
-        Adb.adb = mock_adb
-        device_id = 123
+    def test_install_no_replace(self, adb_handle):
+        handle, run = adb_handle
+        run.return_value = b'succes'
         apk = 'test_apk.apk'
 
-        result = Adb.install(device_id, apk, replace=False)
+        result = handle.install(apk, replace=False)
 
-        assert result == 'succes'
-        expected_calls = [call.set_target_by_name(device_id), call.run_cmd(['install', '-g', '-t', apk])]
-        assert mock_adb.mock_calls == expected_calls
+        assert result == b'succes'
+        run.assert_called_once_with(['install', '-g', '-t', apk])
 
-    def test_install_not_all_permissions(self):
-        mock_adb = Mock()
-        mock_adb._ADB__output = 'succes'
-        Adb.adb = mock_adb
-        device_id = 123
+    def test_install_not_all_permissions(self, adb_handle):
+        handle, run = adb_handle
+        run.return_value = b'succes'
         apk = 'test_apk.apk'
 
-        result = Adb.install(device_id, apk, all_permissions=False)
+        result = handle.install(apk, all_permissions=False)
 
-        assert result == 'succes'
-        expected_calls = [call.set_target_by_name(device_id), call.run_cmd(['install', '-r', '-t', apk])]
-        assert mock_adb.mock_calls == expected_calls
+        assert result == b'succes'
+        run.assert_called_once_with(['install', '-r', '-t', apk])
 
     @patch('AndroidRunner.Adb.success_or_exception')
-    def test_uninstall_delete_data(self, s_or_e):
-        mock_adb = Mock()
-        mock_adb.uninstall.return_value = 'succes'
-        Adb.adb = mock_adb
-        device_id = 123
+    def test_uninstall_delete_data(self, s_or_e, adb_handle):
+        handle, run = adb_handle
+        run.return_value = b'succes'
         name = 'app_name'
 
-        manager = Mock()
-        manager.attach_mock(s_or_e, "s_or_e_mock")
-        manager.mock_adb = mock_adb
-
-        Adb.uninstall(device_id, name)
+        handle.uninstall(name)
 
-        expected_calls = [call.mock_adb.set_target_by_name(123),
-                          call.mock_adb.uninstall(package=name, keepdata=True),
-                          call.s_or_e_mock('succes', '{}: "{}" uninstalled'.format(device_id, name),
-                                           '{}: Failed to uninstall "{}"'.format(device_id, name))]
-        assert manager.mock_calls == expected_calls
+        run.assert_called_once_with(['uninstall', name])
+        s_or_e.assert_called_once_with(b'succes', '123: "{}" uninstalled'.format(name),
+                                       '123: Failed to uninstall "{}"'.format(name))
 
     @patch('AndroidRunner.Adb.success_or_exception')
-    def test_uninstall_keep_data(self, s_or_e):
-        mock_adb = Mock()
-        mock_adb.uninstall.return_value = 'succes'
-        Adb.adb = mock_adb
-        device_id = 123
+    def test_uninstall_keep_data(self, s_or_e, adb_handle):
+        handle, run = adb_handle
+        run.return_value = b'succes'
         name = 'app_name'
 
-        manager = Mock()
-        manager.attach_mock(s_or_e, "s_or_e_mock")
-        manager.mock_adb = mock_adb
-
-        Adb.uninstall(device_id, name, True)
+        handle.uninstall(name, True)
 
-        expected_calls = [call.mock_adb.set_target_by_name(123),
-                          call.mock_adb.uninstall(package=name, keepdata=False),
-                          call.s_or_e_mock('succes', '{}: "{}" uninstalled'.format(device_id, name),
-                                           '{}: Failed to uninstall "{}"'.format(device_id, name))]
-        assert manager.mock_calls == expected_calls
+        run.assert_called_once_with(['uninstall', '-k', name])
+        s_or_e.assert_called_once_with(b'succes', '123: "{}" uninstalled'.format(name),
+                                       '123: Failed to uninstall "{}"'.format(name))
 
     @patch('AndroidRunner.Adb.success_or_exception')
-    def test_clear_app_data(self, s_or_e):
-        mock_adb = Mock()
-        mock_adb.shell_command.return_value = 'succes'
-        Adb.adb = mock_adb
-        device_id = 123
+    def test_clear_app_data(self, s_or_e, adb_handle):
+        handle, run = adb_handle
+        run.return_value = b'succes'
         name = 'app_name'
 
-        manager = Mock()
-        manager.attach_mock(s_or_e, "s_or_e_mock")
-        manager.mock_adb = mock_adb
+        handle.clear_app_data(name)
 
-        Adb.clear_app_data(device_id, name)
+        run.assert_called_once_with(['shell', 'pm clear app_name'])
+        s_or_e.assert_called_once_with(b'succes', '123: Data of "{}" cleared'.format(name),
+                                       '123: Failed to clear data for "{}"'.format(name))
 
-        expected_calls = [call.mock_adb.set_target_by_name(123),
-                          call.mock_adb.shell_command('pm clear app_name'),
-                          call.s_or_e_mock('succes', '{}: Data of "{}" cleared'.format(device_id, name),
-                                           '{}: Failed to clear data for "{}"'.format(device_id, name))]
-        assert manager.mock_calls == expected_calls
 
     @patch('logging.Logger.info')
     def test_success_or_exception_succes(self, logger):
@@ -893,72 +1205,27 @@ class TestAdb(object):
 
         logger.assert_called_once_with(fail_msg + '\nMessage returned:\n{}'.format(input_string))
 
-    def test_push(self):
-        mock_adb = Mock()
-        mock_adb._ADB__output = 'push output'
-        Adb.adb = mock_adb
-
-        device_id = 123
+    def test_push(self, adb_handle):
+        handle, run = adb_handle
+        run.return_value = b'push output'
         local_path = 'local/path'
         remote_path = 'remote/path'
 
-        result = Adb.push(device_id, local_path, remote_path)
+        result = handle.push(local_path, remote_path)
 
-        assert result == 'push output'
-        expected_calls = [call.set_target_by_name(device_id),
-                          call.run_cmd('push {} {}'.format(local_path, remote_path))]
-        assert mock_adb.mock_calls == expected_calls
+        assert result == b'push output'
+        run.assert_called_once_with(['push', local_path, remote_path])
 
-    def test_pull_no_error(self):
-        mock_adb = Mock()
-        mock_adb._ADB__output = 'pull output'
-        mock_adb._ADB__error = None
-        Adb.adb = mock_adb
-
-        device_id = 123
+    def test_pull(self, adb_handle):
+        handle, run = adb_handle
+        run.return_value = b'pull output'
         local_path = 'local/path'
         remote_path = 'remote/path'
 
-        result = Adb.pull(device_id, remote_path, local_path)
+        result = handle.pull(remote_path, local_path)
 
-        assert result == 'pull output'
-        expected_calls = [call.set_target_by_name(device_id),
-                          call.run_cmd('pull {} {}'.format(remote_path, local_path))]
-        assert mock_adb.mock_calls == expected_calls
-
-    def test_pull_error_no_bytes_in(self):
-        mock_adb = Mock()
-        mock_adb._ADB__output = 'pull output'
-        mock_adb._ADB__error = 'error error'
-        Adb.adb = mock_adb
-
-        device_id = 123
-        local_path = 'local/path'
-        remote_path = 'remote/path'
-
-        result = Adb.pull(device_id, remote_path, local_path)
-
-        assert result == 'pull output'
-        expected_calls = [call.set_target_by_name(device_id),
-                          call.run_cmd('pull {} {}'.format(remote_path, local_path))]
-        assert mock_adb.mock_calls == expected_calls
-
-    def test_pull_error_with_bytes_in(self):
-        mock_adb = Mock()
-        mock_adb._ADB__output = 'pull output'
-        mock_adb._ADB__error = 'bytes in error'
-        Adb.adb = mock_adb
-
-        device_id = 123
-        local_path = 'local/path'
-        remote_path = 'remote/path'
-
-        result = Adb.pull(device_id, remote_path, local_path)
-
-        assert result == 'bytes in error'
-        expected_calls = [call.set_target_by_name(device_id),
-                          call.run_cmd('pull {} {}'.format(remote_path, local_path))]
-        assert mock_adb.mock_calls == expected_calls
+        assert result == b'pull output'
+        run.assert_called_once_with(['pull', remote_path, local_path])
 
     def test_logcat_no_regex(self):
         mock_adb = Mock()
@@ -1011,3 +1278,195 @@ class TestAdb(object):
         shell.assert_called_with(123, "settings put secure location_providers_allowed +gps,network")
         Adb.configure_settings(device_id, setting2, enable=False)
         shell.assert_called_with(123, "settings put secure location_providers_allowed -gps")
+
+
+class TestLogcatStream(object):
+
+    @pytest.fixture()
+    def stream(self):
+        return LogcatStream('serial_a')
+
+    def test_dispatch(self, stream):
+        matches = []
+        stream.subscribe(r'Displayed \S+', matches.append)
+        stream.subscribe('never', Mock())
+
+        stream.dispatch('I ActivityManager: Displayed com.example/.Main: +1s')
+        stream.dispatch('I ActivityManager: Start proc com.example')
+
+        assert matches == ['I ActivityManager: Displayed com.example/.Main: +1s']
+        assert stream.lines == 2
+
+    def test_dispatch_once(self, stream):
+        callback = Mock()
+        subscription = stream.subscribe('match', callback, once=True)
+
+        stream.dispatch('match 1')
+        stream.dispatch('match 2')
+
+        callback.assert_called_once_with('match 1')
+        assert not subscription.active
+        assert stream.subscriptions == []
+
+    def test_dispatch_callback_error(self, stream):
+        failing = stream.subscribe('match', Mock(side_effect=ValueError('full')))
+        callback = Mock()
+        stream.subscribe('match', callback)
+
+        stream.dispatch('match')
+
+        callback.assert_called_once_with('match')
+        assert failing.active
+
+    def test_cancel(self, stream):
+        callback = Mock()
+        subscription = stream.subscribe('match', callback)
+        subscription.cancel()
+
+        stream.dispatch('match')
+
+        callback.assert_not_called()
+
+    @patch('AndroidRunner.LogcatStream.subprocess.Popen')
+    def test_binary_backend(self, popen, stream):
+        process = Mock()
+        process.stdout = io.BytesIO(b'I Tag: first\r\nI Tag: match\n')
+        popen.return_value = process
+        matched = threading.Event()
+        stream.subscribe('match', lambda line: matched.set())
+
+        stream.start()
+        assert matched.wait(5)
+        stream.stop()
+
+        popen.assert_called_once_with(['adb', '-s', 'serial_a', 'logcat', '-T', '1'], stdout=subprocess.PIPE,
+                                      stderr=subprocess.DEVNULL)
+        process.terminate.assert_called_once_with()
+        assert not stream.is_running()
+
+    def test_socket_backend(self):
+        with FakeAdbServer(serials=['serial_a']) as server:
+            server.shell_responses['logcat -T 1'] = b'I Tag: first\nI ActivityManager: Displayed com.example\n'
+            client = AdbClient(port=server.port, timeout=5)
+            stream = LogcatStream('serial_a', adb_client=client)
+            matches = []
+            matched = threading.Event()
+            stream.subscribe('Displayed', lambda line: matches.append(line) or matched.set())
+
+            stream.start()
+            assert matched.wait(5)
+            stream.stop()
+            client.close()
+
+        assert matches[0] == 'I ActivityManager: Displayed com.example'
+        assert server.requests[:2] == ['host:transport:serial_a', 'shell:logcat -T 1']
+
+    @patch('AndroidRunner.Adb.LogcatStream')
+    def test_logcat_stream_per_device(self, logcat_stream):
+        logcat_stream.side_effect = lambda device_id, *args: Mock(device_id=device_id)
+
+        first = Adb.logcat_stream('serial_a')
+        assert Adb.logcat_stream('serial_a') is first
+        second = Adb.logcat_stream('serial_b')
+        Adb.close_logcat_streams()
+
+        assert second is not first
+        assert logcat_stream.call_count == 2
+        first.start.assert_called_once_with()
+        first.stop.assert_called_once_with()
+        second.stop.assert_called_once_with()
+        assert Adb.logcat_streams == {}
+
+
+class TestAdbClient(object):
+
+    @pytest.fixture()
+    def server(self):
+        with FakeAdbServer(serials=['serial_a', 'serial_b']) as server:
+            yield server
+
+    @pytest.fixture()
+    def client(self, server):
+        client = AdbClient(port=server.port, timeout=5)
+        yield client
+        client.close()
+
+    def test_version(self, client):
+        assert client.version() == FakeAdbServer.VERSION
+
+    def test_devices(self, client):
+        assert client.devices() == {0: 'serial_a', 1: 'serial_b'}
+
+    def test_connection_refused(self, server):
+        server.tcp_server.server_close()
+        with pytest.raises(AdbClientError):
+            AdbClient(port=server.port, timeout=5).version()
+
+    def test_shell(self, client, server):
+        server.shell_responses['getprop ro.build.version.sdk'] = b'30\n'
+
+        assert client.shell('serial_b', 'getprop ro.build.version.sdk') == b'30\n'
+        assert server.requests == ['host:transport:serial_b', 'shell:getprop ro.build.version.sdk']
+
+    def test_shell_unknown_device(self, client):
+        with pytest.raises(AdbClientError) as except_result:
+            client.shell('serial_c', 'ls')
+        assert 'device not found' in str(except_result.value)
+
+    def test_push_file_into_directory(self, client, server, tmpdir):
+        local_file = tmpdir.join('config.txt')
+        local_file.write('config')
+
+        result = client.push('serial_a', str(local_file), '/sdcard/')
+
+        assert server.files == {'/sdcard/config.txt': b'config'}
+        assert b'1 file pushed' in result
+
+    def test_push_directory(self, client, server, tmpdir):
+        pref_dir = tmpdir.mkdir('trepn.pref')
+        pref_dir.join('a.xml').write('a')
+        pref_dir.mkdir('sub').join('b.xml').write('b')
+
+        client.push('serial_a', str(pref_dir) + '/', '/sdcard')
+
+        assert server.files == {'/sdcard/trepn.pref/a.xml': b'a', '/sdcard/trepn.pref/sub/b.xml': b'b'}
+
+    def test_push_missing_local_file(self, client, tmpdir):
+        assert b'error' in client.push('serial_a', str(tmpdir.join('missing')), '/sdcard/')
+
+    def test_pull_reuses_sync_connection(self, client, server, tmpdir):
+        data = bytes(range(256)) * 100
+        server.files['/sdcard/trace.bin'] = data
+        server.files['/sdcard/log.txt'] = b'log'
+
+        first = client.pull('serial_a', '/sdcard/trace.bin', str(tmpdir))
+        client.pull('serial_a', '/sdcard/log.txt', str(tmpdir.join('renamed.txt')))
+
+        assert tmpdir.join('trace.bin').read_binary() == data
+        assert tmpdir.join('renamed.txt').read_binary() == b'log'
+        assert b'1 file pulled' in first and b'25600 bytes' in first
+        assert server.requests.count('sync:') == 1
+        assert server.connections == 1
+
+    def test_pull_missing_remote_file(self, client, server, tmpdir):
+        result = client.pull('serial_a', '/sdcard/missing.txt', str(tmpdir))
+
+        assert b'error' in result
+        assert not tmpdir.join('missing.txt').exists()
+
+    def test_pull_reconnects_after_server_restart(self, client, server, tmpdir):
+        server.files['/sdcard/log.txt'] = b'log'
+        client.pull('serial_a', '/sdcard/log.txt', str(tmpdir))
+        for connections in client._sync_pool.values():
+            for sock in connections:
+                sock.shutdown(2)
+
+        client.pull('serial_a', '/sdcard/log.txt', str(tmpdir.join('again.txt')))
+
+        assert tmpdir.join('again.txt').read_binary() == b'log'
+        assert server.requests.count('sync:') == 2
+
+    def test_kill_server(self, client, server):
+        client.kill_server()
+
+        assert server.killed
@@ -1,5 +1,7 @@
 import filecmp
+import multiprocessing as mp
 import os
+import threading
 from collections import OrderedDict
 from http.server import HTTPServer
 
@@ -77,7 +79,7 @@ class TestExperiment(object):
         assert experiment.time_between_run == 0
         assert experiment.clear_cache == False
         assert experiment.output_root == paths.OUTPUT_DIR
-        assert experiment.result_file_structure is None
+        assert experiment.run_manifest is None
         assert mock_prepare.call_count == 0
 
     @patch('AndroidRunner.Experiment.Experiment.prepare_device')
@@ -103,7 +105,7 @@ class TestExperiment(object):
         assert experiment.time_between_run == 0
         assert experiment.clear_cache == False
         assert experiment.output_root == paths.OUTPUT_DIR
-        assert experiment.result_file_structure is None
+        assert experiment.run_manifest is None
         assert mock_prepare.call_count == 3
         assert mock_prepare.mock_calls[0] == call('dev1', restart=True)
         assert mock_prepare.mock_calls[1] == call('dev2', restart=True)
@@ -137,10 +139,12 @@ class TestExperiment(object):
         assert experiment.time_between_run == 10
         assert experiment.clear_cache == True
         assert experiment.output_root == paths.OUTPUT_DIR
-        assert experiment.result_file_structure is None
-        mock_devices.assert_called_once_with(['dev1', 'dev2'], adb_path='test_adb', devices_spec=None)
-        mock_profilers.assert_called_once_with({'fake': {'config1': 1, 'config2': 2}})
-        mock_scripts.assert_called_once_with({'script1': 'path/to/1'}, monkeyrunner_path='monkey_path', monkey_playback_path='monkey_playback.py')
+        assert experiment.run_manifest is None
+        mock_devices.assert_called_once_with(['dev1', 'dev2'], adb_path='test_adb', devices_spec=None,
+                                             adb_backend='binary')
+        mock_profilers.assert_called_once_with({'fake': {'config1': 1, 'config2': 2}}, execution='serial')
+        mock_scripts.assert_called_once_with({'script1': 'path/to/1'}, monkeyrunner_path='monkey_path', monkey_playback_path='monkey_playback.py',
+                                             execution='worker')
         mock_test.assert_called_once_with(experiment.devices, [])
         assert mock_prepare.call_count == 0
 
@@ -178,110 +182,246 @@ class TestExperiment(object):
         default_experiment.progress = mock_progress
         assert default_experiment.get_progress_xml_file() == xml_path
 
-    def test_update_progress_empty_folder(self, default_experiment, tmpdir):
+    def test_list_files(self, default_experiment, tmpdir):
+        run_dir = os.path.join(str(tmpdir), 'data', 'device', 'subject')
+        makedirs(os.path.join(run_dir, 'android'))
+        open(os.path.join(run_dir, 'android', 'test.txt'), 'w+')
+
+        assert default_experiment.list_files(run_dir) == {os.path.join(run_dir, 'android'),
+                                                          os.path.join(run_dir, 'android', 'test.txt')}
+        assert default_experiment.list_files(os.path.join(str(tmpdir), 'missing')) == set()
+
+    def test_remove_unsaved_run_files(self, default_experiment, tmpdir):
+        data_dir = os.path.join(str(tmpdir), 'data')
+        run_dir = os.path.join(data_dir, 'device', 'subject')
+        other_run_dir = os.path.join(data_dir, 'device', 'other_subject')
+        makedirs(os.path.join(run_dir, 'android'))
+        makedirs(other_run_dir)
+        open(os.path.join(run_dir, 'android', 'run1.csv'), 'w+')
+        default_experiment.output_dir = run_dir
+        default_experiment.start_run_manifest()
+
+        makedirs(os.path.join(run_dir, 'trepn', 'nested'))
+        open(os.path.join(run_dir, 'trepn', 'nested', 'run2.csv'), 'w+')
+        open(os.path.join(run_dir, 'android', 'run2.csv'), 'w+')
+        open(os.path.join(other_run_dir, 'unrelated.csv'), 'w+')
+        default_experiment.remove_unsaved_run_files()
+
+        assert default_experiment.list_files(data_dir) == {os.path.join(data_dir, 'device'), run_dir, other_run_dir,
+                                                           os.path.join(run_dir, 'android'),
+                                                           os.path.join(run_dir, 'android', 'run1.csv'),
+                                                           os.path.join(other_run_dir, 'unrelated.csv')}
+        assert default_experiment.run_manifest is None
+
+    def test_remove_unsaved_run_files_no_run(self, default_experiment):
+        default_experiment.run_manifest = None
+
+        default_experiment.remove_unsaved_run_files()
+
+    def test_save_progress(self, default_experiment):
+        default_experiment.progress = Mock()
+        default_experiment.run_manifest = ('run/dir', set())
+
+        default_experiment.save_progress()
+
+        default_experiment.progress.write_progress_to_file.assert_called_once_with()
+        assert default_experiment.run_manifest is None
+
+    def test_get_experiment(self, default_experiment):
+        default_experiment.random = False
         mock_progress = Mock()
+        get_next_run_mock = Mock()
+        mock_progress.get_next_run.return_value = get_next_run_mock
         default_experiment.progress = mock_progress
-        paths.BASE_OUTPUT_DIR = str(tmpdir)
-        makedirs(os.path.join(paths.BASE_OUTPUT_DIR, 'data'))
-        default_experiment.update_progress()
 
-        mock_progress.write_progress_to_file.assert_called_once()
-        result_walk_list = list(default_experiment.result_file_structure)
-        expected_walk_list = default_experiment.walk_to_list(os.walk(os.path.join(paths.BASE_OUTPUT_DIR, 'data')))
-        assert result_walk_list == expected_walk_list
+        assert default_experiment.get_experiment() == get_next_run_mock
 
-    def test_update_progress_non_empty_folder(self, default_experiment, tmpdir):
+    def test_get_experiment_random(self, default_experiment):
+        default_experiment.random = True
         mock_progress = Mock()
+        get_random_run_mock = Mock()
+        mock_progress.get_random_run.return_value = get_random_run_mock
         default_experiment.progress = mock_progress
-        paths.BASE_OUTPUT_DIR = str(tmpdir)
-        folder_path = os.path.join(paths.BASE_OUTPUT_DIR, 'data', '1', '2')
-        makedirs(folder_path)
-        open(os.path.join(folder_path, "test.txt"), "w+")
-        default_experiment.update_progress()
 
-        mock_progress.write_progress_to_file.assert_called_once()
-        result_walk_list = list(default_experiment.result_file_structure)
-        expected_walk_list = default_experiment.walk_to_list(os.walk(os.path.join(paths.BASE_OUTPUT_DIR, 'data')))
-        assert result_walk_list == expected_walk_list
+        assert default_experiment.get_experiment() == get_random_run_mock
 
-    def test_walk_to_list(self, default_experiment, tmpdir):
-        paths.BASE_OUTPUT_DIR = str(tmpdir)
-        folder_path1 = os.path.join(paths.BASE_OUTPUT_DIR, 'data', '1', '1')
-        folder_path2 = os.path.join(paths.BASE_OUTPUT_DIR, 'data', '2', '1')
-        makedirs(folder_path1), makedirs(folder_path2)
-        open(os.path.join(folder_path1, "test.txt"), "w+")
-        open(os.path.join(folder_path2, "test.txt"), "w+")
+    def test_get_experiment_device(self, default_experiment):
+        mock_progress = Mock()
+        default_experiment.progress = mock_progress
 
-        walk_list = default_experiment.walk_to_list(os.walk(paths.BASE_OUTPUT_DIR))
-        print(walk_list)
-        assert len(walk_list) == 7
+        default_experiment.random = False
+        assert default_experiment.get_experiment('dev1') == mock_progress.get_next_run.return_value
+        default_experiment.random = True
+        assert default_experiment.get_experiment('dev1') == mock_progress.get_random_run.return_value
 
-        files = ['data/1/1/test.txt', 'data/2/1/test.txt']
-        flags = [False]*2
+        mock_progress.get_next_run.assert_called_once_with('dev1')
+        mock_progress.get_random_run.assert_called_once_with('dev1')
 
-        for item in walk_list:
-            for i, file in enumerate(files):
-                flags[i] |= file in item
+    @patch('AndroidRunner.Tests.check_dependencies')
+    @patch('AndroidRunner.Devices.Devices.__init__')
+    def test_init_scheduler(self, mock_devices, mock_test):
+        mock_devices.return_value = None
 
-        assert(all(flags))
+        assert Experiment({'devices': 'fake_device'}, None, False).scheduler == 'sequential'
+        assert Experiment({'devices': 'fake_device', 'scheduler': 'parallel'}, None, False).scheduler == 'parallel'
+        with pytest.raises(ConfigError):
+            Experiment({'devices': 'fake_device', 'scheduler': 'round_robin'}, None, False)
 
-    def test_check_result_files_correct(self, default_experiment, tmpdir):
-        paths.BASE_OUTPUT_DIR = str(tmpdir)
-        folder_path1 = os.path.join(paths.BASE_OUTPUT_DIR, 'data', '1', '1')
-        folder_path2 = os.path.join(paths.BASE_OUTPUT_DIR, 'data', '2', '1')
-        makedirs(folder_path1), makedirs(folder_path2)
-        open(os.path.join(folder_path1, "test.txt"), "w+")
-        open(os.path.join(folder_path2, "test.txt"), "w+")
-        correct_file_structure1 = os.walk(os.path.join(paths.BASE_OUTPUT_DIR, 'data'))
-        correct_file_structure2 = os.walk(os.path.join(paths.BASE_OUTPUT_DIR, 'data'))
+    @patch('AndroidRunner.Tests.check_dependencies')
+    @patch('AndroidRunner.Devices.Devices.__init__')
+    def test_init_profiler_execution(self, mock_devices, mock_test):
+        mock_devices.return_value = None
 
-        default_experiment.check_result_files(correct_file_structure1)
+        assert Experiment({'devices': 'fake_device'}, None, False).profilers.execution == 'serial'
+        experiment = Experiment({'devices': 'fake_device', 'profiler_execution': 'concurrent'}, None, False)
+        assert experiment.profilers.execution == 'concurrent'
+        with pytest.raises(ConfigError):
+            Experiment({'devices': 'fake_device', 'profiler_execution': 'threads'}, None, False)
 
-        current_file_structure = os.walk(os.path.join(paths.BASE_OUTPUT_DIR, 'data'))
+    @patch('AndroidRunner.Tests.check_dependencies')
+    @patch('AndroidRunner.Devices.Devices.__init__')
+    def test_init_aggregation_processes(self, mock_devices, mock_test):
+        mock_devices.return_value = None
 
-        assert list(current_file_structure) == list(correct_file_structure2)
+        assert Experiment({'devices': 'fake_device'}, None, False).aggregation_processes == mp.cpu_count()
+        assert Experiment({'devices': 'fake_device', 'aggregation_processes': 3}, None, False).aggregation_processes == 3
+        with pytest.raises(ConfigError):
+            Experiment({'devices': 'fake_device', 'aggregation_processes': 0}, None, False)
 
-    def test_check_result_files_incorrect(self, default_experiment, tmpdir):
-        paths.BASE_OUTPUT_DIR = str(tmpdir)
-        folder_path1 = os.path.join(paths.BASE_OUTPUT_DIR, 'data', '1', '1')
-        folder_path2 = os.path.join(paths.BASE_OUTPUT_DIR, 'data', '2', '1')
-        folder_path3 = os.path.join(paths.BASE_OUTPUT_DIR, 'data', '3', '1')
-        makedirs(folder_path1), makedirs(folder_path2)
-        open(os.path.join(folder_path1, "test.txt"), "w+")
-        open(os.path.join(folder_path2, "test.txt"), "w+")
+    @patch('AndroidRunner.Tests.check_dependencies')
+    @patch('AndroidRunner.Devices.Devices.__init__')
+    def test_init_readiness(self, mock_devices, mock_test):
+        mock_devices.return_value = None
+        config = {'devices': 'fake_device', 'readiness': {'close': {'type': 'delay', 'duration': 3000}}}
 
-        correct_file_structure_list1 = default_experiment.walk_to_list(
-            os.walk(os.path.join(paths.BASE_OUTPUT_DIR, 'data')))
-        correct_file_structure_list2 = list(os.walk(os.path.join(paths.BASE_OUTPUT_DIR, 'data')))
+        experiment = NativeExperiment(config, None, False)
 
-        makedirs(folder_path3)
-        open(os.path.join(folder_path3, "test.txt"), "w+")
+        assert experiment.readiness['launch'].type == 'activity'
+        assert experiment.readiness['close'].type == 'delay'
+        assert experiment.readiness['close'].duration == 3
+        with pytest.raises(ConfigError):
+            NativeExperiment({'devices': 'fake_device', 'readiness': {'load': {'type': 'activity'}}}, None, False)
 
-        incorrect_file_structure_list = list(os.walk(os.path.join(paths.BASE_OUTPUT_DIR, 'data')))
-        assert not correct_file_structure_list2 == incorrect_file_structure_list
+    def test_wait_until_ready(self, default_experiment):
+        probe = Mock()
+        default_experiment.readiness = {'launch': probe}
+        device = Mock()
 
-        default_experiment.check_result_files(correct_file_structure_list1)
+        default_experiment.wait_until_ready('launch', device, 'com.test.app')
 
-        current_file_structure_list = list(os.walk(os.path.join(paths.BASE_OUTPUT_DIR, 'data')))
-        assert current_file_structure_list == correct_file_structure_list2
+        probe.wait.assert_called_once_with(device, 'com.test.app')
 
-    def test_get_experiment(self, default_experiment):
-        default_experiment.random = False
-        mock_progress = Mock()
-        get_next_run_mock = Mock()
-        mock_progress.get_next_run.return_value = get_next_run_mock
-        default_experiment.progress = mock_progress
+    @patch('AndroidRunner.Tests.check_dependencies')
+    @patch('AndroidRunner.Devices.Devices.__init__')
+    def test_init_script_execution(self, mock_devices, mock_test):
+        mock_devices.return_value = None
 
-        assert default_experiment.get_experiment() == get_next_run_mock
+        assert Experiment({'devices': 'fake_device'}, None, False).scripts.execution == 'worker'
+        experiment = Experiment({'devices': 'fake_device', 'script_execution': 'process'}, None, False)
+        assert experiment.scripts.execution == 'process'
+        with pytest.raises(ConfigError):
+            Experiment({'devices': 'fake_device', 'script_execution': 'thread'}, None, False)
 
-    def test_get_experiment_random(self, default_experiment):
-        default_experiment.random = True
+    @pytest.mark.parametrize('option', [{'usb_handler': {'enable_command': 'on', 'disable_command': 'off'}},
+                                        {'reset_adb_among_runs': True},
+                                        {'run_stopping_condition': {'post_request': {}}}])
+    @patch('AndroidRunner.Tests.check_dependencies')
+    @patch('AndroidRunner.Devices.Devices.__init__')
+    def test_init_parallel_scheduler_invalid_options(self, mock_devices, mock_test, option):
+        mock_devices.return_value = None
+        config = {'devices': 'fake_device', 'scheduler': 'parallel'}
+        config.update(option)
+
+        with pytest.raises(ConfigError):
+            Experiment(config, None, False)
+
+    @pytest.fixture()
+    def parallel_experiment(self, default_experiment):
+        remaining = {'dev1': 3, 'dev2': 2, 'dev3': 0}
+        devices = []
+        for name in remaining:
+            device = Mock()
+            device.name = name
+            devices.append(device)
         mock_progress = Mock()
-        get_random_run_mock = Mock()
-        mock_progress.get_random_run.return_value = get_random_run_mock
+        mock_progress.device_finished.side_effect = lambda d: remaining[d] == 0
+        mock_progress.get_next_run.side_effect = lambda d: {'device': d, 'runId': remaining[d]}
+        paths.BASE_OUTPUT_DIR = 'test'
+        default_experiment.scheduler = 'parallel'
+        default_experiment.random = False
+        default_experiment.devices = devices
         default_experiment.progress = mock_progress
+        return default_experiment, remaining
 
-        assert default_experiment.get_experiment() == get_random_run_mock
+    @patch('AndroidRunner.Experiment.Experiment.save_progress')
+    @patch('AndroidRunner.Experiment.Experiment.run_experiment')
+    def test_run_parallel(self, run_experiment, save_progress, parallel_experiment):
+        experiment, remaining = parallel_experiment
+        runs = []
+
+        def run(current_run):
+            runs.append((threading.current_thread().name, current_run['device'], current_run['runId']))
+            remaining[current_run['device']] -= 1
+        run_experiment.side_effect = run
+
+        experiment.run_parallel()
+
+        assert sorted(runs) == [('device-dev1', 'dev1', 1), ('device-dev1', 'dev1', 2), ('device-dev1', 'dev1', 3),
+                                ('device-dev2', 'dev2', 1), ('device-dev2', 'dev2', 2)]
+        assert save_progress.call_count == 5
+        assert [d.name for d in experiment.workers] == ['dev1', 'dev2']
+        workers = list(experiment.workers.values())
+        assert workers[0].profilers is not workers[1].profilers
+        assert [w.worker_device.name for w in workers] == ['dev1', 'dev2']
+        assert experiment.worker_device is None
+        assert experiment.profilers is workers[0].profilers
+
+    @patch('AndroidRunner.Experiment.Experiment.save_progress')
+    @patch('AndroidRunner.Experiment.Experiment.run_experiment')
+    def test_run_parallel_worker_error(self, run_experiment, save_progress, parallel_experiment):
+        experiment, remaining = parallel_experiment
+
+        def run(current_run):
+            if current_run['device'] == 'dev1':
+                raise ConfigError('worker failed')
+            remaining[current_run['device']] -= 1
+        run_experiment.side_effect = run
+
+        with pytest.raises(ConfigError):
+            experiment.run_parallel()
+        assert experiment.stop_workers.is_set()
+        assert remaining['dev1'] == 3
+
+    @patch('AndroidRunner.Experiment.Experiment.run_parallel')
+    @patch('AndroidRunner.Experiment.Experiment.get_experiment')
+    @patch('AndroidRunner.Experiment.Experiment.finish_experiment')
+    def test_start_parallel(self, finish_experiment_mock, get_experiment_mock, run_parallel_mock, default_experiment):
+        default_experiment.scheduler = 'parallel'
+        default_experiment.progress = Mock()
+
+        default_experiment.start()
+
+        run_parallel_mock.assert_called_once_with()
+        assert get_experiment_mock.call_count == 0
+        finish_experiment_mock.assert_called_once_with(False, False)
+
+    @patch('AndroidRunner.Experiment.Experiment.aggregate_end')
+    @patch('AndroidRunner.Experiment.Experiment.remove_unsaved_run_files')
+    def test_finish_experiment_parallel_cleanup_by_worker(self, remove_unsaved_run_files, aggregate_end,
+                                                          default_experiment):
+        worker = Mock()
+        device1 = Mock()
+        device2 = Mock()
+        default_experiment.devices = [device1, device2]
+        default_experiment.workers = {device1: worker}
+        default_experiment.profilers = Mock()
+
+        default_experiment.finish_experiment(False, False)
+
+        worker.cleanup.assert_called_once_with(device1)
+        worker.remove_unsaved_run_files.assert_called_once_with()
+        remove_unsaved_run_files.assert_called_once_with()
+        default_experiment.profilers.unload.assert_called_once_with(device2)
 
     def test_stop_run_function_call_on_error(self, default_experiment):
         default_experiment.run_stopping_condition_config = None
@@ -393,6 +533,18 @@ class TestExperiment(object):
         assert os.path.isdir(paths.OUTPUT_DIR)
         assert paths.OUTPUT_DIR == os.path.join(paths.BASE_OUTPUT_DIR, 'data', 'fake_device', 'fake_path')
 
+    def test_prepare_output_dir_parallel(self, tmpdir, default_experiment):
+        paths.BASE_OUTPUT_DIR = str(tmpdir)
+        paths.OUTPUT_DIR = str(tmpdir)
+        default_experiment.scheduler = 'parallel'
+        fake_dict = {'device': 'fake_device', 'path': 'fake_path'}
+
+        default_experiment.prepare_output_dir(fake_dict)
+
+        assert default_experiment.output_dir == os.path.join(str(tmpdir), 'data', 'fake_device', 'fake_path')
+        assert os.path.isdir(default_experiment.output_dir)
+        assert paths.OUTPUT_DIR == str(tmpdir)
+
     @patch('AndroidRunner.Experiment.Experiment.after_run')
     @patch('AndroidRunner.Experiment.Experiment.stop_profiling')
     @patch('AndroidRunner.Experiment.Experiment.interaction')
@@ -489,7 +641,7 @@ class TestExperiment(object):
         mock_manager.attach_mock(script_run, 'script_run_managed')
         default_experiment.before_run(mock_device, path, run, *args, **kwargs)
 
-        expected_calls = [call.set_output_managed(),
+        expected_calls = [call.set_output_managed(None),
                           call.mock_device_managed.shell('logcat -c'),
                           call.script_run_managed('before_run', mock_device, *args, **kwargs)]
         assert mock_manager.mock_calls == expected_calls
@@ -616,42 +768,39 @@ class TestExperiment(object):
 
         default_experiment.aggregate_end()
 
-        aggregate_end.assert_called_once_with(default_experiment.output_root)
+        aggregate_end.assert_called_once_with(default_experiment.output_root,
+                                              processes=default_experiment.aggregation_processes)
 
     @patch('AndroidRunner.Experiment.Experiment.aggregate_end')
     @patch('AndroidRunner.Experiment.Experiment.cleanup')
-    @patch('AndroidRunner.Experiment.Experiment.check_result_files')
-    def test_finish_experiment_regular_no_devices(self, check_result_files, cleanup, aggregate_end, default_experiment):
-        fake_file_structure = 'test_structure'
-        default_experiment.result_file_structure = fake_file_structure
+    @patch('AndroidRunner.Experiment.Experiment.remove_unsaved_run_files')
+    def test_finish_experiment_regular_no_devices(self, remove_unsaved_run_files, cleanup, aggregate_end, default_experiment):
         default_experiment.devices = []
         mock_manager = Mock()
-        mock_manager.attach_mock(check_result_files, "check_result_files_managed")
+        mock_manager.attach_mock(remove_unsaved_run_files, "remove_unsaved_run_files_managed")
         mock_manager.attach_mock(aggregate_end, "aggregate_end_managed")
 
         default_experiment.finish_experiment(False, False)
 
-        expected_calls = [call.check_result_files_managed(fake_file_structure),
+        expected_calls = [call.remove_unsaved_run_files_managed(),
                           call.aggregate_end_managed()]
         assert mock_manager.mock_calls == expected_calls
         assert cleanup.call_count == 0
 
     @patch('AndroidRunner.Experiment.Experiment.aggregate_end')
     @patch('AndroidRunner.Experiment.Experiment.cleanup')
-    @patch('AndroidRunner.Experiment.Experiment.check_result_files')
-    def test_finish_experiment_regular_multiple_devices(self, check_result_files, cleanup, aggregate_end,
+    @patch('AndroidRunner.Experiment.Experiment.remove_unsaved_run_files')
+    def test_finish_experiment_regular_multiple_devices(self, remove_unsaved_run_files, cleanup, aggregate_end,
                                                         default_experiment):
-        fake_file_structure = 'test_structure'
-        default_experiment.result_file_structure = fake_file_structure
         default_experiment.devices = ['1', '2', '3']
         mock_manager = Mock()
-        mock_manager.attach_mock(check_result_files, "check_result_files_managed")
+        mock_manager.attach_mock(remove_unsaved_run_files, "remove_unsaved_run_files_managed")
         mock_manager.attach_mock(aggregate_end, "aggregate_end_managed")
         mock_manager.attach_mock(cleanup, "cleanup_managed")
 
         default_experiment.finish_experiment(False, False)
 
-        expected_calls = [call.check_result_files_managed(fake_file_structure),
+        expected_calls = [call.remove_unsaved_run_files_managed(),
                           call.cleanup_managed('1'),
                           call.cleanup_managed('2'),
                           call.cleanup_managed('3'),
@@ -660,41 +809,35 @@ class TestExperiment(object):
 
     @patch('AndroidRunner.Experiment.Experiment.aggregate_end')
     @patch('AndroidRunner.Experiment.Experiment.cleanup')
-    @patch('AndroidRunner.Experiment.Experiment.check_result_files')
-    def test_finish_experiment_error(self, check_result_files, cleanup, aggregate_end, default_experiment):
-        fake_file_structure = 'test_structure'
+    @patch('AndroidRunner.Experiment.Experiment.remove_unsaved_run_files')
+    def test_finish_experiment_error(self, remove_unsaved_run_files, cleanup, aggregate_end, default_experiment):
         default_experiment.devices = ['1']
-        default_experiment.result_file_structure = fake_file_structure
         default_experiment.finish_experiment(True, False)
 
-        check_result_files.assert_called_once_with(fake_file_structure)
+        remove_unsaved_run_files.assert_called_once_with()
         cleanup.assert_called_once_with('1')
         assert aggregate_end.call_count == 0
 
     @patch('AndroidRunner.Experiment.Experiment.aggregate_end')
     @patch('AndroidRunner.Experiment.Experiment.cleanup')
-    @patch('AndroidRunner.Experiment.Experiment.check_result_files')
-    def test_finish_experiment_interrupted(self, check_result_files, cleanup, aggregate_end, default_experiment):
-        fake_file_structure = 'test_structure'
+    @patch('AndroidRunner.Experiment.Experiment.remove_unsaved_run_files')
+    def test_finish_experiment_interrupted(self, remove_unsaved_run_files, cleanup, aggregate_end, default_experiment):
         default_experiment.devices = ['1']
-        default_experiment.result_file_structure = fake_file_structure
 
         default_experiment.finish_experiment(False, True)
 
-        check_result_files.assert_called_once_with(fake_file_structure)
+        remove_unsaved_run_files.assert_called_once_with()
         cleanup.assert_called_once_with('1')
         assert aggregate_end.call_count == 0
 
     @patch('AndroidRunner.Experiment.Experiment.aggregate_end')
     @patch('AndroidRunner.Experiment.Experiment.cleanup')
-    @patch('AndroidRunner.Experiment.Experiment.check_result_files')
-    def test_finish_experiment_error_in_cleanup(self, check_result_files, cleanup, aggregate_end, default_experiment):
-        fake_file_structure = 'test_structure'
+    @patch('AndroidRunner.Experiment.Experiment.remove_unsaved_run_files')
+    def test_finish_experiment_error_in_cleanup(self, remove_unsaved_run_files, cleanup, aggregate_end, default_experiment):
         default_experiment.devices = ['1']
-        default_experiment.result_file_structure = fake_file_structure
         cleanup.side_effect = Exception
         default_experiment.finish_experiment(True, False)
-        check_result_files.assert_called_once_with(fake_file_structure)
+        remove_unsaved_run_files.assert_called_once_with()
         cleanup.assert_called_once_with('1')
         assert aggregate_end.call_count == 0
 
@@ -715,19 +858,23 @@ class TestExperiment(object):
                           call.finish_run_managed(test_run)]
         assert mock_manager.mock_calls == expected_calls
 
+    @patch('AndroidRunner.Experiment.Experiment.start_run_manifest')
     @patch('AndroidRunner.Experiment.Experiment.prepare_output_dir')
     @patch('AndroidRunner.Experiment.Experiment.first_run_device')
     @patch('AndroidRunner.Experiment.Experiment.before_every_run_subject')
-    def test_prepare_run(self, before_every_run_subject, first_run_device, prepare_output_dir, default_experiment):
+    def test_prepare_run(self, before_every_run_subject, first_run_device, prepare_output_dir, start_run_manifest,
+                         default_experiment):
         test_run = Mock()
         mock_manager = Mock()
         mock_manager.attach_mock(before_every_run_subject, "before_every_run_subject_managed")
         mock_manager.attach_mock(first_run_device, "first_run_device_managed")
         mock_manager.attach_mock(prepare_output_dir, "prepare_output_dir_managed")
+        mock_manager.attach_mock(start_run_manifest, "start_run_manifest_managed")
 
         default_experiment.prepare_run(test_run)
 
         expected_calls = [call.prepare_output_dir_managed(test_run),
+                          call.start_run_manifest_managed(),
                           call.first_run_device_managed(test_run),
                           call.before_every_run_subject_managed(test_run)]
         assert mock_manager.mock_calls == expected_calls
@@ -772,57 +919,33 @@ class TestExperiment(object):
                           call.last_run_device_managed(test_run)]
         assert mock_manager.mock_calls == expected_calls
 
-    @patch('threading.Thread.join')
-    @patch('threading.Thread.start')
-    @patch('threading.Thread.__init__')
-    def test_save_progress(self, mock_threading_init, mock_threading_start, mock_threading_join, default_experiment):
-        mock_threading_init.return_value = None
-        mock_manager = Mock()
-        mock_manager.attach_mock(mock_threading_init, "mock_threading_init_managed")
-        mock_manager.attach_mock(mock_threading_start, "mock_threading_start_managed")
-        mock_manager.attach_mock(mock_threading_join, "mock_threading_join_managed")
-
-        default_experiment.save_progress()
-
-        expected_calls = [call.mock_threading_init_managed(target=default_experiment.update_progress),
-                          call.mock_threading_start_managed(),
-                          call.mock_threading_join_managed()]
-        assert mock_manager.mock_calls == expected_calls
-
     @patch('AndroidRunner.Experiment.Experiment.finish_experiment')
     def test_start_error(self, finish_experiment_mock, capsys, default_experiment):
         mock_logger = Mock()
         default_experiment.logger = mock_logger
-        paths.BASE_OUTPUT_DIR = None  # raises TypeError
+        default_experiment.progress = Mock()
+        default_experiment.progress.experiment_finished_check.side_effect = TypeError('progress error')
 
         with pytest.raises(Exception):
             default_experiment.start()
         captured = capsys.readouterr()  # Catch std out
         finish_experiment_mock.assert_called_once_with(True, False)
-        mock_logger.error.assert_called_once_with("TypeError: expected str, bytes or os.PathLike object, not NoneType")
+        mock_logger.error.assert_called_once_with("TypeError: progress error")
 
-    @patch("AndroidRunner.Experiment.Experiment.walk_to_list")
     @patch('AndroidRunner.Experiment.Experiment.finish_experiment')
-    def test_start_interupt(self, finish_experiment_mock, walk_to_list_mock, default_experiment):
-        paths.BASE_OUTPUT_DIR = "test"
-        walk_to_list_mock.side_effect = KeyboardInterrupt
+    def test_start_interupt(self, finish_experiment_mock, default_experiment):
+        default_experiment.progress = Mock()
+        default_experiment.progress.experiment_finished_check.side_effect = KeyboardInterrupt
         with pytest.raises(KeyboardInterrupt):
             default_experiment.start()
         finish_experiment_mock.assert_called_once_with(False, True)
 
-    @patch("AndroidRunner.Experiment.walk")
     @patch("AndroidRunner.Experiment.Experiment.get_experiment")
     @patch('AndroidRunner.Experiment.Experiment.run_experiment')
     @patch('AndroidRunner.Experiment.Experiment.save_progress')
-    @patch("AndroidRunner.Experiment.Experiment.walk_to_list")
     @patch('AndroidRunner.Experiment.Experiment.finish_experiment')
-    def test_start_experiment_finished(self, finish_experiment_mock, walk_to_list_mock, save_progress_mock,
-                                       run_experiment_mock, get_experiment_mock, walk_mock, default_experiment):
-        paths.BASE_OUTPUT_DIR = "test"
-        mock_walk_to_list_result = Mock()
-        walk_to_list_mock.return_value = mock_walk_to_list_result
-        mock_walk_result = Mock()
-        walk_mock.return_value = mock_walk_result
+    def test_start_experiment_finished(self, finish_experiment_mock, save_progress_mock,
+                                       run_experiment_mock, get_experiment_mock, default_experiment):
         mock_progress = Mock()
         mock_progress.experiment_finished_check.return_value = True
         default_experiment.progress = mock_progress
@@ -830,30 +953,20 @@ class TestExperiment(object):
         default_experiment.start()
 
         assert get_experiment_mock.call_count == run_experiment_mock.call_count == save_progress_mock.call_count == 0
-        walk_to_list_mock.assert_called_once_with(mock_walk_result)
         finish_experiment_mock.assert_called_once_with(False, False)
 
-    @patch("AndroidRunner.Experiment.walk")
     @patch("AndroidRunner.Experiment.Experiment.get_experiment")
     @patch('AndroidRunner.Experiment.Experiment.run_experiment')
     @patch('AndroidRunner.Experiment.Experiment.save_progress')
-    @patch("AndroidRunner.Experiment.Experiment.walk_to_list")
     @patch('AndroidRunner.Experiment.Experiment.finish_experiment')
-    def test_start_experiment_one_run(self, finish_experiment_mock, walk_to_list_mock, save_progress_mock,
-                                      run_experiment_mock, get_experiment_mock, walk_mock, default_experiment):
-        paths.BASE_OUTPUT_DIR = "test"
-        mock_walk_to_list_result = Mock()
-        walk_to_list_mock.return_value = mock_walk_to_list_result
-        mock_walk_result = Mock()
-        walk_mock.return_value = mock_walk_result
+    def test_start_experiment_one_run(self, finish_experiment_mock, save_progress_mock,
+                                      run_experiment_mock, get_experiment_mock, default_experiment):
         mock_progress = Mock()
         mock_progress.experiment_finished_check.side_effect = [False, True]
         default_experiment.progress = mock_progress
         mock_get_experiment_result = Mock()
         get_experiment_mock.return_value = mock_get_experiment_result
         mock_manager = Mock()
-        mock_manager.attach_mock(walk_mock, 'walk_mock_managed')
-        mock_manager.attach_mock(walk_to_list_mock, 'walk_to_list_managed')
         mock_manager.attach_mock(mock_progress, 'mock_progress_managed')
         mock_manager.attach_mock(get_experiment_mock, 'get_experiment_managed')
         mock_manager.attach_mock(run_experiment_mock, 'run_experiment_managed')
@@ -861,9 +974,7 @@ class TestExperiment(object):
         mock_manager.attach_mock(finish_experiment_mock, 'finish_experiment_managed')
 
         default_experiment.start()
-        expected_calls = [call.walk_mock_managed(os.path.join('test', 'data')),
-                          call.walk_to_list_managed(mock_walk_result),
-                          call.mock_progress_managed.experiment_finished_check(),
+        expected_calls = [call.mock_progress_managed.experiment_finished_check(),
                           call.get_experiment_managed(),
                           call.run_experiment_managed(mock_get_experiment_result),
                           call.save_progress_managed(),
@@ -871,19 +982,12 @@ class TestExperiment(object):
                           call.finish_experiment_managed(False, False)]
         assert mock_manager.mock_calls == expected_calls
 
-    @patch("AndroidRunner.Experiment.walk")
     @patch("AndroidRunner.Experiment.Experiment.get_experiment")
     @patch('AndroidRunner.Experiment.Experiment.run_experiment')
     @patch('AndroidRunner.Experiment.Experiment.save_progress')
-    @patch("AndroidRunner.Experiment.Experiment.walk_to_list")
     @patch('AndroidRunner.Experiment.Experiment.finish_experiment')
-    def test_start_experiment_multiple_runs(self, finish_experiment_mock, walk_to_list_mock, save_progress_mock,
-                                            run_experiment_mock, get_experiment_mock, walk_mock, default_experiment):
-        paths.BASE_OUTPUT_DIR = "test"
-        mock_walk_to_list_result = Mock()
-        walk_to_list_mock.return_value = mock_walk_to_list_result
-        mock_walk_result = Mock()
-        walk_mock.return_value = mock_walk_result
+    def test_start_experiment_multiple_runs(self, finish_experiment_mock, save_progress_mock,
+                                            run_experiment_mock, get_experiment_mock, default_experiment):
         mock_progress = Mock()
         mock_progress.experiment_finished_check.side_effect = [False] * 9 + [True]
         default_experiment.progress = mock_progress
@@ -921,6 +1025,12 @@ class TestWebExperiment(object):
         get_browser.assert_called_once_with('chrome')
         mock_browser.assert_called_once_with()
 
+    def test_init_readiness_defaults(self, web_experiment):
+        assert web_experiment.readiness['browser_start'].type == 'activity'
+        assert web_experiment.readiness['load'].type == 'delay'
+        assert web_experiment.readiness['load'].duration == 5
+        assert web_experiment.readiness['close'].type == 'stopped'
+
     @patch('AndroidRunner.BrowserFactory.BrowserFactory.get_browser')
     @patch('AndroidRunner.Tests.check_dependencies')
     @patch('AndroidRunner.Devices.Devices.__init__')
@@ -1082,10 +1192,11 @@ class TestWebExperiment(object):
 
         before_run_subject.assert_called_once_with(mock_device, path, *args, **kwargs)
 
-    @patch('time.sleep')
+    @patch('AndroidRunner.Experiment.Experiment.wait_until_ready')
     @patch('AndroidRunner.Experiment.Experiment.before_run')
-    def test_before_run(self, before_run, sleep, web_experiment):
+    def test_before_run(self, before_run, wait_until_ready, web_experiment):
         mock_browser = Mock()
+        mock_browser.package_name = 'com.browser'
         args = (2, 3)
         kwargs = {'arg1': 1, 'arg2': 2, 'browser': mock_browser}
         mock_device = Mock()
@@ -1097,19 +1208,21 @@ class TestWebExperiment(object):
         mock_manager = Mock()
         mock_manager.attach_mock(before_run, "before_run_managed")
         mock_manager.attach_mock(mock_browser, "mock_browser_managed")
-        mock_manager.attach_mock(sleep, "sleep_managed")
+        mock_manager.attach_mock(wait_until_ready, "wait_until_ready_managed")
 
         web_experiment.before_run(mock_device, path, run, *args, **kwargs)
 
         expected_calls = [call.before_run_managed(mock_device, path, run, *args, **kwargs),
                           call.mock_browser_managed.start(mock_device),
-                          call.sleep_managed(5)]
+                          call.wait_until_ready_managed('browser_start', mock_device, 'com.browser')]
         assert mock_manager.mock_calls == expected_calls
 
+    @patch('AndroidRunner.Experiment.Experiment.wait_until_ready')
     @patch('time.sleep')
     @patch('AndroidRunner.Experiment.Experiment.interaction')
-    def test_interaction(self, interaction, sleep, web_experiment):
+    def test_interaction(self, interaction, sleep, wait_until_ready, web_experiment):
         mock_browser = Mock()
+        mock_browser.package_name = 'com.browser'
         args = (2, 3)
         kwargs = {'arg1': 1, 'arg2': 2, 'browser': mock_browser}
         mock_device = Mock()
@@ -1119,19 +1232,21 @@ class TestWebExperiment(object):
         mock_manager.attach_mock(mock_browser, "mock_browser_managed")
         mock_manager.attach_mock(sleep, "sleep_managed")
         mock_manager.attach_mock(interaction, "interaction_managed")
+        mock_manager.attach_mock(wait_until_ready, "wait_until_ready_managed")
 
         web_experiment.interaction(mock_device, path, run, *args, **kwargs)
 
         expected_calls = [call.mock_browser_managed.load_url(mock_device, path),
-                          call.sleep_managed(5),
+                          call.wait_until_ready_managed('load', mock_device, 'com.browser'),
                           call.interaction_managed(mock_device, path, run, *args, **kwargs),
                           call.sleep_managed(web_experiment.duration)]
         assert mock_manager.mock_calls == expected_calls
 
-    @patch('time.sleep')
+    @patch('AndroidRunner.Experiment.Experiment.wait_until_ready')
     @patch('AndroidRunner.Experiment.Experiment.after_run')
-    def test_after_run(self, after_run,  sleep, web_experiment):
+    def test_after_run(self, after_run, wait_until_ready, web_experiment):
         mock_browser = Mock()
+        mock_browser.package_name = 'com.browser'
         args = (2, 3)
         kwargs = {'arg1': 1, 'arg2': 2, 'browser': mock_browser}
         mock_device = Mock()
@@ -1143,13 +1258,13 @@ class TestWebExperiment(object):
         web_experiment.clear_cache = False
         mock_manager = Mock()
         mock_manager.attach_mock(mock_browser, "mock_browser_managed")
-        mock_manager.attach_mock(sleep, "sleep_managed")
+        mock_manager.attach_mock(wait_until_ready, "wait_until_ready_managed")
         mock_manager.attach_mock(after_run, "after_run_managed")
 
         web_experiment.after_run(mock_device, path, run, *args, **kwargs)
 
         expected_calls = [call.mock_browser_managed.stop(mock_device, False),
-                          call.sleep_managed(3),
+                          call.wait_until_ready_managed('close', mock_device, 'com.browser'),
                           call.after_run_managed(mock_device, path, run, *args, **kwargs)]
         assert mock_manager.mock_calls == expected_calls
 
@@ -1158,7 +1273,7 @@ class TestWebExperiment(object):
         web_experiment.after_run(mock_device, path, run, *args, **kwargs)
 
         expected_calls = [call.mock_browser_managed.stop(mock_device, True),
-                          call.sleep_managed(3),
+                          call.wait_until_ready_managed('close', mock_device, 'com.browser'),
                           call.after_run_managed(mock_device, path, run, *args, **kwargs)]
         assert mock_manager.mock_calls == expected_calls
 
@@ -1297,40 +1412,23 @@ class TestNativeExperiment(object):
         assert native_experiment.package == 'com.test.app'
 
     @patch('AndroidRunner.Experiment.Experiment.before_run_subject')
-    def test_before_run_subject_in_app_list(self, before_run_subject, native_experiment):
+    def test_before_run_subject_install(self, before_run_subject, native_experiment):
         args = (1, 2, 3)
         kwargs = {'arg1': 1, 'arg2': 2}
         mock_device = Mock()
-        test_package = 'com.test.app.apk'
-        path = os.path.join('test', test_package)
-        mock_device.get_app_list.return_value = [test_package]
+        path = os.path.join('test', 'app-release.apk')
+        mock_device.install.return_value = 'com.test.app'
 
         native_experiment.before_run_subject(mock_device, path, *args, **kwargs)
 
         before_run_subject.assert_called_once_with(mock_device, path)
-        mock_device.get_app_list.assert_called_once()
-        assert mock_device.install.call_count == 0
-        assert native_experiment.package == 'com.test.app'
-
-    @patch('AndroidRunner.Experiment.Experiment.before_run_subject')
-    def test_before_run_subject_app_not_installed(self, before_run_subject, native_experiment):
-        args = (1, 2, 3)
-        kwargs = {'arg1': 1, 'arg2': 2}
-        mock_device = Mock()
-        test_package_file = 'com.test.app.apk'
-        path = os.path.join('test', test_package_file)
-        mock_device.get_app_list.return_value = []
-
-        native_experiment.before_run_subject(mock_device, path, *args, **kwargs)
-
-        before_run_subject.assert_called_once_with(mock_device, path)
-        mock_device.get_app_list.assert_called_once()
         mock_device.install.assert_called_once_with(path)
         assert native_experiment.package == 'com.test.app'
 
+    @patch('AndroidRunner.Experiment.Experiment.wait_until_ready')
     @patch('AndroidRunner.Experiment.Experiment.after_launch')
     @patch('AndroidRunner.Experiment.Experiment.before_run')
-    def test_before_run(self, before_run, after_launch, native_experiment):
+    def test_before_run(self, before_run, after_launch, wait_until_ready, native_experiment):
         args = (1, 2, 3)
         kwargs = {'arg1': 1, 'arg2': 2}
         mock_device = Mock()
@@ -1344,12 +1442,14 @@ class TestNativeExperiment(object):
         mock_manager.attach_mock(before_run, 'before_run_managed')
         mock_manager.attach_mock(mock_device, 'mock_device_managed')
         mock_manager.attach_mock(after_launch, 'after_launch_managed')
+        mock_manager.attach_mock(wait_until_ready, 'wait_until_ready_managed')
 
         native_experiment.before_run(mock_device, path, run, *args, **kwargs)
 
         expected_calls = [call.before_run_managed(mock_device, path, run),
                           call.mock_device_managed.configure_settings_device('com.test.app', enable=True),
                           call.mock_device_managed.launch_package('com.test.app'),
+                          call.wait_until_ready_managed('launch', mock_device, 'com.test.app'),
                           call.after_launch_managed(mock_device, path, run)]
         assert mock_manager.mock_calls == expected_calls
 
@@ -1371,8 +1471,9 @@ class TestNativeExperiment(object):
         expected_calls = [call.start_profiling_managed(mock_device, app='com.test.app')]
         assert mock_manager.mock_calls == expected_calls
 
+    @patch('AndroidRunner.Experiment.Experiment.wait_until_ready')
     @patch('AndroidRunner.Experiment.Experiment.after_run')
-    def test_after_run(self, after_run, native_experiment):
+    def test_after_run(self, after_run, wait_until_ready, native_experiment):
         args = (1, 2, 3)
         kwargs = {'arg1': 1, 'arg2': 2}
         mock_device = Mock()
@@ -1386,6 +1487,7 @@ class TestNativeExperiment(object):
         mock_manager = Mock()
         mock_manager.attach_mock(mock_device, 'mock_device_managed')
         mock_manager.attach_mock(after_run, 'after_run_managed')
+        mock_manager.attach_mock(wait_until_ready, 'wait_until_ready_managed')
 
         native_experiment.after_run(mock_device, path, run, *args, **kwargs)
 
@@ -1393,6 +1495,7 @@ class TestNativeExperiment(object):
                           call.mock_device_managed.force_stop(native_experiment.package),
                           call.mock_device_managed.clear_app_data(native_experiment.package),
                           call.mock_device_managed.configure_settings_device(native_experiment.package, enable=False),
+                          call.wait_until_ready_managed('close', mock_device, native_experiment.package),
                           call.after_run_managed(mock_device, path, run)]
         assert mock_manager.mock_calls == expected_calls
 
@@ -1634,12 +1737,9 @@ class TestPrematureStoppableRun(object):
         rsc.interaction_function.assert_called_once_with(rsc.device, rsc.path, rsc.run, rsc.args, rsc.kwargs)
         rsc.queue.put.assert_called_once_with("interaction")
 
-    @patch("time.sleep")
-    def test_mp_logcat_regex(self, time_mock, rsc):
-        rsc.device.logcat_regex.side_effect = [False, True]
-        rsc._mp_logcat_regex(rsc.queue, rsc.device, "test_regex")
+    def test_logcat_regex_matched(self, rsc):
+        rsc._logcat_regex_matched("I ActivityManager: test_regex")
 
-        time_mock.assert_called_once_with(1)
         rsc.queue.put.assert_called_once_with(PrematureStoppableRun.STOPPING_MECHANISM_LOGCAT_REGEX)
     
     @patch("http.server.HTTPServer.serve_forever")
@@ -1676,13 +1776,18 @@ class TestPrematureStoppableRun(object):
         proc.children.return_value = [proc_a, proc_b]
         psutil_.return_value = proc
         rsc.condition = "logcat_regex"
+        rsc.regex = "test_regex"
+        subscription = rsc.device.watch_logcat.return_value
         rsc.run()
 
-        assert mp.call_count == 2
-        assert psutil_.call_count == 2
-        assert proc.children.call_count == 2
-        assert proc_a.terminate.call_count == 2
-        assert proc_b.terminate.call_count == 2
+        rsc.device.watch_logcat.assert_called_once_with("test_regex", rsc._logcat_regex_matched, once=True,
+                                                        include_buffer=True)
+        subscription.cancel.assert_called_once_with()
+        assert mp.call_count == 1
+        assert psutil_.call_count == 1
+        assert proc.children.call_count == 1
+        assert proc_a.terminate.call_count == 1
+        assert proc_b.terminate.call_count == 1
 
     @patch("AndroidRunner.PrematureStoppableRun.mp.Process")
     @patch("AndroidRunner.PrematureStoppableRun.psutil.Process")
@@ -103,6 +103,41 @@ class TestRunnerMain(object):
         assert result_args.get('file') == fake_filename
         assert result_args.get('progress') == fake_progress_file
 
+    def test_parse_arguments_aggregate(self, capsys):
+        result_args = main.parse_arguments(['test/file/name', '--aggregate', 'path/to/output'])
+
+        assert result_args.get('aggregate') == 'path/to/output'
+
+    @patch('runner_main.aggregate')
+    @patch('runner_main.parse_arguments')
+    @patch('AndroidRunner.ExperimentFactory.ExperimentFactory.from_json')
+    def test_main_aggregate(self, from_json_mock, parse_arguments_mock, aggregate_mock):
+        args = {'file': 'config.json', 'aggregate': 'path/to/output'}
+        parse_arguments_mock.return_value = args
+
+        main.main()
+
+        aggregate_mock.assert_called_once_with(args)
+        assert from_json_mock.call_count == 0
+
+    @patch('runner_main.Profilers')
+    @patch('runner_main.setup_logger')
+    @patch('runner_main.setup_paths')
+    def test_aggregate(self, setup_paths_mock, setup_logger_mock, profilers_mock, tmpdir):
+        config_file = op.join(str(tmpdir), 'config.json')
+        with open(config_file, 'w') as f:
+            f.write('{"aggregation_processes": 2, "profilers": {"android": {}}}')
+        output_dir = op.join(str(tmpdir), 'output')
+        mock_logger = Mock()
+        setup_logger_mock.return_value = mock_logger
+
+        main.aggregate({'file': config_file, 'aggregate': output_dir})
+
+        setup_paths_mock.assert_called_once_with(config_file, output_dir)
+        profilers_mock.assert_called_once_with({'android': {}})
+        profilers_mock.return_value.aggregate_end.assert_called_once_with(output_dir, processes=2)
+        assert mock_logger.error.call_count == 0
+
     def test_set_progress_new(self, tmpdir):
         temp_config_file = op.join(str(tmpdir), 'fake_config.json')
         open(temp_config_file, "w+")
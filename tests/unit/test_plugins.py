@@ -1,7 +1,14 @@
 import copy
 import csv
+import gzip
+import hashlib
+import io
 import os.path as op
+import shutil
+import sys
 
+import numpy as np
+import pandas as pd
 import pytest
 from mock import Mock, call, patch, mock_open
 from lxml.etree import ElementTree
@@ -10,12 +17,29 @@ import subprocess
 import datetime
 from AndroidRunner.Plugins.android.Android import Android
 from AndroidRunner.Plugins.batterystats.Batterystats import Batterystats
+from AndroidRunner.Plugins.batterystats import BatterystatsParser
+from AndroidRunner.Plugins.frametimes.Frametimes import ConfigError as FrametimesConfigError, FrameStore, Frametimes
+from AndroidRunner import Aggregation
 from AndroidRunner.Plugins.Profiler import Profiler
 from AndroidRunner.Plugins.Profiler import ProfilerException
+from AndroidRunner.Plugins import ResultWriter
+from AndroidRunner.Plugins.Sampler import Sampler
 from AndroidRunner.Plugins.trepn.Trepn import Trepn
+from AndroidRunner.Adb import CommandResult
 from AndroidRunner.Plugins.perfetto.Perfetto import Perfetto
+from AndroidRunner.Plugins.perfetto.trace_wrapper import PerfettoTrace, PerfettoTraceException
 import AndroidRunner.util as util
 
+
+@pytest.fixture()
+def trace_processor(tmpdir):
+    """A trace_processor that serves the answers of fixtures/fake_trace_processor.py"""
+    fake = op.join(op.dirname(op.abspath(__file__)), 'fixtures', 'fake_trace_processor.py')
+    script = tmpdir.join('trace_processor')
+    script.write('#!/bin/sh\nexec "%s" "%s" "$@"\n' % (sys.executable, fake))
+    script.chmod(0o755)
+    return str(script)
+
 class TestPluginTemplate(object):
     @pytest.fixture()
     def profiler_template(self):
@@ -64,6 +88,120 @@ class TestPluginTemplate(object):
         with pytest.raises(NotImplementedError):
             profiler_template.aggregate_end('data/dir', 'output/file.csv')
 
+class TestSampler(object):
+    @staticmethod
+    def stopping_after(count):
+        """A stopped event that is set after count samples and records the time waited between the samples"""
+        stopped = Mock()
+        stopped.is_set.side_effect = [False] * count + [True]
+        return stopped
+
+    @patch('time.monotonic')
+    def test_run_deadlines(self, monotonic_mock):
+        sample = Mock()
+        sampler = Sampler(1, sample, args=('device', 'app'))
+        sampler.stopped = self.stopping_after(3)
+        # The second sample takes 2.5s, so the sample due at 2s is missed and the one due at 3s is late
+        monotonic_mock.side_effect = [0, 0.2, 0.2, 3.5, 3.5, 3.7, 3.7]
+
+        sampler.run()
+
+        assert sample.mock_calls == [call('device', 'app')] * 3
+        assert sampler.stopped.wait.mock_calls == [call(pytest.approx(0.8)), call(0.0), call(pytest.approx(0.3))]
+        assert sampler.stats() == {'samples': 3, 'overruns': 1, 'missed': 1, 'max_overrun': pytest.approx(1.5)}
+
+    @patch('time.monotonic')
+    def test_run_no_drift(self, monotonic_mock):
+        sampler = Sampler(1, Mock())
+        sampler.stopped = self.stopping_after(3)
+        monotonic_mock.side_effect = [0, 0.5, 0.5, 1.5, 1.5, 2.5, 2.5]
+
+        sampler.run()
+
+        assert sampler.stopped.wait.mock_calls == [call(0.5)] * 3
+        assert sampler.stats() == {'samples': 3, 'overruns': 0, 'missed': 0, 'max_overrun': 0.0}
+
+    def test_run_zero_interval(self):
+        sampler = Sampler(0, Mock())
+        sampler.stopped = self.stopping_after(5)
+
+        sampler.run()
+
+        assert sampler.samples == 5
+        sampler.stopped.wait.assert_not_called()
+
+    def test_run_sample_error(self):
+        sample = Mock(side_effect=[None, ValueError('No process found')])
+        sampler = Sampler(0, sample)
+
+        sampler.run()
+
+        assert sampler.samples == 1
+        assert str(sampler.error) == 'No process found'
+
+    def test_start_stop(self):
+        sample = Mock()
+        sampler = Sampler(0.001, sample, name='test')
+        sampler.start()
+        assert sampler.thread.name == 'sampler-test'
+        assert sampler.thread.daemon
+
+        sampler.stop()
+
+        assert not sampler.is_running()
+        assert sampler.samples == sample.call_count
+        assert sampler.samples > 0
+
+    def test_stop_from_sample(self):
+        sampler = Sampler(0.001, lambda: sampler.stop())
+        sampler.start()
+        sampler.thread.join(5)
+
+        assert not sampler.is_running()
+        assert sampler.samples == 1
+
+
+class TestResultWriter(object):
+    @pytest.fixture()
+    def rows(self):
+        return [['datetime', 'cpu', 'Time', 'mem', 'Time', 'delayed'],
+                ['Sat Mar  3 15:36:04 UTC 2019', 1.5, '10', '', '11', True],
+                ['Sat Mar  3 15:36:05 UTC 2019', 2.25, '20', '300', '21', False]]
+
+    def test_write_csv(self, rows, tmpdir):
+        path = op.join(str(tmpdir), 'results.csv')
+
+        assert ResultWriter.write_results(path, rows) == path
+        with open(path) as f:
+            assert list(csv.reader(f)) == [[str(value) for value in row] for row in rows]
+
+    @pytest.mark.parametrize('result_format', ['npz', 'npy'])
+    def test_write_read_binary(self, rows, tmpdir, result_format):
+        path = ResultWriter.write_results(op.join(str(tmpdir), 'results.csv'), rows, result_format)
+
+        assert path == op.join(str(tmpdir), 'results.' + result_format)
+        assert not op.exists(op.join(str(tmpdir), 'results.csv'))
+        columns = ResultWriter.read_results(path)
+        assert list(columns.keys()) == ['datetime', 'cpu', 'Time', 'mem', 'Time.1', 'delayed']
+        assert list(columns['datetime']) == ['Sat Mar  3 15:36:04 UTC 2019', 'Sat Mar  3 15:36:05 UTC 2019']
+        assert list(columns['cpu']) == [1.5, 2.25]
+        assert columns['Time'].dtype == np.int64
+        assert np.isnan(columns['mem'][0]) and columns['mem'][1] == 300
+        assert list(columns['delayed']) == [True, False]
+
+    def test_read_npy_memory_mapped(self, rows, tmpdir):
+        path = ResultWriter.write_results(op.join(str(tmpdir), 'results.csv'), rows, 'npy')
+
+        assert isinstance(ResultWriter.read_results(path)['cpu'].base, np.memmap)
+
+    def test_write_header_only(self, tmpdir):
+        path = ResultWriter.write_results(op.join(str(tmpdir), 'results.csv'), [['cpu', 'mem']], 'npz')
+
+        columns = ResultWriter.read_results(path)
+        assert list(columns.keys()) == ['cpu', 'mem']
+        assert len(columns['cpu']) == 0
+
+
 class TestAndroidPlugin(object):
     @pytest.fixture()
     def mock_device(self):
@@ -175,41 +313,42 @@ class TestAndroidPlugin(object):
         mock_device.shell.mock_calls[0]('dumpsys meminfo fake.app | grep TOTAL')
         mock_device.shell.mock_calls[1]('dumpsys meminfo fake.app')
 
-    @patch('AndroidRunner.Plugins.android.Android.Android.get_data')
-    def test_start_profiling_with_app(self, get_data_mock, android_plugin, mock_device):
+    @patch('AndroidRunner.Plugins.android.Android.Sampler')
+    def test_start_profiling_with_app(self, sampler_mock, android_plugin, mock_device):
         kwargs = {'arg1': 1, 'app': 'test.app'}
+        mock_device.id = 'device_id'
         android_plugin.start_profiling(mock_device, **kwargs)
 
         assert android_plugin.profile is True
-        get_data_mock.assert_called_once_with(mock_device, 'test.app')
+        sampler_mock.assert_called_once_with(android_plugin.interval, android_plugin.get_data,
+                                             args=(mock_device, 'test.app'), name='android-device_id')
+        sampler_mock.return_value.start.assert_called_once()
+        assert android_plugin.sampler is sampler_mock.return_value
 
-    @patch('AndroidRunner.Plugins.android.Android.Android.get_data')
-    def test_start_profiling_without_app(self, get_data_mock, android_plugin, mock_device):
+    @patch('AndroidRunner.Plugins.android.Android.Sampler')
+    def test_start_profiling_without_app(self, sampler_mock, android_plugin, mock_device):
         kwargs = {'arg1': 1}
+        mock_device.id = 'device_id'
         android_plugin.start_profiling(mock_device, **kwargs)
 
         assert android_plugin.profile is True
-        get_data_mock.assert_called_once_with(mock_device, None)
+        sampler_mock.assert_called_once_with(android_plugin.interval, android_plugin.get_data,
+                                             args=(mock_device, None), name='android-device_id')
+        sampler_mock.return_value.start.assert_called_once()
 
-    @patch('timeit.default_timer')
-    @patch('threading.Timer')
     @patch('AndroidRunner.Plugins.android.Android.Android.get_cpu_usage')
     @patch('AndroidRunner.Plugins.android.Android.Android.get_mem_usage')
-    def test_get_data_all_points(self, get_mem_usage_mock, get_cpu_usage_mock, timer_mock, timeit_mock,
-                                 android_plugin, mock_device):
-        timeit_mock.side_effect = [100, 200]
+    def test_get_data_all_points(self, get_mem_usage_mock, get_cpu_usage_mock, android_plugin, mock_device):
         mock_device.shell.return_value = 'device_time'
         get_mem_usage_mock.return_value = "mem_usage"
         get_cpu_usage_mock.return_value = "cpu_usage"
-        mock_timer_result = Mock()
-        timer_mock.return_value = mock_timer_result
         android_plugin.profile = True
         android_plugin.interval = 200
         android_plugin.get_data(mock_device, 'app')
 
         assert android_plugin.data[1] == ['device_time', 'cpu_usage', 'mem_usage']
-        timer_mock.assert_called_once_with(100, android_plugin.get_data, args=(mock_device, 'app'))
-        mock_timer_result.start.assert_called_once()
+        assert len(android_plugin.data) == 2
+        get_mem_usage_mock.assert_called_once_with(mock_device, 'app')
 
     def test_get_data_race(self, android_plugin, mock_device):
         android_plugin.profile = False
@@ -219,13 +358,9 @@ class TestAndroidPlugin(object):
 
         assert android_plugin.data == old_data
 
-    @patch('timeit.default_timer')
-    @patch('threading.Timer')
     @patch('AndroidRunner.Plugins.android.Android.Android.get_cpu_usage')
     @patch('AndroidRunner.Plugins.android.Android.Android.get_mem_usage')
-    def test_get_data_only_mem(self, get_mem_usage_mock, get_cpu_usage_mock, timer_mock, timeit_mock,
-                               android_plugin, mock_device):
-        timeit_mock.side_effect = [100, 200]
+    def test_get_data_only_mem(self, get_mem_usage_mock, get_cpu_usage_mock, android_plugin, mock_device):
         mock_device.shell.return_value = 'device_time'
         get_mem_usage_mock.return_value = "mem_usage"
         get_cpu_usage_mock.return_value = "cpu_usage"
@@ -235,13 +370,9 @@ class TestAndroidPlugin(object):
 
         assert android_plugin.data[1] == ['device_time', 'mem_usage']
 
-    @patch('timeit.default_timer')
-    @patch('threading.Timer')
     @patch('AndroidRunner.Plugins.android.Android.Android.get_cpu_usage')
     @patch('AndroidRunner.Plugins.android.Android.Android.get_mem_usage')
-    def test_get_data_only_cpu(self, get_mem_usage_mock, get_cpu_usage_mock, timer_mock, timeit_mock,
-                               android_plugin, mock_device):
-        timeit_mock.side_effect = [100, 200]
+    def test_get_data_only_cpu(self, get_mem_usage_mock, get_cpu_usage_mock, android_plugin, mock_device):
         mock_device.shell.return_value = 'device_time'
         get_mem_usage_mock.return_value = "mem_usage"
         get_cpu_usage_mock.return_value = "cpu_usage"
@@ -253,10 +384,14 @@ class TestAndroidPlugin(object):
 
     def test_stop_profiling(self, android_plugin, mock_device):
         android_plugin.profile = True
+        sampler = Mock()
+        android_plugin.sampler = sampler
 
         android_plugin.stop_profiling(mock_device)
 
         assert android_plugin.profile is False
+        sampler.stop.assert_called_once_with()
+        assert android_plugin.sampler is None
 
     @patch('time.strftime')
     def test_collect_results(self, time_mock, android_plugin, mock_device, tmpdir, fixture_dir):
@@ -291,6 +426,107 @@ class TestAndroidPlugin(object):
     def test_unload(self, android_plugin, mock_device):
         assert android_plugin.unload(mock_device) is None
 
+    @pytest.fixture()
+    def android_plugin_device_sampling(self):
+        test_config = {'sample_interval': 100, 'data_points': ['cpu', 'mem'], 'sampling': 'device'}
+        test_paths = {'path1': 'path/1'}
+        return Android(test_config, test_paths)
+
+    def test_android_plugin_invalid_sampling(self):
+        with pytest.raises(util.ConfigError):
+            Android({'data_points': ['cpu'], 'sampling': 'cloud'}, {'path1': 'path/1'})
+
+    def test_load_device_sampling(self, android_plugin_device_sampling, mock_device):
+        android_plugin_device_sampling.load(mock_device)
+        android_plugin_device_sampling.unload(mock_device)
+
+        local_sampler, remote_sampler = mock_device.push.call_args[0]
+        assert op.basename(local_sampler) == 'sampler.sh' and op.isfile(local_sampler)
+        assert remote_sampler == Android.DEVICE_SAMPLER
+        mock_device.shell.assert_called_once_with('rm -f {}'.format(Android.DEVICE_SAMPLER))
+
+    @patch('AndroidRunner.Plugins.android.Android.Android.get_data')
+    def test_start_stop_profiling_device_sampling(self, get_data_mock, android_plugin_device_sampling,
+                                                   mock_device):
+        mock_device.shell.return_value = '4242'
+
+        android_plugin_device_sampling.start_profiling(mock_device, app='test.app')
+        android_plugin_device_sampling.stop_profiling(mock_device)
+
+        get_data_mock.assert_not_called()
+        assert mock_device.shell.mock_calls == [
+            call('nohup sh {} 100 cpu,mem test.app > {} 2> /dev/null < /dev/null & echo $!'.format(
+                Android.DEVICE_SAMPLER, Android.DEVICE_SAMPLES)),
+            call('kill 4242')]
+        assert android_plugin_device_sampling.sampler_pid is None
+
+    def test_parse_device_samples(self, android_plugin_device_sampling):
+        samples = ['sample Thu Jan  1 10:00:00 UTC 2026\n',
+                   'cpu 30% TOTAL: 21% user + 6.7% kernel\n',
+                   'mem  TOTAL    20411     7516    10228\n',
+                   'sample Thu Jan  1 10:00:01 UTC 2026\n',
+                   'cpu 31.-5% TOTAL: 22% user + 6.7% kernel\n',
+                   'mem No process found for: test.app\n',
+                   'sample Thu Jan  1 10:00:02 UTC 2026\n',
+                   'cpu 12% TOTAL: 10% user + 2% kernel\n',
+                   'mem  TOTAL    20500     7516    10228\n',
+                   'sample Thu Jan  1 10:00:03 UTC 2026\n',
+                   'cpu 12% TOTAL: 10% user + 2% kernel\n']
+
+        rows = android_plugin_device_sampling.parse_device_samples(samples, 'test.app')
+
+        assert rows == [['Thu Jan  1 10:00:00 UTC 2026', '30', '20411'],
+                        ['Thu Jan  1 10:00:02 UTC 2026', '12', '20500']]
+
+    def test_parse_device_samples_same_second(self, android_plugin_device_sampling):
+        samples = []
+        for milliseconds in ['000', '250', '500', '750']:
+            samples += ['sample 2026-01-01 10:00:00.%s\n' % milliseconds,
+                        'cpu 30% TOTAL: 21% user + 6.7% kernel\n',
+                        'mem  TOTAL    20411     7516    10228\n']
+
+        rows = android_plugin_device_sampling.parse_device_samples(samples, 'test.app')
+
+        assert [row[0] for row in rows] == ['2026-01-01 10:00:00.000', '2026-01-01 10:00:00.250',
+                                            '2026-01-01 10:00:00.500', '2026-01-01 10:00:00.750']
+        assert [row[1:] for row in rows] == [['30', '20411']] * 4
+
+    @patch('time.strftime')
+    def test_collect_results_npz(self, time_mock, mock_device, tmpdir):
+        android_plugin = Android({'sample_interval': 1000, 'data_points': ['cpu', 'mem'], 'result_format': 'npz'},
+                                 {'path1': 'path/1'})
+        time_mock.return_value = 'experiment_time'
+        mock_device.id = 'device_id'
+        android_plugin.data = [['datetime', 'cpu', 'mem'], ['Sat Mar  3 15:36:04 UTC 2019', 12.5, 3000]]
+        android_plugin.output_dir = str(tmpdir)
+
+        android_plugin.collect_results(mock_device)
+
+        assert not op.exists(op.join(str(tmpdir), 'device_id_experiment_time.csv'))
+        columns = ResultWriter.read_results(op.join(str(tmpdir), 'device_id_experiment_time.npz'))
+        assert list(columns['cpu']) == [12.5]
+        assert list(columns['mem']) == [3000]
+
+    @patch('time.strftime')
+    def test_collect_results_device_sampling(self, time_mock, android_plugin_device_sampling, mock_device, tmpdir):
+        def pull(remote, local):
+            with open(local, 'w') as samples:
+                samples.write('sample Thu Jan  1 10:00:00 UTC 2026\n'
+                              'cpu 30% TOTAL: 21% user + 6.7% kernel\n'
+                              'mem Used RAM: 1016104 kB (819528 used pss + 196576 kernel)\n')
+        time_mock.return_value = 'experiment_time'
+        mock_device.id = 'device_id'
+        mock_device.pull.side_effect = pull
+        android_plugin_device_sampling.output_dir = str(tmpdir)
+
+        android_plugin_device_sampling.collect_results(mock_device)
+
+        assert self.csv_reader_to_table(op.join(str(tmpdir), 'device_id_experiment_time.csv')) == \
+            [['datetime', 'cpu', 'mem'], ['Thu Jan  1 10:00:00 UTC 2026', '30', '1016104']]
+        assert mock_device.pull.call_args[0][0] == Android.DEVICE_SAMPLES
+        mock_device.shell.assert_called_once_with('rm -f {}'.format(Android.DEVICE_SAMPLES))
+        assert tmpdir.listdir() == [tmpdir.join('device_id_experiment_time.csv')]
+
     @patch('AndroidRunner.util.write_to_file')
     @patch('AndroidRunner.Plugins.android.Android.Android.aggregate_android_subject')
     def test_aggregate_subject(self, aggregate_mock, write_to_file_mock, android_plugin):
@@ -319,8 +555,10 @@ class TestAndroidPlugin(object):
         aggregate_mock.assert_called_once_with(test_data_dir)
         write_to_file_mock.assert_called_once_with(test_output_file, mock_rows)
 
-    def test_aggregate_android_subject(self, android_plugin, fixture_dir):
-        test_subject_log_dir = op.join(fixture_dir, 'android_subject_result')
+    def test_aggregate_android_subject(self, android_plugin, fixture_dir, tmpdir):
+        # Copied, as the aggregation cache is written next to the run files
+        test_subject_log_dir = op.join(str(tmpdir), 'android_subject_result')
+        shutil.copytree(op.join(fixture_dir, 'android_subject_result'), test_subject_log_dir)
 
         test_logs_aggregated = android_plugin.aggregate_android_subject(test_subject_log_dir)
         assert len(test_logs_aggregated) == 2
@@ -517,7 +755,7 @@ class TestBatterystatsPlugin(object):
         get_data_mock.return_value = None
         # set global variables
         mock_device.id = '123'
-        mock_device.shell.return_value = "27"
+        mock_device.get_api_level.return_value = "27"
         batterystats_plugin.type = 'web'
         time_mock.return_value = 'strftime'
         batterystats_plugin.output_dir = str(tmpdir)
@@ -537,7 +775,7 @@ class TestBatterystatsPlugin(object):
         get_data_mock.return_value = None
         # set global variables
         mock_device.id = '123'
-        mock_device.shell.return_value = "30"
+        mock_device.get_api_level.return_value = "30"
         batterystats_plugin.type = 'web'
         time_mock.return_value = 'strftime'
         batterystats_plugin.output_dir = str(tmpdir)
@@ -588,9 +826,12 @@ class TestBatterystatsPlugin(object):
                        'wifi_signal_strength=4 wifi_suppl=completed +4m07s375ms (2) 090 volt=4225 +16m24s239ms (3) ' \
                        '089 volt=4195'
         dumpsys_charge = '3450, Computed drain: 150, actual drain: 104-138'
-        mock_device.shell.side_effect = [dumpsys_charge, dumpsys_volt]
+        mock_device.batch.return_value = [CommandResult('charge', dumpsys_charge, 0),
+                                          CommandResult('volt', dumpsys_volt, 0)]
         calculated_j_consumed = batterystats_plugin.get_consumed_joules(mock_device)
         assert calculated_j_consumed == 2292.84
+        mock_device.batch.assert_called_once_with(['dumpsys batterystats | grep "Computed drain:"',
+                                                   'dumpsys batterystats | grep "volt="'], check=True)
 
     @patch('os.remove')
     def test_cleanup_logs_false(self, os_remove_mock, batterystats_plugin):
@@ -670,6 +911,7 @@ class TestBatterystatsPlugin(object):
         parse_mock.return_value = parse_return_value
         mock_device.id = '123'
         mock_device.shell.return_value = 8
+        mock_device.get_api_level.return_value = '28'
         batterystats_plugin.type = 'web'
         time_mock.return_value = 'strftime'
         batterystats_plugin.output_dir = str(tmpdir)
@@ -689,7 +931,8 @@ class TestBatterystatsPlugin(object):
         parse_mock.assert_called_once_with('com.android.chrome', op.join(str(tmpdir), 'systrace_123_strftime.html'),
                                            op.join(str(tmpdir), 'logcat_123_strftime.txt'),
                                            op.join(str(tmpdir), 'batterystats_history_123_strftime.txt'),
-                                           batterystats_plugin.powerprofile, 8, 8)
+                                           batterystats_plugin.powerprofile, 8, 28,
+                                           processes=batterystats_plugin.systrace_parsing_processes)
 
     @patch('AndroidRunner.Plugins.batterystats.BatterystatsParser.parse_systrace')
     @patch('time.strftime')
@@ -798,15 +1041,17 @@ class TestBatterystatsPlugin(object):
         aggregate_mock.assert_called_once_with(test_data_dir)
         write_to_file_mock.assert_called_once_with(test_output_file, mock_rows)
 
-    def test_aggregate_battery_subject_joules_false(self, batterystats_plugin, fixture_dir):
-        test_subject_log_dir = op.join(fixture_dir, 'batterystats_subject_result')
+    def test_aggregate_battery_subject_joules_false(self, batterystats_plugin, fixture_dir, tmpdir):
+        test_subject_log_dir = op.join(str(tmpdir), 'batterystats_subject_result')
+        shutil.copytree(op.join(fixture_dir, 'batterystats_subject_result'), test_subject_log_dir)
 
         test_logs_aggregated = batterystats_plugin.aggregate_battery_subject(test_subject_log_dir, False)
 
         assert len(test_logs_aggregated) == 0
 
-    def test_aggregate_battery_subject_joules_true(self, batterystats_plugin, fixture_dir):
-        test_subject_log_dir = op.join(fixture_dir, 'batterystats_subject_result')
+    def test_aggregate_battery_subject_joules_true(self, batterystats_plugin, fixture_dir, tmpdir):
+        test_subject_log_dir = op.join(str(tmpdir), 'batterystats_subject_result')
+        shutil.copytree(op.join(fixture_dir, 'batterystats_subject_result'), test_subject_log_dir)
 
         test_logs_aggregated = batterystats_plugin.aggregate_battery_subject(test_subject_log_dir, True)
 
@@ -840,6 +1085,236 @@ class TestBatterystatsPlugin(object):
         assert len(aggregated_final_rows) == 1
         assert aggregated_final_rows['batterystats_Joule_calculated'] == '101.227896'
 
+    def test_power_profile_values(self, fixture_dir):
+        power_profile = op.join(fixture_dir, 'power_profile.xml')
+
+        assert BatterystatsParser.get_amp_value(power_profile, 'screen.on') == pytest.approx(0.0424)
+        assert BatterystatsParser.get_amp_value(power_profile, 'camera') == pytest.approx(0.73166)
+        assert BatterystatsParser.get_amp_value(power_profile, 'phone_scanning') == pytest.approx(0.12268)
+        assert BatterystatsParser.get_amp_value(power_profile, 'cpu_frequency', '702000') == pytest.approx(0.1214)
+        assert BatterystatsParser.get_amp_value(power_profile, 'cpu_frequency', '1512000') == pytest.approx(0.2397)
+        # Unknown frequencies and components fall back to the lowest frequency
+        assert BatterystatsParser.get_amp_value(power_profile, 'cpu_frequency', '1') == pytest.approx(0.0926)
+        assert BatterystatsParser.get_amp_value(power_profile, 'flashlight') == pytest.approx(0.0926)
+
+    def test_power_profile_clusters(self, fixture_dir):
+        power_profile = BatterystatsParser.PowerProfile(op.join(fixture_dir, 'power_profile_clusters.xml'))
+
+        assert power_profile.cluster_of(3) == 0
+        assert power_profile.cluster_of(4) == 1
+        assert power_profile.amps('cpu_frequency', '600000', 0) == pytest.approx(0.0855)
+        assert power_profile.amps('cpu_frequency', '1824000', 5) == pytest.approx(0.4205)
+        assert power_profile.amps('cpu_frequency', '384000') == pytest.approx(0.0775)
+        assert power_profile.amps('cpu.idle') == pytest.approx(0.000075)
+
+    def test_power_profile_parsed_once(self, fixture_dir, tmpdir):
+        power_profile = op.join(fixture_dir, 'power_profile.xml')
+        copied_profile = str(tmpdir.join('power_profile.xml'))
+        with open(power_profile) as src, open(copied_profile, 'w') as dst:
+            dst.write(src.read())
+
+        with patch('AndroidRunner.Plugins.batterystats.BatterystatsParser.minidom.parse',
+                   wraps=BatterystatsParser.minidom.parse) as parse_mock:
+            for _ in range(5):
+                BatterystatsParser.get_amp_value(copied_profile, 'screen.full')
+                BatterystatsParser.get_amp_value(copied_profile, 'cpu_frequency', '810000')
+
+        parse_mock.assert_called_once_with(copied_profile)
+        parsed = BatterystatsParser.get_power_profile(copied_profile)
+        assert BatterystatsParser.get_power_profile(parsed) is parsed
+
+    @pytest.fixture()
+    def systrace_run(self, fixture_dir):
+        systrace_dir = op.join(fixture_dir, 'systrace')
+        with patch('AndroidRunner.Plugins.batterystats.BatterystatsParser.parse_logcat') as parse_logcat:
+            parse_logcat.return_value = (1767261600000, 1767261609000)
+            yield (op.join(systrace_dir, 'systrace.html'), op.join(systrace_dir, 'logcat.txt'),
+                   op.join(systrace_dir, 'batterystats.txt'), op.join(fixture_dir, 'power_profile.xml'))
+
+    @staticmethod
+    def expected_systrace_rows(fixture_dir, cores):
+        with open(op.join(fixture_dir, 'systrace', 'expected_{}_cores.csv'.format(cores))) as expected:
+            return expected.read().splitlines()
+
+    @pytest.mark.parametrize('cores', [3, 4, 6])
+    def test_parse_systrace(self, cores, systrace_run, fixture_dir):
+        systrace_file, logcat_file, batterystats_file, power_profile = systrace_run
+
+        rows = BatterystatsParser.parse_systrace('com.example.app', systrace_file, logcat_file, batterystats_file,
+                                                 power_profile, cores, 28)
+
+        assert rows == self.expected_systrace_rows(fixture_dir, cores)
+
+    @patch('multiprocessing.cpu_count')
+    @patch('AndroidRunner.Plugins.batterystats.BatterystatsParser.SYSTRACE_MIN_SHARD_SIZE', 0)
+    def test_parse_systrace_processes(self, cpu_count, systrace_run, fixture_dir):
+        cpu_count.return_value = 4
+        systrace_file, logcat_file, batterystats_file, power_profile = systrace_run
+
+        rows = BatterystatsParser.parse_systrace('com.example.app', systrace_file, logcat_file, batterystats_file,
+                                                 power_profile, 4, 28, processes=3)
+
+        assert rows == self.expected_systrace_rows(fixture_dir, 4)
+
+    def test_read_systrace_events_ranges(self, fixture_dir):
+        systrace_file = op.join(fixture_dir, 'systrace', 'systrace.html')
+        size = op.getsize(systrace_file)
+
+        events = BatterystatsParser.read_systrace_events(systrace_file)
+        ranged_events = []
+        for start in range(0, size, 1000):
+            ranged_events += BatterystatsParser.read_systrace_events(systrace_file, start, start + 1000)
+
+        assert len(events) == 300
+        assert events[0] == (99.536667, 'cpu_frequency', '1026000', 2)
+        assert ranged_events == events
+
+    def test_systrace_clock_sync_missing(self, fixture_dir):
+        with pytest.raises(ValueError):
+            BatterystatsParser.get_systrace_clock_sync(op.join(fixture_dir, 'systrace', 'logcat.txt'))
+
+    @pytest.mark.parametrize('history', [3, 5])
+    def test_parse_batterystats(self, history, fixture_dir, capsys):
+        history_dir = op.join(fixture_dir, 'batterystats_history')
+        with open(op.join(history_dir, 'expected_{}.csv'.format(history))) as expected:
+            expected_rows = expected.read().splitlines()
+
+        rows = BatterystatsParser.parse_batterystats('com.example.app',
+                                                     op.join(history_dir, 'history_{}.txt'.format(history)),
+                                                     op.join(fixture_dir, 'power_profile.xml'))
+        capsys.readouterr()  # Catch print
+
+        assert rows == expected_rows
+
+    def test_parse_history_line(self):
+        event = BatterystatsParser.parse_history_line(
+            '      +1m02s345ms (2) 100 c0900020 volt=4012 +camera +wifi_radio brightness=dim -camera -wifi_scan '
+            'volt=3900 +wake_lock=u0a32:"*job*/com.google.android.gms/.gcm.GcmService" brightness=light\n')
+
+        assert event.time == 62.345
+        assert event.flags == {'camera': '-', 'wifi': '-'}
+        assert event.values == {'volt': '4012', 'wifi': 'scan', 'brightness': 'light'}
+
+    def test_parse_history_line_numeric_brightness(self):
+        event = BatterystatsParser.parse_history_line('      +1s000ms (2) 100 c0900020 +screen brightness=120\n')
+
+        assert event.flags == {'screen': '+'}
+        assert event.values == {}
+
+    def test_parse_history_line_without_timestamp(self):
+        header = BatterystatsParser.parse_history_line('Battery History (1% used, 13KB used of 1024KB):\n')
+
+        assert header == BatterystatsParser.HistoryEvent(0, {}, {})
+        assert BatterystatsParser.parse_history_line('Battery History:\n') is None
+        assert BatterystatsParser.parse_history_line('\n') is None
+
+
+class TestFrametimesPlugin(object):
+    @pytest.fixture()
+    def frametimes_plugin(self):
+        return Frametimes({'sample_interval': 100}, paths.paths_dict())
+
+    @staticmethod
+    def framestats(frames):
+        rows = ['---PROFILEDATA---', 'Flags,IntendedVsync,Vsync,OldestInputEvent,NewestInputEvent']
+        for start, end in frames:
+            rows.append(','.join(['0', str(start)] + ['0'] * 11 + [str(end), '0']))
+        return '\n'.join(rows + ['---PROFILEDATA---'])
+
+    def test_init_max_frames(self, frametimes_plugin):
+        assert frametimes_plugin.max_frames == FrameStore.DEFAULT_MAX_FRAMES
+        assert frametimes_plugin.data.max_frames == FrameStore.DEFAULT_MAX_FRAMES
+        assert Frametimes({'max_frames': 100}, paths.paths_dict()).data.max_frames == 100
+        for max_frames in [None, 0]:
+            with pytest.raises(FrametimesConfigError):
+                Frametimes({'max_frames': max_frames}, paths.paths_dict())
+
+    def test_frame_store_deduplicates_in_time_order(self):
+        store = FrameStore()
+
+        assert store.add([300, 100, 200], [310, 140, 220]) == 3
+        assert store.add([200, 300, 400, 400], [220, 310, 450, 450]) == 1
+
+        starts, ends = store.frames()
+        assert starts.tolist() == [100, 200, 300, 400]
+        assert ends.tolist() == [140, 220, 310, 450]
+
+    def test_frame_store_grows(self):
+        store = FrameStore()
+        starts = np.arange(3000) * 10
+
+        store.add(starts[:1000], starts[:1000] + 5)
+        store.add(starts[1000:], starts[1000:] + 5)
+
+        assert len(store) == 3000
+        assert store.frames()[0].tolist() == starts.tolist()
+
+    def test_frame_store_bounded(self):
+        store = FrameStore(max_frames=4)
+
+        store.add([10, 20, 30], [11, 21, 31])
+        store.add([40, 50, 60], [41, 51, 61])
+        store.add([70, 80, 90, 100, 110], [71, 81, 91, 101, 111])
+
+        assert len(store) == 4
+        assert store.dropped == 7
+        assert store.frames()[0].tolist() == [80, 90, 100, 110]
+        assert store.metrics()['frames'] == 11
+
+    def test_frame_store_metrics(self):
+        store = FrameStore()
+        frame_times = np.array([8, 10, 12, 14, 20, 40] * 10) * 1000000
+        starts = np.arange(frame_times.size) * 100000000
+
+        store.add(starts, starts + frame_times)
+        metrics = store.metrics()
+
+        assert metrics['frames'] == 60
+        assert metrics['p50_frame_time_ms'] == pytest.approx(12, rel=0.01)
+        assert metrics['p99_frame_time_ms'] == pytest.approx(40, rel=0.01)
+        assert metrics['max_frame_time_ms'] == 40
+        assert metrics['frames_over_16ms'] == 20
+        assert metrics['frames_over_32ms'] == 10
+        assert metrics['janky_frames_percent'] == pytest.approx(100 / 3.0)
+
+    def test_get_data(self, frametimes_plugin):
+        mock_device = Mock()
+        frametimes_plugin.profile = True
+        mock_device.shell.side_effect = [self.framestats([(100, 120), (200, 230)]),
+                                         self.framestats([(200, 230), (300, 310)])]
+
+        frametimes_plugin.get_data(mock_device, 'com.app')
+        frametimes_plugin.get_data(mock_device, 'com.app')
+
+        assert frametimes_plugin.data.frames()[0].tolist() == [100, 200, 300]
+        mock_device.shell.assert_called_with('dumpsys gfxinfo com.app framestats | '
+                                             'sed -n /--PROFILEDATA---/,/--PROFILEDATA---/p')
+
+    @patch('time.strftime')
+    def test_collect_results_and_aggregate_subject(self, time_mock, frametimes_plugin, tmpdir):
+        time_mock.return_value = 'time'
+        device = Mock()
+        device.id = 'device'
+        frametimes_plugin.set_output(str(tmpdir))
+        frametimes_plugin.data.add([0, 100000000], [20000000, 110000000])
+
+        frametimes_plugin.collect_results(device)
+        frametimes_plugin.aggregate_subject()
+
+        with open(op.join(str(tmpdir), 'frame_times_device_time.csv')) as f:
+            assert list(csv.reader(f)) == [['frame_start', 'frame_end', 'frame_time', 'is_delayed'],
+                                           ['0', '20000000', '20000000', 'True'],
+                                           ['100000000', '110000000', '10000000', 'False']]
+        with open(op.join(str(tmpdir), 'all_delayed_frame_counts.csv')) as f:
+            assert list(csv.reader(f)) == [['delayed_frames'], ['1']]
+        with open(op.join(str(tmpdir), 'all_frame_times.csv')) as f:
+            assert list(csv.reader(f)) == [['frame_time'], ['20000000'], ['10000000']]
+        with open(op.join(str(tmpdir), 'all_jank_metrics.csv')) as f:
+            metrics = list(csv.DictReader(f))
+        assert metrics[0]['run'] == 'jank_device_time.csv'
+        assert metrics[0]['frames'] == '2'
+        assert float(metrics[0]['janky_frames_percent']) == 50.0
+        assert len(frametimes_plugin.data) == 0
 
 class TestPerfettoPlugin(object):
 
@@ -851,7 +1326,9 @@ class TestPerfettoPlugin(object):
         load_json_mock.return_value = {}
         config = {"config_file" : "/home/user/perfetto_config.pbtx", "config_file_format" : "text"}
         test_paths = paths.paths_dict()
-        return Perfetto(config, test_paths)
+        perfetto_plugin = Perfetto(config, test_paths)
+        perfetto_plugin.logger = Mock()
+        return perfetto_plugin
 
     @pytest.fixture()
     def mock_device(self):
@@ -873,6 +1350,7 @@ class TestPerfettoPlugin(object):
         assert perfetto_plugin.perfetto_config_file_local_path == config["config_file"]
         assert perfetto_plugin.perfetto_config_file_format == config["config_file_format"]
         assert perfetto_plugin.adb_path == "adb"
+        assert perfetto_plugin.compress_transfer is False
     
     def test_dependencies(self, perfetto_plugin):
         assert perfetto_plugin.dependencies() == []
@@ -981,22 +1459,73 @@ class TestPerfettoPlugin(object):
 
         mock_device.shell.assert_called_once_with("kill 42")
 
-    @patch("AndroidRunner.Plugins.perfetto.Perfetto.subprocess.Popen")
-    @patch("builtins.open")
-    def test_collect_results(self, open_mock, subprocess_mock, perfetto_plugin, mock_device) :
-        m = mock_open()
-        popen_mock = Mock()
-        popen_mock.communicate.return_value = (b"42", b"")
+    @pytest.fixture()
+    def trace(self):
+        return b"\n\r\n" + bytes(range(256)) * 64
+
+    @pytest.fixture()
+    def trace_device(self, mock_device, trace):
         mock_device.id = 20
-        subprocess_mock.return_value = popen_mock
+        mock_device.batch.return_value = [CommandResult("stat", f"{len(trace)}\n", 0),
+                                          CommandResult("sha256sum", f"{hashlib.sha256(trace).hexdigest()}  trace\n", 0)]
+        return mock_device
+
+    @staticmethod
+    def exec_out(data, returncode=0):
+        proc = Mock()
+        proc.stdout = io.BytesIO(data)
+        proc.returncode = returncode
+        proc.communicate.return_value = (b"", b"")
+        return proc
+
+    @patch("AndroidRunner.Plugins.perfetto.Perfetto.subprocess.Popen")
+    def test_collect_results(self, subprocess_mock, perfetto_plugin, trace_device, trace, tmpdir):
+        subprocess_mock.return_value = self.exec_out(trace)
         perfetto_plugin.perfetto_trace_file_device_path = op.join(perfetto_plugin.PERFETTO_TRACES_DEVICE_PATH, "filename.perfetto_trace")
-        perfetto_plugin.paths["OUTPUT_DIR"] =  "/home/user/"
-        filename =  "/home/user/filename.perfetto_trace"
+        perfetto_plugin.paths["OUTPUT_DIR"] = str(tmpdir)
+
+        perfetto_plugin.collect_results(trace_device)
+
+        with open(op.join(str(tmpdir), "filename.perfetto_trace"), "rb") as f:
+            assert f.read() == trace
+        subprocess_mock.assert_called_once_with(["adb", "-s", 20, "exec-out", f"cat {perfetto_plugin.perfetto_trace_file_device_path}"],
+                                                stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        trace_device.batch.assert_called_once_with([f"stat -c %s {perfetto_plugin.perfetto_trace_file_device_path}",
+                                                    f"sha256sum {perfetto_plugin.perfetto_trace_file_device_path}"])
+        trace_device.shell.assert_called_once_with(f"rm -f {perfetto_plugin.perfetto_trace_file_device_path}")
 
-        perfetto_plugin.collect_results(mock_device)
+    @patch("AndroidRunner.Plugins.perfetto.Perfetto.subprocess.Popen")
+    def test_transfer_trace_compressed(self, subprocess_mock, perfetto_plugin, trace_device, trace, tmpdir):
+        subprocess_mock.return_value = self.exec_out(gzip.compress(trace))
+        perfetto_plugin.compress_transfer = True
+        host_path = op.join(str(tmpdir), "trace.perfetto_trace")
+
+        perfetto_plugin.transfer_trace(trace_device, "/data/trace", host_path)
+
+        with open(host_path, "rb") as f:
+            assert f.read() == trace
+        assert subprocess_mock.call_args[0][0][-1] == "cat /data/trace | gzip -c"
+
+    @patch("AndroidRunner.Plugins.perfetto.Perfetto.subprocess.Popen")
+    def test_transfer_trace_resumed(self, subprocess_mock, perfetto_plugin, trace_device, trace, tmpdir):
+        subprocess_mock.side_effect = [self.exec_out(trace[:1000], returncode=1), self.exec_out(trace[1000:])]
+        host_path = op.join(str(tmpdir), "trace.perfetto_trace")
+
+        perfetto_plugin.transfer_trace(trace_device, "/data/trace", host_path)
+
+        with open(host_path, "rb") as f:
+            assert f.read() == trace
+        assert subprocess_mock.call_args[0][0][-1] == "tail -c +1001 /data/trace"
+
+    @patch("AndroidRunner.Plugins.perfetto.Perfetto.subprocess.Popen")
+    def test_transfer_trace_checksum_mismatch(self, subprocess_mock, perfetto_plugin, trace_device, trace, tmpdir):
+        subprocess_mock.side_effect = lambda *args, **kwargs: self.exec_out(trace[::-1])
 
-        open_mock.assert_called_once_with(filename, "w")
-        mock_device.shell.assert_called_once_with(f"rm -f {perfetto_plugin.perfetto_trace_file_device_path}")
+        with pytest.raises(ProfilerException):
+            perfetto_plugin.transfer_trace(trace_device, "/data/trace", op.join(str(tmpdir), "trace.perfetto_trace"))
+
+        assert subprocess_mock.call_count == perfetto_plugin.TRANSFER_ATTEMPTS
+        assert all(c[0][0][-1] == "cat /data/trace" for c in subprocess_mock.call_args_list)
 
     def test_unload(self, mock_device, perfetto_plugin):
         perfetto_plugin.perfetto_config_file_device_path = "/sdcard/perfetto/trace.perfetto_trace"
@@ -1004,6 +1533,141 @@ class TestPerfettoPlugin(object):
 
         mock_device.shell.assert_called_once_with(f"rm -Rf {perfetto_plugin.perfetto_config_file_device_path}")
 
+    @patch("AndroidRunner.Plugins.Profiler.__init__")
+    @patch("AndroidRunner.util.load_json")
+    def test_init_queries(self, load_json_mock, super_mock):
+        super_mock.return_value = None
+        load_json_mock.return_value = {}
+        test_paths = paths.paths_dict()
+        config = {"config_file": "perfetto_config.pbtx", "queries": {"slices": "SELECT * FROM slice"},
+                  "trace_processor_path": "tools/trace_processor", "trace_processor_sessions": 2}
+
+        perfetto_plugin = Perfetto(config, test_paths)
+
+        assert perfetto_plugin.queries == {"slices": "SELECT * FROM slice"}
+        assert perfetto_plugin.trace_processor_path == op.join(test_paths["CONFIG_DIR"], "tools/trace_processor")
+        assert perfetto_plugin.trace_processor_sessions == 2
+        del config["trace_processor_sessions"]
+        assert Perfetto(config, test_paths).trace_processor_sessions == Perfetto.DEFAULT_TRACE_PROCESSOR_SESSIONS
+        for queries in [["SELECT 1"], {"../slices": "SELECT 1"}, {"slices": 1}]:
+            with pytest.raises(util.ConfigError):
+                Perfetto(dict(config, queries=queries), test_paths)
+
+    @pytest.fixture()
+    def subject_dir(self, tmpdir):
+        subject_dir = tmpdir.mkdir("data").mkdir("device").mkdir("subject").mkdir("perfetto")
+        for run in ["run_1", "run_2"]:
+            subject_dir.join(f"{run}.perfetto_trace").write(run)
+        return str(subject_dir)
+
+    def test_aggregate_subject_queries(self, perfetto_plugin, subject_dir, trace_processor):
+        perfetto_plugin.queries = {"first": "SELECT 1", "second": "SELECT 2"}
+        perfetto_plugin.trace_processor_path = trace_processor
+        perfetto_plugin.trace_processor_sessions = 2
+        perfetto_plugin.set_output(subject_dir)
+
+        perfetto_plugin.aggregate_subject()
+
+        run = pd.read_csv(op.join(subject_dir, "first", "run_1.csv"))
+        assert list(run.columns) == ["sql", "number", "missing", "ratio"]
+        subject = pd.read_csv(op.join(subject_dir, "Aggregated_second.csv"))
+        assert subject["run"].tolist() == ["run_1", "run_1", "run_2", "run_2"]
+        assert subject["sql"].tolist() == ["SELECT 2", "second"] * 2
+        row = Aggregation.read_aggregated(subject_dir)
+        assert float(row["first_number"]) == 1.0
+        assert float(row["second_ratio"]) == 0.875
+        for run in ["run_1", "run_2"]:
+            with open(op.join(subject_dir, f"{run}.perfetto_trace.loads")) as f:
+                assert len(f.readlines()) == 1
+
+    def test_aggregate_subject_cached(self, perfetto_plugin, subject_dir, trace_processor):
+        perfetto_plugin.queries = {"first": "SELECT 1"}
+        perfetto_plugin.trace_processor_path = trace_processor
+        perfetto_plugin.set_output(subject_dir)
+        perfetto_plugin.aggregate_subject()
+
+        perfetto_plugin.queries = {"first": "SELECT 1", "second": "SELECT 2"}
+        perfetto_plugin.aggregate_subject()
+        perfetto_plugin.aggregate_subject()
+
+        # Once for the first query and once for the new second query
+        with open(op.join(subject_dir, "run_1.perfetto_trace.loads")) as f:
+            assert len(f.readlines()) == 2
+        assert op.isfile(op.join(subject_dir, "second", "run_2.csv"))
+
+    def test_aggregate_subject_no_queries(self, perfetto_plugin, subject_dir):
+        perfetto_plugin.set_output(subject_dir)
+
+        perfetto_plugin.aggregate_subject()
+
+        assert not op.exists(op.join(subject_dir, "Aggregated.csv"))
+
+    def test_aggregate_end_queries(self, perfetto_plugin, subject_dir, trace_processor, tmpdir):
+        perfetto_plugin.queries = {"first": "SELECT 1"}
+        perfetto_plugin.trace_processor_path = trace_processor
+        perfetto_plugin.set_output(subject_dir)
+        perfetto_plugin.aggregate_subject()
+        output_file = op.join(str(tmpdir), "Aggregated_Results_Perfetto.csv")
+
+        perfetto_plugin.aggregate_end(op.join(str(tmpdir), "data"), output_file)
+
+        result = pd.read_csv(output_file)
+        assert result["device"].tolist() == ["device"]
+        assert result["subject"].tolist() == ["subject"]
+        assert result["first_number"].tolist() == [1.0]
+
+class TestPerfettoTrace(object):
+    @pytest.fixture()
+    def trace_path(self, tmpdir):
+        trace = tmpdir.join('trace.perfetto_trace')
+        trace.write('')
+        return str(trace)
+
+    def loads(self, trace_path):
+        with open(trace_path + '.loads') as f:
+            return len(f.readlines())
+
+    def test_open_reuses_trace_processor(self, trace_path, trace_processor):
+        with PerfettoTrace(trace_path, trace_processor) as trace:
+            first = trace.query('SELECT 1')
+            second = trace.query('SELECT 2')
+
+        assert self.loads(trace_path) == 1
+        assert trace.session is None
+        assert list(first.columns) == ['sql', 'number', 'missing', 'ratio']
+        assert first['sql'].tolist() == ['SELECT 1', 'second']
+        assert first['number'].tolist() == [-5, 7]
+        assert first['missing'].isnull().all()
+        assert first['ratio'].tolist() == [1.5, 0.25]
+        assert second['sql'][0] == 'SELECT 2'
+
+    def test_query_many(self, trace_path, trace_processor):
+        trace = PerfettoTrace(trace_path, trace_processor)
+
+        results = trace.query_many(['SELECT a', 'CLOSE b', 'SELECT c'])
+
+        assert [result['sql'][0] for result in results] == ['SELECT a', 'CLOSE b', 'SELECT c']
+        assert self.loads(trace_path) == 1
+        assert trace.session is None
+
+    def test_query_error(self, trace_path, trace_processor):
+        with PerfettoTrace(trace_path, trace_processor) as trace:
+            with pytest.raises(PerfettoTraceException) as except_result:
+                trace.query('FAIL')
+            assert trace.query('SELECT 1')['number'][0] == -5
+
+        assert 'no such table' in str(except_result.value)
+
+    def test_open_trace_processor_exits(self, trace_path, tmpdir):
+        script = tmpdir.join('trace_processor')
+        script.write('#!/bin/sh\necho "cannot read trace" >&2\nexit 1\n')
+        script.chmod(0o755)
+
+        with pytest.raises(PerfettoTraceException) as except_result:
+            PerfettoTrace(trace_path, str(script)).open()
+
+        assert 'cannot read trace' in str(except_result.value)
+
 class TestTrepnPlugin(object):
 
     @pytest.fixture()
@@ -1020,9 +1684,9 @@ class TestTrepnPlugin(object):
     def trepn_plugin(self, super_mock, build_preferences_mock):
         super_mock.return_value = None
         build_preferences_mock.return_value = None
-        config_mock = Mock()
+        test_config = {'data_points': ['battery_power', 'mem_usage']}
         test_paths = paths.paths_dict()
-        return Trepn(config_mock, test_paths)
+        return Trepn(test_config, test_paths)
 
     @staticmethod
     def csv_reader_to_table(filename):
@@ -1043,6 +1707,7 @@ class TestTrepnPlugin(object):
     @patch('AndroidRunner.Plugins.Profiler.__init__')
     def test_int(self, super_mock, build_preferences_mock):
         config_mock = Mock()
+        config_mock.get.side_effect = lambda key, default=None: {'result_format': 'csv'}.get(key, default)
         test_paths = paths.paths_dict()
         trepn_plugin = Trepn(config_mock, test_paths)
 
@@ -1052,6 +1717,8 @@ class TestTrepnPlugin(object):
         assert trepn_plugin.pref_dir is None
         assert trepn_plugin.remote_pref_dir == op.join(trepn_plugin.DEVICE_PATH, 'saved_preferences/')
         build_preferences_mock.assert_called_once_with(config_mock)
+        assert trepn_plugin.result_format == 'csv'
+        assert trepn_plugin.readiness['service'].type == 'process'
 
     def test_dependencies(self, trepn_plugin):
         assert trepn_plugin.dependencies() == ['com.quicinc.trepn']
@@ -1077,26 +1744,28 @@ class TestTrepnPlugin(object):
         assert self.file_content(expected_pref_file) == self.file_content(op.join(fixture_dir, 'exp_trepn_pref.xml'))
         assert self.file_content(expected_dp_file) == self.file_content(op.join(fixture_dir, 'exp_saved_dp.xml'))
 
-    @patch('time.sleep')
-    def test_load(self, sleep_mock, trepn_plugin, mock_device, tmpdir):
+    def test_load(self, trepn_plugin, mock_device, tmpdir):
         test_pref_dir = str(tmpdir)
         trepn_plugin.pref_dir = test_pref_dir
+        trepn_plugin.readiness = {name: Mock() for name in ['launch', 'preferences', 'close', 'service']}
         mock_manager = Mock()
-        mock_manager.attach_mock(sleep_mock, 'sleep_managed')
         mock_manager.attach_mock(mock_device, 'device_managed')
+        for name, probe in trepn_plugin.readiness.items():
+            mock_manager.attach_mock(probe, name)
 
         trepn_plugin.load(mock_device)
 
         expected_calls = [call.device_managed.push(test_pref_dir, trepn_plugin.remote_pref_dir),
                           call.device_managed.launch_package('com.quicinc.trepn'),
-                          call.sleep_managed(5),
+                          call.launch.wait(mock_device, 'com.quicinc.trepn'),
                           call.device_managed.shell('am broadcast -a com.quicinc.trepn.load_preferences '
                                                     '-e com.quicinc.trepn.load_preferences_file "%s"'
                                                     % op.join(trepn_plugin.remote_pref_dir, 'trepn.pref')),
-                          call.sleep_managed(1),
+                          call.preferences.wait(mock_device, 'com.quicinc.trepn'),
                           call.device_managed.force_stop('com.quicinc.trepn'),
-                          call.sleep_managed(2),
-                          call.device_managed.shell('am startservice com.quicinc.trepn/.TrepnService')]
+                          call.close.wait(mock_device, 'com.quicinc.trepn'),
+                          call.device_managed.shell('am startservice com.quicinc.trepn/.TrepnService'),
+                          call.service.wait(mock_device, 'com.quicinc.trepn')]
         assert mock_manager.mock_calls == expected_calls
 
     def test_start_profiling(self, trepn_plugin, mock_device):
@@ -1135,10 +1804,9 @@ class TestTrepnPlugin(object):
                           call.device_managed.pull(op.join(trepn_plugin.DEVICE_PATH, '123_Trepn_2019.08.21_224812.csv')
                                                    , tmpdir_str),
                           call.wait_until_managed(os_path_mock, 5, 1, op.join(trepn_plugin.output_dir, "123_Trepn_2019.08.21_224812.csv")),
-                          call.device_managed.shell(
-                              'rm %s' % op.join(trepn_plugin.DEVICE_PATH, 'Trepn_2019.08.21_224812.db')),
-                          call.device_managed.shell(
-                              'rm %s' % op.join(trepn_plugin.DEVICE_PATH, '123_Trepn_2019.08.21_224812.csv')),
+                          call.device_managed.batch(
+                              ['rm %s' % op.join(trepn_plugin.DEVICE_PATH, 'Trepn_2019.08.21_224812.db'),
+                               'rm %s' % op.join(trepn_plugin.DEVICE_PATH, '123_Trepn_2019.08.21_224812.csv')]),
                           call.filter_managed(op.join(tmpdir_str, '123_Trepn_2019.08.21_224812.csv'))]
         assert mock_manager.mock_calls == expected_calls
 
@@ -1146,7 +1814,8 @@ class TestTrepnPlugin(object):
         path_ = "/sdcard/trepn/"
         file_ = "123_Trepn_2019.08.21_224812.csv"
 
-        mock_device.shell.side_effect = [f"Other data {file_} other data", "Not empty file contents"]
+        mock_device.batch.return_value = [CommandResult('ls', f"Other data {file_} other data", 0),
+                                          CommandResult('cat', "Not empty file contents", 0)]
         res = trepn_plugin.file_exists_and_not_empty(mock_device, path_, file_)
 
         assert res == True
@@ -1155,7 +1824,8 @@ class TestTrepnPlugin(object):
         path_ = "/sdcard/trepn/"
         file_ = "123_Trepn_2019.08.21_224812.csv"
 
-        mock_device.shell.side_effect = [f"Other data other data", "Not empty file contents"]
+        mock_device.batch.return_value = [CommandResult('ls', f"Other data other data", 0),
+                                          CommandResult('cat', "cat: No such file or directory", 1)]
         res = trepn_plugin.file_exists_and_not_empty(mock_device, path_, file_)
 
         assert res == False
@@ -1164,7 +1834,8 @@ class TestTrepnPlugin(object):
         path_ = "/sdcard/trepn/"
         file_ = "123_Trepn_2019.08.21_224812.csv"
 
-        mock_device.shell.side_effect = [f"Other {file_} data other data", ""]
+        mock_device.batch.return_value = [CommandResult('ls', f"Other {file_} data other data", 0),
+                                          CommandResult('cat', "", 0)]
         res = trepn_plugin.file_exists_and_not_empty(mock_device, path_, file_)
 
         assert res == False
@@ -1187,7 +1858,7 @@ class TestTrepnPlugin(object):
 
         trepn_plugin.filter_results(test_filename)
         read_csv_mock.assert_called_once_with(test_filename)
-        write_mock.assert_called_once_with(test_filename, filter_data_result)
+        write_mock.assert_called_once_with(test_filename, filter_data_result, 'csv')
         filter_data_mock.assert_called_once_with(['Battery Power*', 'Memory Usage'], self.csv_reader_to_table(
             op.join(fixture_dir, 'test_trepn_data_to_filter.csv')))
 
@@ -1288,8 +1959,9 @@ class TestTrepnPlugin(object):
         aggregate_mock.assert_called_once_with(test_data_dir)
         write_to_file_mock.assert_called_once_with(test_output_file, mock_rows)
 
-    def test_aggregate_trepn_subject(self, trepn_plugin, fixture_dir):
-        test_subject_log_dir = op.join(fixture_dir, 'trepn_subject_result')
+    def test_aggregate_trepn_subject(self, trepn_plugin, fixture_dir, tmpdir):
+        test_subject_log_dir = op.join(str(tmpdir), 'trepn_subject_result')
+        shutil.copytree(op.join(fixture_dir, 'trepn_subject_result'), test_subject_log_dir)
 
         test_logs_aggregated = trepn_plugin.aggregate_trepn_subject(test_subject_log_dir)
 
@@ -1,4 +1,5 @@
 import os
+import threading
 from shutil import copyfile
 
 import pytest
@@ -116,6 +117,66 @@ class TestProfilers(object):
         profiler1.collect_results.assert_called_once_with(fake_device)
         profiler2.collect_results.assert_called_once_with(fake_device)
 
+    @staticmethod
+    def meeting_profilers(method):
+        """Two profilers whose method only returns when the method of the other profiler was called too"""
+        called = [threading.Event(), threading.Event()]
+        met = []
+        profiler_list = []
+        for i in range(2):
+            profiler = Mock()
+            profiler.name = 'profiler%s' % i
+
+            def meet(*args, i=i, **kwargs):
+                called[i].set()
+                met.append(called[1 - i].wait(5))
+            getattr(profiler, method).side_effect = meet
+            profiler_list.append(profiler)
+        return profiler_list, met
+
+    def test_start_stop_profiling_concurrent(self, profilers):
+        fake_device = Mock()
+        profilers.execution = 'concurrent'
+        profilers.profilers, met = self.meeting_profilers('start_profiling')
+        profilers.start_profiling(fake_device, app='app')
+        profilers.profilers, met_stop = self.meeting_profilers('stop_profiling')
+        profilers.stop_profiling(fake_device, app='app')
+
+        assert met == [True, True]
+        assert met_stop == [True, True]
+        assert list(profilers.timestamps) == ['profiler0', 'profiler1']
+        timestamps = profilers.timestamps['profiler0']
+        assert timestamps['start_requested'] <= timestamps['started'] <= timestamps['stop_requested'] <= \
+            timestamps['stopped']
+
+    def test_stop_profiling_concurrent_error(self, profilers):
+        profiler1 = Mock()
+        profiler1.stop_profiling.side_effect = ValueError('stop failed')
+        profiler2 = Mock()
+        profilers.profilers = [profiler1, profiler2]
+        profilers.execution = 'concurrent'
+
+        with pytest.raises(ValueError):
+            profilers.stop_profiling(Mock())
+        profiler2.stop_profiling.assert_called_once()
+
+    @patch('time.strftime')
+    def test_collect_results_concurrent(self, strftime, profilers, tmpdir):
+        strftime.return_value = 'time'
+        fake_device = Mock()
+        fake_device.id = 'device_id'
+        profilers.profilers, met = self.meeting_profilers('collect_results')
+        profilers.execution = 'concurrent'
+        profilers.output_dir = str(tmpdir)
+        profilers.timestamps = {'profiler0': {'start_requested': 1.5, 'started': 2, 'stop_requested': 3,
+                                              'stopped': 4}, 'profiler1': {}}
+
+        profilers.collect_results(fake_device)
+
+        assert met == [True, True]
+        assert tmpdir.join('profiler_timestamps_device_id_time.csv').read().splitlines() == [
+            'profiler,start_requested,started,stop_requested,stopped', 'profiler0,1.5,2,3,4', 'profiler1,,,,']
+
     def test_unload(self, profilers):
         fake_device = Mock()
         profiler1 = Mock()
@@ -134,8 +195,12 @@ class TestProfilers(object):
         m.__iter__.return_value = [profiler1, profiler2]
         profilers.profilers = m
         profilers.set_output()
-        profiler1.set_output.assert_called_once_with()
-        profiler2.set_output.assert_called_once_with()
+        profiler1.set_output.assert_called_once_with(None)
+        profiler2.set_output.assert_called_once_with(None)
+
+        profilers.set_output('run/output/dir')
+        profiler1.set_output.assert_called_with('run/output/dir')
+        profiler2.set_output.assert_called_with('run/output/dir')
 
     def test_aggregate_subject(self, profilers):
         profiler1 = Mock()
@@ -154,8 +219,14 @@ class TestProfilers(object):
         m.__iter__.return_value = [profiler1, profiler2]
         profilers.profilers = m
         profilers.aggregate_end("fake/dir/path")
-        profiler1.aggregate_data_end.assert_called_once_with("fake/dir/path")
-        profiler2.aggregate_data_end.assert_called_once_with("fake/dir/path")
+        profiler1.aggregate_data_end.assert_called_once_with("fake/dir/path", processes=1)
+        profiler2.aggregate_data_end.assert_called_once_with("fake/dir/path", processes=1)
+
+    def test_aggregate_end_processes(self, profilers):
+        profiler1 = Mock()
+        profilers.profilers = [profiler1]
+        profilers.aggregate_end("fake/dir/path", processes=4)
+        profiler1.aggregate_data_end.assert_called_once_with("fake/dir/path", processes=4)
 
 
 class TestPluginHandler(object):
@@ -264,6 +335,18 @@ class TestPluginHandler(object):
         mock_profiler.set_output.assert_called_once_with(os.path.join(tmpdir, 'Android1'))
         assert os.path.isdir(os.path.join(tmpdir, 'Android1'))
 
+    def test_set_output_explicit_dir(self, android_test_plugin_handler, tmpdir):
+        paths.OUTPUT_DIR = os.path.join(str(tmpdir), 'global')
+        run_dir = os.path.join(str(tmpdir), 'run')
+        mock_profiler = Mock()
+        android_test_plugin_handler.currentProfiler = mock_profiler
+
+        android_test_plugin_handler.set_output(run_dir)
+
+        mock_profiler.set_output.assert_called_once_with(os.path.join(run_dir, 'Android1'))
+        assert os.path.isdir(os.path.join(run_dir, 'Android1'))
+        assert not os.path.exists(paths.OUTPUT_DIR)
+
     def test_list_dir_empty(self, tmpdir, android_test_plugin_handler):
         tmpdir = os.path.join(str(tmpdir), 'test')
         makedirs(tmpdir)
@@ -380,7 +463,7 @@ class TestPluginHandler(object):
         android_test_plugin_handler.currentProfiler = mock_profiler
         android_test_plugin_handler.aggregate_data_end('fake/dir/')
 
-        expected_call_order = "[call.subjects('fake/dir/data'),\n call.end('fake/dir/data', " \
+        expected_call_order = "[call.subjects('fake/dir/data', 1),\n call.end('fake/dir/data', " \
                               "'fake/dir/Aggregated_Results_Android1.csv')]"
         assert expected_call_order == str(mock_manager.mock_calls)
         mock_profiler.aggregate_end.assert_called_once_with('fake/dir/data', 'fake/dir/Aggregated_Results_Android1.csv')
@@ -445,6 +528,28 @@ class TestPluginHandler(object):
         mock_profiler.set_output.called_with(created_paths[2])
         assert mock_profiler.aggregate_subject.call_count == 3
 
+    def test_subject_dirs_sorted(self, android_test_plugin_handler, tmpdir):
+        tmpdir = str(tmpdir)
+        created_paths = self.make_paths(tmpdir, ['device2/native1/Android1', 'device1/subject2/browser1/Android1',
+                                                 'device1/native1/Android1', 'device1/native3/other'])
+
+        assert android_test_plugin_handler.subject_dirs(tmpdir) == [created_paths[2], created_paths[1],
+                                                                   created_paths[0]]
+
+    def test_aggregate_subjects_default_processes(self, fixture_dir, tmpdir):
+        tmpdir = str(tmpdir)
+        subject_dirs = self.make_paths(tmpdir, ['device1/native1/android', 'device1/native2/android'])
+        run_file = 'KYVKK16119600056_2019.03.03_153604.csv'
+        for subject_dir in subject_dirs:
+            copyfile(os.path.join(fixture_dir, 'android_subject_result', run_file), os.path.join(subject_dir, run_file))
+        plugin_handler = PluginHandler('android', {'sample_interval': 200, 'data_points': ['cpu', 'mem']})
+
+        plugin_handler.aggregate_subjects_default(tmpdir, processes=2)
+
+        for subject_dir in subject_dirs:
+            with open(os.path.join(subject_dir, 'Aggregated.csv')) as aggregated:
+                assert aggregated.readline().strip() == 'android_cpu,android_mem'
+
     def test_aggregate_subject_default_web_experiment(self, android_test_plugin_handler, tmpdir):
         tmpdir = str(tmpdir)
         paths_ends = ['device1/subject1/browser1/Android1', 'device1/subject2/browser1/Android1',
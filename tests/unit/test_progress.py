@@ -1,16 +1,29 @@
 import os
 import os.path as op
+import threading
 from shutil import copyfile
 
 import lxml.etree as et
 import pytest
-from mock import Mock, call, patch
+from mock import call, patch
 
 import paths
-from AndroidRunner.Progress import Progress
+from AndroidRunner.Progress import Progress, RunQueue
 from AndroidRunner.util import load_json
 
 
+def elements_equal(e1, e2):
+    if e1.tag != e2.tag:
+        return False
+    if (e1.text or '').strip() != (e2.text or '').strip():
+        return False
+    if e1.attrib != e2.attrib:
+        return False
+    if len(e1) != len(e2):
+        return False
+    return all(elements_equal(c1, c2) for c1, c2 in zip(e1, e2))
+
+
 class TestProgressSetup(object):
     @pytest.fixture()
     def test_config(self):
@@ -22,48 +35,69 @@ class TestProgressSetup(object):
         fixture_dir = op.join(op.dirname(op.realpath(__file__)), "fixtures")
         return op.join(fixture_dir, 'test_progress.xml')
 
-    @patch('AndroidRunner.Progress.Progress.write_progress_to_file')
-    @patch('AndroidRunner.Progress.Progress.build_progress_xml')
-    def test_progress_init(self, build_progress_mock, write_to_file_mock, tmp_path, test_config, test_progress):
-        with open(test_progress, 'r') as f:
-            expected_xml = f.read()
+    @patch('AndroidRunner.Progress.Progress.file_to_hash')
+    def test_progress_init(self, file_to_hash_mock, tmp_path, test_config, test_progress):
         paths.OUTPUT_DIR = tmp_path.as_posix()
-        build_progress_mock.return_value = et.fromstring(expected_xml)
-        mock_manager = Mock()
-        mock_manager.attach_mock(build_progress_mock, 'managed_build_progress')
-        mock_manager.attach_mock(write_to_file_mock, 'managed_write_to_file')
+        file_to_hash_mock.return_value = '8bbc52b2deb22e83ac40b01abb04c95a'
 
         progress = Progress(config_file=test_config, config=load_json(test_config))
 
-        expected_calls = [call.managed_build_progress(load_json(test_config), test_config),
-                          call.managed_write_to_file()]
-        assert mock_manager.mock_calls == expected_calls
-        expected_lxml = et.fromstring(expected_xml)
-        current_lxml = progress.progress_xml_content
-        assert self.elements_equal(current_lxml, expected_lxml)
+        file_to_hash_mock.assert_called_once_with(test_config)
+        expected_lxml = et.parse(test_progress).getroot()
+        expected_lxml.find('outputDir').text = paths.OUTPUT_DIR
+        assert elements_equal(progress.progress_xml_content, expected_lxml)
+        assert elements_equal(et.parse(op.join(paths.OUTPUT_DIR, 'progress.xml')).getroot(), expected_lxml)
 
     @patch('AndroidRunner.Progress.Progress.check_config_hash')
     def test_progress_init_resume(self, check_hash_mock, tmp_path, test_config, test_progress):
         check_hash_mock.return_value = None
         progress = Progress(config_file=test_config, progress_file=test_progress, load_progress=True)
-        with open(test_progress, 'r') as f:
-            expected_xml = f.read()
-        expected_lxml = et.fromstring(expected_xml)
-        current_lxml = progress.progress_xml_content
-        assert self.elements_equal(current_lxml, expected_lxml)
-
-    def elements_equal(self, e1, e2):
-        if e1.tag != e2.tag:
-            return False
-        if e1.text != e2.text:
-            return False
-        if e1.tail != e2.tail:
-            return False
-        if e1.attrib != e2.attrib:
-            return False
-        if len(e1) != len(e2):
-            return False
-        return all(self.elements_equal(c1, c2) for c1, c2 in zip(e1, e2))
+
+        check_hash_mock.assert_called_once_with(test_config)
+        assert elements_equal(progress.progress_xml_content, et.parse(test_progress).getroot())
+
+    @patch('AndroidRunner.Progress.Progress.check_config_hash')
+    def test_progress_init_resume_journal(self, check_hash_mock, tmp_path, test_config, test_progress):
+        progress_file = op.join(tmp_path.as_posix(), 'progress.xml')
+        copyfile(test_progress, progress_file)
+        with open(progress_file + '.journal', 'w') as journal:
+            journal.write('0\n1\n0\n')
+
+        progress = Progress(config_file=test_config, progress_file=progress_file, load_progress=True)
+
+        assert progress.runs_done == ['0', '1']
+        assert progress.journal_size == 3
+        assert progress.get_next_run() == {'runId': '2', 'device': 'nexus6p', 'path': 'https://google.com/',
+                                           'browser': 'firefox', 'runCount': 3}
+        assert not progress.subject_first('nexus6p', 'https://google.com/')
+        assert not progress.device_first('nexus6p')
+
+
+class TestRunQueue(object):
+    def test_order_and_remove(self):
+        queue = RunQueue()
+        for run_id in ['a', 'b', 'c', 'd']:
+            queue.append(run_id)
+
+        queue.remove('a')
+        queue.remove('c')
+
+        assert queue.first() == 'b'
+        assert list(queue) == ['b', 'd']
+        assert len(queue) == 2
+        assert sorted(queue.ids) == ['b', 'd']
+        assert all(queue.ids[queue.positions[run_id]] == run_id for run_id in queue)
+
+    def test_random(self):
+        queue = RunQueue()
+        for run_id in range(10):
+            queue.append(run_id)
+        queue.remove(3)
+
+        picks = set(queue.random() for _ in range(200))
+
+        assert len(picks) > 1
+        assert 3 not in picks
 
 
 class TestProgressMethods(object):
@@ -93,36 +127,63 @@ class TestProgressMethods(object):
     def config_native_dict(self):
         return {'devices': ['device1'], 'paths': ['path1'], 'type': 'native', 'repetitions': 1}
 
-    def elements_equal(self, e1, e2):
-        if e1.tag != e2.tag:
-            return False
-        if e1.text != e2.text:
-            return False
-        if e1.tail != e2.tail:
-            return False
-        if e1.attrib != e2.attrib:
-            return False
-        if len(e1) != len(e2):
-            return False
-        return all(self.elements_equal(c1, c2) for c1, c2 in zip(e1, e2))
+    @pytest.fixture()
+    def two_device_progress(self, tmp_path):
+        runs = ''.join('<run runId="{}"><device>{}</device><path>path{}</path><runCount>1</runCount></run>'
+                       .format(i, 'device%s' % (i % 2), i % 4) for i in range(10))
+        progress_file = op.join(tmp_path.as_posix(), 'progress.xml')
+        with open(progress_file, 'w') as f:
+            f.write('<experiment><configHash>hash</configHash><outputDir>dir</outputDir>'
+                    '<runsToRun>{}</runsToRun><runsDone></runsDone></experiment>'.format(runs))
+        with patch('AndroidRunner.Progress.Progress.check_config_hash'):
+            return Progress(progress_file=progress_file, load_progress=True)
 
     @patch('AndroidRunner.Progress.Progress.run_to_dict')
     def test_ordered_next(self, run_to_dict, current_progress):
-        run_to_dict.return_value = 0
         for _ in range(50):
             current_progress.get_next_run()
-        unique_values = len(set(str(run_to_dict.mock_calls).
-                                replace('[', '').replace(']', '').replace('\n', '').split(', ')))
-        assert unique_values == 1
+        assert all(c == call(current_progress.runs['0']) for c in run_to_dict.mock_calls)
 
     @patch('AndroidRunner.Progress.Progress.run_to_dict')
     def test_random_next(self, run_to_dict, current_progress):
         for _ in range(50):
             current_progress.get_random_run()
-        unique_values = len(set(str(run_to_dict.mock_calls).
-                                replace('[', '').replace(']', '').replace('\n', '').split(', ')))
+        unique_values = len(set(c[1][0]['runId'] for c in run_to_dict.mock_calls))
         assert unique_values > 1
 
+    def test_next_run_of_device(self, two_device_progress):
+        run = two_device_progress.get_next_run('device1')
+        assert run['runId'] == '1' and run['device'] == 'device1'
+
+        two_device_progress.run_finished(run['runId'])
+
+        assert two_device_progress.get_next_run('device1')['runId'] == '3'
+        assert two_device_progress.get_next_run()['runId'] == '0'
+
+    def test_random_run_of_device(self, two_device_progress):
+        runs = [two_device_progress.get_random_run('device0') for _ in range(50)]
+
+        assert all(run['device'] == 'device0' for run in runs)
+        assert len(set(run['runId'] for run in runs)) > 1
+
+    def test_concurrent_device_progress(self, two_device_progress):
+        def run_device(device):
+            while not two_device_progress.device_finished(device):
+                two_device_progress.run_finished(two_device_progress.get_next_run(device)['runId'])
+                two_device_progress.write_progress_to_file()
+
+        threads = [threading.Thread(target=run_device, args=('device%s' % i,)) for i in range(2)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        assert two_device_progress.experiment_finished_check()
+        saved = et.parse(two_device_progress.progress_xml_file).getroot()
+        assert len(saved.find('runsDone')) == 10
+        assert not op.exists(two_device_progress.progress_xml_file + '.tmp')
+        assert not op.exists(two_device_progress.get_journal_file())
+
     def test_get_progress_xml_file(self, current_progress, test_progress):
         progress_file = current_progress.get_progress_xml_file()
         assert op.isfile(progress_file)
@@ -153,6 +214,37 @@ class TestProgressMethods(object):
 
         assert expected_stripped == result_stripped
 
+    def test_write_progress_to_file_journal(self, current_progress, test_progress):
+        with open(current_progress.progress_xml_file, 'r') as f:
+            snapshot = f.read()
+
+        current_progress.run_finished('0')
+        current_progress.run_finished('1')
+        current_progress.write_progress_to_file()
+        current_progress.run_finished('2')
+        current_progress.write_progress_to_file()
+
+        with open(current_progress.progress_xml_file, 'r') as f:
+            assert f.read() == snapshot
+        with open(current_progress.get_journal_file(), 'r') as f:
+            assert f.read() == '0\n1\n2\n'
+        assert current_progress.journal_size == 3
+
+    def test_write_progress_to_file_compact(self, current_progress):
+        current_progress.COMPACT_AFTER = 2
+        current_progress.run_finished('0')
+        current_progress.write_progress_to_file()
+        assert op.isfile(current_progress.get_journal_file())
+
+        current_progress.run_finished('1')
+        current_progress.write_progress_to_file()
+
+        assert not op.isfile(current_progress.get_journal_file())
+        assert current_progress.journal_size == 0
+        saved = et.parse(current_progress.progress_xml_file).getroot()
+        assert [run.get('runId') for run in saved.find('runsDone')] == ['0', '1']
+        assert len(saved.find('runsToRun')) == 7
+
     def test_file_to_hash(self, current_progress, test_config):
         expected_hash = "8bbc52b2deb22e83ac40b01abb04c95a"
         current_hash = current_progress.file_to_hash(test_config)
@@ -176,149 +268,82 @@ class TestProgressMethods(object):
     @patch('AndroidRunner.Progress.Progress.get_run_count')
     def test_run_to_dict(self, get_run_count, current_progress):
         get_run_count.return_value = 1459
-        run_dict = current_progress.run_to_dict(et.fromstring('<run runId="0"><device>device</device><path>path</path>'
-                                                              '<browser>browser</browser><runCount>1</runCount></run>'))
+        run_dict = current_progress.run_to_dict({'runId': '0', 'device': 'device', 'path': 'path',
+                                                 'browser': 'browser', 'runCount': '1'})
         expected_dict = {'runId': '0', 'device': 'device', 'path': 'path', 'browser': 'browser', 'runCount': 1459}
         assert run_dict == expected_dict
+        get_run_count.assert_called_once_with('device', 'path', 'browser')
+
+    def test_build_runs_web(self, current_progress, config_web_dict):
+        config_web_dict['repetitions'] = 2
+        runs = current_progress.build_runs(config_web_dict)
+        assert runs == [{'runId': '0', 'device': 'device1', 'path': 'path1', 'browser': 'browser1', 'runCount': '1'},
+                        {'runId': '1', 'device': 'device1', 'path': 'path1', 'browser': 'browser1', 'runCount': '2'}]
+
+    def test_build_runs_non_web(self, current_progress, config_native_dict):
+        config_native_dict['apps'] = ['app1']
+        runs = current_progress.build_runs(config_native_dict)
+        assert runs == [{'runId': '0', 'device': 'device1', 'path': 'path1', 'runCount': '1'},
+                        {'runId': '1', 'device': 'device1', 'path': 'app1', 'runCount': '1'}]
 
-    def test_build_subject_xml_web(self, current_progress):
-        device = 'device1'
-        path = 'path1'
-        browser = 'browser1'
-        subject_xml = current_progress.build_subject_xml(device, path, browser)
-        expected_xml = '<device>device1</device><path>path1</path><browser>browser1</browser>'
-        assert subject_xml == expected_xml
-
-    def test_build_subject_xml_native(self, current_progress):
-        device = 'device1'
-        path = 'path1'
-        subject_xml = current_progress.build_subject_xml(device, path)
-        expected_xml = '<device>device1</device><path>path1</path>'
-        assert subject_xml == expected_xml
-
-    @patch('AndroidRunner.Progress.Progress.build_runs_xml')
     @patch('AndroidRunner.Progress.Progress.file_to_hash')
-    def test_build_progress_xml(self, file_to_hash_mock, build_runs_xml_mock, current_progress):
-        mock_config = Mock()
-        mock_config_file = Mock()
-        paths.OUTPUT_DIR = "test/dir"
+    def test_to_xml_native(self, file_to_hash_mock, tmp_path, config_native_dict):
+        paths.OUTPUT_DIR = tmp_path.as_posix()
         file_to_hash_mock.return_value = 'hash123'
-        build_runs_xml_mock.return_value = "runs_xml"
-        expected_xml = "<experiment><configHash>hash123</configHash><outputDir>test/dir</outputDir>" \
-                       "<runsToRun>runs_xml</runsToRun><runsDone></runsDone></experiment>"
-        expected_lxml = et.fromstring(expected_xml)
-        build_progress = current_progress.build_progress_xml(mock_config, mock_config_file)
-        assert self.elements_equal(expected_lxml, build_progress)
-        file_to_hash_mock.assert_called_once_with(mock_config_file)
-        build_runs_xml_mock.assert_called_once_with(mock_config)
-
-    @patch('AndroidRunner.Progress.Progress.build_subject_xml')
-    def test_build_runs_xml_web(self, build_subject_xml_mock, current_progress, config_web_dict):
-        build_subject_xml_mock.return_value = "<device>device1</device><path>path1</path><browser>browser1</browser>"
-        runs_xml_web = current_progress.build_runs_xml(config_web_dict)
-        expected_runs_web = '<run runId="0"><device>device1</device><path>path1</path><browser>browser1</browser>' \
-                            '<runCount>1</runCount></run>'
-        assert runs_xml_web == expected_runs_web
-
-    @patch('AndroidRunner.Progress.Progress.build_subject_xml')
-    def test_build_runs_xml_non_web(self, build_subject_xml_mock, current_progress, config_native_dict):
-        build_subject_xml_mock.return_value = "<device>device1</device><path>path1</path>"
-        runs_xml_native = current_progress.build_runs_xml(config_native_dict)
-        expected_runs_native = '<run runId="0"><device>device1</device><path>path1</path><runCount>1</runCount></run>'
-        assert runs_xml_native == expected_runs_native
+        progress = Progress(config_file='config.json', config=config_native_dict)
+        expected_xml = '<experiment><configHash>hash123</configHash><outputDir>{}</outputDir><runsToRun>' \
+                       '<run runId="0"><device>device1</device><path>path1</path><runCount>1</runCount></run>' \
+                       '</runsToRun><runsDone/></experiment>'.format(paths.OUTPUT_DIR)
+        assert et.tostring(progress.to_xml()).decode('utf-8') == expected_xml
 
     def test_get_output_dir(self, current_progress):
         assert current_progress.get_output_dir() == "test/output/dir"
 
-    def test_subject_first_web_first(self, current_progress):
-        mock_find_return_value = Mock()
-        mock_find_return_value.xpath.return_value = []
-        mock_progress_xml = Mock()
-        mock_progress_xml.find.return_value = mock_find_return_value
-        current_progress.progress_xml_content = mock_progress_xml
-        subject_first = current_progress.subject_first('fake_device', 'fake_path', 'fake_browser')
-        assert subject_first is True
-
-    def test_subject_first_native_first(self, current_progress):
-        mock_find_return_value = Mock()
-        mock_find_return_value.xpath.return_value = []
-        mock_progress_xml = Mock()
-        mock_progress_xml.find.return_value = mock_find_return_value
-        current_progress.progress_xml_content = mock_progress_xml
-        subject_first = current_progress.subject_first('fake_device', 'fake_path')
-        assert subject_first is True
-
-    def test_subject_first_web_not_first(self, current_progress):
-        mock_find_return_value = Mock()
-        mock_find_return_value.xpath.return_value = ['not_empty']
-        mock_progress_xml = Mock()
-        mock_progress_xml.find.return_value = mock_find_return_value
-        current_progress.progress_xml_content = mock_progress_xml
-        subject_first = current_progress.subject_first('fake_device', 'fake_path', 'fake_browser')
-        assert subject_first is False
-
-    def test_subject_first_native_not_first(self, current_progress):
-        mock_find_return_value = Mock()
-        mock_find_return_value.xpath.return_value = ['not_empty']
-        mock_progress_xml = Mock()
-        mock_progress_xml.find.return_value = mock_find_return_value
-        current_progress.progress_xml_content = mock_progress_xml
-        subject_first = current_progress.subject_first('fake_device', 'fake_path')
-        assert subject_first is False
-
-    def test_subject_finished_web_finished(self, current_progress):
-        mock_find_return_value = Mock()
-        mock_find_return_value.xpath.return_value = []
-        mock_progress_xml = Mock()
-        mock_progress_xml.find.return_value = mock_find_return_value
-        current_progress.progress_xml_content = mock_progress_xml
-        subject_first = current_progress.subject_finished('fake_device', 'fake_path', 'fake_browser')
-        assert subject_first is True
-
-    def test_subject_finished_native_finished(self, current_progress):
-        mock_find_return_value = Mock()
-        mock_find_return_value.xpath.return_value = []
-        mock_progress_xml = Mock()
-        mock_progress_xml.find.return_value = mock_find_return_value
-        current_progress.progress_xml_content = mock_progress_xml
-        subject_first = current_progress.subject_finished('fake_device', 'fake_path')
-        assert subject_first is True
-
-    def test_subject_finished_web_not_finished(self, current_progress):
-        mock_find_return_value = Mock()
-        mock_find_return_value.xpath.return_value = ['not_empty']
-        mock_progress_xml = Mock()
-        mock_progress_xml.find.return_value = mock_find_return_value
-        current_progress.progress_xml_content = mock_progress_xml
-        subject_first = current_progress.subject_finished('fake_device', 'fake_path', 'fake_browser')
-        assert subject_first is False
-
-    def test_subject_finished_native_not_finished(self, current_progress):
-        mock_find_return_value = Mock()
-        mock_find_return_value.xpath.return_value = ['not_empty']
-        mock_progress_xml = Mock()
-        mock_progress_xml.find.return_value = mock_find_return_value
-        current_progress.progress_xml_content = mock_progress_xml
-        subject_first = current_progress.subject_finished('fake_device', 'fake_path')
-        assert subject_first is False
+    def test_subject_first_web(self, current_progress):
+        assert current_progress.subject_first('nexus6p', 'https://google.com/', 'firefox') is True
+        current_progress.run_finished('0')
+        assert current_progress.subject_first('nexus6p', 'https://google.com/', 'firefox') is False
+        assert current_progress.subject_first('nexus6p', 'https://google.com/', 'chrome') is True
+        assert current_progress.subject_first('nexus6p', 'https://apple.com/', 'firefox') is True
+
+    def test_subject_first_native(self, current_progress):
+        assert current_progress.subject_first('nexus6p', 'https://google.com/') is True
+        current_progress.run_finished('0')
+        assert current_progress.subject_first('nexus6p', 'https://google.com/') is False
+        assert current_progress.subject_first('nexus6p', 'https://apple.com/') is True
+
+    def test_subject_finished_web(self, current_progress):
+        for run_id in ['0', '1']:
+            current_progress.run_finished(run_id)
+        assert current_progress.subject_finished('nexus6p', 'https://google.com/', 'firefox') is False
+        current_progress.run_finished('2')
+        assert current_progress.subject_finished('nexus6p', 'https://google.com/', 'firefox') is True
+        assert current_progress.subject_finished('nexus6p', 'https://apple.com/', 'firefox') is False
+        assert current_progress.subject_finished('nexus6p', 'https://google.com/', 'chrome') is True
+
+    def test_subject_finished_native(self, current_progress):
+        assert current_progress.subject_finished('fake_device', 'fake_path') is True
+        for run_id in ['0', '1']:
+            current_progress.run_finished(run_id)
+        assert current_progress.subject_finished('nexus6p', 'https://google.com/') is False
+        current_progress.run_finished('2')
+        assert current_progress.subject_finished('nexus6p', 'https://google.com/') is True
 
     def test_run_finished(self, current_progress):
-        runs_to_run_mock = Mock()
-        runs_to_run_mock.findall.return_value = ['fake_element']
-        runs_done_mock = Mock()
-        mock_progress_xml = Mock()
-        mock_progress_xml.find.side_effect = [runs_to_run_mock, runs_done_mock]
-        current_progress.progress_xml_content = mock_progress_xml
+        current_progress.run_finished(0)
+
+        assert current_progress.runs_done == ['0']
+        assert '0' not in list(current_progress.runs_to_run)
+        assert current_progress.unsaved_runs == ['0']
 
         current_progress.run_finished(0)
 
-        runs_to_run_mock.remove.assert_called_once_with('fake_element')
-        runs_done_mock.append.assert_called_once_with('fake_element')
+        assert current_progress.runs_done == ['0']
+        assert current_progress.unsaved_runs == ['0']
 
     def test_experiment_finished_check_true(self, current_progress):
-        mock_progress_xml = Mock()
-        mock_progress_xml.find.return_value = et.fromstring('<runsToRun></runsToRun>')
-        current_progress.progress_xml_content = mock_progress_xml
+        for run_id in range(9):
+            current_progress.run_finished(run_id)
         experiment_finished = current_progress.experiment_finished_check()
         assert experiment_finished is True
 
@@ -331,10 +356,8 @@ class TestProgressMethods(object):
         assert device_first is True
 
     def test_device_first_false(self, current_progress):
-        mock_progress_xml = Mock()
-        mock_progress_xml.find.return_value = et.fromstring('<runsDone><run><device>device1</device></run></runsDone>')
-        current_progress.progress_xml_content = mock_progress_xml
-        device_first = current_progress.device_first('device1')
+        current_progress.run_finished(4)
+        device_first = current_progress.device_first('nexus6p')
         assert device_first is False
 
     def test_device_finished_false(self, current_progress):
@@ -348,22 +371,19 @@ class TestProgressMethods(object):
     def test_get_run_count_web(self, current_progress):
         device = 'nexus6p'
         path = 'https://google.com/'
-        run_xml = et.fromstring('<run runId="0"><device>nexus6p</device>'
-                                '<path>https://google.com/</path>'
-                                '<browser>firefox</browser></run>')
-        assert current_progress.get_run_count(run_xml, device, path) == 1
+        assert current_progress.get_run_count(device, path, 'firefox') == 1
 
         for _ in range(2):
             run = current_progress.get_next_run()
             current_progress.run_finished(run['runId'])
 
-        assert current_progress.get_run_count(run_xml, device, path) == 3
+        assert current_progress.get_run_count(device, path, 'firefox') == 3
+        assert current_progress.get_run_count(device, path, 'chrome') == 1
 
     def test_get_run_count_native(self, current_progress):
         device = 'nexus6p'
         path = 'https://google.com/'
-        run_xml = et.fromstring('<run runId="0"><device>nexus6p</device><path>https://google.com/</path></run>')
-        assert current_progress.get_run_count(run_xml, device, path) == 1
+        assert current_progress.get_run_count(device, path) == 1
         run = current_progress.get_next_run()
         current_progress.run_finished(run['runId'])
-        assert current_progress.get_run_count(run_xml, device, path) == 2
+        assert current_progress.get_run_count(device, path) == 2
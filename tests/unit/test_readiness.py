@@ -0,0 +1,89 @@
+import pytest
+from mock import Mock, patch
+
+from AndroidRunner import Readiness
+from AndroidRunner.util import ConfigError
+
+
+class TestProbe(object):
+    @pytest.fixture()
+    def device(self):
+        device = Mock()
+        device.id = 'id'
+        return device
+
+    def test_init(self):
+        probe = Readiness.Probe({'type': 'activity', 'timeout': 2500})
+
+        assert probe.type == 'activity'
+        assert probe.timeout == 2.5
+
+    def test_init_unknown_type(self):
+        with pytest.raises(ConfigError):
+            Readiness.Probe({'type': 'sleep'})
+
+    def test_init_logcat_without_regex(self):
+        with pytest.raises(ConfigError):
+            Readiness.Probe({'type': 'logcat'})
+
+    @patch('time.sleep')
+    def test_delay(self, sleep, device):
+        assert Readiness.Probe({'type': 'delay', 'duration': 1500}).wait(device, 'com.app')
+
+        sleep.assert_called_once_with(1.5)
+        assert device.shell.call_count == 0
+
+    @patch('time.sleep')
+    def test_activity(self, sleep, device):
+        device.shell.side_effect = ['',
+                                    'mResumedActivity: ActivityRecord{1 u0 com.other/.Main t1}',
+                                    'mResumedActivity: ActivityRecord{2 u0 com.app/.MainActivity t2}']
+
+        assert Readiness.Probe({'type': 'activity'}).wait(device, 'com.app')
+
+        assert device.shell.call_count == 3
+        assert sleep.call_count == 2
+
+    def test_activity_timeout(self, device):
+        device.shell.return_value = 'topResumedActivity=ActivityRecord{1 u0 com.other/.Main t1}'
+
+        assert not Readiness.Probe({'type': 'activity', 'timeout': 0}).wait(device, 'com.app')
+
+    @patch('time.sleep')
+    def test_process_and_stopped(self, sleep, device):
+        device.shell.side_effect = ['', '1234', '1234', '']
+
+        assert Readiness.Probe({'type': 'process'}).wait(device, 'com.app')
+        assert Readiness.Probe({'type': 'stopped'}).wait(device, 'com.app')
+
+        device.shell.assert_called_with('pidof com.app')
+
+    def test_logcat(self, device):
+        subscription = Mock()
+        device.watch_logcat.side_effect = lambda regex, callback, **kwargs: callback('line') or subscription
+
+        assert Readiness.Probe({'type': 'logcat', 'regex': 'Displayed {package}/'}).wait(device, 'com.app')
+
+        device.watch_logcat.assert_called_once()
+        assert device.watch_logcat.call_args[0][0] == r'Displayed com\.app/'
+        assert device.watch_logcat.call_args[1] == {'once': True, 'include_buffer': True}
+        subscription.cancel.assert_called_once_with()
+
+    def test_logcat_timeout(self, device):
+        subscription = device.watch_logcat.return_value
+
+        assert not Readiness.Probe({'type': 'logcat', 'regex': 'Displayed', 'timeout': 10}).wait(device, 'com.app')
+        subscription.cancel.assert_called_once_with()
+
+
+class TestProbes(object):
+    def test_defaults(self):
+        probes = Readiness.probes({'close': {'type': 'delay', 'duration': 3000}},
+                                  {'launch': {'type': 'activity'}, 'close': {'type': 'stopped'}})
+
+        assert probes['launch'].type == 'activity'
+        assert probes['close'].type == 'delay'
+
+    def test_unknown_wait_point(self):
+        with pytest.raises(ConfigError):
+            Readiness.probes({'load': {'type': 'activity'}}, {'launch': {'type': 'activity'}})
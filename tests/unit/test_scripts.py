@@ -1,19 +1,37 @@
 import collections
+import multiprocessing as mp
 import os.path as op
+import threading
 
 import pytest
-from mock import Mock, call, patch
+from mock import ANY, Mock, call, patch
 import time
 import paths
 import subprocess
 from AndroidRunner.MonkeyReplay import MonkeyReplay, MonkeyReplayError
 from AndroidRunner.MonkeyRunner import MonkeyRunner, MonkeyRunnerError
+from AndroidRunner.PrematureStoppableRun import PrematureStoppableRun
 from AndroidRunner.Python3 import Python3
 from AndroidRunner.Script import Script, ScriptError
+from AndroidRunner.ScriptWorker import ScriptWorker
 from AndroidRunner.Scripts import Scripts
 from AndroidRunner.util import ConfigError, FileNotFoundError
 
 
+class FakeExperiment(object):
+    """Cannot be pickled, like the experiment passed to the interaction script"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.run = 0
+
+    def get_experiment(self):
+        return {'run': self.run}
+
+    def stop_run(self):
+        raise ConfigError('no run_stopping_condition')
+
+
 class TestScripts(object):
     @pytest.fixture()
     def paths_dict(self, tmpdir):
@@ -25,7 +43,7 @@ class TestScripts(object):
             test_path = 'test/path/to/script.py'
             test_config = collections.OrderedDict()
             test_config['testscript'] = test_path
-            return Scripts(test_config)
+            return Scripts(test_config, execution='process')
 
     @patch('AndroidRunner.Python3.Python3.__init__')
     def test_experiment_script_init(self, mock, paths_dict):
@@ -116,6 +134,76 @@ class TestScripts(object):
         scripts.run('testscript1', fake_device)
         assert mock.call_count == 0
 
+    @patch('AndroidRunner.ScriptWorker.ScriptWorker.run')
+    def test_run_worker(self, mock, scripts):
+        fake_device = Mock()
+        scripts.execution = 'worker'
+
+        scripts.run('testscript', fake_device, 'arg', key='value')
+        scripts.run('testscript', fake_device)
+
+        assert mock.call_args_list == [call('testscript', 0, 'arg', key='value'), call('testscript', 0)]
+        assert list(scripts.workers.keys()) == [fake_device]
+
+    @patch('AndroidRunner.ScriptWorker.ScriptWorker.stop')
+    def test_stop_workers(self, mock, scripts):
+        scripts.worker(Mock())
+        scripts.worker(Mock())
+
+        scripts.stop_workers()
+
+        assert mock.call_count == 2
+        assert scripts.workers == {}
+
+
+    def test_worker_kept_across_runs(self, paths_dict, tmpdir):
+        output = tmpdir.join('output')
+        for hook in ['before_run', 'after_run']:
+            tmpdir.join('%s.py' % hook).write('\n'.join(['import os',
+                                                        'def main(device, path):',
+                                                        '    open(path, "a").write("%d\\n" % os.getpid())']))
+        tmpdir.join('interaction.py').write('\n'.join(['import os',
+                                                       'def main(device, experiment, path):',
+                                                       '    run = experiment.get_experiment()["run"]',
+                                                       '    open(path, "a").write("%d %d\\n" % (os.getpid(), run))']))
+        test_config = collections.OrderedDict([('before_run', 'before_run.py'), ('interaction', 'interaction.py'),
+                                               ('after_run', 'after_run.py')])
+        scripts = Scripts(test_config)
+        experiment = FakeExperiment()
+        try:
+            for run in range(2):
+                experiment.run = run
+                scripts.run('before_run', None, str(output))
+                scripts.run('interaction', None, experiment, str(output))
+                scripts.run('after_run', None, str(output))
+            pid = scripts.worker(None).process.pid
+        finally:
+            scripts.stop_workers()
+
+        assert output.read().split('\n') == [str(pid), '%d 0' % pid, str(pid), str(pid), '%d 1' % pid, str(pid), '']
+
+    def test_interaction_in_premature_stoppable_run(self, paths_dict, tmpdir):
+        tmpdir.join('before_run.py').write('def main(device):\n    pass')
+        tmpdir.join('interaction.py').write('def main(device, path):\n    open(path, "w").write("interaction")')
+        test_config = collections.OrderedDict([('before_run', 'before_run.py'), ('interaction', 'interaction.py')])
+        scripts = Scripts(test_config)
+        output = str(tmpdir.join('output'))
+        try:
+            scripts.run('before_run', None)
+            assert scripts.worker(None).is_alive()
+            premature_stoppable_run = PrematureStoppableRun(
+                {'function': {}}, mp.Queue(), lambda device, path, run: scripts.run('interaction', device, output),
+                None, 'path', 1)
+            # The interaction is run in a forked process, which runs its scripts without the worker of the experiment
+            thread = threading.Thread(target=premature_stoppable_run.run, daemon=True)
+            thread.start()
+            thread.join(30)
+        finally:
+            scripts.stop_workers()
+
+        assert not thread.is_alive()
+        with open(output) as f:
+            assert f.read() == 'interaction'
 
 class TestPython3(object):
     @pytest.fixture()
@@ -243,19 +331,12 @@ class TestScript(object):
     def script(self, script_path):
         return Script(script_path)
 
-    def test_logcat_regex(self, script):
-        fake_device = Mock()
+    def test_logcat_regex_matched(self, script):
         test_queue = Mock()
-        manager = Mock()
-
-        manager.fake_device_mock = fake_device
-        manager.test_queu_mock = test_queue
 
-        script.mp_logcat_regex(test_queue, fake_device, 'test_regex')
+        script.logcat_regex_matched(test_queue, 'I ActivityManager: test_regex')
 
-        expected_calls = [call.fake_device_mock.logcat_regex('test_regex'), call.test_queu_mock.put('logcat')]
-
-        assert manager.mock_calls == expected_calls
+        test_queue.put.assert_called_once_with('logcat')
 
     def test_script_not_found_init(self):
         with pytest.raises(FileNotFoundError):
@@ -271,8 +352,17 @@ class TestScript(object):
 
     def test_script_run_logcat(self, script_path):
         fake_device = Mock()
+        fake_device.watch_logcat.side_effect = lambda regex, callback, **kwargs: callback('line') or Mock()
         assert Python3(script_path, logcat_regex='').run(fake_device) == 'logcat'
 
+    def test_script_run_logcat_no_match(self, script_path):
+        fake_device = Mock()
+        subscription = fake_device.watch_logcat.return_value
+
+        assert Python3(script_path, logcat_regex='Displayed').run(fake_device) == 'script'
+        fake_device.watch_logcat.assert_called_once_with('Displayed', ANY, once=True, include_buffer=True)
+        subscription.cancel.assert_called_once_with()
+
     def test_script_error(self, error_script_path):
         fake_device = Mock()
         with pytest.raises(ScriptError) as expect_ex:
@@ -296,13 +386,127 @@ class TestScript(object):
         assert 'NotImplementedError' in str(test_queue.put.call_args_list)
         assert 'script' in str(test_queue.put.call_args_list[1][0])
 
-    @patch("time.sleep")
-    def test_mp_logcat_regex_one_iteration(self, sleep, script_path):
-        fake_device = Mock()
-        fake_device.logcat_regex.side_effect = [False, True]
-        test_queue = Mock()
-        test_script = Python3(script_path)
-        test_script.mp_logcat_regex(test_queue, fake_device, "Test")
 
-        sleep.assert_called_once_with(1)
-        test_queue.put.assert_called_once_with("logcat")
+class TestScriptWorker(object):
+    @pytest.fixture()
+    def make_script(self, tmpdir):
+        def make(name, body, **kwargs):
+            temp_file = tmpdir.join('%s.py' % name)
+            temp_file.write('\n'.join(['import os', 'from time import sleep', body]))
+            return Python3(str(temp_file), **kwargs)
+        return make
+
+    @pytest.fixture()
+    def worker(self):
+        workers = []
+
+        def make(scripts, device=None):
+            workers.append(ScriptWorker(scripts, device if device is not None else Mock()))
+            return workers[-1]
+        yield make
+        for w in workers:
+            w.stop()
+
+    def test_run_reuses_process(self, make_script, worker):
+        script = make_script('pid', 'def main(device):\n    return os.getpid()')
+        script_worker = worker({'interaction': [script]})
+
+        assert script_worker.run('interaction', 0) == 'script'
+        pid = script_worker.process.pid
+        assert script_worker.run('interaction', 0) == 'script'
+
+        assert script_worker.process.pid == pid
+
+    def test_run_arguments(self, make_script, worker, tmpdir):
+        output = str(tmpdir.join('output'))
+        script = make_script('args', '\n'.join(['def main(device, experiment, path, mode="w"):',
+                                                '    with open(path, mode) as f:',
+                                                '        f.write("%s " % experiment.get_experiment()["run"])']))
+        script_worker = worker({'interaction': [script]})
+        # Cannot be pickled, the script calls the experiment in this process through a proxy
+        experiment = FakeExperiment()
+
+        script_worker.run('interaction', 0, experiment, output)
+        experiment.run = 1
+        script_worker.run('interaction', 0, experiment, output, mode='a')
+
+        with open(output) as f:
+            assert f.read() == '0 1 '
+
+    def test_run_proxy_error(self, make_script, worker):
+        script = make_script('stop', 'def main(device, experiment):\n    experiment.stop_run()')
+        script_worker = worker({'interaction': [script]})
+
+        with pytest.raises(ScriptError) as expect_ex:
+            script_worker.run('interaction', 0, FakeExperiment())
+
+        assert 'no run_stopping_condition' in str(expect_ex.value)
+        assert script_worker.is_alive()
+
+    def test_run_current_state(self, make_script, worker, tmpdir):
+        output = str(tmpdir.join('output'))
+        script = make_script('state', '\n'.join(['import paths',
+                                                  'def main(device, state, path):',
+                                                  '    with open(path, "a") as f:',
+                                                  '        f.write("%s %s\\n" % (paths.OUTPUT_DIR, state.value))']))
+        script_worker = worker({'interaction': [script]})
+        # Cannot be pickled, the script reads its current state through a proxy
+        state = Mock()
+        original_output_dir = paths.OUTPUT_DIR
+        try:
+            for value in ['first', 'second']:
+                paths.OUTPUT_DIR = 'output/%s' % value
+                state.value = value
+                script_worker.run('interaction', 0, state, output)
+        finally:
+            paths.OUTPUT_DIR = original_output_dir
+
+        with open(output) as f:
+            assert f.read() == 'output/first first\noutput/second second\n'
+
+    def test_run_error(self, make_script, worker):
+        script = make_script('error', 'def main(device):\n    raise NotImplementedError')
+        script_worker = worker({'interaction': [script]})
+
+        with pytest.raises(ScriptError) as expect_ex:
+            script_worker.run('interaction', 0)
+
+        assert 'NotImplementedError' in str(expect_ex.value)
+        assert script_worker.is_alive()
+
+    def test_run_timeout_cancels_script(self, make_script, worker):
+        script = make_script('sleep', 'def main(device):\n    sleep(10)', timeout=100)
+        script_worker = worker({'interaction': [script]})
+
+        start = time.time()
+        assert script_worker.run('interaction', 0) == 'timeout'
+        pid = script_worker.process.pid
+        assert script_worker.run('interaction', 0) == 'timeout'
+
+        assert time.time() - start < 5
+        assert script_worker.process.pid == pid
+
+    def test_run_logcat(self, make_script, worker):
+        script = make_script('sleep', 'def main(device):\n    sleep(10)', logcat_regex='Displayed')
+        fake_device = Mock()
+        subscription = Mock()
+        fake_device.watch_logcat.side_effect = lambda regex, callback, **kwargs: callback('line') or subscription
+        script_worker = worker({'interaction': [script]}, fake_device)
+
+        assert script_worker.run('interaction', 0) == 'logcat'
+        fake_device.watch_logcat.assert_called_once_with('Displayed', ANY, once=True, include_buffer=True)
+        subscription.cancel.assert_called_once_with()
+
+    def test_run_terminates_stuck_script(self, make_script, worker):
+        script = make_script('stuck', '\n'.join(['def main(device):',
+                                                 '    while True:',
+                                                 '        try:',
+                                                 '            sleep(10)',
+                                                 '        except BaseException:',
+                                                 '            pass']), timeout=100)
+        script_worker = worker({'interaction': [script]})
+        script_worker.CANCEL_GRACE = 0.5
+
+        assert script_worker.run('interaction', 0) == 'timeout'
+
+        assert script_worker.process is None